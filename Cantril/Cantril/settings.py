@@ -10,12 +10,18 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
+import sys
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
 
+# CANTRIL_ENV=production switches on the production profile (SQLite tuning, ...)
+PRODUCTION = os.environ.get('CANTRIL_ENV', 'development') == 'production'
+
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.2/howto/deployment/checklist/
 
@@ -41,11 +47,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # outermost: times everything below it, incl. session/auth queries
+    'cantrilapp.middleware.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # after auth: staff may force a profile with ?_profile=<token>
+    'cantrilapp.middleware.ProfilingMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -54,7 +64,8 @@ ROOT_URLCONF = 'Cantril.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates + render timing for Server-Timing / metrics
+        'BACKEND': 'cantrilapp.metrics.TimedDjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -67,6 +78,21 @@ TEMPLATES = [
     },
 ]
 
+# Production rendering profile: templates are parsed once per process (cached
+# loader, listed explicitly: APP_DIRS must then be off) and rendered without
+# template debug info regardless of DEBUG. Benchmark: manage.py bench_templates
+if PRODUCTION:
+    TEMPLATES[0]['APP_DIRS'] = False
+    TEMPLATES[0]['OPTIONS'].update({
+        'debug': False,
+        'loaders': [
+            ('django.template.loaders.cached.Loader', [
+                'django.template.loaders.filesystem.Loader',
+                'django.template.loaders.app_directories.Loader',
+            ]),
+        ],
+    })
+
 WSGI_APPLICATION = 'Cantril.wsgi.application'
 
 
@@ -80,6 +106,52 @@ DATABASES = {
     }
 }
 
+# SQLite concurrency mode (WAL + pragmas applied by cantrilapp.db on every new connection).
+# Enabled in production or with CANTRIL_SQLITE_TUNED=1.
+SQLITE_TUNING = {
+    'enabled': PRODUCTION or os.environ.get('CANTRIL_SQLITE_TUNED') == '1',
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout_ms': int(os.environ.get('CANTRIL_SQLITE_BUSY_TIMEOUT_MS', 5000)),
+    'mmap_size': int(os.environ.get('CANTRIL_SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+    'cache_size_kib': int(os.environ.get('CANTRIL_SQLITE_CACHE_KIB', 64 * 1024)),
+    'temp_store': 'MEMORY',
+}
+
+if SQLITE_TUNING['enabled']:
+    DATABASES['default']['OPTIONS'] = {
+        # BEGIN IMMEDIATE for every atomic block: take the write lock up front
+        'transaction_mode': 'IMMEDIATE',
+        'timeout': SQLITE_TUNING['busy_timeout_ms'] / 1000,
+    }
+
+# Read replica for panel/analytics/export views (cantrilapp.routers).
+# SQLite: CANTRIL_DB_REPLICA=1 serves those reads from a read-only snapshot refreshed by
+# `manage.py refresh_replica --loop`. PostgreSQL: define DATABASES['replica'] pointing
+# at the streaming standby instead.
+if os.environ.get('CANTRIL_DB_REPLICA') == '1':
+    DATABASES['replica'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': f"file:{BASE_DIR / 'db.replica.sqlite3'}?mode=ro",
+        'OPTIONS': {'uri': True},
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_ROUTERS = ['cantrilapp.routers.PrimaryReplicaRouter']
+# replica older than this (seconds) -> reads fall back to the primary
+DATABASE_REPLICA_MAX_LAG = int(os.environ.get('CANTRIL_DB_REPLICA_MAX_LAG', 300))
+# after a doctor saves something, their session reads from the primary for this long
+DATABASE_PIN_PRIMARY_SECONDS = 30
+
+# Short-batching writers (cantrilapp.db.BatchedWriter) for high-frequency updates
+WRITE_BATCHING = {
+    'scores': {
+        'enabled': SQLITE_TUNING['enabled'],
+        'max_batch': 200,
+        'max_delay_ms': 0,
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -122,6 +194,167 @@ STATICFILES_DIRS = [
     BASE_DIR / 'static',
 ]
 
+# collectstatic target, served by cantrilapp.staticfiles.serve (Cantril/urls.py)
+STATIC_ROOT = BASE_DIR / 'staticfiles'
+
+# Production: content-hashed names plus .gz/.br siblings written at collectstatic
+# (run it after every deploy); hashed files are cached by the tablets for a year
+STORAGES = {
+    'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+    'staticfiles': {
+        'BACKEND': (
+            'cantrilapp.staticfiles.CompressedManifestStaticFilesStorage' if PRODUCTION
+            else 'django.contrib.staticfiles.storage.StaticFilesStorage'
+        ),
+    },
+}
+
+# /metrics (Prometheus text format): with a token set, scrapers send
+# "Authorization: Bearer <token>"; without one only these addresses may scrape
+METRICS_TOKEN = os.environ.get('CANTRIL_METRICS_TOKEN', '')
+METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+# window (seconds) for the cantril_webhook_lag_seconds gauge
+METRICS_WEBHOOK_LAG_WINDOW = 900
+SERVER_TIMING_HEADER = True
+
+# Slow-request profiler (cantrilapp.profiling): samples request stacks and keeps
+# those slower than threshold_ms in BASE_DIR/profiles (see /panel/profiles/)
+PROFILING = {
+    'enabled': os.environ.get('CANTRIL_PROFILING') == '1',
+    'threshold_ms': int(os.environ.get('CANTRIL_PROFILING_THRESHOLD_MS', 500)),
+    'interval_ms': 10,
+    'max_files': 500,
+}
+
+# ASGI (uvicorn Cantril.asgi:application): serve the voice flow and the n8n
+# results webhook from async views
+ASYNC_VIEWS = os.environ.get('CANTRIL_ASYNC_VIEWS') == '1'
+
+# Live scores on panel pages (cantrilapp.events, /panel/events/scores/): SSE
+# streams need ASYNC_VIEWS; unset keys use events.DEFAULT_SCORE_EVENTS
+SCORE_EVENTS = {
+    'heartbeat': 15.0,
+    'max_age': 600.0,
+}
+
+# Recording profile of voice answers (cantrilapp.audio): defaults for the
+# keys a survey leaves unset; unset keys here use audio.DEFAULT_AUDIO_PROFILE
+AUDIO_PROFILE = {
+    'bitrate': 24000,
+    'max_seconds': 120,
+}
+
+# Offline kiosk (cantrilapp.kiosk, /kiosk/): runs recorded on tablets are
+# uploaded in batches; unset keys use kiosk.DEFAULT_KIOSK
+KIOSK = {
+    'max_runs': 20,
+    'sync_interval': 60,
+}
+
+# n8n scoring webhook client (cantrilapp.n8n); unset keys use DEFAULT_N8N
+N8N = {
+    'webhook_url': os.environ.get(
+        'CANTRIL_N8N_WEBHOOK_URL',
+        'http://localhost:5678/webhook/198c3dbf-28a7-4fbd-a770-483b2ce47bdc',
+    ),
+    'connect_timeout': 3.05,
+    'read_timeout': 10.0,
+    'pool_maxsize': 20,
+    'async_max_connections': 50,
+    'max_in_flight': 200,
+    # fail fast for reset_timeout seconds after this many consecutive failures
+    'failure_threshold': 5,
+    'reset_timeout': 30.0,
+}
+
+# Logging (cantrilapp.log): request threads only enqueue records, a listener
+# thread writes them as JSON lines to stderr. Per-logger levels via
+# CANTRIL_LOG_LEVELS="cantrilapp.webhook=DEBUG,django.db.backends=INFO".
+LOG_LEVEL = os.environ.get('CANTRIL_LOG_LEVEL', 'INFO').upper()
+LOG_LEVELS = {
+    'cantrilapp': LOG_LEVEL,
+    'cantrilapp.webhook': LOG_LEVEL,
+    'django': 'INFO',
+}
+for _part in os.environ.get('CANTRIL_LOG_LEVELS', '').split(','):
+    _name, _, _level = _part.strip().partition('=')
+    if _name and _level:
+        LOG_LEVELS[_name.strip()] = _level.strip().upper()
+# `manage.py test`: records still reach assertLogs and the queue, nothing is written to stderr
+TESTING = sys.argv[1:2] == ['test']
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'json': {'()': 'cantrilapp.log.JsonFormatter'},
+    },
+    'filters': {
+        # payloads (webhook bodies, n8n error texts): keep 1 in N, cut to max_chars
+        'payload': {
+            '()': 'cantrilapp.log.PayloadFilter',
+            'sample_rate': float(os.environ.get('CANTRIL_LOG_PAYLOAD_SAMPLE_RATE', 0.1 if PRODUCTION else 1.0)),
+            'max_chars': int(os.environ.get('CANTRIL_LOG_PAYLOAD_MAX_CHARS', 2000)),
+        },
+    },
+    'handlers': {
+        'console': {
+            'class': 'logging.NullHandler' if TESTING else 'logging.StreamHandler',
+            'formatter': 'json',
+            'filters': ['payload'],
+        },
+        'queue': {
+            '()': 'cantrilapp.log.AsyncQueueHandler',
+            'handlers': ['cfg://handlers.console'],
+            'maxsize': 10000,
+        },
+    },
+    'root': {'handlers': ['queue'], 'level': 'WARNING'},
+    'loggers': {
+        name: {'handlers': ['queue'], 'level': level, 'propagate': False}
+        for name, level in LOG_LEVELS.items()
+    },
+}
+
+# Panel fragment cache (cantrilapp.fragments): CANTRIL_FRAGMENT_CACHE=locmem|file|redis|off.
+# locmem is per process - with several workers use file (one host) or redis.
+FRAGMENT_CACHE_BACKENDS = {
+    'locmem': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'cantril-fragments',
+               'OPTIONS': {'MAX_ENTRIES': 20000}},
+    'file': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+             'LOCATION': os.environ.get('CANTRIL_FRAGMENT_CACHE_DIR', str(BASE_DIR / 'cache' / 'fragments')),
+             'OPTIONS': {'MAX_ENTRIES': 20000}},
+    # needs the redis package; any Redis-protocol server works (redis, valkey, a local stand-in)
+    'redis': {'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+              'LOCATION': os.environ.get('CANTRIL_REDIS_URL', 'redis://127.0.0.1:6379/1')},
+    'off': {'BACKEND': 'django.core.cache.backends.dummy.DummyCache'},
+}
+CACHES = {
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+    'fragments': {
+        **FRAGMENT_CACHE_BACKENDS[os.environ.get('CANTRIL_FRAGMENT_CACHE', 'file' if PRODUCTION else 'locmem')],
+        # superseded versions are never deleted, they expire
+        'TIMEOUT': int(os.environ.get('CANTRIL_FRAGMENT_CACHE_TIMEOUT', 24 * 3600)),
+        'KEY_PREFIX': 'cantril',
+    },
+}
+
+# ETag / Last-Modified on survey, panel and result pages (cantrilapp.conditional);
+# RELEASE goes into every ETag - without it the newest template mtime is used
+CONDITIONAL_GET = os.environ.get('CANTRIL_CONDITIONAL_GET', '1') == '1'
+RELEASE = os.environ.get('CANTRIL_RELEASE', '')
+
+# Columnar research snapshots written by `manage.py snapshot_responses`
+RESEARCH_SNAPSHOT_DIR = BASE_DIR / 'snapshots'
+
+# Retention (cantrilapp.archive): `manage.py archive_responses` moves runs older
+# than RETENTION['months'] to gzip NDJSON month files under ARCHIVE_DIR; unset
+# keys use archive.DEFAULT_RETENTION
+ARCHIVE_DIR = BASE_DIR / 'archive'
+RETENTION = {
+    'months': 24,
+}
+
 # Redirect for login-required views (use admin login page in this prototype)
 LOGIN_URL = '/admin/login/'
 
@@ -14,11 +14,16 @@ Including another URLconf
     1. Import the include() function: from django.urls import include, path
     2. Add a URL to urlpatterns:  path('blog/', include('blog.urls'))
 """
+from django.conf import settings
 from django.contrib import admin
-from django.urls import path, include
+from django.urls import path, include, re_path
 from django.shortcuts import redirect
 
+from cantrilapp import staticfiles
+
 urlpatterns = [
     path('admin/', admin.site.urls),
+    # hashed + precompressed static files with long cache headers (runserver keeps its own handler)
+    re_path(rf'^{settings.STATIC_URL.strip("/")}/(?P<path>.+)$', staticfiles.serve, name='static'),
     path('', include('cantrilapp.urls')),               # ← Twoje własne widoki
 ]
\ No newline at end of file
@@ -1,15 +1,65 @@
-from django.contrib import admin
-from .models import Patient, PatientResponse, Question
+from django.contrib import admin, messages
+from django.core.paginator import Paginator
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from . import fragments, patients
+from .db import estimated_row_count
+from .models import ArchivedRun, KioskRun, Patient, PatientResponse, Question
+from .reconcile import DISPATCHED_TYPES
+
+
+# =====================
+# Duże tabele
+# =====================
+class EstimatedCountPaginator(Paginator):
+    """No exact COUNT(*) per changelist page.
+
+    Unfiltered lists take the table size from ``estimated_row_count``; filtered
+    ones count at most ``max_count`` rows (the last page number is then a
+    lower bound).
+    """
+    max_count = 10_000
+
+    @cached_property
+    def count(self):
+        qs = self.object_list
+        if not qs.query.where:
+            estimate = estimated_row_count(qs.model, qs.db)
+            if estimate is not None:
+                return estimate
+        return qs[:self.max_count].count()
+
+
+class PeselPrefixSearchMixin:
+    """Digits in the search box are a PESEL prefix, searched as an index range
+    (pesel >= '8501' AND pesel < '8502') instead of a LIKE '%...%' scan."""
+    pesel_lookup = 'pesel'
+    search_help_text = 'PESEL (początek numeru)'
+
+    def get_search_results(self, request, queryset, search_term):
+        term = search_term.strip()
+        if term.isdigit() and len(term) <= 11:
+            return queryset.filter(**patients.pesel_prefix(term, self.pesel_lookup)), False
+        return super().get_search_results(request, queryset, search_term)
+
+
+class LargeTableAdmin(admin.ModelAdmin):
+    paginator = EstimatedCountPaginator
+    # otherwise the changelist runs a second COUNT(*) over the whole table
+    show_full_result_count = False
 
 
 @admin.register(Patient)
-class PatientAdmin(admin.ModelAdmin):
+class PatientAdmin(PeselPrefixSearchMixin, LargeTableAdmin):
     list_display = ('pesel', 'first_name', 'last_name', 'date_of_birth', 'created_at')
-    search_fields = ('pesel', 'first_name', 'last_name')
+    search_fields = ('=pesel', '^last_name')
+    search_help_text = 'PESEL (początek numeru) lub początek nazwiska'
+    ordering = ('pesel',)
 
 
 @admin.register(PatientResponse)
-class PatientResponseAdmin(admin.ModelAdmin):
+class PatientResponseAdmin(PeselPrefixSearchMixin, LargeTableAdmin):
     list_display = (
         'get_pesel',
         'get_survey_title',
@@ -21,7 +71,14 @@ class PatientResponseAdmin(admin.ModelAdmin):
         'created_at',
     )
     list_filter = ('response_type', 'is_processed')
-    search_fields = ('patient__pesel',)
+    list_select_related = ('patient', 'survey')
+    # resp_created_idx
+    date_hierarchy = 'created_at'
+    ordering = ('-created_at',)
+    search_fields = ('=patient__pesel',)
+    pesel_lookup = 'patient__pesel'
+    raw_id_fields = ('patient', 'survey')
+    actions = ('redispatch', 'rescore')
 
     def get_pesel(self, obj):
         return obj.patient.pesel
@@ -33,13 +90,54 @@ class PatientResponseAdmin(admin.ModelAdmin):
 
     get_survey_title.short_description = 'Survey'
 
+    def _queue(self, request, queryset, message, **fields):
+        # one UPDATE; the n8n calls are made by `manage.py reconcile_responses`
+        queryset = queryset.filter(response_type__in=DISPATCHED_TYPES)
+        fragments.invalidate_responses(queryset.values_list('patient_id', 'json_survey_id').distinct())
+        count = queryset.update(is_processed=False, dispatch_attempts=0, last_dispatch_at=None, **fields)
+        self.message_user(request, message.format(count=count), messages.SUCCESS)
+
+    @admin.action(description='Wyślij ponownie do n8n (tekst/audio)')
+    def redispatch(self, request, queryset):
+        self._queue(request, queryset, '{count} odpowiedzi w kolejce do ponownej wysyłki (reconcile_responses).')
+
+    @admin.action(description='Oceń ponownie: wyczyść wynik n8n i wyślij ponownie')
+    def rescore(self, request, queryset):
+        self._queue(request, queryset, '{count} odpowiedzi do ponownej oceny (reconcile_responses).',
+                    # scored_at marks the change for the incremental jobs (agreement, snapshots)
+                    evaluated_score=None, scored_at=timezone.now(), transcript='')
 
 
 @admin.register(Question)
-class QuestionAdmin(admin.ModelAdmin):
-    list_display = ('order', 'short')
+class QuestionAdmin(LargeTableAdmin):
+    list_display = ('order', 'short', 'survey')
+    list_select_related = ('survey',)
+    raw_id_fields = ('survey',)
     ordering = ('order',)
 
     def short(self, obj):
         return str(obj)
     short.short_description = 'Question'
+
+
+@admin.register(KioskRun)
+class KioskRunAdmin(PeselPrefixSearchMixin, LargeTableAdmin):
+    list_display = ('run_id', 'patient', 'survey', 'mode', 'answers', 'device', 'finished_at', 'received_at')
+    list_filter = ('mode',)
+    list_select_related = ('patient', 'survey')
+    ordering = ('-received_at',)
+    search_fields = ('=patient__pesel',)
+    pesel_lookup = 'patient__pesel'
+    raw_id_fields = ('patient', 'survey')
+
+
+@admin.register(ArchivedRun)
+class ArchivedRunAdmin(PeselPrefixSearchMixin, LargeTableAdmin):
+    list_display = ('run_id', 'patient', 'survey', 'responses', 'processed', 'last_response_at', 'period', 'archived_at')
+    list_filter = ('period',)
+    list_select_related = ('patient', 'survey')
+    ordering = ('-last_response_at',)
+    search_fields = ('=patient__pesel',)
+    pesel_lookup = 'patient__pesel'
+    raw_id_fields = ('patient', 'survey')
+    readonly_fields = ('period', 'offset', 'length', 'archived_at')
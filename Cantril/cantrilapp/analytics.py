@@ -0,0 +1,166 @@
+"""
+Agreement between the patient's own scale_value and the n8n evaluated_score.
+
+Metrics are computed per (survey, question_id, month) partition with NumPy
+group-by reductions (``np.bincount``) and stored in ``ScoreAgreement``.
+Only partitions touched since the previous run (new responses or new webhook
+scores) are recomputed.
+"""
+from datetime import date, datetime, time, timedelta
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import JobWatermark, PatientResponse, ScoreAgreement
+
+JOB_NAME = 'score_agreement'
+# 1.96 SD -> 95% limits of agreement (Bland–Altman)
+LOA_Z = 1.96
+# scored_at is stamped before its transaction commits (BatchedWriter batches, long
+# transactions), so the next run re-reads this much before the watermark; a
+# recomputed month is simply replaced, so the overlap costs time, not correctness
+WATERMARK_OVERLAP = timedelta(minutes=5)
+
+
+def month_start(dt):
+    """First day of the (local time) month of an aware datetime."""
+    local = timezone.localtime(dt)
+    return date(local.year, local.month, 1)
+
+
+def month_bounds(period):
+    """Aware [start, end) datetimes for a month given as its first day."""
+    tz = timezone.get_current_timezone()
+    start = timezone.make_aware(datetime.combine(period, time.min), tz)
+    if period.month == 12:
+        nxt = date(period.year + 1, 1, 1)
+    else:
+        nxt = date(period.year, period.month + 1, 1)
+    end = timezone.make_aware(datetime.combine(nxt, time.min), tz)
+    return start, end
+
+
+def scored_responses():
+    """Responses that have both a self-reported and an n8n score."""
+    return PatientResponse.objects.filter(scale_value__isnull=False, evaluated_score__isnull=False)
+
+
+def touched_periods(since):
+    """Months containing responses created or scored after ``since`` (None = all).
+
+    Rows without a score count too: a cleared score (admin "rescore") stamps
+    scored_at, and its month has to drop the old value.
+    """
+    qs = PatientResponse.objects.filter(scale_value__isnull=False)
+    if since is not None:
+        qs = qs.filter(Q(created_at__gt=since) | Q(scored_at__gt=since))
+    periods = set()
+    for created_at in qs.values_list('created_at', flat=True).iterator(chunk_size=5000):
+        periods.add(month_start(created_at))
+    return sorted(periods)
+
+
+def agreement_metrics(group, self_scores, evaluated, n_groups):
+    """Vectorized agreement metrics for rows labelled with ``group`` (0..n_groups-1).
+
+    Returns a dict of arrays (one entry per group): n, bias, mad, corr, loa_lower, loa_upper.
+    Correlation and limits are NaN when they are undefined (n < 2 or zero variance).
+    """
+    x = np.asarray(self_scores, dtype=np.float64)
+    y = np.asarray(evaluated, dtype=np.float64)
+    d = y - x
+
+    def total(weights=None):
+        return np.bincount(group, weights=weights, minlength=n_groups)
+
+    n = total()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bias = total(d) / n
+        mad = total(np.abs(d)) / n
+
+        # sample SD of the differences
+        ss_d = total(d * d) - n * bias * bias
+        sd = np.sqrt(np.clip(ss_d, 0, None) / (n - 1))
+        sd[n < 2] = np.nan
+
+        sx, sy = total(x), total(y)
+        cov = total(x * y) - sx * sy / n
+        var_x = total(x * x) - sx * sx / n
+        var_y = total(y * y) - sy * sy / n
+        corr = cov / np.sqrt(var_x * var_y)
+        corr[~np.isfinite(corr)] = np.nan
+
+    return {
+        'n': n.astype(np.int64),
+        'bias': bias,
+        'mad': mad,
+        'corr': corr,
+        'loa_lower': bias - LOA_Z * sd,
+        'loa_upper': bias + LOA_Z * sd,
+    }
+
+
+def _nan_to_none(value):
+    value = float(value)
+    return None if np.isnan(value) else value
+
+
+def compute_period(period, chunk_size=5000):
+    """Recompute and replace all ScoreAgreement rows of one month. Returns rows written."""
+    start, end = month_bounds(period)
+    rows = (
+        scored_responses()
+        .filter(created_at__gte=start, created_at__lt=end)
+        .values_list('survey_id', 'question_id', 'scale_value', 'evaluated_score')
+        .iterator(chunk_size=chunk_size)
+    )
+
+    keys = {}
+    group, self_scores, evaluated = [], [], []
+    for survey_id, question_id, scale_value, evaluated_score in rows:
+        group.append(keys.setdefault((survey_id, question_id), len(keys)))
+        self_scores.append(scale_value)
+        evaluated.append(evaluated_score)
+
+    objs = []
+    if keys:
+        m = agreement_metrics(np.asarray(group, dtype=np.int64), self_scores, evaluated, len(keys))
+        for (survey_id, question_id), i in keys.items():
+            objs.append(ScoreAgreement(
+                survey_id=survey_id,
+                question_id=question_id,
+                period=period,
+                sample_size=int(m['n'][i]),
+                bias=float(m['bias'][i]),
+                mean_abs_diff=float(m['mad'][i]),
+                correlation=_nan_to_none(m['corr'][i]),
+                loa_lower=_nan_to_none(m['loa_lower'][i]),
+                loa_upper=_nan_to_none(m['loa_upper'][i]),
+            ))
+
+    with transaction.atomic():
+        ScoreAgreement.objects.filter(period=period).delete()
+        ScoreAgreement.objects.bulk_create(objs, batch_size=500)
+    return len(objs)
+
+
+def refresh_score_agreement(full=False, chunk_size=5000):
+    """Recompute partitions touched since the last run and advance the watermark.
+
+    Returns (periods recomputed, rows written).
+    """
+    # the new watermark is taken before reading so rows written during the run are picked up next time
+    started_at = timezone.now()
+    watermark = None if full else JobWatermark.objects.filter(name=JOB_NAME).first()
+    periods = touched_periods(watermark.value - WATERMARK_OVERLAP if watermark else None)
+
+    written = 0
+    for period in periods:
+        written += compute_period(period, chunk_size=chunk_size)
+    if full:
+        ScoreAgreement.objects.exclude(period__in=periods).delete()
+
+    JobWatermark.objects.update_or_create(name=JOB_NAME, defaults={'value': started_at})
+    return periods, written
@@ -1,6 +1,17 @@
 from django.apps import AppConfig
+from django.db.backends.signals import connection_created
 
 
 class CantrilappConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'cantrilapp'
+
+    def ready(self):
+        from .db import configure_sqlite_connection
+        from .fragments import connect_signals
+        from .ladder import connect_signals as connect_ladder_signals
+        from .metrics import install_db_hook
+        connection_created.connect(configure_sqlite_connection, dispatch_uid='cantrilapp_sqlite_tuning')
+        connection_created.connect(install_db_hook, dispatch_uid='cantrilapp_db_timings')
+        connect_signals()
+        connect_ladder_signals()
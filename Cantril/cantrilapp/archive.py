@@ -0,0 +1,280 @@
+"""
+Retention of PatientResponse: cold archive of old runs (``manage.py archive_responses``).
+
+A run (patient, ``json_survey_id``) whose last answer is older than
+``RETENTION['months']`` is moved out of the hot table:
+
+* its answers go to the archive of the month of that last answer as NDJSON,
+  one line per response with every column::
+
+      <ARCHIVE_DIR>/responses-2024-03.ndjson.gz
+      <ARCHIVE_DIR>/responses-2024-03.index.json    {"<patient_id>/<run_id>": [offset, length, rows]}
+
+  Each run is its own gzip member appended to the file (concatenated members
+  are still one valid gzip stream, so ``zcat`` reads the whole month), and
+  the index gives its byte range, so reading one run back decompresses only
+  that run.
+* an ``ArchivedRun`` row keeps what the panel lists - counts, first/last
+  answer, per-question scale values and n8n scores - plus the byte range.
+* the hot rows are deleted in batches of ``delete_batch`` primary keys.
+
+Runs are handled ``batch_runs`` at a time: the members are appended and
+synced first, then the summaries are inserted and the hot rows deleted in one
+transaction, then the month index is rewritten (atomically). The database is
+the authority - a member written by a batch that rolled back is simply never
+referenced.
+
+``read_runs`` turns archived runs back into unsaved ``PatientResponse``
+objects, which the panel pages render like hot rows. When the month file is
+missing or unreadable (moved to other storage, truncated) the run is shown
+from its ``ArchivedRun`` summary: scale values and scores, no texts.
+Answers without a run id (legacy rows) are not archived. Audio files stay
+where they are in MEDIA_ROOT.
+"""
+import gzip
+import json
+import logging
+import os
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from . import fragments, surveys
+from .models import ArchivedRun, PatientResponse
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RETENTION = {
+    'months': 24,          # runs whose last answer is older than this are archived
+    'batch_runs': 500,     # runs per archive transaction
+    'delete_batch': 1000,  # primary keys per DELETE
+}
+# every PatientResponse column, in file order
+FIELDS = [f.attname for f in PatientResponse._meta.concrete_fields]
+DATETIME_FIELDS = {'created_at', 'scored_at', 'last_dispatch_at'}
+
+
+def retention_config():
+    config = dict(DEFAULT_RETENTION)
+    config.update(getattr(settings, 'RETENTION', {}))
+    return config
+
+
+def archive_dir():
+    return str(getattr(settings, 'ARCHIVE_DIR', os.path.join(settings.BASE_DIR, 'archive')))
+
+
+def data_path(directory, period):
+    return os.path.join(directory, f'responses-{period}.ndjson.gz')
+
+
+def index_path(directory, period):
+    return os.path.join(directory, f'responses-{period}.index.json')
+
+
+def cutoff(months, now=None):
+    """Retention boundary: ``months`` of 30 days before ``now``."""
+    return (now or timezone.now()) - timedelta(days=30 * months)
+
+
+# =====================
+# Archiving
+# =====================
+def candidate_runs(before):
+    """(patient_id, run id) of runs with no answer at or after ``before``, oldest first."""
+    runs = (
+        PatientResponse.objects.exclude(json_survey_id__isnull=True).exclude(json_survey_id='')
+        .values('patient_id', 'json_survey_id')
+        .annotate(last=Max('created_at'))
+        .filter(last__lt=before)
+        .order_by('last')
+    )
+    return [(r['patient_id'], r['json_survey_id']) for r in runs]
+
+
+def _encode(row):
+    data = {}
+    for name in FIELDS:
+        value = getattr(row, name)
+        if name in DATETIME_FIELDS and value is not None:
+            value = value.isoformat()
+        elif name in ('id', 'survey_id') and value is not None:
+            value = str(value)
+        elif name == 'audio_file':
+            value = value.name or None
+        data[name] = value
+    return data
+
+
+def _summary(patient_id, run_id, rows):
+    scale = [r.scale_value for r in rows if r.scale_value is not None]
+    scores = [r.evaluated_score for r in rows if r.evaluated_score is not None]
+    return ArchivedRun(
+        patient_id=patient_id,
+        survey_id=next((r.survey_id for r in rows if r.survey_id), None),
+        run_id=run_id,
+        responses=len(rows),
+        processed=sum(1 for r in rows if r.is_processed),
+        scores={r.question_id: [r.scale_value, r.evaluated_score] for r in rows},
+        mean_scale=sum(scale) / len(scale) if scale else None,
+        mean_score=sum(scores) / len(scores) if scores else None,
+        first_response_at=min(r.created_at for r in rows),
+        last_response_at=max(r.created_at for r in rows),
+    )
+
+
+def _append_members(directory, period, members):
+    """Append gzip members (one per run) to the month file; returns their (offset, length)."""
+    os.makedirs(directory, exist_ok=True)
+    ranges = []
+    with open(data_path(directory, period), 'ab') as f:
+        for blob in members:
+            ranges.append((f.tell(), len(blob)))
+            f.write(blob)
+        f.flush()
+        os.fsync(f.fileno())
+    return ranges
+
+
+def _update_index(directory, period, runs):
+    path = index_path(directory, period)
+    index = {}
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as f:
+            index = json.load(f)
+    for run in runs:
+        index[f'{run.patient_id}/{run.run_id}'] = [run.offset, run.length, run.responses]
+    surveys.write_json_atomic(path, index)
+
+
+def archive_batch(keys, directory, delete_batch):
+    """Archive one batch of (patient_id, run id); returns (runs, rows) archived."""
+    run_ids = {run_id for _, run_id in keys}
+    wanted = set(keys)
+    by_run = defaultdict(list)
+    for row in PatientResponse.objects.filter(json_survey_id__in=run_ids).order_by('created_at'):
+        if (row.patient_id, row.json_survey_id) in wanted:
+            by_run[(row.patient_id, row.json_survey_id)].append(row)
+
+    by_period = defaultdict(list)
+    for (patient_id, run_id), rows in by_run.items():
+        summary = _summary(patient_id, run_id, rows)
+        summary.period = timezone.localtime(summary.last_response_at).strftime('%Y-%m')
+        by_period[summary.period].append((summary, rows))
+
+    archived, pks = [], []
+    for period, items in sorted(by_period.items()):
+        members = [
+            gzip.compress(''.join(json.dumps(_encode(r), ensure_ascii=False) + '\n' for r in rows).encode(), mtime=0)
+            for _, rows in items
+        ]
+        for (summary, rows), (offset, length) in zip(items, _append_members(directory, period, members)):
+            summary.offset, summary.length = offset, length
+            archived.append(summary)
+            pks += [r.pk for r in rows]
+
+    pk_field = PatientResponse._meta.pk
+    table = connection.ops.quote_name(PatientResponse._meta.db_table)
+    pk_column = connection.ops.quote_name(pk_field.column)
+    pks = [pk_field.get_db_prep_value(pk, connection) for pk in pks]
+    with transaction.atomic(), connection.cursor() as cursor:
+        ArchivedRun.objects.bulk_create(archived)
+        for i in range(0, len(pks), delete_batch):
+            # plain DELETE: QuerySet.delete() has no fast path while the fragments' post_delete
+            # receiver is connected, it would reload every row and signal one by one
+            # (nothing references responses; the fragments are invalidated once, below)
+            batch = pks[i:i + delete_batch]
+            cursor.execute(f'DELETE FROM {table} WHERE {pk_column} IN ({", ".join(["%s"] * len(batch))})', batch)
+        fragments.invalidate(patients={r.patient_id for r in archived}, runs={r.run_id for r in archived})
+
+    for period in {r.period for r in archived}:
+        _update_index(directory, period, [r for r in archived if r.period == period])
+    return len(archived), len(pks)
+
+
+def archive_runs(months=None, directory=None, batch_runs=None, delete_batch=None, dry_run=False, now=None):
+    """Archive every run past retention; returns counts of runs and rows (to be) archived."""
+    config = retention_config()
+    months = config['months'] if months is None else months
+    directory = directory or archive_dir()
+    batch_runs = batch_runs or config['batch_runs']
+    delete_batch = delete_batch or config['delete_batch']
+
+    keys = candidate_runs(cutoff(months, now))
+    stats = {'runs': 0, 'rows': 0, 'batches': 0}
+    if dry_run:
+        stats['runs'] = len(keys)
+        for i in range(0, len(keys), batch_runs):
+            stats['rows'] += PatientResponse.objects.filter(
+                json_survey_id__in={run_id for _, run_id in keys[i:i + batch_runs]}).count()
+        return stats
+    for i in range(0, len(keys), batch_runs):
+        runs, rows = archive_batch(keys[i:i + batch_runs], directory, delete_batch)
+        stats['runs'] += runs
+        stats['rows'] += rows
+        stats['batches'] += 1
+    return stats
+
+
+# =====================
+# Reading back
+# =====================
+def _decode(data):
+    return PatientResponse(**{
+        f.attname: f.to_python(data.get(f.attname)) for f in PatientResponse._meta.concrete_fields
+    })
+
+
+def _summary_rows(run):
+    """Rows rebuilt from an ``ArchivedRun`` summary (its archive member cannot be read)."""
+    return [
+        PatientResponse(
+            patient_id=run.patient_id, survey_id=run.survey_id, json_survey_id=run.run_id, question_id=question_id,
+            response_type='scale' if scale is not None else 'text', scale_value=scale, evaluated_score=score,
+            is_processed=score is not None, created_at=run.last_response_at,
+        )
+        for question_id, (scale, score) in run.scores.items()
+    ]
+
+
+def _read_members(path, runs):
+    """{run_id: rows} of ``runs`` from one month file; summaries for what cannot be read."""
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        logger.warning('Archive %s unreadable, showing %d run summaries', path, len(runs), exc_info=True)
+        return {run.run_id: _summary_rows(run) for run in runs}
+    result = {}
+    with f:
+        for run in sorted(runs, key=lambda r: r.offset):
+            try:
+                f.seek(run.offset)
+                lines = gzip.decompress(f.read(run.length)).decode().splitlines()
+            except (OSError, EOFError):
+                logger.warning('Archived run %s unreadable in %s, showing its summary', run.run_id, path, exc_info=True)
+                result[run.run_id] = _summary_rows(run)
+            else:
+                result[run.run_id] = [_decode(json.loads(line)) for line in lines if line]
+    return result
+
+
+def read_runs(archived_runs, directory=None):
+    """{run_id: [unsaved PatientResponse, oldest first]} for ``ArchivedRun`` rows; one open per month file."""
+    directory = directory or archive_dir()
+    result = {}
+    by_period = defaultdict(list)
+    for run in archived_runs:
+        by_period[run.period].append(run)
+    for period, runs in by_period.items():
+        rows_by_run = _read_members(data_path(directory, period), runs)
+        for run in sorted(runs, key=lambda r: r.offset):
+            rows = rows_by_run[run.run_id]
+            if ArchivedRun.patient.is_cached(run):
+                for row in rows:
+                    row.patient = run.patient
+            result[run.run_id] = rows
+    return result
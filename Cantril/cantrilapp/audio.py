@@ -0,0 +1,175 @@
+"""
+Recording profile of voice answers and the server-side limits derived from it.
+
+Each survey carries an ``audio_profile`` (``Survey.audio_profile``, edited in
+the generator): target bitrate, maximum duration and an optional silence
+trim. The browser records with it (static/js/recorder.js): mono Opus in WebM
+or Ogg via MediaRecorder (AAC in MP4 on Safari versions that cannot record
+Opus), stopped at ``max_seconds``, paused while the input
+stays silent when ``trim_silence`` is on. Unset keys fall back to
+settings.AUDIO_PROFILE, then ``DEFAULT_AUDIO_PROFILE``.
+
+A profile bounds the size of a recording (``max_bytes``), so uploads are
+checked against it while they arrive:
+
+* ``limit_uploads`` answers 413 from Content-Length alone, before the body is
+  read, and installs ``LimitedUploadHandler``, which counts the bytes of each
+  file as they are streamed and drops a file as soon as it passes the limit
+  (the field name lands in ``request.oversized_uploads``).
+* ``check_upload`` then checks the size of what was kept and that the file
+  starts with a WebM or Ogg signature, or is an MP4 (``ftyp`` box first).
+"""
+import functools
+from inspect import iscoroutinefunction
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.uploadhandler import FileUploadHandler, SkipFile
+from django.http import HttpResponse
+from django.views.decorators.csrf import csrf_exempt, csrf_protect
+
+DEFAULT_AUDIO_PROFILE = {
+    'bitrate': 24000,       # bit/s; Opus speech is clear from 16 kbit/s on
+    'max_seconds': 120,
+    'trim_silence': False,  # pause the recorder during silence longer than SILENCE_MS
+}
+BITRATES = (16000, 24000, 32000, 48000)
+MAX_SECONDS = (10, 600)
+# recorder.js: RMS level below which the input counts as silence, and for how long
+SILENCE_THRESHOLD = 0.015
+SILENCE_MS = 800
+# in order of preference; audio/mp4 (AAC) is what older iPad Safari records, same size limits
+MIME_TYPES = ('audio/webm;codecs=opus', 'audio/ogg;codecs=opus', 'audio/mp4')
+SIGNATURES = (b'\x1a\x45\xdf\xa3', b'OggS')  # EBML (WebM), Ogg
+MP4_BOX = b'ftyp'  # an MP4 file starts with a box: 4-byte size, then its type
+# container overhead and encoder overshoot on top of bitrate * duration
+SLACK = 1.25
+OVERHEAD_BYTES = 64 * 1024
+# other form fields of a voice answer (CSRF token, type, text)
+FORM_BYTES = 64 * 1024
+
+
+class AudioRejected(Exception):
+    """The upload does not fit the survey's recording profile."""
+
+
+def clean_profile(data):
+    """Validated profile from ``data`` (a form or stored dict); ValueError on bad values."""
+    profile = dict(DEFAULT_AUDIO_PROFILE)
+    profile.update(getattr(settings, 'AUDIO_PROFILE', {}))
+    data = data or {}
+    try:
+        profile['bitrate'] = int(data.get('bitrate', profile['bitrate']))
+        profile['max_seconds'] = int(data.get('max_seconds', profile['max_seconds']))
+    except (TypeError, ValueError):
+        raise ValueError('Bitrate i maksymalny czas nagrania muszą być liczbami.')
+    if profile['bitrate'] not in BITRATES:
+        raise ValueError(f'Bitrate musi być jedną z wartości: {", ".join(str(b // 1000) for b in BITRATES)} kbit/s.')
+    if not MAX_SECONDS[0] <= profile['max_seconds'] <= MAX_SECONDS[1]:
+        raise ValueError(f'Maksymalny czas nagrania: {MAX_SECONDS[0]}-{MAX_SECONDS[1]} s.')
+    trim = data.get('trim_silence', profile['trim_silence'])
+    profile['trim_silence'] = trim in (True, 'on', '1', 'true')
+    return profile
+
+
+def profile_for(survey):
+    """Profile of ``survey`` (None: the defaults); a stored profile that no longer validates gives the defaults."""
+    try:
+        return clean_profile(survey.audio_profile if survey is not None else None)
+    except ValueError:
+        return clean_profile(None)
+
+
+def max_bytes(profile):
+    """Largest upload a recording made with ``profile`` can produce."""
+    return int(profile['bitrate'] / 8 * profile['max_seconds'] * SLACK) + OVERHEAD_BYTES
+
+
+# any survey's recording (the kiosk sync checks per run once it knows the surveys)
+MAX_UPLOAD_BYTES = max_bytes({'bitrate': max(BITRATES), 'max_seconds': MAX_SECONDS[1]})
+
+
+def client_profile(profile):
+    """What recorder.js needs (json_script / the kiosk survey definitions)."""
+    return {
+        **profile,
+        'mime_types': list(MIME_TYPES),
+        'silence_threshold': SILENCE_THRESHOLD,
+        'silence_ms': SILENCE_MS,
+        'max_bytes': max_bytes(profile),
+    }
+
+
+def check_upload(upload, profile):
+    """Raise AudioRejected unless ``upload`` is a WebM/Ogg/MP4 file within the profile's size."""
+    if upload.size > max_bytes(profile):
+        raise AudioRejected(f'Nagranie jest za duże (limit {profile["max_seconds"]} s).')
+    upload.seek(0)
+    head = upload.read(8)
+    upload.seek(0)
+    if head[:4] not in SIGNATURES and head[4:8] != MP4_BOX:
+        raise AudioRejected('Nieobsługiwany format nagrania (oczekiwano WebM, Ogg lub MP4).')
+
+
+# =====================
+# Streaming limits
+# =====================
+class LimitedUploadHandler(FileUploadHandler):
+    """First upload handler: drops any file larger than ``max_file`` while it is streamed."""
+
+    def __init__(self, request, max_file):
+        super().__init__(request)
+        self.max_file = max_file
+        self.received = 0
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.received = 0
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > self.max_file:
+            self.request.oversized_uploads.append(self.field_name)
+            raise SkipFile  # the rest of this file is read and discarded, not stored
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None  # the next handler builds the file
+
+
+def limit_uploads(limits):
+    """View decorator: stream-checked uploads; ``limits(request, *args, **kwargs)`` -> (per file, per request).
+
+    The upload handlers have to be in place before anything reads
+    ``request.POST``, so CSRF is checked here, after them, rather than by the
+    middleware.
+    """
+    def prepare(request, args, kwargs):
+        request.oversized_uploads = []
+        if request.method != 'POST':
+            return None
+        max_file, max_request = limits(request, *args, **kwargs)
+        try:
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        if length > max_request:
+            return HttpResponse(f'Request body larger than {max_request} bytes', status=413,
+                                content_type='text/plain; charset=utf-8')
+        request.upload_handlers.insert(0, LimitedUploadHandler(request, max_file))
+        return None
+
+    def decorator(view):
+        protected = csrf_protect(view)
+        if iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                rejected = await sync_to_async(prepare)(request, args, kwargs)
+                return rejected or await protected(request, *args, **kwargs)
+            return csrf_exempt(async_wrapper)
+
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            return prepare(request, args, kwargs) or protected(request, *args, **kwargs)
+        return csrf_exempt(wrapper)
+    return decorator
@@ -0,0 +1,141 @@
+"""
+Conditional GET (ETag / Last-Modified) for survey, panel and result pages.
+
+``@conditional_page(fingerprint)`` calls ``fingerprint(request, *args, **kwargs)``
+before the view. It returns ``(parts, last_modified)`` built from cheap inputs -
+survey versions, the question file's mtime, MAX(created_at) / MAX(scored_at) on
+their indexes, job watermarks and the fragment generation counters - or None
+when the page must not be validated (e.g. a GET that finishes a survey run).
+
+When the client's If-None-Match / If-Modified-Since still match, a 304 goes
+out before the view runs its queries or renders a template. Otherwise the view
+runs and a 200 gets the ETag, Last-Modified and ``Cache-Control: private,
+no-cache`` (browsers revalidate every time, shared caches never store it).
+
+Every ETag also covers the path with its query string, the release (templates
+change on deploy) and the CSRF cookie, because pages embed a token derived
+from it.
+"""
+import functools
+import hashlib
+import os
+from datetime import datetime, timezone as dt_timezone
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db.models import Count, Max, Sum
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+from . import fragments
+from .models import JobWatermark, Survey
+
+
+@functools.lru_cache(maxsize=1)
+def release():
+    """settings.RELEASE, or the newest template mtime of this app."""
+    if getattr(settings, 'RELEASE', ''):
+        return settings.RELEASE
+    templates = os.path.join(os.path.dirname(__file__), 'templates')
+    return str(max((e.stat().st_mtime_ns for e in os.scandir(templates)), default=0))
+
+
+def make_etag(request, parts):
+    raw = repr((release(), request.get_full_path(), request.COOKIES.get(settings.CSRF_COOKIE_NAME), *parts))
+    return '"%s"' % hashlib.sha1(raw.encode()).hexdigest()
+
+
+def latest(*values):
+    values = [v for v in values if v is not None]
+    return max(values) if values else None
+
+
+def _check(request, fingerprint, args, kwargs):
+    """(etag, last-modified timestamp, 304 response or None); None when not applicable."""
+    if request.method not in ('GET', 'HEAD') or not getattr(settings, 'CONDITIONAL_GET', True):
+        return None
+    result = fingerprint(request, *args, **kwargs)
+    if result is None:
+        return None
+    parts, last_modified = result
+    etag = make_etag(request, parts)
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    return etag, timestamp, get_conditional_response(request, etag=etag, last_modified=timestamp)
+
+
+def _finish(response, etag, timestamp):
+    if response.status_code in (200, 304):
+        response.headers.setdefault('ETag', etag)
+        if timestamp is not None:
+            response.headers.setdefault('Last-Modified', http_date(timestamp))
+        patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def conditional_page(fingerprint):
+    """Answer 304 from ``fingerprint`` before the view runs; works on sync and async views."""
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @functools.wraps(view)
+            async def async_wrapper(request, *args, **kwargs):
+                checked = await sync_to_async(_check)(request, fingerprint, args, kwargs)
+                if checked is None:
+                    return await view(request, *args, **kwargs)
+                etag, timestamp, not_modified = checked
+                return _finish(not_modified or await view(request, *args, **kwargs), etag, timestamp)
+            return async_wrapper
+
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            checked = _check(request, fingerprint, args, kwargs)
+            if checked is None:
+                return view(request, *args, **kwargs)
+            etag, timestamp, not_modified = checked
+            return _finish(not_modified or view(request, *args, **kwargs), etag, timestamp)
+        return wrapper
+    return decorator
+
+
+# =====================
+# Inputs
+# =====================
+def response_watermarks(queryset):
+    """(MAX(created_at), MAX(scored_at)) of a response queryset.
+
+    Two statements on purpose: SQLite serves a lone MAX() from an index, two
+    aggregates in one SELECT would scan.
+    """
+    ordered = queryset.order_by()
+    return (ordered.aggregate(m=Max('created_at'))['m'], ordered.aggregate(m=Max('scored_at'))['m'])
+
+
+def file_version(path):
+    """(mtime, size) of a file such as the question JSON, and its mtime as a datetime."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None, None
+    return (st.st_mtime_ns, st.st_size), datetime.fromtimestamp(st.st_mtime, dt_timezone.utc)
+
+
+def surveys_version():
+    """Count, summed versions and last edit of all surveys (one small aggregate)."""
+    agg = Survey.objects.aggregate(n=Count('id'), v=Sum('version'), at=Max('updated_at'))
+    return (agg['n'], agg['v']), agg['at']
+
+
+def job_watermark(name):
+    return JobWatermark.objects.filter(name=name).values_list('value', flat=True).first()
+
+
+def generations(*scopes):
+    """(counters, last bump) of fragment scopes, or None when the fragment cache is off.
+
+    Without a store the counters never move, so a page validated by them would
+    get 304 forever; callers then return None and skip validation.
+    """
+    if not fragments.keeps_counters():
+        return None
+    gens = fragments.generations(scopes)
+    return tuple(gens[s] for s in scopes), fragments.changed_at(gens)
+
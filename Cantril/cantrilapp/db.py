@@ -0,0 +1,175 @@
+"""
+SQLite production mode: connection pragmas and a short-batching writer.
+
+``configure_sqlite_connection`` is connected to ``connection_created`` (see
+``CantrilappConfig.ready``) and applies ``settings.SQLITE_TUNING``. Write
+transactions use ``BEGIN IMMEDIATE`` via the database OPTIONS
+(``transaction_mode``), so writers queue on the busy timeout instead of
+failing with "database is locked" when upgrading a read lock.
+
+``BatchedWriter`` coalesces many small, high-frequency writes (webhook scores)
+from concurrent requests into one transaction, i.e. one fsync per batch.
+
+``estimated_row_count`` gives a table size without ``COUNT(*)`` (admin paginator).
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from django.conf import settings
+from django.db import close_old_connections, connection, connections, transaction
+
+DEFAULT_SQLITE_TUNING = {
+    'enabled': False,
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout_ms': 5000,
+    'mmap_size': 256 * 1024 * 1024,
+    # page cache per connection in KiB (sent as a negative cache_size)
+    'cache_size_kib': 64 * 1024,
+    'temp_store': 'MEMORY',
+}
+
+
+def sqlite_tuning():
+    config = dict(DEFAULT_SQLITE_TUNING)
+    config.update(getattr(settings, 'SQLITE_TUNING', {}))
+    return config
+
+
+def sqlite_pragmas(config, read_only=False):
+    """PRAGMA statements for a tuning config (shared with bench_sqlite_writers)."""
+    writer_pragmas = [] if read_only else [
+        f"PRAGMA journal_mode={config['journal_mode']}",
+        f"PRAGMA synchronous={config['synchronous']}",
+    ]
+    return writer_pragmas + [
+        f"PRAGMA busy_timeout={int(config['busy_timeout_ms'])}",
+        f"PRAGMA mmap_size={int(config['mmap_size'])}",
+        f"PRAGMA cache_size=-{int(config['cache_size_kib'])}",
+        f"PRAGMA temp_store={config['temp_store']}",
+    ]
+
+
+def configure_sqlite_connection(sender, connection, **kwargs):
+    """connection_created handler: apply SQLITE_TUNING pragmas to new SQLite connections."""
+    if connection.vendor != 'sqlite':
+        return
+    config = sqlite_tuning()
+    if not config['enabled']:
+        return
+    # read-only snapshot connections (see cantrilapp.routers) only get the read pragmas
+    read_only = connection.alias != 'default'
+    with connection.cursor() as cursor:
+        for pragma in sqlite_pragmas(config, read_only=read_only):
+            cursor.execute(pragma)
+
+
+class BatchedWriter:
+    """Run submitted write callables on one thread, many per transaction.
+
+    ``submit(fn, *args)`` returns a Future resolved after the batch commits.
+    A batch takes everything queued while the previous one was committing, up
+    to ``max_batch`` items, optionally lingering ``max_delay_ms`` for more.
+    Each item runs in its own savepoint, so a failing item does not roll back
+    the others.
+    """
+
+    def __init__(self, max_batch=200, max_delay_ms=0):
+        self.max_batch = max_batch
+        self.max_delay = max_delay_ms / 1000.0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        self._ensure_thread()
+        self._queue.put((future, fn, args, kwargs))
+        return future
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='cantril-batched-writer', daemon=True)
+                self._thread.start()
+
+    def _next_batch(self):
+        # everything already queued joins the batch; max_delay_ms only adds an optional linger
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0:
+                    batch.append(self._queue.get(timeout=remaining))
+                else:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            close_old_connections()
+            results = []
+            try:
+                with transaction.atomic():
+                    for future, fn, args, kwargs in batch:
+                        try:
+                            with transaction.atomic():
+                                results.append((future, fn(*args, **kwargs), None))
+                        except Exception as exc:
+                            results.append((future, None, exc))
+            except Exception as exc:
+                # the commit itself failed: nothing from this batch was written
+                for future, *_ in batch:
+                    future.set_exception(exc)
+                connection.close()
+                continue
+            for future, result, exc in results:
+                if exc is not None:
+                    future.set_exception(exc)
+                else:
+                    future.set_result(result)
+
+
+_writers = {}
+_writers_lock = threading.Lock()
+
+
+def get_writer(name):
+    """Shared BatchedWriter configured from settings.WRITE_BATCHING[name], or None if disabled."""
+    config = getattr(settings, 'WRITE_BATCHING', {}).get(name) or {}
+    if not config.get('enabled'):
+        return None
+    with _writers_lock:
+        if name not in _writers:
+            _writers[name] = BatchedWriter(
+                max_batch=config.get('max_batch', 200),
+                max_delay_ms=config.get('max_delay_ms', 0),
+            )
+        return _writers[name]
+
+
+def estimated_row_count(model, using='default'):
+    """Approximate row count from catalog data, or None when the backend has none.
+
+    PostgreSQL: ``pg_class.reltuples`` (refreshed by ANALYZE/autovacuum).
+    SQLite: ``MAX(rowid)`` - one index seek; counts deleted rows below the max.
+    """
+    conn = connections[using]
+    table = model._meta.db_table
+    with conn.cursor() as cursor:
+        if conn.vendor == 'postgresql':
+            cursor.execute('SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass', [table])
+            row = cursor.fetchone()
+            return row[0] if row and row[0] >= 0 else None
+        if conn.vendor == 'sqlite':
+            cursor.execute(f'SELECT MAX(rowid) FROM {conn.ops.quote_name(table)}')
+            return cursor.fetchone()[0] or 0
+    return None
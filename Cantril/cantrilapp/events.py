@@ -0,0 +1,228 @@
+"""
+Live score updates for the doctor panel (Server-Sent Events).
+
+``scoring.record_scores`` publishes one event per scored answer once its
+transaction commits. Every open stream (``views.panel_score_events``) holds a
+``Subscription``: an ``asyncio.Queue`` on the stream's event loop plus a
+patient/run filter, so the webhook thread hands events over with
+``call_soon_threadsafe`` and an idle viewer costs one parked coroutine.
+
+Event ids are ``<boot>-<seq>`` and the last ``buffer_size`` events stay in a
+ring buffer: a reconnecting EventSource sends Last-Event-ID and gets what it
+missed. When the id cannot be resumed (another process or restart, dropped
+from the buffer, a viewer too slow to drain its queue) the stream sends
+``reset`` and the page reloads once.
+
+The first connect resumes from the id rendered into the page. That page may be
+a revalidated (304) copy, so an unknown id there starts the stream from now
+instead: the page's ETag covers the data it shows and the broker's boot, so a
+cached copy holds no score the missing events could have changed.
+
+The broker is per process: with several ASGI workers a stream only sees scores
+delivered to its own worker, so the panel should sit behind one worker (or
+sticky routing of the webhook) to get every update.
+"""
+import asyncio
+import itertools
+import json
+import threading
+import uuid
+from collections import deque, namedtuple
+
+from django.conf import settings
+from django.db import transaction
+
+DEFAULT_SCORE_EVENTS = {
+    'buffer_size': 1000,   # events kept for Last-Event-ID resumption
+    'queue_size': 256,     # per viewer; a stream that falls further behind is reset
+    'heartbeat': 15.0,     # seconds between keep-alive comments
+    'retry_ms': 3000,      # EventSource reconnect delay
+    'max_age': 600.0,      # streams end after this long and the browser resumes
+}
+
+Event = namedtuple('Event', 'id seq patient run data')
+
+
+def events_config():
+    config = dict(DEFAULT_SCORE_EVENTS)
+    config.update(getattr(settings, 'SCORE_EVENTS', {}))
+    return config
+
+
+class Subscription:
+    def __init__(self, broker, patients, runs, queue_size):
+        self.broker = broker
+        self.patients = set(patients)
+        self.runs = set(runs)
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.overflowed = False
+        # newest event this viewer has been given or has no use for; runs on the
+        # loop in publish order, so with an empty queue nothing before it is pending
+        self.position = None
+
+    def matches(self, event):
+        if not self.patients and not self.runs:
+            return True
+        return event.patient in self.patients or event.run in self.runs
+
+    def offer(self, event):
+        """Called from any thread; the event is queued (or skipped) on the subscriber's loop."""
+        try:
+            self.loop.call_soon_threadsafe(self._put if self.matches(event) else self.advance, event)
+        except RuntimeError:  # loop already closed: the stream is gone
+            self.close()
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+
+    def advance(self, event):
+        if self.position is None or event.seq > self.position.seq:
+            self.position = event
+
+    async def get(self, timeout):
+        """Next event, or None after ``timeout`` seconds."""
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class Broker:
+    def __init__(self, buffer_size):
+        self.boot = uuid.uuid4().hex[:12]
+        self._seq = itertools.count(1)
+        self._buffer = deque(maxlen=buffer_size)
+        self._subscribers = set()
+        self._lock = threading.Lock()
+
+    def publish(self, patient_id, run_id, data):
+        with self._lock:
+            seq = next(self._seq)
+            event = Event(f'{self.boot}-{seq}', seq, patient_id, run_id, data)
+            self._buffer.append(event)
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            sub.offer(event)
+        return event
+
+    def subscribe(self, patients=(), runs=(), last_event_id=None, queue_size=256):
+        """(subscription, missed events); missed is None when ``last_event_id`` cannot be resumed."""
+        sub = Subscription(self, patients, runs, queue_size)
+        with self._lock:
+            # registered under the lock: nothing published after the replay is missed
+            self._subscribers.add(sub)
+            missed = self._since(last_event_id)
+        if missed is not None:
+            missed = [e for e in missed if sub.matches(e)]
+        return sub, missed
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def subscriber_count(self):
+        return len(self._subscribers)
+
+    def last_id(self):
+        """Id a freshly rendered page resumes from (no event is missed between render and connect)."""
+        with self._lock:
+            return self._buffer[-1].id if self._buffer else f'{self.boot}-0'
+
+    def _since(self, last_event_id):
+        if not last_event_id:
+            return []
+        boot, _, seq = last_event_id.partition('-')
+        if boot != self.boot or not seq.isdigit():
+            return None
+        seq = int(seq)
+        if self._buffer and seq < self._buffer[0].seq - 1:
+            return None  # some events after seq were already dropped
+        return [e for e in self._buffer if e.seq > seq]
+
+
+_broker = None
+_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _lock:
+            if _broker is None:
+                _broker = Broker(events_config()['buffer_size'])
+    return _broker
+
+
+def publish_scores(rows):
+    """Publish (patient_id, run_id, question_id, score) rows after the current transaction commits."""
+    rows = list(rows)
+    if not rows:
+        return
+
+    def send():
+        broker = get_broker()
+        for patient_id, run_id, question_id, score in rows:
+            broker.publish(patient_id, run_id, {
+                'patient': patient_id, 'run': run_id, 'question': question_id, 'score': score,
+            })
+    transaction.on_commit(send)
+
+
+# =====================
+# SSE framing
+# =====================
+def format_event(event):
+    return f'id: {event.id}\nevent: score\ndata: {json.dumps(event.data)}\n\n'
+
+
+async def stream(patients, runs, last_event_id, config, rendered=False):
+    """SSE body: missed events first, then live ones with heartbeats.
+
+    ``rendered``: ``last_event_id`` comes from the page (first connect), not
+    from a reconnect; if it cannot be resumed the stream starts from now
+    instead of sending ``reset``.
+
+    Subscribes on first iteration, on the loop that serves the response (a view
+    adapted by sync middleware may run on another one), and unsubscribes when the
+    client goes away.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + config['max_age']
+    sub, missed = get_broker().subscribe(patients, runs, last_event_id, config['queue_size'])
+    if missed is None and rendered:
+        missed = []
+    try:
+        yield f'retry: {config["retry_ms"]}\n\n'
+        if missed is None:
+            yield 'event: reset\ndata: {}\n\n'
+            return
+        for event in missed:
+            sub.advance(event)
+            yield format_event(event)
+        sent = sub.position
+        while loop.time() < deadline:
+            event = await sub.get(min(config['heartbeat'], max(deadline - loop.time(), 0)))
+            if sub.overflowed:
+                yield 'event: reset\ndata: {}\n\n'
+                return
+            if event is not None:
+                sub.advance(event)
+                sent = event
+                yield format_event(event)
+            elif sub.position is not sent:
+                # id-only message: moves the browser's Last-Event-ID past events
+                # this viewer filtered out, so a reconnect does not replay from far back
+                sent = sub.position
+                yield f'id: {sent.id}\n\n'
+            else:
+                # a comment keeps proxies from closing an idle connection
+                yield ': ping\n\n'
+    finally:
+        sub.close()
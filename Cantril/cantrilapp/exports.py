@@ -0,0 +1,130 @@
+"""
+Streaming CSV export of PatientResponse joined with patient and survey.
+
+Rows are read with ``.iterator(chunk_size=...)`` and encoded by a generator,
+so memory use does not depend on the size of the export. Optional gzip is
+applied on the fly with zlib (gzip container), chunk by chunk.
+"""
+import csv
+import uuid
+import zlib
+from datetime import datetime, time
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from .models import PatientResponse
+
+# (nagłówek CSV, pole w values_list)
+EXPORT_COLUMNS = [
+    ('response_id', 'id'),
+    ('created_at', 'created_at'),
+    ('patient_id', 'patient_id'),
+    ('pesel', 'patient__pesel'),
+    ('first_name', 'patient__first_name'),
+    ('last_name', 'patient__last_name'),
+    ('survey_uuid', 'survey_id'),
+    ('survey_title', 'survey__title'),
+    ('survey_run_id', 'json_survey_id'),
+    ('question_id', 'question_id'),
+    ('question_text', 'question_text'),
+    ('response_type', 'response_type'),
+    ('scale_value', 'scale_value'),
+    ('text_answer', 'text_answer'),
+    ('audio_file', 'audio_file'),
+    ('transcript', 'transcript'),
+    ('evaluated_score', 'evaluated_score'),
+    ('is_processed', 'is_processed'),
+]
+
+DEFAULT_CHUNK_SIZE = 2000
+# rows encoded per yielded chunk (the header is always yielded on its own, immediately)
+ROWS_PER_WRITE = 500
+
+
+class _Echo:
+    """File-like object whose write() just returns the value (for csv.writer)."""
+
+    def write(self, value):
+        return value
+
+
+def _aware_day(value, name, end=False):
+    try:
+        day = parse_date(value) if isinstance(value, str) else value
+    except ValueError:  # well-formed but not a real day, e.g. 2025-02-30
+        day = None
+    if day is None:
+        raise ValueError(f'{name}: expected a YYYY-MM-DD date, got {value!r}')
+    return timezone.make_aware(datetime.combine(day, time.max if end else time.min))
+
+
+def export_queryset(pesel='', survey_id='', survey_uuid='', date_from='', date_to=''):
+    """Responses filtered like the panel (pesel, survey run id) plus survey and date range.
+
+    ``date_from``/``date_to`` are inclusive YYYY-MM-DD days in the local time zone.
+    Raises ValueError for a malformed date or survey UUID.
+    """
+    qs = PatientResponse.objects.all()
+    if pesel:
+        qs = qs.filter(patient__pesel=pesel)
+    if survey_id and survey_id != 'None':
+        qs = qs.filter(json_survey_id=survey_id)
+    if survey_uuid and survey_uuid != 'None':
+        try:
+            qs = qs.filter(survey_id=uuid.UUID(survey_uuid))
+        except ValueError:
+            raise ValueError(f'survey: not a UUID: {survey_uuid!r}') from None
+    start = _aware_day(date_from, 'date_from') if date_from else None
+    end = _aware_day(date_to, 'date_to', end=True) if date_to else None
+    if start:
+        qs = qs.filter(created_at__gte=start)
+    if end:
+        qs = qs.filter(created_at__lte=end)
+    return qs.order_by('created_at')
+
+
+def _format(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return timezone.localtime(value).isoformat(timespec='seconds')
+    return value
+
+
+def iter_csv(qs, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield the CSV as text chunks: the header first, then batches of rows."""
+    writer = csv.writer(_Echo())
+    yield writer.writerow([name for name, _ in EXPORT_COLUMNS])
+
+    fields = [field for _, field in EXPORT_COLUMNS]
+    batch = []
+    for row in qs.values_list(*fields).iterator(chunk_size=chunk_size):
+        batch.append(writer.writerow([_format(v) for v in row]))
+        if len(batch) >= ROWS_PER_WRITE:
+            yield ''.join(batch)
+            batch = []
+    if batch:
+        yield ''.join(batch)
+
+
+def iter_encoded(chunks, compress=False):
+    """Encode text chunks as UTF-8 bytes, optionally gzip-compressed on the fly."""
+    if not compress:
+        for chunk in chunks:
+            yield chunk.encode('utf-8')
+        return
+
+    # wbits=31 -> gzip header/trailer
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        # sync flush so every chunk (the header in particular) reaches the client right away
+        data = compressor.compress(chunk.encode('utf-8')) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_filename(compress=False):
+    stamp = timezone.localtime().strftime('%Y%m%dT%H%M%S')
+    return f"odpowiedzi_{stamp}.csv" + ('.gz' if compress else '')
@@ -0,0 +1,179 @@
+"""
+Versioned cache for rendered doctor-panel fragments.
+
+A fragment is stored under a key that includes the generation counters of the
+data it was built from:
+
+* ``history``               - any response, patient or survey change (panel_history)
+* ``surveys``               - survey titles (patient run lists)
+* ``patient:<id>``          - responses of one patient (run lists, completion pages)
+* ``run:<json_survey_id>``  - answers of one run (completion cards)
+
+Counters are bumped by the model signals below (``connect_signals``) and
+explicitly by writes that bypass them: bulk inserts, ``scoring.record_scores``,
+the reconcile sweeper and admin bulk actions.
+
+Writers never delete fragments; after their transaction commits they bump the
+counters (``invalidate``), so the next read looks up a new key and rebuilds the
+fragment, and superseded versions expire after the cache ``TIMEOUT``. A counter
+is the time of its last bump in nanoseconds (kept strictly increasing), so an
+evicted counter never comes back to a cached version, and ``changed_at`` gives
+pages a Last-Modified without a query.
+
+Order matters for correctness: generations are read before the data, counters
+are bumped after the commit. Fragments are built with reads on the primary,
+otherwise a lagging replica could store pre-write data under a post-write
+generation.
+
+The store is ``CACHES['fragments']`` (``CANTRIL_FRAGMENT_CACHE=locmem|file|redis|off``).
+"""
+import hashlib
+import time
+from datetime import datetime, timezone as dt_timezone
+
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.db import transaction
+
+from . import metrics
+from .routers import use_primary
+
+ALIAS = 'fragments'
+HISTORY = 'history'
+SURVEYS = 'surveys'
+
+
+def patient_scope(patient_id):
+    return f'patient:{patient_id}'
+
+
+def run_scope(run_id):
+    return f'run:{run_id}'
+
+
+def get_cache():
+    return caches[ALIAS]
+
+
+def keeps_counters(cache=None):
+    """False for the ``off`` backend: it stores nothing, every counter reads back as 0."""
+    return not isinstance(cache or get_cache(), DummyCache)
+
+
+def _counter_key(scope):
+    return f'gen:{scope}'
+
+
+def _fragment_key(name, key, gens):
+    # user input (search terms) goes into keys: hash it to a safe, bounded length
+    digest = hashlib.sha1(f'{key}|{gens}'.encode()).hexdigest()
+    return f'frag:{name}:{digest}'
+
+
+# =====================
+# Generation counters
+# =====================
+def generations(scopes, cache=None):
+    """Current counter of every scope; missing counters are started."""
+    cache = cache or get_cache()
+    keys = {scope: _counter_key(scope) for scope in scopes}
+    found = cache.get_many(keys.values())
+    gens = {}
+    for scope, key in keys.items():
+        if key not in found:
+            cache.add(key, time.time_ns(), timeout=None)
+            found[key] = cache.get(key, 0)
+        gens[scope] = found[key]
+    return gens
+
+
+def bump(*scopes):
+    cache = get_cache()
+    keys = [_counter_key(scope) for scope in set(scopes)]
+    current = cache.get_many(keys)
+    # concurrent bumps may both win, but either value differs from what readers cached
+    cache.set_many({key: max(current.get(key, 0) + 1, time.time_ns()) for key in keys}, timeout=None)
+
+
+def changed_at(gens):
+    """Time of the latest bump among ``generations()`` values."""
+    return datetime.fromtimestamp(max(gens.values()) / 1e9, dt_timezone.utc) if gens else None
+
+
+def invalidate(patients=(), runs=(), history=True, surveys=False):
+    """Bump the counters for changed patients/runs once the current transaction commits."""
+    scopes = [patient_scope(p) for p in patients if p is not None]
+    scopes += [run_scope(r) for r in runs if r]
+    if history:
+        scopes.append(HISTORY)
+    if surveys:
+        scopes.append(SURVEYS)
+    if scopes:
+        transaction.on_commit(lambda: bump(*scopes))
+
+
+def invalidate_responses(rows):
+    """invalidate() for (patient_id, json_survey_id) pairs of changed responses."""
+    rows = list(rows)
+    invalidate(patients={p for p, _ in rows}, runs={r for _, r in rows})
+
+
+# =====================
+# Fragments
+# =====================
+def cached_many(name, items, build):
+    """Fragments for ``items`` ({key: scopes}); ``build(missing_keys)`` returns {key: fragment}.
+
+    One ``get_many`` for the counters and one for the fragments; only the
+    missing fragments are built (on the primary) and stored.
+    """
+    if not items:
+        return {}
+    cache = get_cache()
+    gens = generations({scope for scopes in items.values() for scope in scopes}, cache)
+    keys = {
+        key: _fragment_key(name, key, tuple(gens[s] for s in scopes))
+        for key, scopes in items.items()
+    }
+    found = cache.get_many(keys.values())
+    result = {key: found[k] for key, k in keys.items() if k in found}
+    missing = [key for key in items if key not in result]
+    metrics.FRAGMENTS_TOTAL.inc(name, 'hit', amount=len(result))
+    if missing:
+        metrics.FRAGMENTS_TOTAL.inc(name, 'miss', amount=len(missing))
+        with use_primary():
+            built = build(missing)
+        cache.set_many({keys[key]: value for key, value in built.items()})
+        result.update(built)
+    return result
+
+
+def cached(name, key, scopes, build):
+    """Single fragment: ``build()`` is called only when a counter in ``scopes`` moved."""
+    return cached_many(name, {key: scopes}, lambda missing: {key: build()})[key]
+
+
+# =====================
+# Model signals
+# =====================
+def _response_changed(sender, instance, **kwargs):
+    invalidate(patients=[instance.patient_id], runs=[instance.json_survey_id])
+
+
+def _patient_changed(sender, instance, **kwargs):
+    invalidate(patients=[instance.pk])
+
+
+def _survey_changed(sender, instance, **kwargs):
+    invalidate(surveys=True)
+
+
+def connect_signals():
+    from django.db.models.signals import post_delete, post_save
+
+    from .models import Patient, PatientResponse, Survey
+
+    for model, receiver in ((PatientResponse, _response_changed), (Patient, _patient_changed),
+                            (Survey, _survey_changed)):
+        for signal in (post_save, post_delete):
+            signal.connect(receiver, sender=model, dispatch_uid=f'cantrilapp_fragments_{model.__name__}')
@@ -0,0 +1,246 @@
+"""
+Offline kiosk mode (/kiosk/) for clinic tablets with unreliable Wi-Fi.
+
+The kiosk page runs the whole survey in the browser (static/js/kiosk.js). A
+service worker (/kiosk/sw.js) precaches the page, the static assets and the
+compiled survey definitions (/kiosk/surveys.json: questions in order with their
+pre-rendered ladders, see ``survey_definitions``), so moving between questions
+needs no request. Every answer, audio included, is written to IndexedDB as
+soon as it is given.
+
+Finished runs are uploaded in batches to /kiosk/sync/ whenever the tablet is
+online (``ingest``). Each run is stored in one transaction: a ``KioskRun`` row
+keyed by the run id generated on the device, then all its answers in one
+INSERT. A run that is already stored (a retry after a lost response) reports
+``duplicate`` and writes nothing, so the device can always resend. Runs that
+can never be stored are reported as ``rejected`` with a reason and kept on the
+device.
+
+Audio is recorded with the survey's recording profile (``audio``); the upload
+is size-checked while it streams (``audio.limit_uploads`` in the view) and
+each file again against its run's survey. Text and audio answers are not sent
+to n8n during the upload: they are left for ``reconcile_responses``, which
+works through the backlog at its own rate.
+
+Answers get ``created_at`` = the time of the upload, not of the run: the
+analytics and snapshot refreshes and the results page validators find new
+rows by ``created_at``, so a run backdated to when the tablet went offline
+would be missed by them. When the run was taken is ``KioskRun.started_at`` /
+``finished_at`` (device clock).
+"""
+import os
+import re
+import uuid
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import Prefetch
+from django.utils.dateparse import parse_datetime
+
+from . import audio, fragments, ladder, patients, surveys
+from .models import KioskRun, Patient, PatientResponse, Question, Survey
+
+DEFAULT_KIOSK = {
+    'max_runs': 20,                      # runs per /kiosk/sync/ request (the client batches to this)
+    'max_answers': 100,                  # answers per run
+    'max_text': 5000,                    # characters per text answer
+    'max_request_bytes': 64 * 1024 * 1024,  # whole /kiosk/sync/ body, checked before it is read
+    'sync_interval': 60,                 # seconds between the client's upload attempts
+}
+
+# same format as the runs started on the server (views.ankieta_select_survey)
+RUN_ID_RE = re.compile(r'[0-9a-f]{32}_\d{8}T\d{6}')
+ANSWER_TYPES = {'cantril': ('scale', 'text'), 'voice': ('text', 'audio')}
+CREATED, DUPLICATE = 'created', 'duplicate'
+
+
+class RunRejected(Exception):
+    """The run can never be stored (the device keeps it and shows the reason)."""
+
+
+def kiosk_config():
+    config = dict(DEFAULT_KIOSK)
+    config.update(getattr(settings, 'KIOSK', {}))
+    return config
+
+
+# =====================
+# Survey definitions
+# =====================
+def survey_definitions():
+    """Every survey as the kiosk needs it (two queries); ladders come from ``ladder``'s cache."""
+    questions = Prefetch('questions', queryset=Question.objects.order_by('order'))
+    result = []
+    for survey in Survey.objects.prefetch_related(questions).order_by('title'):
+        data = surveys.mirror_data(survey, survey.questions.all())
+        for q in data['questions']:
+            q['ladder'] = ladder.ladder_html(survey.ladder_design, q['scale_labels'])
+        data.update(id=str(survey.id), version=survey.version)
+        result.append(data)
+    return result
+
+
+# =====================
+# Ingestion
+# =====================
+def ingest(runs, files, device='', oversized=()):
+    """Store uploaded runs; returns {run_id: 'created' | 'duplicate' | 'rejected: <reason>'}.
+
+    ``runs`` is the decoded JSON list sent by the device, ``files`` the uploaded
+    audio (``request.FILES``), ``oversized`` the file fields dropped while
+    streaming (``request.oversized_uploads``). A malformed batch raises ValueError.
+    """
+    config = kiosk_config()
+    if not isinstance(runs, list) or not all(isinstance(r, dict) for r in runs):
+        raise ValueError('runs must be a list of objects')
+    if len(runs) > config['max_runs']:
+        raise ValueError(f'at most {config["max_runs"]} runs per request')
+
+    run_ids = [str(r.get('run_id') or '') for r in runs]
+    stored = set(KioskRun.objects.filter(run_id__in=run_ids).values_list('run_id', flat=True))
+    # a resent batch is answered from the primary key lookup alone
+    survey_ids = {_uuid(r.get('survey')) for i, r in zip(run_ids, runs) if i not in stored} - {None}
+    known_surveys = Survey.objects.in_bulk(survey_ids) if survey_ids else {}
+    texts = {
+        (survey_id, key): text
+        for survey_id, key, text in Question.objects.filter(survey__in=survey_ids).values_list('survey', 'key', 'text')
+    } if survey_ids else {}
+
+    results = {}
+    for run_id, run in zip(run_ids, runs):
+        if not RUN_ID_RE.fullmatch(run_id) or run_id in results:
+            continue  # nothing the device could match a status to
+        if run_id in stored:
+            results[run_id] = DUPLICATE
+            continue
+        try:
+            survey = known_surveys.get(_uuid(run.get('survey')))
+            results[run_id] = _store_run(run_id, run, survey, texts, files, oversized, device[:64], config)
+        except RunRejected as e:
+            results[run_id] = f'rejected: {e}'
+    return results
+
+
+def _uuid(value):
+    try:
+        return uuid.UUID(str(value))
+    except ValueError:
+        return None
+
+
+def _answers(run_id, run, survey, texts, files, oversized, config):
+    """Unsaved PatientResponse rows of a run, plus (row, upload) pairs for the audio answers."""
+    mode = run.get('mode')
+    if mode not in ANSWER_TYPES:
+        raise RunRejected(f'nieznany tryb {mode!r}')
+    answers = run.get('answers')
+    if not isinstance(answers, list) or not answers:
+        raise RunRejected('brak odpowiedzi')
+    if len(answers) > config['max_answers']:
+        raise RunRejected(f'więcej niż {config["max_answers"]} odpowiedzi')
+
+    rows, uploads, seen = [], [], set()
+    profile = audio.profile_for(survey)
+    for answer in answers:
+        if not isinstance(answer, dict):
+            raise RunRejected('nieprawidłowa odpowiedź')
+        question_id = str(answer.get('question') or '')[:100]
+        if not question_id or question_id in seen:
+            raise RunRejected(f'brak lub powtórzony identyfikator pytania {question_id!r}')
+        seen.add(question_id)
+        kind = answer.get('type')
+        if kind not in ANSWER_TYPES[mode]:
+            raise RunRejected(f'{question_id}: typ {kind!r} niedozwolony w trybie {mode}')
+
+        row = PatientResponse(
+            survey=survey,
+            json_survey_id=run_id,
+            question_id=question_id,
+            response_type=kind,
+            question_text=texts.get((survey.pk if survey else None, question_id)) or str(answer.get('text') or ''),
+            is_processed=False,
+        )
+        if kind == 'scale':
+            try:
+                value = int(answer.get('value'))
+            except (TypeError, ValueError):
+                value = None
+            if value is None or not 1 <= value <= 10:
+                raise RunRejected(f'{question_id}: wartość skali poza 1-10')
+            row.scale_value = value
+        elif kind == 'text':
+            text = str(answer.get('value') or '').strip()
+            if not text or len(text) > config['max_text']:
+                raise RunRejected(f'{question_id}: pusta lub zbyt długa odpowiedź tekstowa')
+            row.text_answer = text
+        else:
+            name = str(answer.get('file') or '')
+            if name in oversized:
+                raise RunRejected(f'{question_id}: plik audio większy niż {audio.MAX_UPLOAD_BYTES} B')
+            upload = files.get(name)
+            if upload is None:
+                raise RunRejected(f'{question_id}: brak pliku audio')
+            try:
+                audio.check_upload(upload, profile)
+            except audio.AudioRejected as e:
+                raise RunRejected(f'{question_id}: {e}')
+            uploads.append((row, upload))
+        rows.append(row)
+    return rows, uploads
+
+
+def _store_run(run_id, run, survey, texts, files, oversized, device, config):
+    pesel = str(run.get('pesel') or '')
+    born, errors = patients.validate_pesels([pesel])
+    if errors[0]:
+        raise RunRejected(errors[0])
+    rows, uploads = _answers(run_id, run, survey, texts, files, oversized, config)
+
+    # files first: storage is not transactional, so they are removed again on failure
+    saved = []
+    try:
+        for row, upload in uploads:
+            row.audio_file = default_storage.save(
+                os.path.join('audio_answers', f'{uuid.uuid4().hex}_{os.path.basename(upload.name)}'), upload,
+            )
+            saved.append(row.audio_file.name)
+        with transaction.atomic():
+            patient, _ = Patient.objects.get_or_create(
+                pesel=pesel, defaults={'date_of_birth': born[0].item()},
+            )
+            try:
+                with transaction.atomic():
+                    KioskRun.objects.create(
+                        run_id=run_id, patient=patient, survey=survey, mode=run['mode'], device=device,
+                        answers=len(rows), started_at=_device_time(run.get('started_at')),
+                        finished_at=_device_time(run.get('finished_at')),
+                    )
+            except IntegrityError:
+                # stored by a concurrent upload of the same batch
+                if not KioskRun.objects.filter(run_id=run_id).exists():
+                    raise
+                _delete(saved)
+                return DUPLICATE
+            for row in rows:
+                row.patient = patient
+            # created_at is the upload time on purpose (see the module docstring)
+            PatientResponse.objects.bulk_create(rows)
+            # bulk_create sends no post_save
+            fragments.invalidate(patients=[patient.id], runs=[run_id])
+    except BaseException:
+        _delete(saved)
+        raise
+    return CREATED
+
+
+def _device_time(value):
+    try:
+        return parse_datetime(str(value)) if value else None
+    except ValueError:
+        return None
+
+
+def _delete(names):
+    for name in names:
+        default_storage.delete(name)
@@ -0,0 +1,57 @@
+"""
+Pre-rendered Cantril ladder for the question page.
+
+The ladder markup depends only on the design and the question's scale labels,
+so it is rendered once per (design, max label, min label) and kept in process
+memory; ``ankieta_question.html`` inserts the finished HTML instead of looping
+over the steps and branching on the design on every request.
+
+``precompile`` renders the ladders of a survey when it is saved (question
+mirror written, design changed), so the first patient does not pay for it.
+Other workers fill their cache on first use. In development the cache is
+cleared when a template file changes (the autoreloader only resets the
+template loaders).
+"""
+from functools import lru_cache
+
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+TEMPLATE = 'ladder_fragment.html'
+STEPS = tuple(range(1, 11))
+DEFAULT_DESIGN = 'classic'
+
+
+@lru_cache(maxsize=512)
+def _render(design, label_max, label_min):
+    return mark_safe(render_to_string(TEMPLATE, {
+        'design': design, 'steps': STEPS, 'label_max': label_max, 'label_min': label_min,
+    }))
+
+
+def ladder_html(design, scale_labels=None):
+    labels = scale_labels if isinstance(scale_labels, dict) else {}
+    return _render(design or DEFAULT_DESIGN, str(labels.get('max') or ''), str(labels.get('min') or ''))
+
+
+def precompile(data):
+    """Render the ladders of a question mirror ({'ladder_design', 'questions': [...]})."""
+    design = data.get('ladder_design') or DEFAULT_DESIGN
+    for q in data.get('questions') or ():
+        ladder_html(design, q.get('scale_labels') if isinstance(q, dict) else None)
+
+
+def clear_cache():
+    _render.cache_clear()
+
+
+def _file_changed(sender, file_path, **kwargs):
+    if file_path.suffix == '.html':
+        clear_cache()
+    # returns None: whether to restart is still up to the autoreloader
+
+
+def connect_signals():
+    from django.utils.autoreload import file_changed
+
+    file_changed.connect(_file_changed, dispatch_uid='cantrilapp_ladder_templates')
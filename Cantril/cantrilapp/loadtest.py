@@ -0,0 +1,455 @@
+"""
+End-to-end load test of the patient flows (used by ``manage.py loadtest``).
+
+The app is served in-process by a threaded WSGI server, n8n is replaced by a
+local HTTP stand-in with configurable latency / failure rate (optionally
+posting scores back to the results webhook like the real workflow), and N
+simulated patients walk ankieta_choice -> ankieta_select_survey ->
+cantril/voice questions (text answers and WebM uploads) -> ankieta_done.
+
+Every app request runs inside a ``connection.execute_wrapper`` probe, so the
+report includes time spent acquiring the SQLite write lock (``BEGIN``) and
+"database is locked" errors next to the per-URL latencies.
+
+Client threads share the GIL with the server: absolute numbers are pessimistic,
+but runs on the same machine are comparable across commits.
+"""
+import json
+import random
+import re
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.core.wsgi import get_wsgi_application
+from django.db import OperationalError, connection
+from django.test.utils import override_settings
+from django.urls import Resolver404, resolve, reverse
+
+SURVEY_UUID_RE = re.compile(r'name="survey_uuid"\s+value="([0-9a-f-]{36})"')
+# question pages contain one of these inputs; the final step renders the "done" page instead
+QUESTION_FORM_RE = re.compile(r'name="(answer|response_type)"')
+TEXT_ANSWERS = ['Dobrze.', 'Trochę gorzej niż wczoraj.', 'Bez zmian.', 'Lepiej niż w zeszłym tygodniu.']
+
+
+def percentiles(values, points=(0.50, 0.95, 0.99)):
+    """{'p50': ms, ...} for a list of durations in seconds (nearest-rank)."""
+    ordered = sorted(values)
+    out = {}
+    for p in points:
+        key = f'p{int(p * 100)}'
+        out[key] = round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 2) if ordered else None
+    return out
+
+
+def _summary(values):
+    data = {'count': len(values), **percentiles(values)}
+    data['mean'] = round(sum(values) / len(values) * 1000, 2) if values else None
+    data['max'] = round(max(values) * 1000, 2) if values else None
+    return data
+
+
+class Stats:
+    """Thread-safe collector of per-URL latencies, errors and DB probe timings."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.error_samples = []
+        self.sessions_completed = 0
+        self.sessions_failed = 0
+        self.db_begin = []
+        self.db_writes = []
+        self.db_statements = 0
+        self.db_lock_errors = 0
+
+    def request(self, name, seconds, error=None):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(seconds)
+            if error:
+                self.errors[name] = self.errors.get(name, 0) + 1
+                if len(self.error_samples) < 20:
+                    self.error_samples.append({'url': name, 'error': error})
+
+    def session(self, ok):
+        with self.lock:
+            if ok:
+                self.sessions_completed += 1
+            else:
+                self.sessions_failed += 1
+
+    def __call__(self, execute, sql, params, many, context):
+        # connection.execute_wrapper probe (runs in server threads)
+        t0 = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        except OperationalError as exc:
+            if 'locked' in str(exc):
+                with self.lock:
+                    self.db_lock_errors += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - t0
+            verb = sql.lstrip()[:6].upper()
+            with self.lock:
+                self.db_statements += 1
+                if verb.startswith('BEGIN'):
+                    self.db_begin.append(elapsed)
+                elif verb in ('INSERT', 'UPDATE', 'DELETE'):
+                    self.db_writes.append(elapsed)
+
+    def report(self, elapsed):
+        with self.lock:
+            total = sum(len(v) for v in self.latencies.values())
+            errors = sum(self.errors.values())
+            return {
+                'totals': {
+                    'requests': total,
+                    'errors': errors,
+                    'error_rate': round(errors / total, 4) if total else 0.0,
+                    'throughput_rps': round(total / elapsed, 2) if elapsed else None,
+                    'sessions_completed': self.sessions_completed,
+                    'sessions_failed': self.sessions_failed,
+                    'sessions_per_second': round(self.sessions_completed / elapsed, 3) if elapsed else None,
+                    'seconds': round(elapsed, 3),
+                },
+                'urls': {
+                    name: {**_summary(values), 'errors': self.errors.get(name, 0)}
+                    for name, values in sorted(self.latencies.items())
+                },
+                'db': {
+                    'statements': self.db_statements,
+                    'lock_errors': self.db_lock_errors,
+                    # time to get the write lock (BEGIN IMMEDIATE) / run a write statement
+                    'begin_wait_ms': _summary(self.db_begin),
+                    'begin_wait_total_ms': round(sum(self.db_begin) * 1000, 1),
+                    'write_statement_ms': _summary(self.db_writes),
+                },
+                'error_samples': list(self.error_samples),
+            }
+
+
+# =====================
+# Fake n8n
+# =====================
+class FakeN8n:
+    """Local stand-in for the n8n webhook.
+
+    Each delivery waits ``latency_ms`` (+ uniform ``jitter_ms``), fails with HTTP 500
+    at ``failure_rate`` and, with ``callback_url`` set, posts a score back to the
+    app's results webhook after ``callback_delay_ms`` like the real workflow.
+    """
+
+    def __init__(self, latency_ms=200, jitter_ms=100, failure_rate=0.0, callback_url=None,
+                 callback_delay_ms=500, seed=None):
+        self.latency = latency_ms / 1000.0
+        self.jitter = jitter_ms / 1000.0
+        self.failure_rate = failure_rate
+        self.callback_url = callback_url
+        self.callback_delay = callback_delay_ms / 1000.0
+        self.rnd = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {'requests': 0, 'failures': 0, 'bytes': 0, 'callbacks': 0, 'callback_errors': 0}
+        self._callbacks = ThreadPoolExecutor(max_workers=8, thread_name_prefix='fake-n8n-callback')
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fake-n8n', daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}/webhook/fake-n8n'
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                with fake.lock:
+                    delay = fake.latency + fake.rnd.uniform(0, fake.jitter)
+                    fail = fake.rnd.random() < fake.failure_rate
+                    fake.counts['requests'] += 1
+                    fake.counts['bytes'] += len(body)
+                    if fail:
+                        fake.counts['failures'] += 1
+                time.sleep(delay)
+                status, payload = (500, b'{"error": "simulated failure"}') if fail else (200, b'{"status": "ok"}')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+                if not fail and fake.callback_url:
+                    fake._callbacks.submit(fake._post_score, self.headers.get('Content-Type', ''), body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def _post_score(self, content_type, body):
+        # the app sends surveyID/questionID either as JSON or as multipart form fields
+        text = body[:4096].decode('utf-8', 'replace')
+        if 'json' in content_type:
+            try:
+                data = json.loads(body)
+            except ValueError:
+                return
+            survey, qid = data.get('surveyID'), data.get('questionID')
+        else:
+            fields = dict(re.findall(r'name="(surveyID|questionID)"\r\n\r\n([^\r]*)', text))
+            survey, qid = fields.get('surveyID'), fields.get('questionID')
+        if not survey or not qid:
+            return
+        time.sleep(self.callback_delay)
+        try:
+            requests.post(self.callback_url, json={'surveyID': survey, 'questionID': qid,
+                                                   'score': self.rnd.randint(1, 10)}, timeout=30)
+            key = 'callbacks'
+        except requests.RequestException:
+            key = 'callback_errors'
+        with self.lock:
+            self.counts[key] += 1
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._callbacks.shutdown(wait=True)
+
+
+# =====================
+# App server
+# =====================
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class _LoadTestServer(ThreadedWSGIServer):
+    # default backlog (5) refuses connections under a few dozen concurrent patients
+    request_queue_size = 256
+
+
+class AppServer:
+    """The Django app on a threaded WSGI server, every request wrapped in the DB probe."""
+
+    def __init__(self, probe, port=0):
+        self.server = _LoadTestServer(('127.0.0.1', port), _QuietHandler)
+        inner = get_wsgi_application()
+
+        def app(environ, start_response):
+            with connection.execute_wrapper(probe):
+                return inner(environ, start_response)
+
+        self.server.set_app(app)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='loadtest-app', daemon=True)
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# =====================
+# Simulated patients
+# =====================
+class SimulatedPatient:
+    """One patient (own cookie jar) repeatedly walking the survey flow."""
+
+    def __init__(self, number, base_url, stats, options, audio_bytes):
+        self.base_url = base_url
+        self.stats = stats
+        self.o = options
+        self.rnd = random.Random(None if options['seed'] is None else options['seed'] * 10_000 + number)
+        self.audio = audio_bytes
+        self.session = requests.Session()
+        self.pesel = self._pesel(number)
+
+    def _pesel(self, number):
+        # imported lazily: management/commands is not a regular package
+        from cantrilapp.management.commands.seed_synthetic import pesel_for
+        born = date(1950, 1, 1) + timedelta(days=self.rnd.randint(0, 365 * 50))
+        return pesel_for(born, number % 1000, self.rnd.random() < 0.5)
+
+    def _label(self, url):
+        try:
+            return resolve(urlsplit(url).path).url_name or url
+        except Resolver404:
+            return urlsplit(url).path
+
+    def _think(self):
+        if self.o['think_ms']:
+            time.sleep(self.rnd.uniform(0.5, 1.5) * self.o['think_ms'] / 1000.0)
+
+    def call(self, method, url, expect, **kwargs):
+        """One timed request; `expect` is the status code the flow relies on."""
+        if not url.startswith('http'):
+            url = self.base_url + url
+        name = self._label(url)
+        if method == 'POST':
+            kwargs.setdefault('data', {})['csrfmiddlewaretoken'] = self.session.cookies.get('csrftoken', '')
+            kwargs.setdefault('headers', {})['Referer'] = url
+        t0 = time.perf_counter()
+        try:
+            resp = self.session.request(method, url, allow_redirects=False, timeout=self.o['timeout'], **kwargs)
+        except requests.RequestException as exc:
+            self.stats.request(name, time.perf_counter() - t0, f'{type(exc).__name__}: {exc}')
+            raise _FlowError(name)
+        elapsed = time.perf_counter() - t0
+        error = None
+        if resp.status_code != expect:
+            error = f'HTTP {resp.status_code} (expected {expect})'
+        self.stats.request(name, elapsed, error)
+        if error:
+            raise _FlowError(name)
+        return resp
+
+    def walk(self):
+        """ankieta_choice -> select_survey -> questions -> done. Returns True when completed."""
+        mode = 'voice' if self.rnd.random() < self.o['voice_ratio'] else 'cantril'
+        start_url = reverse('ankieta_choice')
+        self.call('GET', start_url, 200)
+        self._think()
+        resp = self.call('POST', start_url, 302, data={'pesel': self.pesel, 'mode': mode})
+
+        select = self.call('GET', resp.headers['Location'], 200)
+        surveys = SURVEY_UUID_RE.findall(select.text)
+        if not surveys:
+            self.stats.request('ankieta_select_survey', 0.0, 'no surveys on the selection page')
+            raise _FlowError('ankieta_select_survey')
+        self._think()
+        resp = self.call('POST', reverse('ankieta_select_survey'), 302,
+                         data={'survey_uuid': self.rnd.choice(surveys), 'mode': mode})
+
+        for _ in range(100):
+            url = resp.headers['Location']
+            page = self.call('GET', url, 200)
+            if not QUESTION_FORM_RE.search(page.text):
+                break
+            self._think()
+            resp = self.call('POST', url, 302, **self._answer(mode))
+        self.call('GET', reverse('ankieta_done'), 200)
+        return True
+
+    def _answer(self, mode):
+        if mode == 'cantril':
+            return {'data': {'response_type': 'scale', 'answer': str(self.rnd.randint(1, 10))}}
+        if self.rnd.random() < self.o['audio_ratio']:
+            return {
+                'data': {'response_type': 'audio'},
+                'files': {'audio_file': ('nagranie.webm', self.audio, 'audio/webm')},
+            }
+        return {'data': {'response_type': 'text', 'text_answer': self.rnd.choice(TEXT_ANSWERS)}}
+
+    def run(self, deadline, sessions):
+        done = 0
+        while (sessions is None or done < sessions) and time.monotonic() < deadline:
+            self.session.cookies.clear()
+            try:
+                ok = self.walk()
+            except _FlowError:
+                ok = False
+            self.stats.session(ok)
+            done += 1
+
+
+class _FlowError(Exception):
+    pass
+
+
+def git_revision():
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=settings.BASE_DIR,
+                             capture_output=True, text=True, timeout=5)
+        return out.stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_load_test(options, log=print):
+    """Start fake n8n + app, run the patients, return the JSON-able report."""
+    from cantrilapp.management.commands.seed_synthetic import placeholder_webm
+
+    stats = Stats()
+    app = AppServer(stats, port=options['port']).start()
+    fake = FakeN8n(
+        latency_ms=options['n8n_latency_ms'],
+        jitter_ms=options['n8n_jitter_ms'],
+        failure_rate=options['n8n_failure_rate'],
+        callback_url=app.base_url + reverse('n8n_results_webhook') if options['n8n_callback'] else None,
+        callback_delay_ms=options['n8n_callback_delay_ms'],
+        seed=options['seed'],
+    ).start()
+    n8n_settings = override_settings(N8N={**getattr(settings, 'N8N', {}), 'webhook_url': fake.url})
+    n8n_settings.enable()
+    log(f'App on {app.base_url}, fake n8n on {fake.url}')
+
+    audio = placeholder_webm(options['audio_bytes'])
+    patients = [SimulatedPatient(n, app.base_url, stats, options, audio) for n in range(options['patients'])]
+    threads = []
+    started_at = datetime.now(dt_timezone.utc)
+    t0 = time.monotonic()
+    deadline = t0 + options['duration'] if options['duration'] else float('inf')
+    ramp = options['ramp_up'] / max(1, len(patients))
+    try:
+        for patient in patients:
+            t = threading.Thread(target=patient.run, args=(deadline, options['sessions']), daemon=True)
+            t.start()
+            threads.append(t)
+            if ramp:
+                time.sleep(ramp)
+        for t in threads:
+            t.join()
+        elapsed = time.monotonic() - t0
+    finally:
+        n8n_settings.disable()
+        fake.stop()
+        app.stop()
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'started_at': started_at.isoformat(),
+            'patients': options['patients'],
+            'sessions_per_patient': options['sessions'],
+            'duration_limit': options['duration'],
+            'voice_ratio': options['voice_ratio'],
+            'audio_ratio': options['audio_ratio'],
+            'audio_bytes': options['audio_bytes'],
+            'think_ms': options['think_ms'],
+            'database': connection.vendor,
+            'sqlite_tuning': bool(getattr(settings, 'SQLITE_TUNING', {}).get('enabled')),
+            'debug': settings.DEBUG,
+        },
+        **stats.report(elapsed),
+        'n8n': {
+            'latency_ms': options['n8n_latency_ms'],
+            'jitter_ms': options['n8n_jitter_ms'],
+            'failure_rate': options['n8n_failure_rate'],
+            **fake.counts,
+        },
+    }
+    return report
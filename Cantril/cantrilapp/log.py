@@ -0,0 +1,107 @@
+"""
+Non-blocking structured logging.
+
+Request threads only put records on an in-memory queue (``AsyncQueueHandler``);
+a ``QueueListener`` thread formats them as one JSON object per line
+(``JsonFormatter``) and writes them out. When the queue is full records are
+dropped (and counted) rather than blocking the request.
+
+Extra fields go in ``extra=``; a large structure (e.g. a webhook body) goes in
+``extra={'payload': ...}`` and is sampled and truncated by ``PayloadFilter`` on
+the listener thread. Don't mutate a payload after logging it.
+
+Wired up in ``settings.LOGGING``; per-logger levels come from
+``CANTRIL_LOG_LEVELS="cantrilapp.webhook=DEBUG,django.db.backends=INFO"``.
+"""
+import atexit
+import json
+import logging
+import queue
+import random
+from datetime import datetime, timezone as dt_timezone
+from logging.handlers import QueueHandler, QueueListener
+
+# attributes every LogRecord has; anything else came in via extra=
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class AsyncQueueHandler(QueueHandler):
+    """QueueHandler with its own listener thread feeding ``handlers``."""
+
+    def __init__(self, handlers=(), maxsize=10000, respect_handler_level=True):
+        super().__init__(queue.Queue(maxsize))
+        # dictConfig's ConvertingList resolves 'cfg://handlers.x' on indexing, not on iteration
+        handlers = [handlers[i] for i in range(len(handlers))]
+        self.dropped = 0
+        self.listener = QueueListener(self.queue, *handlers, respect_handler_level=respect_handler_level)
+        self.listener.start()
+        self._stopped = False
+        atexit.register(self.stop)
+
+    def prepare(self, record):
+        # only the cheap part on the request thread: message interpolation and traceback text
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def stop(self):
+        """Flush the queue and stop the listener thread (idempotent)."""
+        if not self._stopped:
+            self._stopped = True
+            self.listener.stop()
+
+    def close(self):
+        self.stop()
+        super().close()
+
+
+class PayloadFilter(logging.Filter):
+    """Keep ``payload`` on a sample of records only, serialised and cut to ``max_chars``."""
+
+    def __init__(self, sample_rate=1.0, max_chars=2000):
+        super().__init__()
+        self.sample_rate = float(sample_rate)
+        self.max_chars = int(max_chars)
+
+    def filter(self, record):
+        if not hasattr(record, 'payload'):
+            return True
+        payload = record.payload
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            record.payload = None
+            record.payload_sampled_out = True
+            return True
+        text = payload if isinstance(payload, str) else json.dumps(payload, ensure_ascii=False, default=str)
+        record.payload_size = len(text)
+        if len(text) > self.max_chars:
+            text = text[:self.max_chars] + '…'
+            record.payload_truncated = True
+        record.payload = text
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        data = {
+            'ts': datetime.fromtimestamp(record.created, dt_timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage() if record.args else record.msg,
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                data[key] = value
+        if record.exc_text or record.exc_info:
+            data['exc'] = record.exc_text or self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
@@ -0,0 +1,36 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cantrilapp import archive
+
+
+class Command(BaseCommand):
+    help = ('Move runs older than the retention period (settings.RETENTION) from PatientResponse to the cold '
+            'archive: gzip NDJSON per month with an index, a summary row per run, hot rows deleted in batches')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--months', type=int, default=None, help='Retention in months (default: RETENTION["months"])')
+        parser.add_argument('--dir', default=None, help='Archive directory (default: settings.ARCHIVE_DIR)')
+        parser.add_argument('--batch-runs', type=int, default=None, help='Runs per transaction')
+        parser.add_argument('--delete-batch', type=int, default=None, help='Primary keys per DELETE')
+        parser.add_argument('--dry-run', action='store_true', help='Count what would be archived, change nothing')
+
+    def handle(self, *args, **options):
+        for name in ('months', 'batch_runs', 'delete_batch'):
+            if options[name] is not None and options[name] < 1:
+                raise CommandError(f'--{name.replace("_", "-")} must be >= 1')
+        directory = options['dir'] or archive.archive_dir()
+        t0 = time.monotonic()
+        stats = archive.archive_runs(
+            months=options['months'],
+            directory=directory,
+            batch_runs=options['batch_runs'],
+            delete_batch=options['delete_batch'],
+            dry_run=options['dry_run'],
+        )
+        prefix = '[dry run] ' if options['dry_run'] else ''
+        self.stdout.write(self.style.SUCCESS(
+            f"{prefix}{stats['runs']} run(s), {stats['rows']} response(s) archived under {directory} "
+            f"in {stats['batches']} batch(es) ({time.monotonic() - t0:.2f}s)"
+        ))
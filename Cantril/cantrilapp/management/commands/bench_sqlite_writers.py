@@ -0,0 +1,203 @@
+import json
+import os
+import queue
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+
+from django.core.management.base import BaseCommand
+
+from cantrilapp.db import DEFAULT_SQLITE_TUNING, sqlite_pragmas
+
+SCHEMA = """
+CREATE TABLE response (
+    id INTEGER PRIMARY KEY,
+    run_id TEXT NOT NULL,
+    question_id TEXT NOT NULL,
+    scale_value REAL,
+    evaluated_score REAL,
+    is_processed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX response_run_question ON response (run_id, question_id);
+"""
+
+
+def _connect(path, mode, synchronous=None):
+    # isolation_level=None: we issue BEGIN ourselves, like Django's atomic()
+    conn = sqlite3.connect(path, timeout=5.0, isolation_level=None, check_same_thread=False)
+    if mode != 'default':
+        config = dict(DEFAULT_SQLITE_TUNING, enabled=True)
+        if synchronous:
+            config['synchronous'] = synchronous
+        for pragma in sqlite_pragmas(config):
+            conn.execute(pragma)
+    return conn
+
+
+def _begin(conn, mode):
+    conn.execute('BEGIN' if mode == 'default' else 'BEGIN IMMEDIATE')
+
+
+def _insert(conn, worker, i):
+    conn.execute(
+        'INSERT INTO response (run_id, question_id, scale_value) VALUES (?, ?, ?)',
+        (f'run{worker}', f'q{i}', i % 10),
+    )
+
+
+def _score(conn, worker, i):
+    # read-then-write, like the webhook looking a response up before updating it
+    conn.execute('SELECT id FROM response WHERE run_id = ? AND question_id = ?', (f'run{worker}', f'q{i}')).fetchone()
+    conn.execute(
+        'UPDATE response SET evaluated_score = ?, is_processed = 1 WHERE run_id = ? AND question_id = ?',
+        (i % 10, f'run{worker}', f'q{i}'),
+    )
+
+
+class _BatchWriter(threading.Thread):
+    """Minimal stand-in for cantrilapp.db.BatchedWriter on a raw sqlite3 connection."""
+
+    def __init__(self, path, max_batch, max_delay, synchronous=None):
+        super().__init__(daemon=True)
+        self.conn = _connect(path, 'tuned', synchronous)
+        self.q = queue.Queue()
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.q.put((future, fn, args))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.q.get()]
+            if batch[0] is None:
+                return
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self.q.get(timeout=remaining) if remaining > 0 else self.q.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.q.put(None)
+                    break
+                batch.append(item)
+            try:
+                _begin(self.conn, 'tuned')
+                for _, fn, args in batch:
+                    fn(self.conn, *args)
+                self.conn.execute('COMMIT')
+            except sqlite3.Error as exc:
+                self.conn.execute('ROLLBACK') if self.conn.in_transaction else None
+                for future, _, _ in batch:
+                    future.set_exception(exc)
+                continue
+            for future, _, _ in batch:
+                future.set_result(True)
+
+
+class Command(BaseCommand):
+    help = 'Benchmark concurrent SQLite writers: default config vs WAL/pragmas/BEGIN IMMEDIATE vs batched writer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--writers', type=int, default=16, help='Concurrent writer threads')
+        parser.add_argument('--ops', type=int, default=200, help='Insert+score operations per writer')
+        parser.add_argument('--modes', default='default,tuned,batched', help='Comma separated: default,tuned,batched')
+        parser.add_argument('--synchronous', default=None, help='Override PRAGMA synchronous for tuned/batched (e.g. FULL)')
+        parser.add_argument('--json', action='store_true', help='Print results as JSON')
+
+    def _run_mode(self, mode, writers, ops, synchronous=None):
+        tmpdir = tempfile.mkdtemp(prefix='cantril-bench-')
+        path = os.path.join(tmpdir, 'bench.sqlite3')
+        setup = _connect(path, mode, synchronous)
+        setup.executescript(SCHEMA)
+        setup.close()
+
+        batcher = None
+        if mode == 'batched':
+            batcher = _BatchWriter(path, max_batch=200, max_delay=0, synchronous=synchronous)
+            batcher.start()
+
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+        start_gate = threading.Barrier(writers)
+
+        def worker(n):
+            conn = None if batcher else _connect(path, mode, synchronous)
+            start_gate.wait()
+            for i in range(ops):
+                for op in (_insert, _score):
+                    t0 = time.perf_counter()
+                    try:
+                        if batcher:
+                            batcher.submit(op, n, i).result()
+                        else:
+                            _begin(conn, mode)
+                            op(conn, n, i)
+                            conn.execute('COMMIT')
+                    except sqlite3.OperationalError as exc:
+                        if conn is not None and conn.in_transaction:
+                            conn.execute('ROLLBACK')
+                        with lock:
+                            errors.append(str(exc))
+                        continue
+                    with lock:
+                        latencies.append(time.perf_counter() - t0)
+            if conn is not None:
+                conn.close()
+
+        threads = [threading.Thread(target=worker, args=(n,)) for n in range(writers)]
+        t0 = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - t0
+        if batcher:
+            batcher.q.put(None)
+            batcher.join()
+
+        latencies.sort()
+
+        def pct(p):
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000, 2) if latencies else None
+
+        return {
+            'mode': mode,
+            'writers': writers,
+            'ops': writers * ops * 2,
+            'committed': len(latencies),
+            'errors': len(errors),
+            'locked_errors': sum('locked' in e for e in errors),
+            'seconds': round(elapsed, 3),
+            'ops_per_second': round(len(latencies) / elapsed, 1) if elapsed else None,
+            'p50_ms': pct(0.50),
+            'p95_ms': pct(0.95),
+            'p99_ms': pct(0.99),
+            'mean_ms': round(statistics.mean(latencies) * 1000, 2) if latencies else None,
+        }
+
+    def handle(self, *args, **options):
+        results = [
+            self._run_mode(mode.strip(), options['writers'], options['ops'], options['synchronous'])
+            for mode in options['modes'].split(',') if mode.strip()
+        ]
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        header = f"{'mode':<10}{'ops/s':>10}{'committed':>11}{'locked':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+        self.stdout.write(header)
+        self.stdout.write('-' * len(header))
+        for r in results:
+            self.stdout.write(
+                f"{r['mode']:<10}{r['ops_per_second']:>10}{r['committed']:>11}{r['locked_errors']:>8}"
+                f"{r['p50_ms']!s:>9}{r['p95_ms']!s:>9}{r['p99_ms']!s:>9}"
+            )
@@ -0,0 +1,151 @@
+import json
+import statistics
+import time
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.template.backends.django import DjangoTemplates
+from django.utils.safestring import mark_safe
+
+from cantrilapp import ladder
+
+# development: what DEBUG=True gave us (templates re-read and re-parsed, ladder
+# rendered on every request); production: the settings.PRODUCTION profile
+MODES = {
+    'development': {'APP_DIRS': False, 'OPTIONS': {'debug': True, 'loaders': [
+        'django.template.loaders.filesystem.Loader',
+        'django.template.loaders.app_directories.Loader',
+    ]}},
+    'production': {'APP_DIRS': False, 'OPTIONS': {'debug': False, 'loaders': [
+        ('django.template.loaders.cached.Loader', [
+            'django.template.loaders.filesystem.Loader',
+            'django.template.loaders.app_directories.Loader',
+        ]),
+    ]}},
+}
+LABELS = {'min': 'Najgorsze możliwe życie', 'max': 'Najlepsze możliwe życie'}
+
+
+def _engine(mode):
+    config = MODES[mode]
+    return DjangoTemplates({'NAME': f'bench-{mode}', 'DIRS': [], **config, 'OPTIONS': dict(config['OPTIONS'])})
+
+
+def _response_rows(n):
+    created = datetime(2025, 1, 15, 10, 30)
+    return [{
+        'patient_pesel': f'{90010100000 + i % 50:011d}',
+        'json_survey_id': f'run_{i // 10}',
+        'survey_label': f'Ankieta {i // 10} - 2025-01-15 10:30',
+        'question_id': f'q{i % 10 + 1}',
+        'question_text': 'Jak ocenia Pan/Pani swoje obecne życie?',
+        'response_type': ('scale', 'text', 'audio')[i % 3],
+        'response_type_label': ('Skala', 'Tekst', 'Audio')[i % 3],
+        'scale_value': i % 10 + 1,
+        'text_answer': 'Dobrze, choć bywa różnie.',
+        'audio_file': '/media/audio_answers/a.webm' if i % 3 == 2 else None,
+        'evaluated_score': 7.5 if i % 2 else None,
+        'evaluated_label': '7.5' if i % 2 else 'Brak',
+        'is_processed': bool(i % 2),
+        'created_at': created,
+        'created_cet': '2025-01-15 10:30:00',
+        'created_label': '2025-01-15 10:30',
+    } for i in range(n)]
+
+
+def _history_patients(n):
+    return [{
+        'id': i, 'pesel': f'{90010100000 + i:011d}', 'first_name': 'Jan', 'last_name': f'Kowalski{i}',
+        'surveys': [{
+            'survey_id': f'run_{i}_{j}', 'survey_label': f'Ankieta {j}', 'responses_count': 10,
+            'processed_count': 10 - j, 'first_response_at': '2025-01-15 10:30', 'last_response_at': '2025-01-15 10:41',
+        } for j in range(3)],
+    } for i in range(n)]
+
+
+class Command(BaseCommand):
+    help = 'Micro-benchmark of template rendering per page: development profile vs production profile'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=300, help='Timed renders per page and mode')
+        parser.add_argument('--warmup', type=int, default=10, help='Untimed renders first')
+        parser.add_argument('--rows', type=int, default=50, help='Cards on the panel pages')
+        parser.add_argument('--modes', default='development,production', help=f'Comma separated: {",".join(MODES)}')
+        parser.add_argument('--json', action='store_true', help='Print results as JSON')
+
+    def _pages(self, engine, mode, rows):
+        precompiled = mode == 'production'
+
+        def question():
+            if precompiled:
+                html = ladder.ladder_html('classic', LABELS)
+            else:
+                html = mark_safe(engine.get_template(ladder.TEMPLATE).render({
+                    'design': 'classic', 'steps': list(range(1, 11)),
+                    'label_max': LABELS['max'], 'label_min': LABELS['min'],
+                }))
+            return engine.get_template('ankieta_question.html').render({
+                'question': 'Jak ocenia Pan/Pani swoje obecne życie?', 'question_number': 3,
+                'total_questions': 10, 'progress_percent': 30, 'ladder_design': 'classic',
+                'ladder': html, 'csrf_token': 'bench',
+            })
+
+        response_rows = _response_rows(rows)
+        patients = _history_patients(rows)
+        return {
+            'ankieta_question': question,
+            'panel_results': lambda: engine.get_template('panel_results.html').render({
+                'rows': response_rows, 'pesel': '', 'survey_id': '', 'csrf_token': 'bench',
+            }),
+            'panel_history_patients': lambda: engine.get_template('panel_history_patients.html').render({
+                'patients': patients,
+            }),
+        }
+
+    def _run(self, mode, iterations, warmup, rows):
+        engine = _engine(mode)
+        ladder.clear_cache()
+        results = []
+        for page, render in self._pages(engine, mode, rows).items():
+            for _ in range(warmup):
+                render()
+            timings = []
+            for _ in range(iterations):
+                t0 = time.perf_counter()
+                render()
+                timings.append(time.perf_counter() - t0)
+            timings.sort()
+            results.append({
+                'page': page,
+                'mode': mode,
+                'renders': iterations,
+                'mean_ms': round(statistics.mean(timings) * 1000, 3),
+                'p50_ms': round(timings[len(timings) // 2] * 1000, 3),
+                'p95_ms': round(timings[min(len(timings) - 1, int(0.95 * len(timings)))] * 1000, 3),
+                'renders_per_second': round(iterations / sum(timings), 1),
+            })
+        return results
+
+    def handle(self, *args, **options):
+        modes = [m.strip() for m in options['modes'].split(',') if m.strip()]
+        unknown = set(modes) - set(MODES)
+        if unknown:
+            raise CommandError(f'unknown mode(s): {", ".join(sorted(unknown))}')
+        if options['iterations'] < 1:
+            raise CommandError('--iterations must be >= 1')
+
+        results = []
+        for mode in modes:
+            results += self._run(mode, options['iterations'], options['warmup'], options['rows'])
+        if options['json']:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+
+        header = f"{'page':<24}{'mode':<13}{'mean ms':>9}{'p50 ms':>9}{'p95 ms':>9}{'renders/s':>11}"
+        self.stdout.write(header)
+        self.stdout.write('-' * len(header))
+        for r in sorted(results, key=lambda r: r['page']):
+            self.stdout.write(
+                f"{r['page']:<24}{r['mode']:<13}{r['mean_ms']:>9.3f}{r['p50_ms']:>9.3f}"
+                f"{r['p95_ms']:>9.3f}{r['renders_per_second']:>11.1f}"
+            )
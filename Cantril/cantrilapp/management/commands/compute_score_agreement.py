@@ -0,0 +1,26 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from cantrilapp.analytics import refresh_score_agreement
+
+
+class Command(BaseCommand):
+    help = 'Recompute self-report vs n8n score agreement for months touched since the last run'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--full', action='store_true', help='Ignore the watermark and recompute every month')
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Rows fetched per database round trip')
+
+    def handle(self, *args, **options):
+        t0 = time.monotonic()
+        periods, written = refresh_score_agreement(full=options['full'], chunk_size=options['chunk_size'])
+        elapsed = time.monotonic() - t0
+
+        if not periods:
+            self.stdout.write('No new scored responses since the last run')
+        for period in periods:
+            self.stdout.write(f'Recomputed {period:%Y-%m}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Done. {len(periods)} month(s), {written} partition row(s) in {elapsed:.2f}s'
+        ))
@@ -0,0 +1,57 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cantrilapp import exports
+from cantrilapp.routers import read_replica
+
+
+class Command(BaseCommand):
+    help = 'Stream PatientResponse rows (joined with patient and survey) to a CSV file or stdout'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', '-o', default='-', help='Output file path, "-" for stdout (default)')
+        parser.add_argument('--gzip', action='store_true', help='Compress the output with gzip')
+        parser.add_argument('--pesel', default='')
+        parser.add_argument('--survey-id', default='', help='Survey run id (json_survey_id)')
+        parser.add_argument('--survey', default='', help='Survey UUID')
+        parser.add_argument('--date-from', default='', help='YYYY-MM-DD (inclusive)')
+        parser.add_argument('--date-to', default='', help='YYYY-MM-DD (inclusive)')
+        parser.add_argument('--chunk-size', type=int, default=exports.DEFAULT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        try:
+            qs = exports.export_queryset(
+                pesel=options['pesel'],
+                survey_id=options['survey_id'],
+                survey_uuid=options['survey'],
+                date_from=options['date_from'],
+                date_to=options['date_to'],
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+        chunks = exports.iter_encoded(
+            exports.iter_csv(qs, chunk_size=options['chunk_size']),
+            compress=options['gzip'],
+        )
+
+        t0 = time.monotonic()
+        written = 0
+        to_stdout = options['output'] == '-'
+        out = sys.stdout.buffer if to_stdout else open(options['output'], 'wb')
+        try:
+            with read_replica():
+                for chunk in chunks:
+                    out.write(chunk)
+                    written += len(chunk)
+        finally:
+            if to_stdout:
+                out.flush()
+            else:
+                out.close()
+
+        if not to_stdout:
+            self.stdout.write(self.style.SUCCESS(
+                f"Wrote {written} bytes to {options['output']} in {time.monotonic() - t0:.2f}s"
+            ))
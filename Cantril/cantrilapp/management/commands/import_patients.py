@@ -0,0 +1,53 @@
+import os
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cantrilapp.patients import DEFAULT_BATCH_SIZE, PatientImport
+
+
+class Command(BaseCommand):
+    help = ('Create or update patients from a CSV (pesel[, first_name, last_name, date_of_birth]). '
+            'Rows are validated and upserted in batches; rejected rows go to an error report.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='CSV file, "-" for stdin (UTF-8, optional BOM)')
+        parser.add_argument('--errors', default='',
+                            help='Error report path (default: <path>.errors.csv; none when reading stdin)')
+        parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+        parser.add_argument('--delimiter', default=None, help='Column separator (default: ";" or "," from the header)')
+        parser.add_argument('--dry-run', action='store_true', help='Validate and count only, write nothing')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be >= 1')
+        path = options['path']
+        report_path = options['errors'] or (f'{path}.errors.csv' if path != '-' else '')
+
+        source = sys.stdin if path == '-' else open(path, encoding='utf-8-sig', newline='')
+        report = open(report_path, 'w', encoding='utf-8', newline='') if report_path else None
+        job = PatientImport(batch_size=options['batch_size'], report=report, dry_run=options['dry_run'],
+                            delimiter=options['delimiter'])
+        t0 = time.monotonic()
+        try:
+            stats = job.run(source)
+        except ValueError as e:
+            raise CommandError(str(e))
+        finally:
+            if source is not sys.stdin:
+                source.close()
+            if report is not None:
+                report.close()
+                if not job.stats['errors']:
+                    os.remove(report_path)
+
+        prefix = '[dry run] ' if options['dry_run'] else ''
+        self.stdout.write(self.style.SUCCESS(
+            f"{prefix}{stats['rows']} row(s) in {time.monotonic() - t0:.2f}s: {stats['created']} created, "
+            f"{stats['updated']} updated, {stats['errors']} rejected"
+        ))
+        if stats['errors']:
+            target = f'see {report_path}' if report_path else 'first: ' + '; '.join(
+                f"line {e['line']}: {e['error']}" for e in job.errors[:5])
+            self.stdout.write(self.style.WARNING(f"{stats['errors']} row(s) rejected, {target}"))
@@ -0,0 +1,56 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from cantrilapp.loadtest import run_load_test
+from cantrilapp.models import Survey
+
+
+class Command(BaseCommand):
+    help = ('End-to-end load test: in-process app + fake n8n + N concurrent simulated patients. '
+            'Writes real rows to the configured database - point it at a scratch/seeded copy.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patients', type=int, default=20, help='Concurrent simulated patients')
+        parser.add_argument('--sessions', type=int, default=5, help='Survey runs per patient (0 = until --duration)')
+        parser.add_argument('--duration', type=float, default=0, help='Stop after N seconds (0 = no limit)')
+        parser.add_argument('--ramp-up', type=float, default=2.0, help='Seconds over which patients are started')
+        parser.add_argument('--think-ms', type=int, default=0, help='Mean pause between steps')
+        parser.add_argument('--voice-ratio', type=float, default=0.4, help='Share of runs in voice mode')
+        parser.add_argument('--audio-ratio', type=float, default=0.6, help='Share of voice answers sent as audio')
+        parser.add_argument('--audio-bytes', type=int, default=48_000, help='Size of the uploaded WebM')
+        parser.add_argument('--n8n-latency-ms', type=int, default=200)
+        parser.add_argument('--n8n-jitter-ms', type=int, default=100)
+        parser.add_argument('--n8n-failure-rate', type=float, default=0.0)
+        parser.add_argument('--n8n-callback', action='store_true',
+                            help='Fake n8n posts scores back to the results webhook')
+        parser.add_argument('--n8n-callback-delay-ms', type=int, default=500)
+        parser.add_argument('--timeout', type=float, default=60.0, help='Client request timeout (s)')
+        parser.add_argument('--port', type=int, default=0, help='App port (0 = any free port)')
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--output', default=None, help='Write the JSON report to this file')
+
+    def handle(self, *args, **options):
+        if options['patients'] < 1:
+            raise CommandError('--patients must be >= 1')
+        options['sessions'] = options['sessions'] or None
+        if options['sessions'] is None and not options['duration']:
+            raise CommandError('--sessions 0 needs --duration')
+        if not Survey.objects.exists():
+            raise CommandError('No surveys in the database - create one or run seed_synthetic first')
+        if settings.DEBUG:
+            self.stderr.write('DEBUG=True: query logging adds overhead, numbers are not comparable with production')
+
+        report = run_load_test(options, log=self.stderr.write)
+        payload = json.dumps(report, indent=2, ensure_ascii=False)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as f:
+                f.write(payload)
+            totals = report['totals']
+            self.stderr.write(self.style.SUCCESS(
+                f"Done. {totals['requests']} request(s), {totals['throughput_rps']} req/s, "
+                f"error rate {totals['error_rate']:.2%} -> {options['output']}"
+            ))
+        else:
+            self.stdout.write(payload)
@@ -0,0 +1,70 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from cantrilapp.reconcile import Sweeper, backlog_ages, dispatch_backlog
+
+
+def _age(seconds):
+    seconds = int(seconds)
+    if seconds < 3600:
+        return f'{seconds // 60}m {seconds % 60}s'
+    if seconds < 86400:
+        return f'{seconds // 3600}h {seconds % 3600 // 60}m'
+    return f'{seconds // 86400}d {seconds % 86400 // 3600}h'
+
+
+class Command(BaseCommand):
+    help = ('Re-send text/audio answers n8n has not accepted (is_processed=False), in rate-limited batches '
+            'grouped by run. Meant to run periodically, e.g. every 5 minutes from cron.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=600,
+                            help='Only answers older than N seconds (leave fresh ones to the live flow)')
+        parser.add_argument('--retry-after', type=int, default=900, help='Seconds between attempts for one answer')
+        parser.add_argument('--max-attempts', type=int, default=10, help='Give up on an answer after N attempts')
+        parser.add_argument('--batch-size', type=int, default=50)
+        parser.add_argument('--rate', type=float, default=5.0, help='Max answers sent per second (0 = unlimited)')
+        parser.add_argument('--limit', type=int, default=0, help='Max answers sent in this sweep (0 = all)')
+        parser.add_argument('--dry-run', action='store_true', help='Only report the backlog')
+
+    def report(self, label, ages):
+        if not ages['count']:
+            self.stdout.write(f'{label}: empty')
+            return
+        self.stdout.write(
+            f"{label}: {ages['count']} answer(s), age p50 {_age(ages['p50'])}, p90 {_age(ages['p90'])}, "
+            f"p99 {_age(ages['p99'])}, oldest {_age(ages['max'])}"
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be >= 1')
+        backlog = dispatch_backlog()
+        self.report('Backlog', backlog_ages(backlog, timezone.now()))
+        given_up = backlog.filter(dispatch_attempts__gte=options['max_attempts']).count()
+        if given_up:
+            self.stdout.write(self.style.WARNING(
+                f"{given_up} answer(s) reached --max-attempts {options['max_attempts']} and are skipped"
+            ))
+        if options['dry_run']:
+            return
+
+        sweeper = Sweeper(
+            older_than=timedelta(seconds=options['older_than']),
+            retry_after=timedelta(seconds=options['retry_after']),
+            max_attempts=options['max_attempts'],
+            batch_size=options['batch_size'],
+            rate=options['rate'],
+            limit=options['limit'] or None,
+            log=self.stdout.write if options['verbosity'] > 1 else None,
+        )
+        stats = sweeper.run()
+        if stats['stopped']:
+            self.stderr.write(self.style.WARNING(f"Stopped early: {stats['stopped']}"))
+        self.report('Backlog after', backlog_ages(backlog, timezone.now()))
+        self.stdout.write(self.style.SUCCESS(
+            f"Done. {stats['dispatched']} answer(s) from {stats['runs']} run(s) sent, "
+            f"{stats['accepted']} accepted, {stats['failed']} failed"
+        ))
@@ -0,0 +1,35 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from cantrilapp.routers import REPLICA_ALIAS, refresh_sqlite_replica
+
+
+class Command(BaseCommand):
+    help = 'Refresh the SQLite read replica snapshot using the online backup API'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--loop', action='store_true', help='Keep refreshing every --interval seconds')
+        parser.add_argument('--interval', type=float, default=60, help='Seconds between refreshes with --loop')
+
+    def handle(self, *args, **options):
+        db = settings.DATABASES.get(REPLICA_ALIAS)
+        if not db:
+            raise CommandError('No replica database configured (set CANTRIL_DB_REPLICA=1).')
+        if 'sqlite' not in db['ENGINE']:
+            raise CommandError('The replica is not SQLite; it is kept up to date by the database itself.')
+
+        max_lag = getattr(settings, 'DATABASE_REPLICA_MAX_LAG', 300)
+        if options['loop'] and options['interval'] >= max_lag:
+            self.stdout.write(self.style.WARNING(
+                f'--interval {options["interval"]}s >= DATABASE_REPLICA_MAX_LAG {max_lag}s: '
+                'reads will fall back to the primary between refreshes'
+            ))
+
+        while True:
+            elapsed = refresh_sqlite_replica()
+            self.stdout.write(self.style.SUCCESS(f'Replica refreshed in {elapsed:.2f}s'))
+            if not options['loop']:
+                break
+            time.sleep(max(0.0, options['interval'] - elapsed))
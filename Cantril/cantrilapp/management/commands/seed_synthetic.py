@@ -0,0 +1,418 @@
+import functools
+import math
+import os
+import random
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone as dt_timezone
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connection, connections, transaction
+
+from cantrilapp.models import Patient, PatientResponse, Question, Survey
+from cantrilapp.patients import PESEL_WEIGHTS
+
+FIRST_NAMES = [
+    'Anna', 'Maria', 'Katarzyna', 'Małgorzata', 'Agnieszka', 'Barbara', 'Ewa', 'Zofia', 'Joanna', 'Magdalena',
+    'Piotr', 'Krzysztof', 'Andrzej', 'Tomasz', 'Paweł', 'Jan', 'Michał', 'Marcin', 'Jakub', 'Adam',
+]
+LAST_NAMES = [
+    'Nowak', 'Kowalski', 'Wiśniewski', 'Wójcik', 'Kowalczyk', 'Kamiński', 'Lewandowski', 'Zieliński',
+    'Szymański', 'Woźniak', 'Dąbrowski', 'Kozłowski', 'Jankowski', 'Mazur', 'Kwiatkowski', 'Krawczyk',
+]
+QUESTION_TOPICS = [
+    'swój nastrój', 'poziom energii', 'poziom stresu', 'jakość snu', 'apetyt', 'relacje z bliskimi',
+    'koncentrację', 'samopoczucie fizyczne', 'poczucie sensu', 'zadowolenie z życia', 'poziom lęku', 'motywację',
+]
+TEXT_ANSWERS = [
+    'Dziś jest całkiem dobrze.', 'Trochę gorzej niż wczoraj.', 'Bez zmian.', 'Czuję się zmęczony.',
+    'Lepiej niż w zeszłym tygodniu.', 'Ciężko powiedzieć, raczej średnio.', 'Bardzo dobrze, dużo energii.',
+    'Słabo spałem, ale poza tym w porządku.',
+]
+SCALE_LABELS = {"min": "Bardzo źle", "max": "Bardzo dobrze"}
+
+# godziny pracy poradni: większość ankiet w dni robocze 8-16
+HOUR_WEIGHTS = [0, 0, 0, 0, 0, 0, 1, 3, 8, 10, 10, 9, 7, 8, 9, 8, 6, 4, 3, 2, 1, 1, 0, 0]
+HOUR_CUM_WEIGHTS = [sum(HOUR_WEIGHTS[:h + 1]) for h in range(24)]
+
+
+def pesel_for(birth_date, serial, female):
+    """Valid PESEL (with checksum) for a birth date and a 0-999 serial."""
+    month = birth_date.month + {1800: 80, 1900: 0, 2000: 20, 2100: 40}[birth_date.year // 100 * 100]
+    sex_digit = (serial % 5) * 2 + (0 if female else 1)  # parzysta = kobieta
+    digits = f"{birth_date.year % 100:02d}{month:02d}{birth_date.day:02d}{serial % 1000:03d}{sex_digit}"
+    checksum = (10 - sum(int(d) * w for d, w in zip(digits, PESEL_WEIGHTS)) % 10) % 10
+    return digits + str(checksum)
+
+
+def _ebml(element_id, payload):
+    # 8-byte size vint, valid for any payload length
+    return element_id + b'\x01' + len(payload).to_bytes(7, 'big') + payload
+
+
+def placeholder_webm(size):
+    """Minimal WebM (EBML header + empty Segment) padded with a Void element to ~size bytes."""
+    header = _ebml(b'\x1a\x45\xdf\xa3', b''.join([
+        _ebml(b'\x42\x86', b'\x01'),  # EBMLVersion
+        _ebml(b'\x42\xf7', b'\x01'),  # EBMLReadVersion
+        _ebml(b'\x42\xf2', b'\x04'),  # EBMLMaxIDLength
+        _ebml(b'\x42\xf3', b'\x08'),  # EBMLMaxSizeLength
+        _ebml(b'\x42\x82', b'webm'),  # DocType
+        _ebml(b'\x42\x87', b'\x02'),  # DocTypeVersion
+        _ebml(b'\x42\x85', b'\x02'),  # DocTypeReadVersion
+    ]))
+    padding = max(0, size - len(header) - 2 * 12)
+    # random padding: compresses like real Opus audio would (i.e. not at all)
+    return header + _ebml(b'\x18\x53\x80\x67', _ebml(b'\xec', os.urandom(padding)))
+
+
+@contextmanager
+def explicit_timestamps(*fields):
+    """Let bulk_create keep the created_at values we generate (auto_now_add would overwrite them)."""
+    saved = [(f, f.auto_now_add) for f in fields]
+    for f, _ in saved:
+        f.auto_now_add = False
+    try:
+        yield
+    finally:
+        for f, value in saved:
+            f.auto_now_add = value
+
+
+class _Progress:
+    def __init__(self, stdout, label, total):
+        self.stdout = stdout
+        self.label = label
+        self.total = total
+        self.done = 0
+        self.t0 = time.monotonic()
+
+    def advance(self, n):
+        self.done += n
+        elapsed = time.monotonic() - self.t0
+        rate = self.done / elapsed if elapsed else 0.0
+        eta = (self.total - self.done) / rate if rate else 0.0
+        pct = 100.0 * self.done / self.total if self.total else 100.0
+        self.stdout.write(
+            f'  {self.label}: {self.done:,}/{self.total:,} ({pct:5.1f}%)  {rate:,.0f} rows/s  eta {eta:,.0f}s'
+        )
+        self.stdout.flush()
+
+    def summary(self):
+        elapsed = time.monotonic() - self.t0
+        return self.done, elapsed, (self.done / elapsed if elapsed else 0.0)
+
+
+class Command(BaseCommand):
+    help = 'Generate a large synthetic dataset (patients, surveys, runs, responses, placeholder audio) for load testing'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--patients', type=int, default=10_000)
+        parser.add_argument('--surveys', type=int, default=8)
+        parser.add_argument('--versions', type=int, default=3,
+                            help='Question wording revisions per survey (older runs keep the older question_text)')
+        parser.add_argument('--questions', type=int, default=5, help='Questions per survey')
+        parser.add_argument('--runs', type=int, default=None, help='Survey runs in total (default: 8 per patient)')
+        parser.add_argument('--responses', type=int, default=None,
+                            help='Target number of responses; overrides --runs (runs = responses / questions)')
+        parser.add_argument('--days', type=int, default=730, help='Time span of the generated history')
+        parser.add_argument('--voice-ratio', type=float, default=0.3, help='Share of runs taken in voice mode')
+        parser.add_argument('--audio-ratio', type=float, default=0.6, help='Share of voice answers recorded as audio')
+        parser.add_argument('--scored-ratio', type=float, default=0.95,
+                            help='Share of responses already scored by n8n (the last day is mostly unscored)')
+        parser.add_argument('--audio-files', type=int, default=50, help='Distinct placeholder WebM files to write')
+        parser.add_argument('--audio-bytes', type=int, default=48_000, help='Approximate size of each placeholder')
+        parser.add_argument('--batch-size', type=int, default=5000, help='Rows per bulk_create INSERT batch')
+        parser.add_argument('--commit-every', type=int, default=200_000, help='Rows per transaction')
+        parser.add_argument('--seed', type=int, default=None, help='Random seed (repeatable datasets)')
+        parser.add_argument('--fast', action='store_true',
+                            help='SQLite only: PRAGMA synchronous=OFF for this connection (data loss on power cut)')
+
+    def handle(self, *args, **options):
+        for name in ('patients', 'surveys', 'versions', 'questions', 'batch_size', 'commit_every'):
+            if options[name] < 1:
+                raise CommandError(f'--{name.replace("_", "-")} must be >= 1')
+
+        self.rnd = random.Random(options['seed'])
+        self.options = options
+        questions = options['questions']
+        if options['responses'] is not None:
+            runs = math.ceil(options['responses'] / questions)
+        else:
+            runs = options['runs'] if options['runs'] is not None else options['patients'] * 8
+
+        if options['fast'] and connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA synchronous=OFF')
+
+        self.end = datetime.now(dt_timezone.utc).replace(microsecond=0)
+        self.start = self.end - timedelta(days=options['days'])
+
+        t0 = time.monotonic()
+        surveys = self.create_surveys()
+        patients = self.create_patients()
+        audio = self.write_placeholders()
+        total = runs * questions
+        self.stdout.write(f'Generating {runs:,} run(s) -> {total:,} response(s)')
+        written, elapsed, rate = self.create_responses(patients, surveys, audio, runs, total)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Done. {len(patients):,} patient(s), {len(surveys)} survey(s), {runs:,} run(s), '
+            f'{written:,} response(s) at {rate:,.0f} rows/s ({time.monotonic() - t0:.1f}s total)'
+        ))
+
+    # --- surveys -----------------------------------------------------------------
+
+    def create_surveys(self):
+        """Surveys with questions; each survey gets `versions` wording revisions spread over the span."""
+        o = self.options
+        designs = [key for key, _ in Survey.LADDER_DESIGNS]
+        span = self.end - self.start
+        surveys = []
+        with transaction.atomic():
+            for s in range(o['surveys']):
+                survey = Survey.objects.create(
+                    title=f'Ankieta syntetyczna {s + 1} ({uuid.uuid4().hex[:6]})',
+                    ladder_design=designs[s % len(designs)],
+                )
+                topics = self.rnd.sample(QUESTION_TOPICS, k=min(o['questions'], len(QUESTION_TOPICS)))
+                topics += [f'aspekt {i}' for i in range(len(topics) + 1, o['questions'] + 1)]
+                # version v is live from start + v * span / versions; the DB holds the newest wording
+                versions = [
+                    (self.start + span * v / o['versions'],
+                     [self._wording(topic, v) for topic in topics])
+                    for v in range(o['versions'])
+                ]
+                Question.objects.bulk_create([
+                    Question(survey=survey, key=f'q{i}', text=text, order=i, scale_labels=SCALE_LABELS)
+                    for i, text in enumerate(versions[-1][1], start=1)
+                ])
+                surveys.append((survey, versions))
+        self.stdout.write(f'Created {len(surveys)} survey(s) x {o["versions"]} version(s) x {o["questions"]} question(s)')
+        return surveys
+
+    @staticmethod
+    def _wording(topic, version):
+        variants = ['Jak oceniasz {}?', 'Jak oceniasz dziś {}?', 'W skali 1-10: jak oceniasz {}?', 'Oceń {} w ostatnim tygodniu.']
+        return variants[version % len(variants)].format(topic)
+
+    def version_for(self, versions, when):
+        current = versions[0][1]
+        for since, texts in versions:
+            if since > when:
+                break
+            current = texts
+        return current
+
+    # --- patients ----------------------------------------------------------------
+
+    def create_patients(self):
+        """Returns [(patient_id, created_at, mood, activity_weight)]."""
+        o = self.options
+        rnd = self.rnd
+        existing = set(Patient.objects.values_list('pesel', flat=True))
+        span_seconds = (self.end - self.start).total_seconds()
+        created_at_field = Patient._meta.get_field('created_at')
+        progress = _Progress(self.stdout, 'patients', o['patients'])
+        result = []
+
+        remaining = o['patients']
+        with explicit_timestamps(created_at_field):
+            while remaining:
+                batch = []
+                for _ in range(min(remaining, o['commit_every'])):
+                    female = rnd.random() < 0.55
+                    while True:
+                        born = date(1940, 1, 1) + timedelta(days=rnd.randint(0, 365 * 65))
+                        pesel = pesel_for(born, rnd.randint(0, 999), female)
+                        if pesel not in existing:
+                            existing.add(pesel)
+                            break
+                    # enrolment skewed towards the start of the span; nobody enrols in the last day
+                    created = self.start + timedelta(seconds=span_seconds * 0.98 * rnd.random() ** 1.5)
+                    batch.append(Patient(
+                        pesel=pesel,
+                        first_name=rnd.choice(FIRST_NAMES),
+                        last_name=rnd.choice(LAST_NAMES) + ('a' if female and rnd.random() < 0.5 else ''),
+                        date_of_birth=born,
+                        created_at=created,
+                    ))
+                with transaction.atomic():
+                    created_objs = Patient.objects.bulk_create(batch, batch_size=o['batch_size'])
+                if created_objs and created_objs[0].pk is None:
+                    # backend without RETURNING: read the ids back by PESEL
+                    ids = dict(Patient.objects.filter(pesel__in=[p.pesel for p in batch]).values_list('pesel', 'id'))
+                    for p in created_objs:
+                        p.pk = ids[p.pesel]
+                for p in created_objs:
+                    # a few very active patients, a long tail of occasional ones
+                    result.append((p.pk, p.created_at, rnd.gauss(6.0, 1.5), rnd.paretovariate(1.6)))
+                remaining -= len(batch)
+                progress.advance(len(batch))
+        return result
+
+    # --- audio -------------------------------------------------------------------
+
+    def write_placeholders(self):
+        """Write a pool of placeholder WebM files to storage; responses reference them round-robin."""
+        o = self.options
+        if o['audio_files'] < 1:
+            return []
+        names = []
+        for i in range(o['audio_files']):
+            name = f'audio_answers/synthetic/placeholder_{i:04d}.webm'
+            if not default_storage.exists(name):
+                name = default_storage.save(name, ContentFile(placeholder_webm(o['audio_bytes'])))
+            names.append(name)
+        self.stdout.write(f'{len(names)} placeholder WebM file(s) in audio_answers/synthetic/')
+        return names
+
+    # --- responses ---------------------------------------------------------------
+
+    def run_start(self, patient_created):
+        """Run time after enrolment, denser towards the present, during clinic hours, mostly on weekdays."""
+        rnd = self.rnd
+        window = (self.end - patient_created).total_seconds()
+        when = patient_created + timedelta(seconds=window * (1 - rnd.random() ** 1.3))
+        if when.weekday() >= 5 and rnd.random() < 0.8:
+            # weekend -> a weekday of the same week
+            when -= timedelta(days=when.weekday() - rnd.randint(0, 4))
+        hour = rnd.choices(range(24), cum_weights=HOUR_CUM_WEIGHTS)[0]
+        when = when.replace(hour=hour, minute=rnd.randint(0, 59), second=rnd.randint(0, 59))
+        return min(max(when, patient_created), self.end)
+
+    def iter_responses(self, patients, surveys, audio, runs):
+        """Yield {attname: value} dicts, one per response (see ResponseInserter)."""
+        o = self.options
+        rnd = self.rnd
+        cum_weights = []
+        acc = 0.0
+        for p in patients:
+            acc += p[3]
+            cum_weights.append(acc)
+        # a few surveys dominate
+        survey_cum_weights = [sum(1.0 / (j + 1) for j in range(i + 1)) for i in range(len(surveys))]
+        backlog_from = self.end - timedelta(days=1)
+        audio_i = 0
+
+        for _ in range(runs):
+            patient_id, patient_created, mood, _w = rnd.choices(patients, cum_weights=cum_weights)[0]
+            survey, versions = rnd.choices(surveys, cum_weights=survey_cum_weights)[0]
+            started = self.run_start(patient_created)
+            texts = self.version_for(versions, started)
+            run_id = f"{uuid.uuid4().hex}_{started:%Y%m%dT%H%M%S}"
+            voice = rnd.random() < o['voice_ratio']
+            run_mood = mood + rnd.gauss(0, 1.0)
+            recent = started >= backlog_from
+            when = started
+
+            for i, text in enumerate(texts, start=1):
+                when += timedelta(seconds=rnd.randint(8, 90 if voice else 30))
+                value = min(10, max(1, round(rnd.gauss(run_mood, 1.2))))
+                if not voice:
+                    kind = 'scale'
+                elif rnd.random() < o['audio_ratio'] and audio:
+                    kind = 'audio'
+                else:
+                    kind = 'text'
+                scored = rnd.random() < (0.3 if recent else o['scored_ratio'])
+                score = None
+                scored_at = None
+                if scored:
+                    score = float(min(10, max(1, round(value + rnd.gauss(0.3, 1.2)))))
+                    scored_at = min(self.end, when + timedelta(seconds=rnd.expovariate(1 / 120)))
+
+                audio_file = None
+                if kind == 'audio':
+                    audio_file = audio[audio_i % len(audio)]
+                    audio_i += 1
+                yield {
+                    'id': uuid.uuid4(),
+                    'patient_id': patient_id,
+                    'survey_id': survey.id,
+                    'json_survey_id': run_id,
+                    'question_id': f'q{i}',
+                    'question_text': text,
+                    'response_type': kind,
+                    'scale_value': float(value) if kind == 'scale' else None,
+                    'text_answer': rnd.choice(TEXT_ANSWERS) if kind == 'text' else '',
+                    'audio_file': audio_file,
+                    'transcript': rnd.choice(TEXT_ANSWERS) if kind == 'audio' and scored else '',
+                    'evaluated_score': score,
+                    'is_processed': scored,
+                    'scored_at': scored_at,
+                    'dispatch_attempts': 0 if kind == 'scale' else 1,
+                    'last_dispatch_at': None if kind == 'scale' else when,
+                    'created_at': when,
+                }
+
+    def create_responses(self, patients, surveys, audio, runs, total):
+        o = self.options
+        progress = _Progress(self.stdout, 'responses', total)
+        rows = self.iter_responses(patients, surveys, audio, runs)
+        inserter = ResponseInserter()
+
+        while True:
+            with transaction.atomic():
+                in_tx = 0
+                while in_tx < o['commit_every']:
+                    batch = [r for _, r in zip(range(min(o['batch_size'], o['commit_every'] - in_tx)), rows)]
+                    if not batch:
+                        break
+                    inserter.insert(batch)
+                    in_tx += len(batch)
+            if not in_tx:
+                break
+            progress.advance(in_tx)
+        return progress.summary()
+
+
+class ResponseInserter:
+    """executemany() of the single-row INSERT that bulk_create would issue for PatientResponse.
+
+    bulk_create builds one multi-row statement per batch, preparing every value
+    through the field API; on SQLite the 999-variable limit caps that at ~60 rows
+    per statement. Here each column gets its DB conversion once (only for types
+    that need one: UUIDs, datetimes) and the driver binds plain tuples. Fields the
+    generator does not produce are filled with their model default, so new
+    columns with defaults do not break the seeder.
+    """
+
+    PREPARED_TYPES = {'UUIDField', 'DateTimeField', 'DateField'}
+
+    def __init__(self, model=PatientResponse, using=DEFAULT_DB_ALIAS):
+        # the real connection object, not the thread-local proxy (hot loop)
+        self.connection = connections[using]
+        self.fields = list(model._meta.concrete_fields)
+        qn = self.connection.ops.quote_name
+        self.sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+            qn(model._meta.db_table),
+            ', '.join(qn(f.column) for f in self.fields),
+            ', '.join(['%s'] * len(self.fields)),
+        )
+        self.columns = []
+        for f in self.fields:
+            target = f.target_field if f.is_relation else f
+            prep = None
+            if target.get_internal_type() in self.PREPARED_TYPES:
+                prep = functools.partial(f.get_db_prep_save, connection=self.connection)
+                if f.is_relation:
+                    # few distinct values (survey ids): convert each once
+                    prep = functools.lru_cache(maxsize=1024)(prep)
+            self.columns.append((f.attname, prep, f.get_default()))
+
+    def row(self, values):
+        out = []
+        for attname, prep, default in self.columns:
+            value = values.get(attname, default)
+            if prep is not None and value is not None:
+                value = prep(value)
+            out.append(value)
+        return out
+
+    def insert(self, batch):
+        with self.connection.cursor() as cursor:
+            cursor.executemany(self.sql, [self.row(values) for values in batch])
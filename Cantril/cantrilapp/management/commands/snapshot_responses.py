@@ -0,0 +1,29 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from cantrilapp import snapshots
+
+
+class Command(BaseCommand):
+    help = 'Append new/re-scored responses to the columnar research snapshot (month x survey partitions)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', default=None, help='Snapshot directory (default: settings.RESEARCH_SNAPSHOT_DIR)')
+        parser.add_argument('--full', action='store_true', help='Drop existing parts and rebuild from scratch')
+        parser.add_argument('--flush-rows', type=int, default=250_000, help='Max rows per part file')
+        parser.add_argument('--chunk-size', type=int, default=5000, help='Rows fetched per database round trip')
+
+    def handle(self, *args, **options):
+        base = options['dir'] or snapshots.snapshot_dir()
+        t0 = time.monotonic()
+        rows, parts = snapshots.update_snapshots(
+            base=base,
+            full=options['full'],
+            flush_rows=options['flush_rows'],
+            chunk_size=options['chunk_size'],
+        )
+        elapsed = time.monotonic() - t0
+        self.stdout.write(self.style.SUCCESS(
+            f'Done. {rows} row(s) in {parts} new part(s) under {base} ({elapsed:.2f}s)'
+        ))
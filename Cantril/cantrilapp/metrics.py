@@ -0,0 +1,295 @@
+"""
+In-process request metrics and the Prometheus text exposition behind ``/metrics``.
+
+``InstrumentationMiddleware`` (cantrilapp.middleware) opens a ``RequestTimings``
+for every request; DB time comes from ``db_execute_hook`` (installed on every
+connection), template time from the ``TimedDjangoTemplates`` backend and n8n
+time from ``n8n.post`` / ``n8n.apost``. The totals go out as a ``Server-Timing``
+header and into the histograms below.
+
+Histograms live in process memory: with several worker processes each one
+exposes its own, and Prometheus sums them per instance label.
+"""
+import contextvars
+import os
+import threading
+import time
+from bisect import bisect_left
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import DurationField, ExpressionWrapper, F, Max, Min
+from django.template.backends.django import DjangoTemplates, Template as DjangoTemplate
+from django.utils import timezone
+
+# Prometheus default latency buckets (seconds)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by a tuple of label values."""
+
+    def __init__(self, name, help_text, labelnames, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            i = bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            items = sorted((labels, ([*b], s, c)) for labels, (b, s, c) in self._series.items())
+        for labels, (bucket_counts, total, count) in items:
+            base = _labels(self.labelnames, labels)
+            cumulative = 0
+            for bound, n in zip(self.buckets, bucket_counts):
+                cumulative += n
+                lines.append(f'{self.name}_bucket{_labels(self.labelnames, labels, le=_num(bound))} {cumulative}')
+            lines.append(f'{self.name}_bucket{_labels(self.labelnames, labels, le="+Inf")} {count}')
+            lines.append(f'{self.name}_sum{base} {_num(total)}')
+            lines.append(f'{self.name}_count{base} {count}')
+        return lines
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+
+class Counter:
+    def __init__(self, name, help_text, labelnames):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def collect(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            items = sorted(self._values.items())
+        lines += [f'{self.name}{_labels(self.labelnames, labels)} {_num(v)}' for labels, v in items]
+        return lines
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _labels(names, values, **extra):
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _num(value):
+    if isinstance(value, float):
+        return repr(round(value, 6))
+    return str(value)
+
+
+REQUEST_SECONDS = Histogram('cantril_request_duration_seconds', 'View wall time', ['view', 'method'])
+REQUESTS_TOTAL = Counter('cantril_requests_total', 'Requests by view and status class', ['view', 'method', 'status'])
+DB_SECONDS = Histogram('cantril_db_duration_seconds', 'Time spent in SQL per request', ['view'])
+DB_QUERIES = Histogram('cantril_db_queries', 'SQL statements per request', ['view'], QUERY_COUNT_BUCKETS)
+TEMPLATE_SECONDS = Histogram('cantril_template_render_seconds', 'Template render time per request', ['view'])
+N8N_SECONDS = Histogram('cantril_n8n_request_duration_seconds', 'Outbound n8n webhook calls', ['kind'])
+N8N_TOTAL = Counter('cantril_n8n_requests_total', 'Outbound n8n webhook calls by outcome', ['kind', 'outcome'])
+FRAGMENTS_TOTAL = Counter('cantril_fragment_cache_total', 'Panel fragment cache lookups', ['fragment', 'outcome'])
+
+REGISTRY = [REQUEST_SECONDS, REQUESTS_TOTAL, DB_SECONDS, DB_QUERIES, TEMPLATE_SECONDS, N8N_SECONDS, N8N_TOTAL,
+            FRAGMENTS_TOTAL]
+
+
+# =====================
+# Per-request timings
+# =====================
+class RequestTimings:
+    __slots__ = ('db_seconds', 'db_queries', 'template_seconds', 'n8n_seconds', 'n8n_calls')
+
+    def __init__(self):
+        self.db_seconds = 0.0
+        self.db_queries = 0
+        self.template_seconds = 0.0
+        self.n8n_seconds = 0.0
+        self.n8n_calls = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        # connection.execute_wrapper
+        t0 = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_seconds += time.perf_counter() - t0
+            self.db_queries += 1
+
+    def server_timing(self, total_seconds):
+        parts = [
+            f'app;dur={total_seconds * 1000:.1f}',
+            f'db;dur={self.db_seconds * 1000:.1f};desc="{self.db_queries} queries"',
+            f'tpl;dur={self.template_seconds * 1000:.1f}',
+        ]
+        if self.n8n_calls:
+            parts.append(f'n8n;dur={self.n8n_seconds * 1000:.1f};desc="{self.n8n_calls} calls"')
+        return ', '.join(parts)
+
+
+_current = contextvars.ContextVar('cantril_request_timings', default=None)
+
+
+def db_execute_hook(execute, sql, params, many, context):
+    """Permanent execute wrapper: times queries into the current request's timings.
+
+    The request is found through a contextvar rather than a per-request
+    execute_wrapper, so queries run by sync_to_async in async views (other
+    thread, other connection object) are counted too.
+    """
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    return timings(execute, sql, params, many, context)
+
+
+def install_db_hook(sender, connection, **kwargs):
+    # connection_created fires on every (re)connect of the same wrapper
+    if db_execute_hook not in connection.execute_wrappers:
+        connection.execute_wrappers.append(db_execute_hook)
+
+
+def start_request():
+    timings = RequestTimings()
+    return timings, _current.set(timings)
+
+
+def end_request(token):
+    _current.reset(token)
+
+
+def current_timings():
+    return _current.get()
+
+
+def observe_request(view, method, status, seconds, timings):
+    REQUEST_SECONDS.observe(seconds, view, method)
+    REQUESTS_TOTAL.inc(view, method, f'{status // 100}xx')
+    DB_SECONDS.observe(timings.db_seconds, view)
+    DB_QUERIES.observe(timings.db_queries, view)
+    TEMPLATE_SECONDS.observe(timings.template_seconds, view)
+
+
+class TimedTemplate(DjangoTemplate):
+    def render(self, context=None, request=None):
+        t0 = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            timings = _current.get()
+            if timings is not None:
+                timings.template_seconds += time.perf_counter() - t0
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """DjangoTemplates whose top-level renders are timed (includes count towards the parent)."""
+
+    def from_string(self, template_code):
+        return TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        template = super().get_template(template_name)
+        return TimedTemplate(template.template, self)
+
+
+def observe_n8n(kind, outcome, elapsed):
+    N8N_SECONDS.observe(elapsed, kind)
+    N8N_TOTAL.inc(kind, outcome)
+    timings = _current.get()
+    if timings is not None:
+        timings.n8n_seconds += elapsed
+        timings.n8n_calls += 1
+
+
+
+# =====================
+# Exposition
+# =====================
+def _gauge(name, help_text, value):
+    return [f'# HELP {name} {help_text}', f'# TYPE {name} gauge', f'{name} {_num(value)}']
+
+
+def backlog_gauges():
+    """Outbox backlog and webhook lag, read from the database at scrape time."""
+    from .models import PatientResponse
+
+    now = timezone.now()
+    pending = PatientResponse.objects.filter(is_processed=False)  # resp_unprocessed_idx
+    backlog = pending.count()
+    oldest = pending.aggregate(oldest=Min('created_at'))['oldest']
+    # cleared scores (admin "rescore") carry scored_at too
+    scored = PatientResponse.objects.filter(evaluated_score__isnull=False)
+    last_scored = scored.aggregate(last=Max('scored_at'))['last']
+    window = getattr(settings, 'METRICS_WEBHOOK_LAG_WINDOW', 900)
+    recent_lag = scored.filter(
+        scored_at__gte=now - timedelta(seconds=window),
+    ).aggregate(lag=Max(ExpressionWrapper(F('scored_at') - F('created_at'), output_field=DurationField())))['lag']
+
+    out_dir = os.path.join(settings.BASE_DIR, 'outbox')
+    try:
+        outbox_files = sum(1 for entry in os.scandir(out_dir) if entry.name.endswith('.json'))
+    except FileNotFoundError:
+        outbox_files = 0
+
+    lines = []
+    lines += _gauge('cantril_outbox_backlog_responses', 'Responses not yet scored by n8n', backlog)
+    lines += _gauge('cantril_outbox_oldest_age_seconds', 'Age of the oldest unscored response',
+                    (now - oldest).total_seconds() if oldest else 0)
+    lines += _gauge('cantril_outbox_files', 'JSON payloads in the outbox directory', outbox_files)
+    lines += _gauge('cantril_webhook_last_score_age_seconds', 'Seconds since n8n last delivered a score',
+                    (now - last_scored).total_seconds() if last_scored else -1)
+    lines += _gauge('cantril_webhook_lag_seconds',
+                    f'Max response-to-score delay over the last {window}s',
+                    recent_lag.total_seconds() if recent_lag else 0)
+    return lines
+
+
+def n8n_gauges():
+    from .n8n import CircuitBreaker, get_breaker
+
+    breaker = get_breaker()
+    return _gauge('cantril_n8n_circuit_open', 'n8n circuit breaker open (1) or not (0)',
+                  int(breaker.state == CircuitBreaker.OPEN))
+
+
+def render_prometheus():
+    lines = []
+    for metric in REGISTRY:
+        lines += metric.collect()
+    lines += backlog_gauges()
+    lines += n8n_gauges()
+    return '\n'.join(lines) + '\n'
+
+
+def reset():
+    for metric in REGISTRY:
+        metric.reset()
@@ -1,6 +1,13 @@
 """
-Middleware to allow microphone access via Permissions-Policy header.
+Middleware to allow microphone access via Permissions-Policy header,
+per-request performance instrumentation and the slow-request profiler.
 """
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from . import metrics, profiling
 
 
 class PermissionsPolicyMiddleware:
@@ -19,3 +26,69 @@ class PermissionsPolicyMiddleware:
         response['Permissions-Policy'] = 'microphone=*'
         response['Feature-Policy'] = 'microphone *'
         return response
+
+
+class InstrumentationMiddleware:
+    """
+    Per-request wall time, SQL count/time, template and n8n time.
+    Emitted as a Server-Timing header and aggregated for /metrics (see cantrilapp.metrics).
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        timings, token = metrics.start_request()
+        t0 = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.end_request(token)
+        return self.finish(request, response, timings, time.perf_counter() - t0)
+
+    async def __acall__(self, request):
+        timings, token = metrics.start_request()
+        t0 = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.end_request(token)
+        return self.finish(request, response, timings, time.perf_counter() - t0)
+
+    def finish(self, request, response, timings, elapsed):
+        match = getattr(request, 'resolver_match', None)
+        view = (match.url_name or match.view_name) if match else 'unresolved'
+        metrics.observe_request(view, request.method, response.status_code, elapsed, timings)
+        if getattr(settings, 'SERVER_TIMING_HEADER', True):
+            response['Server-Timing'] = timings.server_timing(elapsed)
+        return response
+
+
+class ProfilingMiddleware:
+    """
+    Sampling profiler for slow requests (see cantrilapp.profiling).
+    Must come after AuthenticationMiddleware: staff can force a profile with ?_profile=<token>.
+    The sampler follows request threads, so under ASGI (async chain) requests pass through unprofiled.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.get_response(request)
+        config = profiling.profiling_config()
+        forced = profiling.forced_by(request, config['token_max_age'])
+        if not (config['enabled'] or forced):
+            return self.get_response(request)
+        return profiling.profile_request(request, self.get_response, config, forced)
@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-19 17:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cantrilapp', '0003_remove_patientresponse_survey_id_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobWatermark',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('value', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='patientresponse',
+            name='scored_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='ScoreAgreement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('question_id', models.CharField(max_length=100)),
+                ('period', models.DateField()),
+                ('sample_size', models.PositiveIntegerField()),
+                ('bias', models.FloatField()),
+                ('mean_abs_diff', models.FloatField()),
+                ('correlation', models.FloatField(blank=True, null=True)),
+                ('loa_lower', models.FloatField(blank=True, null=True)),
+                ('loa_upper', models.FloatField(blank=True, null=True)),
+                ('computed_at', models.DateTimeField(auto_now=True)),
+                ('survey', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='score_agreements', to='cantrilapp.survey')),
+            ],
+            options={
+                'ordering': ['-period', 'survey', 'question_id'],
+                'indexes': [models.Index(fields=['period', 'survey', 'question_id'], name='cantrilapp__period_f32742_idx')],
+            },
+        ),
+    ]
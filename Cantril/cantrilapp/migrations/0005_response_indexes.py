@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-19 17:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cantrilapp', '0004_score_agreement'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='patientresponse',
+            index=models.Index(fields=['json_survey_id', 'question_id'], name='resp_run_question_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patientresponse',
+            index=models.Index(fields=['patient', 'survey', 'created_at', 'is_processed'], name='resp_patient_survey_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patientresponse',
+            index=models.Index(fields=['patient', 'json_survey_id', 'created_at', 'is_processed'], name='resp_patient_run_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patientresponse',
+            index=models.Index(fields=['created_at'], name='resp_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patientresponse',
+            index=models.Index(condition=models.Q(('is_processed', False)), fields=['created_at'], name='resp_unprocessed_idx'),
+        ),
+    ]
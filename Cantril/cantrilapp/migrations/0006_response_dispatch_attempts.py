@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cantrilapp', '0005_response_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='patientresponse',
+            name='dispatch_attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='patientresponse',
+            name='last_dispatch_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='patientresponse',
+            index=models.Index(condition=models.Q(('is_processed', False), ('response_type__in', ['text', 'audio'])), fields=['created_at', 'id'], name='resp_dispatch_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cantrilapp', '0006_response_dispatch_attempts'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='survey',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddField(
+            model_name='survey',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,66 @@
+from django.db import migrations, models
+from django.db.models.functions import Lower
+
+import cantrilapp.models
+
+
+def backfill_question_keys(apps, schema_editor):
+    """Existing questions keep the ids their answers were stored under (q<order>)."""
+    Question = apps.get_model('cantrilapp', 'Question')
+    questions = list(Question.objects.order_by('survey_id', 'order', 'id'))
+    seen = set()
+    for q in questions:
+        key = f'q{q.order}'
+        if (q.survey_id, key) in seen:
+            key = cantrilapp.models.question_key()
+        seen.add((q.survey_id, key))
+        q.key = key
+    Question.objects.bulk_update(questions, ['key'], batch_size=500)
+
+
+def dedupe_survey_titles(apps, schema_editor):
+    """Titles equal up to case get a ' (2)', ' (3)' ... suffix before the unique index is built."""
+    Survey = apps.get_model('cantrilapp', 'Survey')
+    taken = set()
+    renamed = []
+    for survey in Survey.objects.order_by('created_at', 'id'):
+        title, n = survey.title, 1
+        while title.lower() in taken:
+            n += 1
+            title = f'{survey.title} ({n})'
+        taken.add(title.lower())
+        if title != survey.title:
+            survey.title = title
+            renamed.append(survey)
+    Survey.objects.bulk_update(renamed, ['title'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cantrilapp', '0007_survey_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='question',
+            name='key',
+            field=models.CharField(default='', max_length=32),
+            preserve_default=False,
+        ),
+        migrations.RunPython(backfill_question_keys, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='question',
+            name='key',
+            field=models.CharField(default=cantrilapp.models.question_key, max_length=32),
+        ),
+        migrations.AddConstraint(
+            model_name='question',
+            constraint=models.UniqueConstraint(fields=('survey', 'key'), name='question_survey_key_uniq'),
+        ),
+        migrations.RunPython(dedupe_survey_titles, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='survey',
+            constraint=models.UniqueConstraint(Lower('title'), name='survey_title_ci_uniq'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:43
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cantrilapp', '0008_question_key_survey_title_ci'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='KioskRun',
+            fields=[
+                ('run_id', models.CharField(max_length=100, primary_key=True, serialize=False)),
+                ('mode', models.CharField(max_length=10)),
+                ('device', models.CharField(blank=True, max_length=64)),
+                ('answers', models.PositiveSmallIntegerField()),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('received_at', models.DateTimeField(auto_now_add=True)),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='kiosk_runs', to='cantrilapp.patient')),
+                ('survey', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='kiosk_runs', to='cantrilapp.survey')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cantrilapp', '0009_kiosk_run'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='survey',
+            name='audio_profile',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-19 18:55
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cantrilapp', '0010_survey_audio_profile'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run_id', models.CharField(max_length=100)),
+                ('responses', models.PositiveSmallIntegerField()),
+                ('processed', models.PositiveSmallIntegerField()),
+                ('scores', models.JSONField(default=dict)),
+                ('mean_scale', models.FloatField(blank=True, null=True)),
+                ('mean_score', models.FloatField(blank=True, null=True)),
+                ('first_response_at', models.DateTimeField()),
+                ('last_response_at', models.DateTimeField()),
+                ('period', models.CharField(max_length=7)),
+                ('offset', models.PositiveBigIntegerField()),
+                ('length', models.PositiveIntegerField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+                ('patient', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_runs', to='cantrilapp.patient')),
+                ('survey', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='archived_runs', to='cantrilapp.survey')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['patient', 'survey', 'last_response_at'], name='archived_patient_survey_idx'), models.Index(fields=['run_id'], name='archived_run_idx')],
+                'constraints': [models.UniqueConstraint(fields=('patient', 'run_id'), name='archived_run_uniq')],
+            },
+        ),
+    ]
@@ -1,5 +1,6 @@
 import uuid
 from django.db import models
+from django.db.models.functions import Lower
 
 
 class Patient(models.Model):
@@ -25,15 +26,35 @@ class Survey(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     title = models.CharField(max_length=255)
     ladder_design = models.CharField(max_length=20, choices=LADDER_DESIGNS, default='classic')
+    # nagrania odpowiedzi głosowych: {"bitrate": 24000, "max_seconds": 120, "trim_silence": false}
+    # (puste klucze: settings.AUDIO_PROFILE, patrz cantrilapp.audio)
+    audio_profile = models.JSONField(default=dict, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # podbijane przy każdej edycji (walidatory ETag / Last-Modified stron ankiety)
+    version = models.PositiveIntegerField(default=1)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            # tytuły unikalne bez względu na wielkość liter (indeks funkcyjny na LOWER(title))
+            models.UniqueConstraint(Lower('title'), name='survey_title_ci_uniq'),
+        ]
 
     def __str__(self):
         return self.title
 
 
+def question_key():
+    """Stable id of a new question (``id`` in the question JSON, ``PatientResponse.question_id``)."""
+    return uuid.uuid4().hex[:12]
+
+
 
 class Question(models.Model):
     survey = models.ForeignKey(Survey, on_delete=models.CASCADE, related_name='questions')
+    # stały identyfikator pytania - nie zmienia się przy edycji treści ani kolejności
+    # (pytania sprzed migracji 0008 mają q<order>, tak jak w zapisanych odpowiedziach)
+    key = models.CharField(max_length=32, default=question_key)
     text = models.TextField()
     order = models.PositiveIntegerField()
     # scale_labels: JSON in format {"min": "Bardzo słaby", "max": "Bardzo dobry"}
@@ -41,6 +62,9 @@ class Question(models.Model):
 
     class Meta:
         ordering = ['order']
+        constraints = [
+            models.UniqueConstraint(fields=['survey', 'key'], name='question_survey_key_uniq'),
+        ]
 
     def __str__(self):
         return f"{self.order}. {self.text[:50]}"
@@ -74,6 +98,122 @@ class PatientResponse(models.Model):
     transcript = models.TextField(blank=True)
     evaluated_score = models.FloatField(null=True, blank=True)
     is_processed = models.BooleanField(default=False)
+    # ostatnia zmiana oceny: zapis z webhooka n8n albo jej wyczyszczenie (znacznik dla zadań przyrostowych)
+    scored_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    # wysyłki do n8n (widok + reconcile_responses)
+    dispatch_attempts = models.PositiveSmallIntegerField(default=0)
+    last_dispatch_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # webhook n8n: lookup by (run id, question id)
+            models.Index(fields=['json_survey_id', 'question_id'], name='resp_run_question_idx'),
+            # select-survey / patient history / completions; covering for the panel aggregates
+            models.Index(fields=['patient', 'survey', 'created_at', 'is_processed'], name='resp_patient_survey_idx'),
+            # voice flow finalisation and panel_history grouping by run
+            models.Index(fields=['patient', 'json_survey_id', 'created_at', 'is_processed'], name='resp_patient_run_idx'),
+            # panel_results / exports ordered by time, date range filters
+            models.Index(fields=['created_at'], name='resp_created_idx'),
+            # dispatch backlog: only not-yet-scored rows are indexed
+            models.Index(fields=['created_at'], condition=models.Q(is_processed=False), name='resp_unprocessed_idx'),
+            # reconcile_responses: text/audio answers n8n has not accepted yet
+            models.Index(fields=['created_at', 'id'], condition=models.Q(is_processed=False, response_type__in=['text', 'audio']),
+                         name='resp_dispatch_idx'),
+        ]
 
     def __str__(self):
         return f"{self.patient.pesel} | {self.json_survey_id or self.survey.title if self.survey else 'N/A'} | {self.question_id}"
+
+
+class JobWatermark(models.Model):
+    """Last successful run of an incremental batch job (keyed by job name)."""
+    name = models.CharField(max_length=100, unique=True)
+    value = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.name} @ {self.value}"
+
+
+class ScoreAgreement(models.Model):
+    """Self-reported scale_value vs n8n evaluated_score for one survey/question/month.
+
+    Rows are produced by the ``compute_score_agreement`` command and read by the panel.
+    """
+    survey = models.ForeignKey(Survey, on_delete=models.CASCADE, related_name='score_agreements', null=True, blank=True)
+    question_id = models.CharField(max_length=100)
+    period = models.DateField()  # pierwszy dzień miesiąca
+
+    sample_size = models.PositiveIntegerField()
+    bias = models.FloatField()  # średnia (evaluated_score - scale_value)
+    mean_abs_diff = models.FloatField()
+    correlation = models.FloatField(null=True, blank=True)
+    loa_lower = models.FloatField(null=True, blank=True)  # Bland–Altman: bias - 1.96 SD
+    loa_upper = models.FloatField(null=True, blank=True)  # Bland–Altman: bias + 1.96 SD
+    computed_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-period', 'survey', 'question_id']
+        indexes = [
+            models.Index(fields=['period', 'survey', 'question_id']),
+        ]
+
+    def __str__(self):
+        return f"{self.period:%Y-%m} | {self.survey_id} | {self.question_id} (n={self.sample_size})"
+
+
+class KioskRun(models.Model):
+    """A run recorded offline on a kiosk tablet and uploaded to /kiosk/sync/.
+
+    ``run_id`` is generated on the device and equals ``PatientResponse.json_survey_id``
+    of the run's answers; as the primary key it makes a re-sent upload a no-op.
+    """
+    run_id = models.CharField(max_length=100, primary_key=True)
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='kiosk_runs')
+    survey = models.ForeignKey(Survey, on_delete=models.SET_NULL, related_name='kiosk_runs', null=True, blank=True)
+    mode = models.CharField(max_length=10)  # cantril | voice
+    device = models.CharField(max_length=64, blank=True)
+    answers = models.PositiveSmallIntegerField()
+    # zegar tabletu (może się różnić od serwera)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    received_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.run_id} ({self.answers} odpowiedzi)"
+
+
+class ArchivedRun(models.Model):
+    """Summary of a run moved to the cold archive by ``manage.py archive_responses``.
+
+    The answers themselves are one gzip member of ``responses-<period>.ndjson.gz``
+    (``offset``/``length`` bytes), read back by ``cantrilapp.archive.read_runs``.
+    """
+    patient = models.ForeignKey(Patient, on_delete=models.CASCADE, related_name='archived_runs')
+    survey = models.ForeignKey(Survey, on_delete=models.SET_NULL, related_name='archived_runs', null=True, blank=True)
+    run_id = models.CharField(max_length=100)  # PatientResponse.json_survey_id
+    responses = models.PositiveSmallIntegerField()
+    processed = models.PositiveSmallIntegerField()
+    # question_id -> [scale_value, evaluated_score]
+    scores = models.JSONField(default=dict)
+    mean_scale = models.FloatField(null=True, blank=True)
+    mean_score = models.FloatField(null=True, blank=True)
+    first_response_at = models.DateTimeField()
+    last_response_at = models.DateTimeField()
+
+    period = models.CharField(max_length=7)  # YYYY-MM (plik archiwum)
+    offset = models.PositiveBigIntegerField()
+    length = models.PositiveIntegerField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['patient', 'run_id'], name='archived_run_uniq'),
+        ]
+        indexes = [
+            # patient history / completions (same shape as resp_patient_survey_idx)
+            models.Index(fields=['patient', 'survey', 'last_response_at'], name='archived_patient_survey_idx'),
+            models.Index(fields=['run_id'], name='archived_run_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.run_id} ({self.period}, {self.responses} odp.)"
@@ -0,0 +1,311 @@
+"""
+Client for the n8n scoring webhook - every outbound n8n call goes through here.
+
+``post`` (sync views) uses one shared ``requests.Session`` whose ``HTTPAdapter``
+pool keeps TCP/TLS connections alive; ``apost`` (async views) uses one pooled
+``httpx.AsyncClient`` per event loop plus a semaphore capping in-flight calls.
+Endpoint, timeouts and pool sizes come from ``settings.N8N``.
+
+Both paths share one ``CircuitBreaker``: after ``failure_threshold`` consecutive
+failures (connection errors, timeouts, 5xx) calls fail fast with
+``N8nUnavailable`` for ``reset_timeout`` seconds, then one trial call decides
+whether n8n is back (a trial that ends without a verdict - cancelled, or
+stuck for longer than ``reset_timeout`` - makes room for the next one).
+Latency and outcomes go to the ``cantril_n8n_*`` metrics
+and the request's Server-Timing.
+"""
+import asyncio
+import os
+import threading
+import time
+import weakref
+
+import httpx
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.files.storage import default_storage
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+
+DEFAULT_N8N = {
+    'webhook_url': 'http://localhost:5678/webhook/198c3dbf-28a7-4fbd-a770-483b2ce47bdc',
+    'connect_timeout': 3.05,
+    'read_timeout': 10.0,
+    # requests: connection pools per host / connections kept per pool
+    'pool_connections': 4,
+    'pool_maxsize': 20,
+    # httpx (async views)
+    'async_max_connections': 50,
+    'async_max_keepalive_connections': 20,
+    'keepalive_expiry': 30.0,
+    'max_in_flight': 200,
+    # circuit breaker
+    'failure_threshold': 5,
+    'reset_timeout': 30.0,
+}
+
+# audio read from storage per step of an async upload
+AUDIO_CHUNK_BYTES = 64 * 1024
+
+# extension -> MIME type sent with audio uploads
+AUDIO_MIME_TYPES = {
+    '.webm': 'audio/webm',
+    '.ogg': 'audio/ogg',
+    '.opus': 'audio/ogg',
+    '.mp3': 'audio/mpeg',
+    '.wav': 'audio/wav',
+    '.m4a': 'audio/mp4',
+}
+
+
+def n8n_config():
+    config = dict(DEFAULT_N8N)
+    config.update(getattr(settings, 'N8N', {}))
+    return config
+
+
+def mime_type(name):
+    return AUDIO_MIME_TYPES.get(os.path.splitext(name)[1].lower(), 'application/octet-stream')
+
+
+class N8nUnavailable(Exception):
+    """The circuit is open: n8n failed repeatedly and is not being called."""
+
+
+# =====================
+# Circuit breaker
+# =====================
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """True if a call may go out; in half-open state only one trial call is let through."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            now = time.monotonic()
+            since = self.opened_at if self.state == self.OPEN else self.trial_at
+            if now - since >= self.reset_timeout:
+                # open long enough, or a trial that never reported back: (another) trial
+                self.state = self.HALF_OPEN
+                self.trial_at = now
+                return True
+            return False
+
+    def release(self):
+        """A call ended without a verdict on n8n (e.g. cancelled): a waiting trial slot is freed."""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+# =====================
+# Shared clients
+# =====================
+_lock = threading.Lock()
+_breakers = {}
+_sessions = {}
+# event loop -> (AsyncClient, Semaphore); a client must not outlive or cross its loop
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_breaker(config=None):
+    config = config or n8n_config()
+    key = (config['failure_threshold'], config['reset_timeout'])
+    breaker = _breakers.get(key)
+    if breaker is None:
+        with _lock:
+            breaker = _breakers.setdefault(key, CircuitBreaker(*key))
+    return breaker
+
+
+def get_session(config=None):
+    config = config or n8n_config()
+    key = (config['pool_connections'], config['pool_maxsize'])
+    session = _sessions.get(key)
+    if session is None:
+        with _lock:
+            session = _sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=key[0], pool_maxsize=key[1], max_retries=0)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _sessions[key] = session
+    return session
+
+
+def _async_client(config):
+    loop = asyncio.get_running_loop()
+    entry = _async_clients.get(loop)
+    if entry is None:
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=config['async_max_connections'],
+                max_keepalive_connections=config['async_max_keepalive_connections'],
+                keepalive_expiry=config['keepalive_expiry'],
+            ),
+            timeout=httpx.Timeout(config['read_timeout'], connect=config['connect_timeout']),
+        )
+        entry = _async_clients[loop] = (client, asyncio.Semaphore(config['max_in_flight']))
+    return entry
+
+
+def _outcome(breaker, status_code):
+    if status_code >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+    return f'{status_code // 100}xx'
+
+
+# =====================
+# Calls
+# =====================
+def post(kind, url=None, **kwargs):
+    """POST to the n8n webhook on the shared session; raises N8nUnavailable while the circuit is open."""
+    config = n8n_config()
+    breaker = get_breaker(config)
+    if not breaker.allow():
+        metrics.N8N_TOTAL.inc(kind, 'short_circuit')
+        raise N8nUnavailable(f'n8n circuit open after {breaker.failures} failures')
+    kwargs.setdefault('timeout', (config['connect_timeout'], config['read_timeout']))
+    t0 = time.perf_counter()
+    outcome = 'error'
+    settled = False
+    try:
+        resp = get_session(config).post(url or config['webhook_url'], **kwargs)
+        outcome = _outcome(breaker, resp.status_code)
+        settled = True
+        return resp
+    except Exception:
+        breaker.record_failure()
+        settled = True
+        raise
+    finally:
+        if not settled:
+            breaker.release()
+        metrics.observe_n8n(kind, outcome, time.perf_counter() - t0)
+
+
+async def apost(kind, url=None, **kwargs):
+    """post() on the loop's pooled httpx client; an async ``content`` body is streamed as it is produced."""
+    config = n8n_config()
+    breaker = get_breaker(config)
+    if not breaker.allow():
+        metrics.N8N_TOTAL.inc(kind, 'short_circuit')
+        raise N8nUnavailable(f'n8n circuit open after {breaker.failures} failures')
+    client, slots = _async_client(config)
+    settled = False
+    try:
+        async with slots:
+            t0 = time.perf_counter()
+            outcome = 'error'
+            try:
+                resp = await client.post(url or config['webhook_url'], **kwargs)
+                outcome = _outcome(breaker, resp.status_code)
+                settled = True
+                return resp
+            except Exception:
+                breaker.record_failure()
+                settled = True
+                raise
+            finally:
+                metrics.observe_n8n(kind, outcome, time.perf_counter() - t0)
+    finally:
+        # CancelledError (client went away, or while waiting for a slot) says nothing about n8n
+        if not settled:
+            breaker.release()
+
+
+# =====================
+# Answers
+# =====================
+def answer_fields(pr):
+    """Form fields n8n gets with every answer (PatientResponse)."""
+    return {
+        'question': pr.question_text or '',
+        'patientID': str(pr.patient_id),
+        'surveyID': pr.json_survey_id,
+        'questionID': pr.question_id,
+    }
+
+
+def send_answer(pr):
+    """Send a text answer as JSON, an audio answer as multipart streamed from storage."""
+    if pr.response_type == 'text':
+        return post('text', json=dict(answer_fields(pr), text=pr.text_answer))
+    name = pr.audio_file.name
+    with default_storage.open(name, 'rb') as f:
+        return post('audio', data=answer_fields(pr), files={'audio': (os.path.basename(name), f, mime_type(name))})
+
+
+def _multipart_parts(boundary, fields, filename, content_type):
+    """Bytes around the audio in a multipart/form-data body: form fields plus the file part header, and the end."""
+    filename = filename.replace('\\', '\\\\').replace('"', '%22')
+    head = ''.join(
+        f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n{value}\r\n'
+        for key, value in fields.items()
+    ) + (
+        f'--{boundary}\r\nContent-Disposition: form-data; name="audio"; filename="{filename}"\r\n'
+        f'Content-Type: {content_type}\r\n\r\n'
+    )
+    return head.encode(), f'\r\n--{boundary}--\r\n'.encode()
+
+
+async def _afile_body(f, head, tail):
+    # httpx reads files= synchronously on the loop; here every read (local disk or
+    # remote storage) runs in a worker thread
+    yield head
+    while chunk := await sync_to_async(f.read)(AUDIO_CHUNK_BYTES):
+        yield chunk
+    yield tail
+
+
+async def asend_answer(pr):
+    """send_answer() for async views; the audio is read from storage off the event loop."""
+    if pr.response_type == 'text':
+        return await apost('text', json=dict(answer_fields(pr), text=pr.text_answer))
+    name = pr.audio_file.name
+    size = await sync_to_async(default_storage.size)(name)
+    boundary = os.urandom(16).hex()
+    head, tail = _multipart_parts(boundary, answer_fields(pr), os.path.basename(name), mime_type(name))
+    f = await sync_to_async(default_storage.open)(name, 'rb')
+    try:
+        return await apost('audio', content=_afile_body(f, head, tail), headers={
+            'Content-Type': f'multipart/form-data; boundary={boundary}',
+            'Content-Length': str(len(head) + size + len(tail)),
+        })
+    finally:
+        f.close()
+
+
+async def aclose():
+    """Close the current loop's client (ASGI lifespan shutdown / tests)."""
+    entry = _async_clients.pop(asyncio.get_running_loop(), None)
+    if entry is not None:
+        await entry[0].aclose()
+
@@ -0,0 +1,186 @@
+"""
+Bulk patient import (``manage.py import_patients`` and the upload on /panel/patients/).
+
+The CSV (``pesel`` plus optional ``first_name``, ``last_name``, ``date_of_birth``)
+is read as a stream and handled ``batch_size`` rows at a time:
+
+* PESELs of a batch are validated together with numpy - 11 digits, checksum
+  and the birth date encoded in the first six digits (century from the month
+  offset). The patient's ``date_of_birth`` is taken from the PESEL; a
+  ``date_of_birth`` column that disagrees with it rejects the row.
+* PESELs already in the database are loaded into a set once, so inserts are
+  told from updates, and repeats within the file are caught, without a query
+  per row.
+* Valid rows of a batch go to the database in one
+  ``bulk_create(update_conflicts=True)`` (INSERT .. ON CONFLICT (pesel) DO
+  UPDATE) in its own transaction. Only the columns present in the file are
+  updated on existing patients; ``created_at`` is never touched.
+
+Rejected rows are written to an error report (CSV: line, pesel, error, then
+the original columns).
+"""
+import csv
+from datetime import date
+
+import numpy as np
+from django.db import transaction
+
+from . import fragments
+from .models import Patient
+
+PESEL_WEIGHTS = np.array([1, 3, 7, 9, 1, 3, 7, 9, 1, 3])
+# month offset / 20 -> century (1800-1899: +80, 1900: +0, 2000: +20, 2100: +40, 2200: +60)
+PESEL_CENTURIES = np.array([1900, 2000, 2100, 2200, 1800])
+
+NAME_COLUMNS = ('first_name', 'last_name')
+DEFAULT_BATCH_SIZE = 2000
+REPORT_HEADER = ['line', 'pesel', 'error']
+
+
+def validate_pesels(pesels, today=None):
+    """Birth dates and errors for a batch of PESEL strings.
+
+    Returns ``(birth_dates, errors)``: a ``datetime64[D]`` array and a list with
+    an error message (or None) per PESEL.
+    """
+    if not pesels:
+        return np.array([], dtype='datetime64[D]'), []
+    today = np.datetime64(today or date.today(), 'D')
+    well_formed = np.array([len(p) == 11 and p.isascii() and p.isdigit() for p in pesels])
+    raw = ''.join(p if ok else '0' * 11 for p, ok in zip(pesels, well_formed))
+    digits = (np.frombuffer(raw.encode('ascii'), dtype=np.uint8).reshape(-1, 11) - ord('0')).astype(np.int64)
+
+    checksum_ok = (10 - digits[:, :10] @ PESEL_WEIGHTS % 10) % 10 == digits[:, 10]
+    yy = digits[:, 0] * 10 + digits[:, 1]
+    mm = digits[:, 2] * 10 + digits[:, 3]
+    dd = digits[:, 4] * 10 + digits[:, 5]
+    month = mm % 20
+    year = PESEL_CENTURIES[mm // 20] + yy
+    month_ok = (month >= 1) & (month <= 12)
+    first_day = ((year - 1970) * 12 + np.where(month_ok, month, 1) - 1).astype('datetime64[M]')
+    days_in_month = ((first_day + 1).astype('datetime64[D]') - first_day.astype('datetime64[D]')).astype(np.int64)
+    date_ok = month_ok & (dd >= 1) & (dd <= days_in_month)
+    birth_dates = first_day.astype('datetime64[D]') + np.where(date_ok, dd - 1, 0)
+
+    errors = [None] * len(pesels)
+    checks = (
+        (~well_formed, 'PESEL musi mieć dokładnie 11 cyfr'),
+        (~checksum_ok, 'Błędna suma kontrolna PESEL'),
+        (~date_ok, 'Błędna data urodzenia w PESEL'),
+        (birth_dates > today, 'Data urodzenia z PESEL jest w przyszłości'),
+    )
+    for failed, message in checks:
+        for i in np.flatnonzero(failed):
+            errors[i] = errors[i] or message
+    return birth_dates, errors
+
+
+def birth_date(pesel):
+    """Birth date encoded in a valid PESEL, else None."""
+    dates, errors = validate_pesels([pesel])
+    return None if errors[0] else dates[0].item()
+
+
+def pesel_prefix(prefix, lookup='pesel'):
+    """Filter kwargs for a PESEL prefix as an index range (pesel >= '8501' AND pesel < '8502').
+
+    ``__startswith`` compiles to LIKE .. ESCAPE, which SQLite cannot serve from
+    the unique index.
+    """
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)  # '9' -> ':' sorts right after the digits
+    return {f'{lookup}__gte': prefix, f'{lookup}__lt': upper}
+
+
+def existing_pesels():
+    return set(Patient.objects.values_list('pesel', flat=True).iterator(chunk_size=10000))
+
+
+def read_rows(lines, delimiter=None):
+    """(header, DictReader) over text lines; the delimiter is ';' or ',' from the header when not given."""
+    lines = iter(lines)
+    header_line = next(lines, '')
+    if delimiter is None:
+        delimiter = ';' if header_line.count(';') > header_line.count(',') else ','
+    header = [h.strip().lower() for h in next(csv.reader([header_line], delimiter=delimiter), [])]
+    return header, csv.DictReader(lines, fieldnames=header, delimiter=delimiter)
+
+
+class PatientImport:
+    """Streaming import; ``run(lines)`` returns counts of rows, created, updated and errors."""
+
+    def __init__(self, batch_size=DEFAULT_BATCH_SIZE, report=None, dry_run=False, delimiter=None):
+        self.batch_size = batch_size
+        self.report = report  # text file for the error report, or None
+        self.dry_run = dry_run
+        self.delimiter = delimiter
+        self.stats = {'rows': 0, 'created': 0, 'updated': 0, 'errors': 0}
+        self.errors = []  # first few, for the panel
+        self._report_writer = None
+
+    def run(self, lines):
+        header, reader = read_rows(lines, self.delimiter)
+        if 'pesel' not in header:
+            raise ValueError('Brak kolumny "pesel" w nagłówku CSV.')
+        self.header = header
+        # names absent from the file are left as they are on existing patients
+        self.update_fields = [c for c in NAME_COLUMNS if c in header] + ['date_of_birth']
+        self.existing = existing_pesels()
+        self.seen = {}
+
+        batch = []
+        for row in reader:
+            # the header was read before the reader: file line = reader line + 1
+            batch.append((reader.line_num + 1, row))
+            if len(batch) >= self.batch_size:
+                self._import_batch(batch)
+                batch = []
+        if batch:
+            self._import_batch(batch)
+        return self.stats
+
+    def _import_batch(self, batch):
+        self.stats['rows'] += len(batch)
+        pesels = [(row.get('pesel') or '').strip() for _, row in batch]
+        birth_dates, errors = validate_pesels(pesels)
+
+        patients = []
+        for (line, row), pesel, born, error in zip(batch, pesels, birth_dates, errors):
+            born = born.item()
+            if error is None and (row.get('date_of_birth') or '').strip():
+                if row['date_of_birth'].strip() != born.isoformat():
+                    error = f'date_of_birth niezgodna z PESEL ({born.isoformat()})'
+            if error is None and pesel in self.seen:
+                error = f'Duplikat PESEL w pliku (wiersz {self.seen[pesel]})'
+            if error is not None:
+                self._reject(line, pesel, error, row)
+                continue
+            self.seen[pesel] = line
+            patients.append(Patient(
+                pesel=pesel,
+                first_name=(row.get('first_name') or '').strip()[:50],
+                last_name=(row.get('last_name') or '').strip()[:50],
+                date_of_birth=born,
+            ))
+
+        updated = [p.pesel for p in patients if p.pesel in self.existing]
+        self.stats['updated'] += len(updated)
+        self.stats['created'] += len(patients) - len(updated)
+        if self.dry_run or not patients:
+            return
+        with transaction.atomic():
+            Patient.objects.bulk_create(
+                patients, update_conflicts=True, unique_fields=['pesel'], update_fields=self.update_fields,
+            )
+            # pks come back on backends with RETURNING; without them only the history pages are refreshed
+            fragments.invalidate(patients=[p.pk for p in patients if p.pesel in self.existing])
+        self.existing.update(p.pesel for p in patients)
+
+    def _reject(self, line, pesel, error, row):
+        self.stats['errors'] += 1
+        if len(self.errors) < 50:
+            self.errors.append({'line': line, 'pesel': pesel, 'error': error})
+        if self.report is not None:
+            if self._report_writer is None:
+                self._report_writer = csv.writer(self.report)
+                self._report_writer.writerow(REPORT_HEADER + self.header)
+            self._report_writer.writerow([line, pesel, error] + [row.get(c) or '' for c in self.header])
@@ -0,0 +1,332 @@
+"""
+Opt-in profiler for slow requests.
+
+With ``settings.PROFILING['enabled']`` every request thread is registered with
+one background ``StackSampler`` that reads ``sys._current_frames()`` every
+``interval_ms``; when the request ends the samples are dropped, unless it took
+longer than ``threshold_ms`` - then its collapsed stacks are written to the
+on-disk store (``ProfileStore``, one JSON file per request, oldest files removed
+beyond ``max_files``).
+
+Staff can force a profile of a single request by adding ``?_profile=<token>``
+(``profile_token(user)``, signed, expires after ``token_max_age``): that request
+is sampled, additionally run under cProfile and stored regardless of the
+threshold.
+
+Cost: disabled = a substring check on the query string. Enabled = one sampler
+thread (idle while no request is active) with work bounded by ``max_active`` x
+``max_depth`` per tick, and at most ``max_writes_per_minute`` files written.
+"""
+import cProfile
+import io
+import json
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core import signing
+
+QUERY_PARAM = '_profile'
+TOKEN_SALT = 'cantrilapp.profiling'
+
+DEFAULT_PROFILING = {
+    'enabled': False,
+    'threshold_ms': 500,
+    'interval_ms': 10,
+    'forced_interval_ms': 1,
+    'max_depth': 80,
+    'max_active': 32,
+    'max_files': 500,
+    'max_writes_per_minute': 30,
+    'token_max_age': 3600,
+    'store_dir': None,  # default: BASE_DIR / 'profiles'
+}
+
+
+def profiling_config():
+    config = dict(DEFAULT_PROFILING)
+    config.update(getattr(settings, 'PROFILING', {}))
+    if not config['store_dir']:
+        config['store_dir'] = os.path.join(settings.BASE_DIR, 'profiles')
+    return config
+
+
+# =====================
+# Signed per-request opt-in
+# =====================
+def profile_token(user):
+    return signing.dumps({'u': user.pk}, salt=TOKEN_SALT, compress=True)
+
+
+def forced_by(request, max_age):
+    """True when the request carries a valid token for the logged-in staff user."""
+    if f'{QUERY_PARAM}=' not in request.META.get('QUERY_STRING', ''):
+        return False
+    user = getattr(request, 'user', None)
+    if user is None or not user.is_authenticated or not user.is_staff:
+        return False
+    try:
+        data = signing.loads(request.GET.get(QUERY_PARAM, ''), salt=TOKEN_SALT, max_age=max_age)
+    except signing.BadSignature:
+        return False
+    return data.get('u') == user.pk
+
+
+# =====================
+# Sampler
+# =====================
+def _frame_label(code):
+    filename = code.co_filename
+    # keep the interesting tail of the path (package/module.py)
+    parts = filename.replace('\\', '/').rsplit('/', 2)
+    return f"{'/'.join(parts[-2:])}:{code.co_name}"
+
+
+class StackSampler:
+    """One daemon thread sampling the stacks of registered request threads."""
+
+    def __init__(self, interval, max_depth, max_active):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.max_active = max_active
+        self._active = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def register(self, thread_id, interval=None):
+        """Start sampling a thread; returns its Counter of collapsed stacks (or None if at capacity)."""
+        with self._lock:
+            if len(self._active) >= self.max_active:
+                return None
+            samples = Counter()
+            self._active[thread_id] = (samples, interval or self.interval, [0.0])
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='cantril-profiler', daemon=True)
+                self._thread.start()
+        self._wake.set()
+        return samples
+
+    def unregister(self, thread_id):
+        with self._lock:
+            self._active.pop(thread_id, None)
+
+    def _sample(self, now):
+        frames = sys._current_frames()
+        with self._lock:
+            active = list(self._active.items())
+        next_due = None
+        for thread_id, (samples, interval, last) in active:
+            if now - last[0] < interval:
+                due = last[0] + interval
+                next_due = due if next_due is None else min(next_due, due)
+                continue
+            last[0] = now
+            frame = frames.get(thread_id)
+            stack = []
+            while frame is not None and len(stack) < self.max_depth:
+                stack.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                samples[';'.join(reversed(stack))] += 1
+            due = now + interval
+            next_due = due if next_due is None else min(next_due, due)
+        return next_due
+
+    def _run(self):
+        while True:
+            with self._lock:
+                idle = not self._active
+            if idle:
+                self._wake.clear()
+                self._wake.wait()
+                continue
+            now = time.perf_counter()
+            next_due = self._sample(now)
+            time.sleep(max(0.0005, (next_due or now + self.interval) - time.perf_counter()))
+
+
+# =====================
+# Store
+# =====================
+class ProfileStore:
+    """One JSON file per profiled request; the oldest files go beyond max_files."""
+
+    def __init__(self, directory, max_files, max_writes_per_minute):
+        self.directory = directory
+        self.max_files = max_files
+        self.max_writes = max_writes_per_minute
+        self._lock = threading.Lock()
+        self._window = (0, 0)  # (minute, writes)
+
+    def _allow_write(self):
+        minute = int(time.time() // 60)
+        with self._lock:
+            current, writes = self._window
+            if current != minute:
+                current, writes = minute, 0
+            if writes >= self.max_writes:
+                return False
+            self._window = (current, writes + 1)
+            return True
+
+    def save(self, record, force=False):
+        if not force and not self._allow_write():
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        stamp = datetime.now(dt_timezone.utc).strftime('%Y%m%dT%H%M%S%f')
+        view = re.sub(r'[^\w-]', '_', record['view'])
+        name = f"{stamp}_{view}_{int(record['duration_ms'])}ms.json"
+        path = os.path.join(self.directory, name)
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(record, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        self._rotate()
+        return path
+
+    def _rotate(self):
+        files = sorted(e.name for e in os.scandir(self.directory) if e.name.endswith('.json'))
+        for old in files[:max(0, len(files) - self.max_files)]:
+            try:
+                os.remove(os.path.join(self.directory, old))
+            except FileNotFoundError:
+                pass
+
+    def records(self):
+        if not os.path.isdir(self.directory):
+            return []
+        out = []
+        for name in sorted(os.listdir(self.directory), reverse=True):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), encoding='utf-8') as f:
+                    record = json.load(f)
+            except (OSError, ValueError):
+                continue
+            record['file'] = name
+            out.append(record)
+        return out
+
+    def load(self, name):
+        if os.path.basename(name) != name or not name.endswith('.json'):
+            return None
+        try:
+            with open(os.path.join(self.directory, name), encoding='utf-8') as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        record['file'] = name
+        return record
+
+
+def endpoint_summary(records):
+    """Per-view count, p50/max duration and merged collapsed stacks, slowest first."""
+    by_view = {}
+    for r in records:
+        by_view.setdefault(r['view'], []).append(r)
+    rows = []
+    for view, items in by_view.items():
+        durations = sorted(r['duration_ms'] for r in items)
+        stacks = Counter()
+        for r in items:
+            stacks.update(r.get('stacks', {}))
+        rows.append({
+            'view': view,
+            'count': len(items),
+            'p50_ms': durations[len(durations) // 2],
+            'max_ms': durations[-1],
+            'last_seen': max(r['started_at'] for r in items),
+            'samples': sum(stacks.values()),
+            'stacks': stacks,
+            'records': items,
+        })
+    rows.sort(key=lambda row: row['max_ms'], reverse=True)
+    return rows
+
+
+def collapsed(stacks):
+    """Brendan Gregg's collapsed format (flamegraph.pl, speedscope)."""
+    return ''.join(f'{stack} {count}\n' for stack, count in sorted(stacks.items()))
+
+
+def top_frames(stacks, limit=25):
+    """Leaf frames by self samples, with their share of all samples."""
+    total = sum(stacks.values()) or 1
+    leaves = Counter()
+    for stack, count in stacks.items():
+        leaves[stack.rsplit(';', 1)[-1]] += count
+    return [(frame, count, 100.0 * count / total) for frame, count in leaves.most_common(limit)]
+
+
+# =====================
+# Request profiling
+# =====================
+_components_cache = {}
+_setup_lock = threading.Lock()
+# cProfile hooks are process-wide: one forced profile at a time, others are only sampled
+_cprofile_lock = threading.Lock()
+
+
+def _components(config):
+    key = tuple(config[k] for k in ('store_dir', 'max_files', 'max_writes_per_minute',
+                                    'interval_ms', 'max_depth', 'max_active'))
+    components = _components_cache.get(key)
+    if components is None:
+        with _setup_lock:
+            components = _components_cache.get(key)
+            if components is None:
+                components = _components_cache[key] = (
+                    StackSampler(config['interval_ms'] / 1000.0, config['max_depth'], config['max_active']),
+                    ProfileStore(config['store_dir'], config['max_files'], config['max_writes_per_minute']),
+                )
+    return components
+
+
+def get_store():
+    return _components(profiling_config())[1]
+
+
+def profile_request(request, get_response, config, forced):
+    sampler, store = _components(config)
+    thread_id = threading.get_ident()
+    samples = sampler.register(thread_id, config['forced_interval_ms'] / 1000.0 if forced else None)
+    profiler = cProfile.Profile() if forced and _cprofile_lock.acquire(blocking=False) else None
+    started_at = datetime.now(dt_timezone.utc)
+    t0 = time.perf_counter()
+    try:
+        if profiler is not None:
+            response = profiler.runcall(get_response, request)
+        else:
+            response = get_response(request)
+    finally:
+        sampler.unregister(thread_id)
+        if profiler is not None:
+            _cprofile_lock.release()
+    duration_ms = (time.perf_counter() - t0) * 1000
+
+    if forced or duration_ms >= config['threshold_ms']:
+        match = getattr(request, 'resolver_match', None)
+        record = {
+            'view': (match.url_name or match.view_name) if match else 'unresolved',
+            'path': request.path,
+            'method': request.method,
+            'status': response.status_code,
+            'duration_ms': round(duration_ms, 1),
+            'started_at': started_at.isoformat(),
+            'forced': forced,
+            'stacks': dict(samples or {}),
+        }
+        if profiler is not None:
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(40)
+            record['cprofile'] = out.getvalue()
+        store.save(record, force=forced)
+    return response
@@ -0,0 +1,159 @@
+"""
+Re-dispatch of text/audio answers n8n never accepted (``manage.py reconcile_responses``).
+
+The voice flow sends every answer to n8n once; when that call fails the row
+stays ``is_processed=False``. The sweeper reads the backlog oldest first from
+the partial index ``resp_dispatch_idx`` (only unaccepted text/audio rows), keeps
+answers of one run together, sends them at a bounded rate and records
+``dispatch_attempts`` / ``last_dispatch_at`` per row. Rows are retried at most
+every ``retry_after`` and given up after ``max_attempts``; an open n8n circuit
+breaker stops the sweep.
+"""
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.db.models import BooleanField, F, Q
+from django.db.models.expressions import RawSQL
+from django.utils import timezone
+
+from . import fragments, n8n
+from .models import PatientResponse
+
+DISPATCHED_TYPES = ('text', 'audio')  # scale answers are never sent to n8n
+
+# SQLite only uses a partial index when the WHERE clause implies its condition at
+# prepare time; response_type__in would bind the types as parameters, so the
+# resp_dispatch_idx predicate is spelled out with literals instead.
+_DISPATCHED = RawSQL(
+    '"{}"."response_type" IN ({})'.format(
+        PatientResponse._meta.db_table, ', '.join(f"'{t}'" for t in DISPATCHED_TYPES),
+    ),
+    [],
+    output_field=BooleanField(),
+)
+
+
+def dispatch_backlog():
+    return PatientResponse.objects.filter(_DISPATCHED, is_processed=False)
+
+
+def stale_responses(now, older_than, retry_after, max_attempts):
+    return dispatch_backlog().filter(
+        created_at__lt=now - older_than,
+        dispatch_attempts__lt=max_attempts,
+    ).filter(Q(last_dispatch_at__isnull=True) | Q(last_dispatch_at__lt=now - retry_after))
+
+
+def backlog_ages(queryset, now, percentiles=(50, 90, 99)):
+    """Count and age percentiles (seconds) of a backlog.
+
+    Each percentile is one ``ORDER BY created_at LIMIT 1 OFFSET k`` on the
+    index, so large backlogs are not loaded into memory.
+    """
+    count = queryset.count()
+    ages = {'count': count}
+    if not count:
+        return ages
+    ordered = queryset.order_by('created_at').values_list('created_at', flat=True)
+    for p in (*percentiles, 100):
+        # oldest first: the p-th percentile age is (100 - p)% into the list
+        created = ordered[int((100 - p) / 100 * (count - 1))]
+        ages['max' if p == 100 else f'p{p}'] = (now - created).total_seconds()
+    return ages
+
+
+def group_by_run(responses):
+    """Answers of one run together, in question order; runs by their oldest answer."""
+    runs = OrderedDict()
+    for pr in responses:
+        runs.setdefault(pr.json_survey_id, []).append(pr)
+    for answers in runs.values():
+        answers.sort(key=lambda pr: (pr.created_at, pr.question_id))
+    return runs
+
+
+class Sweeper:
+    def __init__(self, older_than=timedelta(minutes=10), retry_after=timedelta(minutes=15), max_attempts=10,
+                 batch_size=50, rate=5.0, limit=None, log=None):
+        self.older_than = older_than
+        self.retry_after = retry_after
+        self.max_attempts = max_attempts
+        self.batch_size = batch_size
+        self.rate = rate
+        self.limit = limit
+        self.log = log or (lambda msg: None)
+        self.stats = {'dispatched': 0, 'accepted': 0, 'failed': 0, 'runs': 0, 'stopped': None}
+        self._next_send = 0.0
+        self._runs = set()
+
+    def _throttle(self):
+        if not self.rate:
+            return
+        now = time.monotonic()
+        if now < self._next_send:
+            time.sleep(self._next_send - now)
+        self._next_send = max(now, self._next_send) + 1.0 / self.rate
+
+    def _send(self, pr):
+        try:
+            resp = n8n.send_answer(pr)
+        except n8n.N8nUnavailable:
+            raise
+        except Exception as e:
+            self.log(f'  {pr.id}: {type(e).__name__}: {e}')
+            return False
+        if 200 <= resp.status_code < 300:
+            return True
+        self.log(f'  {pr.id}: n8n returned {resp.status_code}')
+        return False
+
+    def run(self):
+        started = timezone.now()
+        last = None
+        while self.limit is None or self.stats['dispatched'] < self.limit:
+            size = self.batch_size
+            if self.limit is not None:
+                size = min(size, self.limit - self.stats['dispatched'])
+            # keyset on (created_at, id): each row is tried at most once per sweep
+            batch = stale_responses(started, self.older_than, self.retry_after, self.max_attempts)
+            if last is not None:
+                batch = batch.filter(Q(created_at__gt=last.created_at) | Q(created_at=last.created_at, id__gt=last.id))
+            batch = list(batch.order_by('created_at', 'id')[:size])
+            if not batch:
+                break
+            last = batch[-1]
+            if not self.dispatch_batch(batch):
+                break
+        return self.stats
+
+    def dispatch_batch(self, batch):
+        """Send one batch run by run; False when n8n is unavailable and the sweep should stop."""
+        accepted, attempted = [], []
+        try:
+            for run_id, answers in group_by_run(batch).items():
+                self._runs.add(run_id)
+                self.stats['runs'] = len(self._runs)
+                for pr in answers:
+                    self._throttle()
+                    attempted.append(pr.pk)
+                    if self._send(pr):
+                        accepted.append(pr.pk)
+        except n8n.N8nUnavailable as e:
+            attempted.pop()  # the short-circuited call never went out
+            self.stats['stopped'] = str(e)
+        finally:
+            now = timezone.now()
+            # two narrow updates: is_processed is never written back to False,
+            # so a score delivered by the webhook meanwhile is not overwritten
+            PatientResponse.objects.filter(pk__in=attempted).update(
+                dispatch_attempts=F('dispatch_attempts') + 1, last_dispatch_at=now,
+            )
+            if accepted:
+                PatientResponse.objects.filter(pk__in=accepted).update(is_processed=True)
+                fragments.invalidate_responses((pr.patient_id, pr.json_survey_id) for pr in batch if pr.pk in accepted)
+            self.stats['dispatched'] += len(attempted)
+            self.stats['accepted'] += len(accepted)
+            self.stats['failed'] += len(attempted) - len(accepted)
+            self.log(f'batch: {len(attempted)} sent, {len(accepted)} accepted')
+        return self.stats['stopped'] is None
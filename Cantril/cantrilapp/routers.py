@@ -0,0 +1,212 @@
+"""
+Read/write routing: heavy panel, analytics and export reads go to a replica.
+
+Reads are only sent to the ``replica`` alias inside ``read_replica()`` (or a
+view decorated with ``@replica_reads``) and only while the replica is fresher
+than ``settings.DATABASE_REPLICA_MAX_LAG`` seconds; otherwise they fall back to
+the primary. Writes always go to ``default``.
+
+* SQLite: the replica is a snapshot file produced with the online backup API
+  (``refresh_sqlite_replica``, run periodically by ``manage.py refresh_replica``).
+* PostgreSQL: the replica is a streaming standby; lag is read from
+  ``pg_last_xact_replay_timestamp()``.
+
+``use_primary()`` forces the primary (read-after-write), and ``pin_primary``
+keeps a session on the primary for a short time after it wrote something.
+"""
+import contextvars
+import functools
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections
+
+REPLICA_ALIAS = 'replica'
+PIN_SESSION_KEY = 'db_pin_primary_until'
+# how long a measured replication lag is trusted before asking again
+LAG_CACHE_SECONDS = 2.0
+
+_read_target = contextvars.ContextVar('cantril_read_target', default=None)
+_lag_cache = {'value': None, 'checked_at': 0.0}
+
+
+def replica_configured():
+    return REPLICA_ALIAS in settings.DATABASES
+
+
+def _sqlite_path(alias):
+    name = str(settings.DATABASES[alias]['NAME'])
+    if name.startswith('file:'):
+        name = name[len('file:'):].split('?', 1)[0]
+    return name
+
+
+def _measure_lag():
+    db = settings.DATABASES[REPLICA_ALIAS]
+    if 'sqlite' in db['ENGINE']:
+        path = _sqlite_path(REPLICA_ALIAS)
+        if not os.path.exists(path):
+            return None
+        # refresh_sqlite_replica sets the mtime to when its copy started
+        return max(0.0, time.time() - os.path.getmtime(path))
+    if 'postgresql' in db['ENGINE']:
+        with connections[REPLICA_ALIAS].cursor() as cursor:
+            cursor.execute(
+                "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END"
+            )
+            row = cursor.fetchone()
+        return float(row[0]) if row and row[0] is not None else None
+    return None
+
+
+def replica_lag():
+    """Seconds the replica is behind the primary (None = unknown / unavailable)."""
+    now = time.monotonic()
+    if now - _lag_cache['checked_at'] > LAG_CACHE_SECONDS:
+        try:
+            _lag_cache['value'] = _measure_lag()
+        except Exception:
+            _lag_cache['value'] = None
+        _lag_cache['checked_at'] = now
+    return _lag_cache['value']
+
+
+def replica_is_fresh():
+    if not replica_configured():
+        return False
+    lag = replica_lag()
+    return lag is not None and lag <= getattr(settings, 'DATABASE_REPLICA_MAX_LAG', 300)
+
+
+@contextmanager
+def read_replica():
+    """Route reads in this block to the replica (when it is fresh enough)."""
+    token = _read_target.set(REPLICA_ALIAS if _read_target.get() is None else _read_target.get())
+    try:
+        yield
+    finally:
+        _read_target.reset(token)
+
+
+@contextmanager
+def use_primary():
+    """Force reads in this block to the primary, even inside read_replica()."""
+    token = _read_target.set('default')
+    try:
+        yield
+    finally:
+        _read_target.reset(token)
+
+
+def pin_primary(request, seconds=None):
+    """Keep this session's reads on the primary for a while (call after a write)."""
+    seconds = seconds if seconds is not None else getattr(settings, 'DATABASE_PIN_PRIMARY_SECONDS', 30)
+    request.session[PIN_SESSION_KEY] = time.time() + seconds
+
+
+def replica_reads(view):
+    """View decorator: read-only view whose queries may be served by the replica."""
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        session = getattr(request, 'session', None)
+        pinned = session is not None and session.get(PIN_SESSION_KEY, 0) > time.time()
+        with (use_primary() if pinned else read_replica()):
+            return view(request, *args, **kwargs)
+    return wrapper
+
+
+def preserve_read_target(iterable):
+    """Wrap a lazy iterable (e.g. a StreamingHttpResponse body) so it is consumed
+    with the read target that was active when it was created."""
+    target = _read_target.get()
+
+    def generate():
+        token = _read_target.set(target)
+        try:
+            yield from iterable
+        finally:
+            _read_target.reset(token)
+    return generate()
+
+
+def apreserve_read_target(iterable):
+    """Async counterpart of preserve_read_target for ASGI responses.
+
+    Django consumes a sync streaming body under ASGI with ``sync_to_async(list)``,
+    i.e. the whole body in memory before the first byte. Here the iterable is
+    advanced one item per ``sync_to_async`` call (thread-sensitive, so a DB
+    cursor stays on one thread), with the read target set around each step.
+    """
+    target = _read_target.get()
+    iterator = iter(iterable)
+    done = object()
+
+    def step():
+        token = _read_target.set(target)
+        try:
+            return next(iterator, done)
+        finally:
+            _read_target.reset(token)
+
+    async def generate():
+        while (item := await sync_to_async(step)()) is not done:
+            yield item
+    return generate()
+
+
+class PrimaryReplicaRouter:
+    """Send reads to the replica only when asked to and when it is fresh; writes to the primary."""
+
+    def db_for_read(self, model, **hints):
+        if _read_target.get() == REPLICA_ALIAS and replica_is_fresh():
+            return REPLICA_ALIAS
+        return 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # the replica is a copy of the primary, never migrated on its own
+        return db != REPLICA_ALIAS
+
+
+def refresh_sqlite_replica():
+    """Copy the primary SQLite database to the replica path with the online backup API.
+
+    The copy is written next to the replica and atomically renamed over it, so
+    connections opened afterwards see a consistent snapshot. Its mtime is set
+    to when the copy started - the moment the snapshot reflects, which
+    ``_measure_lag`` reads. Returns seconds taken.
+    """
+    t0 = time.monotonic()
+    started_at = time.time()
+    source_path = _sqlite_path('default')
+    target_path = _sqlite_path(REPLICA_ALIAS)
+    tmp_path = target_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+
+    source = sqlite3.connect(source_path)
+    target = sqlite3.connect(tmp_path)
+    try:
+        # one step: a stepped backup restarts whenever another connection writes between
+        # steps, so under kiosk and webhook writes it might never finish; in WAL mode the
+        # read transaction of a single step does not block those writers
+        source.backup(target, pages=-1)
+        # the snapshot is opened read-only, which a WAL-mode file does not allow
+        target.execute('PRAGMA journal_mode=DELETE')
+    finally:
+        target.close()
+        source.close()
+    os.utime(tmp_path, (started_at, started_at))
+    os.replace(tmp_path, target_path)
+    _lag_cache['checked_at'] = 0.0
+    return time.monotonic() - t0
@@ -0,0 +1,63 @@
+"""
+Applying n8n scores to PatientResponse rows.
+
+All score writes go through ``record_scores`` so the webhook (and anything
+else that applies scores) shares one write path - including the invalidation
+of the panel fragments showing those runs and the live score events pushed to
+open panel pages.
+"""
+from django.utils import timezone
+
+from . import events, fragments
+from .db import get_writer
+from .models import PatientResponse
+
+# how long a webhook request waits for its batch to commit
+BATCH_RESULT_TIMEOUT = 30
+
+
+def apply_score(question_id, run_id, score):
+    """Store one evaluated score. Returns the number of responses updated."""
+    return PatientResponse.objects.filter(
+        question_id=str(question_id),
+        json_survey_id=str(run_id),
+    ).update(
+        evaluated_score=float(score) if score is not None else None,
+        is_processed=True,
+        scored_at=timezone.now(),
+    )
+
+
+def record_scores(items):
+    """Apply (question_id, run_id, score) tuples; returns updated counts in the same order.
+
+    With ``WRITE_BATCHING['scores']`` enabled the updates are queued on the shared
+    batched writer and committed together with concurrent webhook deliveries.
+    """
+    writer = get_writer('scores')
+    if writer is None:
+        counts = [apply_score(*item) for item in items]
+    else:
+        futures = [writer.submit(apply_score, *item) for item in items]
+        counts = [f.result(timeout=BATCH_RESULT_TIMEOUT) for f in futures]
+    _after_scores([item for item, n in zip(items, counts) if n])
+    return counts
+
+
+def _after_scores(items):
+    """Invalidate the panel fragments of the scored runs and publish one event per answer."""
+    if not items:
+        return
+    rows = list(
+        PatientResponse.objects.filter(json_survey_id__in={str(run_id) for _, run_id, _ in items})
+        .values_list('patient_id', 'json_survey_id').distinct()
+    )
+    fragments.invalidate_responses(rows)
+    patients = {}
+    for patient_id, run_id in rows:
+        patients.setdefault(run_id, []).append(patient_id)
+    events.publish_scores(
+        (patient_id, str(run_id), str(question_id), float(score) if score is not None else None)
+        for question_id, run_id, score in items
+        for patient_id in patients.get(str(run_id), ())
+    )
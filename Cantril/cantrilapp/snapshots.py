@@ -0,0 +1,199 @@
+"""
+Incremental columnar research snapshots of PatientResponse.
+
+Layout under the snapshot directory::
+
+    manifest.json                      watermark, dictionaries, list of parts
+    month=2025-12/survey=<uuid|none>/part-000001/<column>.npy
+
+Every column is a plain ``.npy`` file, so analysts can ``np.load(path,
+mmap_mode='r')`` it without touching the production database. Question ids
+are dictionary-encoded (``question_code`` indexes ``manifest['question_ids']``),
+survey run ids are encoded per part (``run_code`` indexes ``part['runs']``).
+
+Each run appends new parts with rows created or scored after the previous
+watermark, less ``analytics.WATERMARK_OVERLAP`` (timestamps are stamped before
+their transaction commits). A response re-scored by n8n, or one that falls in
+the overlap, is therefore written again; when reading, keep the last
+occurrence of each ``id`` in manifest part order.
+Free-text columns and PESEL are deliberately not exported.
+"""
+import json
+import os
+import shutil
+from datetime import timezone as dt_timezone
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .analytics import WATERMARK_OVERLAP, month_start
+from .models import PatientResponse
+
+MANIFEST_NAME = 'manifest.json'
+FORMAT_VERSION = 1
+RESPONSE_TYPES = [code for code, _ in PatientResponse.RESPONSE_TYPE]
+
+# kolumna -> dtype zapisany w .npy
+COLUMNS = {
+    'id': ('u1', 16),                 # UUID bytes
+    'patient_id': 'i8',
+    'question_code': 'i4',
+    'run_code': 'i4',
+    'response_type': 'i1',            # index into manifest['response_types']
+    'created_at': 'datetime64[us]',   # UTC
+    'scored_at': 'datetime64[us]',    # UTC, last score change; NaT when never scored
+    'scale_value': 'f8',              # NaN when empty
+    'evaluated_score': 'f8',          # NaN when empty
+    'is_processed': '?',
+}
+
+FIELDS = [
+    'id', 'patient_id', 'survey_id', 'json_survey_id', 'question_id', 'response_type',
+    'created_at', 'scored_at', 'scale_value', 'evaluated_score', 'is_processed',
+]
+
+
+def snapshot_dir():
+    return str(getattr(settings, 'RESEARCH_SNAPSHOT_DIR', os.path.join(settings.BASE_DIR, 'snapshots')))
+
+
+def load_manifest(base):
+    path = os.path.join(base, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {
+            'format_version': FORMAT_VERSION,
+            'watermark': None,
+            'columns': {name: str(np.dtype(dtype)) for name, dtype in COLUMNS.items()},
+            'response_types': RESPONSE_TYPES,
+            'question_ids': [],
+            'parts': [],
+        }
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _write_manifest(base, manifest):
+    path = os.path.join(base, MANIFEST_NAME)
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, path)
+
+
+def _utc_naive(dt):
+    return None if dt is None else timezone.localtime(dt, dt_timezone.utc).replace(tzinfo=None)
+
+
+class _PartitionBuffer:
+    """Rows of one (month, survey) partition accumulated column by column."""
+
+    def __init__(self):
+        self.columns = {name: [] for name in COLUMNS}
+        self.runs = {}
+
+    def __len__(self):
+        return len(self.columns['patient_id'])
+
+    def append(self, row, question_code):
+        c = self.columns
+        c['id'].append(row['id'].bytes)
+        c['patient_id'].append(row['patient_id'])
+        c['question_code'].append(question_code)
+        c['run_code'].append(self.runs.setdefault(row['json_survey_id'] or '', len(self.runs)))
+        c['response_type'].append(RESPONSE_TYPES.index(row['response_type']) if row['response_type'] in RESPONSE_TYPES else -1)
+        c['created_at'].append(_utc_naive(row['created_at']))
+        c['scored_at'].append(_utc_naive(row['scored_at']))
+        c['scale_value'].append(np.nan if row['scale_value'] is None else row['scale_value'])
+        c['evaluated_score'].append(np.nan if row['evaluated_score'] is None else row['evaluated_score'])
+        c['is_processed'].append(row['is_processed'])
+
+    def arrays(self):
+        out = {}
+        for name, dtype in COLUMNS.items():
+            values = self.columns[name]
+            if name == 'id':
+                out[name] = np.frombuffer(b''.join(values), dtype=np.uint8).reshape(-1, 16)
+            elif dtype == 'datetime64[us]':
+                out[name] = np.array([np.datetime64('NaT') if v is None else v for v in values], dtype=dtype)
+            else:
+                out[name] = np.array(values, dtype=dtype)
+        return out
+
+
+def _write_part(base, manifest, month, survey_key, buf):
+    """Write one partition buffer as a new part directory and register it in the manifest."""
+    rel_dir = os.path.join(f"month={month:%Y-%m}", f"survey={survey_key}")
+    part_no = 1 + sum(1 for p in manifest['parts'] if p['partition'] == rel_dir)
+    # skip leftovers of an interrupted run (written but never listed in the manifest)
+    while os.path.exists(os.path.join(base, rel_dir, f"part-{part_no:06d}")):
+        part_no += 1
+    rel_path = os.path.join(rel_dir, f"part-{part_no:06d}")
+    final = os.path.join(base, rel_path)
+    tmp = final + '.tmp'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for name, arr in buf.arrays().items():
+        np.save(os.path.join(tmp, f"{name}.npy"), arr, allow_pickle=False)
+    os.replace(tmp, final)
+
+    manifest['parts'].append({
+        'partition': rel_dir,
+        'path': rel_path,
+        'month': f"{month:%Y-%m}",
+        'survey': survey_key,
+        'rows': len(buf),
+        'runs': list(buf.runs),
+        'written_at': timezone.now().isoformat(),
+    })
+
+
+def update_snapshots(base=None, full=False, flush_rows=250_000, chunk_size=5000):
+    """Append rows created/scored since the manifest watermark. Returns (rows, parts written)."""
+    base = base or snapshot_dir()
+    if full and os.path.isdir(base):
+        for entry in os.listdir(base):
+            if entry == MANIFEST_NAME or entry.startswith('month='):
+                path = os.path.join(base, entry)
+                shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+    os.makedirs(base, exist_ok=True)
+
+    manifest = load_manifest(base)
+    question_codes = {qid: i for i, qid in enumerate(manifest['question_ids'])}
+    parts_before = len(manifest['parts'])
+
+    started_at = timezone.now()
+    qs = PatientResponse.objects.all()
+    watermark = parse_datetime(manifest['watermark']) if manifest['watermark'] else None
+    if watermark is not None:
+        since = watermark - WATERMARK_OVERLAP
+        qs = qs.filter(Q(created_at__gt=since) | Q(scored_at__gt=since))
+
+    buffers = {}
+    total = 0
+    for row in qs.values(*FIELDS).iterator(chunk_size=chunk_size):
+        qid = row['question_id']
+        if qid not in question_codes:
+            question_codes[qid] = len(manifest['question_ids'])
+            manifest['question_ids'].append(qid)
+        key = (month_start(row['created_at']), str(row['survey_id']) if row['survey_id'] else 'none')
+        buf = buffers.setdefault(key, _PartitionBuffer())
+        buf.append(row, question_codes[qid])
+        total += 1
+        if len(buf) >= flush_rows:
+            _write_part(base, manifest, key[0], key[1], buffers.pop(key))
+
+    for (month, survey_key), buf in sorted(buffers.items()):
+        _write_part(base, manifest, month, survey_key, buf)
+
+    # the manifest is the commit point: parts not listed in it are ignored by readers
+    manifest['watermark'] = started_at.isoformat()
+    _write_manifest(base, manifest)
+    return total, len(manifest['parts']) - parts_before
+
+
+def load_column(base, part, column, mmap_mode='r'):
+    """Memory-map one column of a manifest part (helper for analysts)."""
+    return np.load(os.path.join(base, part['path'], f"{column}.npy"), mmap_mode=mmap_mode)
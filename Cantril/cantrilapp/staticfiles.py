@@ -0,0 +1,121 @@
+"""
+Static files for the kiosk tablets: hashed names, precompressed copies, long caching.
+
+``CompressedManifestStaticFilesStorage`` (STORAGES["staticfiles"] in the
+production profile) is Django's manifest storage - ``cantril.<hash>.css``
+names, ``{% static %}`` resolves through staticfiles.json - that also writes
+``.gz`` and, with the optional ``brotli`` package, ``.br`` siblings during
+``collectstatic``. A sibling is kept only when it is clearly smaller.
+
+``serve`` (mounted under STATIC_URL in Cantril/urls.py) answers from
+STATIC_ROOT, falling back to the finders before collectstatic has run. It
+sends the precompressed sibling the client accepts and marks hashed names
+``immutable`` for a year: a new build changes the name, so a tablet fetches
+each file once and then loads question pages from its cache. Unhashed names
+are revalidated (Last-Modified) on every use.
+"""
+import gzip
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.contrib.staticfiles import finders
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponseNotModified
+from django.utils._os import safe_join
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date
+from django.views.decorators.http import require_safe
+from django.views.static import was_modified_since
+
+try:
+    import brotli
+except ImportError:  # optional: without it only .gz siblings are written
+    brotli = None
+
+COMPRESSIBLE = {'.css', '.js', '.mjs', '.json', '.map', '.svg', '.txt', '.html', '.xml', '.ico', '.webmanifest'}
+MIN_SIZE = 512  # bytes; smaller files are not worth a second request path
+MIN_SAVING = 0.95  # keep a sibling only below 95% of the original size
+# ManifestStaticFilesStorage names: <name>.<12 hex>.<ext>
+HASHED_RE = re.compile(r'\.[0-9a-f]{12}\.[^./]+$')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+# preference order when the client accepts several
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def compress(data):
+    """{suffix: bytes} of the worthwhile compressed variants of ``data``."""
+    variants = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['.br'] = brotli.compress(data, quality=11)
+    return {suffix: blob for suffix, blob in variants.items() if len(blob) < len(data) * MIN_SAVING}
+
+
+class CompressedManifestStaticFilesStorage(ManifestStaticFilesStorage):
+    def post_process(self, paths, dry_run=False, **options):
+        yield from super().post_process(paths, dry_run, **options)
+        if dry_run:
+            return
+        # final names only (css files go through several passes)
+        for name in sorted(set(self.hashed_files.values())):
+            for written in self.write_compressed(name):
+                yield written, written, True
+
+    def write_compressed(self, name):
+        path = self.path(name)
+        if os.path.splitext(name)[1].lower() not in COMPRESSIBLE or os.path.getsize(path) < MIN_SIZE:
+            return []
+        with open(path, 'rb') as f:
+            data = f.read()
+        written = []
+        for suffix, blob in compress(data).items():
+            with open(path + suffix, 'wb') as f:
+                f.write(blob)
+            written.append(name + suffix)
+        return written
+
+
+def find(path):
+    """Absolute path of a static file: STATIC_ROOT first, then the finders (development)."""
+    if settings.STATIC_ROOT:
+        try:
+            fullpath = safe_join(settings.STATIC_ROOT, path)
+        except SuspiciousFileOperation:
+            return None
+        if os.path.isfile(fullpath):
+            return fullpath
+    try:
+        return finders.find(path)
+    except SuspiciousFileOperation:
+        return None
+
+
+@require_safe
+def serve(request, path):
+    if path.endswith(('.gz', '.br')):
+        raise Http404  # siblings are only sent through Content-Encoding
+    fullpath = find(path)
+    if fullpath is None:
+        raise Http404
+    content_type = mimetypes.guess_type(fullpath)[0] or 'application/octet-stream'
+
+    encoding = None
+    accepted = {e.split(';')[0].strip() for e in request.headers.get('Accept-Encoding', '').split(',')}
+    for name, suffix in ENCODINGS:
+        if name in accepted and os.path.isfile(fullpath + suffix):
+            fullpath, encoding = fullpath + suffix, name
+            break
+
+    mtime = os.stat(fullpath).st_mtime
+    if not was_modified_since(request.headers.get('If-Modified-Since'), mtime):
+        response = HttpResponseNotModified()
+    else:
+        response = FileResponse(open(fullpath, 'rb'), content_type=content_type, filename=os.path.basename(path))
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+    response.headers['Last-Modified'] = http_date(mtime)
+    response.headers['Cache-Control'] = IMMUTABLE if HASHED_RE.search(path) else 'no-cache'
+    patch_vary_headers(response, ['Accept-Encoding'])
+    return response
@@ -0,0 +1,152 @@
+"""
+Saving surveys edited in the generator (``views.manage_questions``).
+
+``save_survey`` diffs the submitted question list against the stored one by
+``Question.key`` and, in one transaction, deletes the dropped questions,
+``bulk_update``s the edited or moved ones and ``bulk_create``s the new ones;
+untouched questions are not written. Keys never change, so answers stored
+under a question id keep pointing at the same question after edits and
+reorders.
+
+Title uniqueness (case-insensitive) is enforced by the ``survey_title_ci_uniq``
+index on LOWER(title); a clash surfaces as ``SurveyTitleTaken``. SQLite's
+LOWER() folds ASCII letters only - the same as the ``iexact`` check it replaces.
+
+The JSON mirrors read by the patient flow (the active question file and
+``surveys/<uuid>.json``) are written after the transaction commits, each to a
+temporary file that replaces the old one, so a reader never sees a half-written
+file or questions that were rolled back. The survey's ladders are pre-rendered
+at the same time (``ladder.precompile``).
+"""
+import json
+import os
+import re
+import tempfile
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from . import audio, ladder
+from .models import Question, Survey, question_key
+
+TITLE_INDEX = 'survey_title_ci_uniq'
+# keys accepted from the form; anything else gets a fresh key
+KEY_RE = re.compile(r'[\w-]{1,32}')
+
+
+class SurveyTitleTaken(Exception):
+    """Another survey has the same title (ignoring case)."""
+
+
+def survey_file_path(survey):
+    return os.path.join(settings.BASE_DIR, 'surveys', f'{survey.id}.json')
+
+
+def save_survey(title, ladder_design, questions, survey=None, active_file=None, audio_profile=None):
+    """Create ``survey`` (None) or apply the edit; ``questions`` are dicts with key, text, scale_labels.
+
+    ``audio_profile`` (already validated, see ``audio.clean_profile``) replaces
+    the stored one when given.
+
+    Returns ``(survey, changes)`` with the number of created, updated, deleted
+    and unchanged questions.
+    """
+    with transaction.atomic():
+        created = survey is None
+        if created:
+            survey = Survey(title=title, ladder_design=ladder_design, audio_profile=audio_profile or {})
+            existing = {}
+        else:
+            survey = Survey.objects.select_for_update().get(pk=survey.pk)
+            existing = {q.key: q for q in Question.objects.filter(survey=survey)}
+
+        to_create, to_update, final, seen = [], [], [], set()
+        for order, item in enumerate(questions, start=1):
+            key = item.get('key') or ''
+            if not KEY_RE.fullmatch(key) or key in seen:
+                key = question_key()
+            seen.add(key)
+            text, labels = item['text'], item.get('scale_labels') or {}
+            labels = {'min': labels.get('min', ''), 'max': labels.get('max', '')}
+            q = existing.pop(key, None)
+            if q is None:
+                q = Question(key=key, text=text, order=order, scale_labels=labels)
+                to_create.append(q)
+            elif (q.text, q.order, q.scale_labels) != (text, order, labels):
+                q.text, q.order, q.scale_labels = text, order, labels
+                to_update.append(q)
+            final.append(q)
+        deleted = list(existing.values())
+
+        if audio_profile is None or audio.profile_for(survey) == audio_profile:
+            audio_profile = survey.audio_profile  # unchanged (an empty stored profile means the defaults)
+        edited = created or (survey.title, survey.ladder_design, survey.audio_profile) != (
+            title, ladder_design, audio_profile)
+        if edited or to_create or to_update or deleted:
+            survey.title = title
+            survey.ladder_design = ladder_design
+            survey.audio_profile = audio_profile
+            if not created:
+                survey.version += 1
+            try:
+                with transaction.atomic():
+                    survey.save()
+            except IntegrityError as e:
+                if TITLE_INDEX not in str(e):
+                    raise
+                raise SurveyTitleTaken(title) from e
+
+        if deleted:
+            Question.objects.filter(pk__in=[q.pk for q in deleted]).delete()
+        if to_update:
+            Question.objects.bulk_update(to_update, ['text', 'order', 'scale_labels'])
+        if to_create:
+            for q in to_create:
+                q.survey = survey
+            Question.objects.bulk_create(to_create)
+
+        data = mirror_data(survey, final)
+        paths = [p for p in (active_file, survey_file_path(survey)) if p]
+        transaction.on_commit(lambda: write_mirrors(data, paths))
+
+    changes = {
+        'created': len(to_create),
+        'updated': len(to_update),
+        'deleted': len(deleted),
+        'unchanged': len(final) - len(to_create) - len(to_update),
+    }
+    return survey, changes
+
+
+def mirror_data(survey, questions):
+    """Question JSON read by the patient flow (ids are the stable question keys)."""
+    return {
+        'title': survey.title,
+        'ladder_design': survey.ladder_design,
+        'audio_profile': audio.client_profile(audio.profile_for(survey)),
+        'questions': [
+            {'id': q.key, 'text': q.text, 'scale_labels': q.scale_labels or {}}
+            for q in questions
+        ],
+    }
+
+
+def write_json_atomic(path, data):
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix='.json')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+        os.chmod(tmp, 0o644)  # mkstemp creates 0600; the mirrors used to be plain open() files
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def write_mirrors(data, paths):
+    for path in paths:
+        write_json_atomic(path, data)
+    ladder.precompile(data)
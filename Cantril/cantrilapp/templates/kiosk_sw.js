@@ -0,0 +1,41 @@
+// Service worker trybu kiosku (cantrilapp.kiosk); wersja {{ version }}
+const CACHE = 'cantril-kiosk-{{ version }}';
+const PRECACHE = {{ precache }};
+// strona kiosku i definicje ankiet: najpierw sieć, przy braku połączenia kopia z cache
+const PAGES = {{ pages }};
+
+self.addEventListener('install', (event) => {
+  event.waitUntil(caches.open(CACHE).then((cache) => cache.addAll(PRECACHE)).then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', (event) => {
+  event.waitUntil(
+    caches.keys()
+      .then((keys) => Promise.all(keys.filter((k) => k.startsWith('cantril-kiosk-') && k !== CACHE).map((k) => caches.delete(k))))
+      .then(() => self.clients.claim())
+  );
+});
+
+self.addEventListener('fetch', (event) => {
+  const request = event.request;
+  if (request.method !== 'GET') return;  // synchronizacja idzie zawsze do sieci
+  const url = new URL(request.url);
+  if (url.origin !== self.location.origin) return;
+
+  if (PAGES.includes(url.pathname)) {
+    event.respondWith(
+      fetch(request)
+        .then((response) => {
+          if (response.ok) {
+            const copy = response.clone();
+            caches.open(CACHE).then((cache) => cache.put(url.pathname, copy));
+          }
+          return response;
+        })
+        .catch(() => caches.match(url.pathname).then((cached) => cached || Response.error()))
+    );
+  } else if (PRECACHE.includes(url.pathname)) {
+    // zasoby statyczne: nazwy z hashem w produkcji, więc cache wystarcza
+    event.respondWith(caches.match(url.pathname).then((cached) => cached || fetch(request)));
+  }
+});
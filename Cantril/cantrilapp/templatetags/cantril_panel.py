@@ -0,0 +1,22 @@
+"""
+Row cards of the doctor panel lists: ``{% load cantril_panel %}``.
+
+An inclusion tag resolves its template once per render and gives it a fresh
+context holding just the row, so a card does not look names up through the
+page's whole context stack (request, user, messages, ...) on every row.
+"""
+from django import template
+
+register = template.Library()
+
+
+@register.inclusion_tag('panel_response_card.html')
+def response_card(row):
+    """One answer on /panel/results/ (a row dict from views.panel_results)."""
+    return {'r': row}
+
+
+@register.inclusion_tag('panel_patient_card.html')
+def patient_card(patient):
+    """One patient with their runs on /panel/history/."""
+    return {'p': patient}
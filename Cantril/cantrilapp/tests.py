@@ -1,3 +1,1678 @@
-from django.test import TestCase
+import asyncio
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+from concurrent.futures import Future
+from datetime import date, datetime, timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.template.loader import render_to_string
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import path, reverse
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from . import analytics, archive, audio, db, events, exports, fragments, kiosk, ladder, log, metrics, n8n, patients, profiling, reconcile, routers, snapshots, staticfiles, surveys, urls as app_urls, views
+from .models import ArchivedRun, JobWatermark, KioskRun, Patient, PatientResponse, Question, ScoreAgreement, Survey
+from .management.commands.seed_synthetic import pesel_for
+from .scoring import record_scores
+
+RESPONSE_TABLE = PatientResponse._meta.db_table
+# any SCAN of the response table - bare, or walking a whole index ("USING [COVERING] INDEX")
+FULL_SCAN_RE = re.compile(rf'^SCAN (TABLE )?{RESPONSE_TABLE}\b')
+
+QUESTIONS = [
+    {"id": f"q{i}", "text": f"Pytanie {i}", "scale_labels": {"min": "źle", "max": "dobrze"}}
+    for i in range(1, 4)
+]
+
+
+class _FakeN8nResponse:
+    status_code = 200
+    text = 'ok'
+
+
+class QueryPlanRegressionTests(TestCase):
+    """Every view in cantrilapp/urls.py against a synthetic dataset.
+
+    For each view the captured SQL is checked for a query budget, and every
+    statement touching the response table is run through EXPLAIN QUERY PLAN to
+    make sure it is served by an index search rather than a scan of the table
+    or of a whole index (exceptions, each with its reason, in
+    ``ALLOWED_INDEX_SCANS``).
+    """
+
+    PATIENTS = 60
+    RUNS_PER_PATIENT = 12
+    # view -> indexes it may walk; only partial indexes, whose size is the backlog rather
+    # than the table, or walks cut short by a LIMIT belong here
+    ALLOWED_INDEX_SCANS = {
+        'metrics': {'resp_unprocessed_idx'},  # outbox backlog COUNT(*)
+        # unfiltered page: newest first down resp_created_idx, stops at views.RESULTS_LIMIT rows
+        # (the MAX() validators are single index lookups)
+        'panel_results': {'resp_created_idx'},
+    }
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp(prefix='cantril-tests-')
+        cls.questions_path = os.path.join(cls.tmpdir, 'ankieta_pytania.json')
+        with open(cls.questions_path, 'w', encoding='utf-8') as f:
+            json.dump({"title": "Test", "ladder_design": "classic", "questions": QUESTIONS}, f)
+        cls._overrides = override_settings(BASE_DIR=cls.tmpdir, MEDIA_ROOT=cls.tmpdir)
+        cls._overrides.enable()
+        cls._questions_patch = mock.patch('cantrilapp.views.QUESTION_FILE_PATH', cls.questions_path)
+        cls._questions_patch.start()
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls._questions_patch.stop()
+        cls._overrides.disable()
+        shutil.rmtree(cls.tmpdir, ignore_errors=True)
+
+    @classmethod
+    def setUpTestData(cls):
+        rnd = random.Random(31)
+        cls.surveys = [Survey.objects.create(title=f'Ankieta {i}') for i in range(4)]
+        Question.objects.bulk_create([
+            Question(survey=s, text=q['text'], order=i, scale_labels=q['scale_labels'])
+            for s in cls.surveys for i, q in enumerate(QUESTIONS, start=1)
+        ])
+        patients = Patient.objects.bulk_create([
+            Patient(pesel=f'{90010100000 + i:011d}', first_name=f'Imię{i}', last_name=f'Nazwisko{i}')
+            for i in range(cls.PATIENTS)
+        ])
+
+        now = timezone.now()
+        responses = []
+        for patient in patients:
+            for run in range(cls.RUNS_PER_PATIENT):
+                survey = rnd.choice(cls.surveys)
+                started = now - timedelta(days=rnd.randint(0, 720), minutes=rnd.randint(0, 1440))
+                run_id = f"{survey.id.hex}_{started:%Y%m%dT%H%M%S}"
+                for q in QUESTIONS:
+                    kind = rnd.choice(['scale', 'scale', 'text', 'audio'])
+                    scored = rnd.random() < 0.8
+                    responses.append(PatientResponse(
+                        patient=patient,
+                        survey=survey,
+                        json_survey_id=run_id,
+                        question_id=q['id'],
+                        question_text=q['text'],
+                        response_type=kind,
+                        scale_value=rnd.randint(1, 10) if kind != 'audio' else None,
+                        text_answer='odpowiedź' if kind == 'text' else '',
+                        audio_file='audio_answers/x.webm' if kind == 'audio' else None,
+                        evaluated_score=rnd.randint(1, 10) if scored else None,
+                        is_processed=scored,
+                    ))
+        PatientResponse.objects.bulk_create(responses, batch_size=1000)
+        # created_at is auto_now_add: spread the runs over time afterwards
+        for i, run_id in enumerate(PatientResponse.objects.values_list('json_survey_id', flat=True).distinct()):
+            PatientResponse.objects.filter(json_survey_id=run_id).update(created_at=now - timedelta(hours=i))
+
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+        cls.patient = patients[0]
+        cls.response = PatientResponse.objects.filter(patient=cls.patient).first()
+
+    def setUp(self):
+        # budgets are for a cold fragment cache
+        fragments.get_cache().clear()
+
+    # --- helpers -----------------------------------------------------------------
+
+    def start_session(self, mode='cantril', answers=None):
+        session = self.client.session
+        session['patient_id'] = self.patient.id
+        session['survey_uuid'] = str(self.surveys[0].id)
+        session['survey_run_id'] = f"{self.surveys[0].id.hex}_20250101T120000"
+        session['survey_mode'] = mode
+        session['answers'] = answers or {}
+        session.save()
+
+    def login_staff(self):
+        staff, _ = User.objects.get_or_create(username='staff', defaults={'is_staff': True})
+        self.client.force_login(staff)
+
+    def explain(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assert_indexed(self, name, queries):
+        for q in queries:
+            sql = q['sql']
+            if RESPONSE_TABLE not in sql or not sql.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+                continue
+            plan = self.explain(sql)
+            allowed = self.ALLOWED_INDEX_SCANS.get(name, ())
+            scans = [step for step in plan if FULL_SCAN_RE.match(step) and step.split()[-1] not in allowed]
+            self.assertFalse(scans, f'{name}: full scan of {RESPONSE_TABLE}\n{sql}\n{plan}')
+
+    def run_view(self, name, request, max_queries, setup=None):
+        if setup:
+            setup()
+        with CaptureQueriesContext(connection) as ctx:
+            response = request()
+            if getattr(response, 'streaming', False):
+                b''.join(response.streaming_content)
+        self.assertLess(response.status_code, 400, f'{name} returned {response.status_code}')
+        self.assertLessEqual(
+            len(ctx.captured_queries), max_queries,
+            f'{name}: {len(ctx.captured_queries)} queries (budget {max_queries})\n'
+            + '\n'.join(q['sql'] for q in ctx.captured_queries),
+        )
+        self.assert_indexed(name, ctx.captured_queries)
+        return response
+
+    # --- cases ---------------------------------------------------------------------
+
+    def view_cases(self):
+        """url name -> (session setup or None, callable issuing the request, query budget).
+
+        Budgets include the session lookup (@replica_reads checks the primary pin)
+        and the conditional-GET validators (cantrilapp.conditional).
+        """
+        c = self.client
+        survey = self.surveys[0]
+        run_id = self.response.json_survey_id
+        webhook_body = json.dumps({'questionID': self.response.question_id, 'surveyID': run_id, 'score': 7})
+        return {
+            'home': (None, lambda: c.get(reverse('home')), 0),
+            'ankieta_choice': (None, lambda: c.post(reverse('ankieta_choice'), {'pesel': self.patient.pesel}), 6),
+            'ankieta_select_survey': (self.start_session, lambda: c.get(reverse('ankieta_select_survey')), 5),
+            'ankieta_cantril_question': (
+                lambda: self.start_session(answers={'1': {'type': 'scale', 'value': 5}}),
+                lambda: c.post(reverse('ankieta_cantril_question', args=[2]), {'response_type': 'scale', 'answer': '7'}),
+                5,
+            ),
+            'ankieta_voice_question': (
+                lambda: self.start_session(mode='voice'),
+                lambda: c.post(reverse('ankieta_voice_question', args=[1]), {'response_type': 'text', 'text_answer': 'ok'}),
+                5,
+            ),
+            'ankieta_done': (None, lambda: c.get(reverse('ankieta_done')), 0),
+            'patient_form': (None, lambda: c.get(reverse('patient_form')), 0),
+            'manage_questions': (None, lambda: c.get(reverse('manage_questions'), {'mode': str(survey.id)}), 4),
+            'panel_home': (None, lambda: c.get(reverse('panel_home')), 1),
+            'ladder_designs': (None, lambda: c.get(reverse('ladder_designs')), 0),
+            'panel_results': (None, lambda: c.get(reverse('panel_results')), 5),
+            'panel_history': (None, lambda: c.get(reverse('panel_history')), 3),
+            'panel_patient_history': (None, lambda: c.get(reverse('panel_patient_history', args=[self.patient.id])), 4),
+            'panel_survey_completions': (
+                None, lambda: c.get(reverse('panel_survey_completions', args=[survey.id, self.patient.id])), 5,
+            ),
+            'panel_profiles': (None, lambda: c.get(reverse('panel_profiles')), 2),
+            'kiosk': (None, lambda: c.get(reverse('kiosk')), 0),
+            'kiosk_service_worker': (None, lambda: c.get(reverse('kiosk_service_worker')), 0),
+            # survey validators + surveys with their questions
+            'kiosk_surveys': (None, lambda: c.get(reverse('kiosk_surveys')), 3),
+            # stored runs + surveys + question texts, then per run: patient, KioskRun, one INSERT (+ savepoints)
+            'kiosk_sync': (None, lambda: c.post(reverse('kiosk_sync'), {'runs': json.dumps([{
+                'run_id': f'{"a" * 32}_20250115T103000', 'survey': str(survey.id), 'pesel': self.patient.pesel,
+                'mode': 'cantril', 'answers': [{'question': 'q1', 'type': 'scale', 'value': 7}],
+            }])}), 10),
+            # session + staff user + one page of the patient list
+            'manage_patients': (self.login_staff, lambda: c.get(reverse('manage_patients'), {'q': '9001'}), 3),
+            'panel_agreement': (None, lambda: c.get(reverse('panel_agreement')), 4),
+            # session + staff user + the export itself
+            'export_responses': (self.login_staff, lambda: c.get(reverse('export_responses'), {'survey_id': run_id}), 3),
+            'metrics': (None, lambda: c.get(reverse('metrics')), 4),
+            # 204 without ASGI; a stream never touches the database either
+            'panel_score_events': (None, lambda: c.get(reverse('panel_score_events')), 0),
+            # the score UPDATE + owners of the scored runs (fragment invalidation)
+            'n8n_results_webhook': (
+                None, lambda: c.post(reverse('n8n_results_webhook'), webhook_body, content_type='application/json'), 2,
+            ),
+        }
+
+    @mock.patch('cantrilapp.n8n.requests.Session.post', return_value=_FakeN8nResponse())
+    def test_every_view_is_indexed_and_within_query_budget(self, _post):
+        cases = self.view_cases()
+        names = {p.name for p in app_urls.urlpatterns}
+        missing = names - set(cases)
+        self.assertFalse(missing, f'add a query-plan case for new views: {sorted(missing)}')
+
+        for name in sorted(names):
+            setup, request, budget = cases[name]
+            with self.subTest(view=name):
+                self.client.logout()  # every case starts anonymous unless its setup logs in
+                self.run_view(name, request, budget, setup=setup)
+
+    def test_panel_views_filtered_variants(self):
+        c = self.client
+        run_id = self.response.json_survey_id
+        self.run_view('panel_results[pesel]', lambda: c.get(reverse('panel_results'), {'pesel': self.patient.pesel}), 5)
+        self.run_view('panel_results[survey_id]', lambda: c.get(reverse('panel_results'), {'survey_id': run_id}), 5)
+        self.run_view('panel_history[q]', lambda: c.get(reverse('panel_history'), {'q': self.patient.pesel}), 3)
+        self.run_view('export_responses[dates]', lambda: c.get(
+            reverse('export_responses'),
+            {'date_from': (timezone.localdate() - timedelta(days=3)).isoformat()},
+        ), 2)
+
+    def test_unfiltered_results_page_is_bounded(self):
+        with CaptureQueriesContext(connection) as ctx, mock.patch.object(views, 'RESULTS_LIMIT', 5):
+            page = self.client.get(reverse('panel_results'))
+        self.assertEqual(len(page.context['rows']), 5)
+        self.assertContains(page, 'Pokazano 5 najnowszych')
+        listing = [q['sql'] for q in ctx.captured_queries if RESPONSE_TABLE in q['sql'] and 'ORDER BY' in q['sql']]
+        self.assertTrue(listing)
+        self.assertTrue(all('LIMIT 5' in sql for sql in listing))
+
+    def test_finishing_cantril_survey_inserts_in_one_query(self):
+        answers = {str(i): {'type': 'scale', 'value': i} for i in range(1, len(QUESTIONS) + 1)}
+        self.start_session(answers=answers)
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(reverse('ankieta_cantril_question', args=[len(QUESTIONS) + 1]))
+        inserts = [q for q in ctx.captured_queries if q['sql'].startswith(f'INSERT INTO "{RESPONSE_TABLE}"')]
+        self.assertEqual(len(inserts), 1)
+
+    def test_dispatch_backlog_uses_partial_index(self):
+        qs = PatientResponse.objects.filter(is_processed=False).order_by('created_at').values('id')
+        plan = ' '.join(self.explain(str(qs.query)))
+        self.assertIn('resp_unprocessed_idx', plan)
+
+    def test_reconcile_sweep_uses_dispatch_index(self):
+        now = timezone.now()
+        qs = reconcile.stale_responses(now, timedelta(minutes=10), timedelta(minutes=15), 10).order_by('created_at', 'id')
+        sql, params = qs.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            plan = ' '.join(row[-1] for row in cursor.fetchall())
+        self.assertIn('resp_dispatch_idx', plan)
+
+
+class InstrumentationTests(TestCase):
+    def setUp(self):
+        metrics.reset()
+
+    def test_server_timing_header(self):
+        response = self.client.get(reverse('home'))
+        header = response['Server-Timing']
+        for part in ('app;dur=', 'db;dur=', 'tpl;dur='):
+            self.assertIn(part, header)
+
+    def test_metrics_exposition(self):
+        self.client.get(reverse('home'))
+        body = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('cantril_request_duration_seconds_bucket{view="home",method="GET",le="+Inf"} 1', body)
+        self.assertIn('cantril_requests_total{view="home",method="GET",status="2xx"} 1', body)
+        self.assertIn('# TYPE cantril_outbox_backlog_responses gauge', body)
+        self.assertIn('cantril_webhook_lag_seconds 0', body)
+
+    @override_settings(METRICS_TOKEN='s3cret')
+    def test_metrics_token(self):
+        self.assertEqual(self.client.get(reverse('metrics')).status_code, 403)
+        ok = self.client.get(reverse('metrics'), HTTP_AUTHORIZATION='Bearer s3cret')
+        self.assertEqual(ok.status_code, 200)
+
+
+class ProfilingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('lekarz', password='x', is_staff=True)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix='cantril-profiles-')
+        self.addCleanup(shutil.rmtree, self.tmpdir, ignore_errors=True)
+
+    def profiling(self, **overrides):
+        return override_settings(PROFILING={'store_dir': self.tmpdir, **overrides})
+
+    def test_slow_requests_are_stored(self):
+        with self.profiling(enabled=True, threshold_ms=0, interval_ms=1):
+            self.client.get(reverse('home'))
+        records = profiling.ProfileStore(self.tmpdir, 10, 10).records()
+        self.assertEqual([r['view'] for r in records], ['home'])
+        self.assertFalse(records[0]['forced'])
+
+    def test_disabled_stores_nothing(self):
+        with self.profiling(enabled=False, threshold_ms=0):
+            self.client.get(reverse('home'))
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_signed_param_forces_cprofile_for_staff_only(self):
+        token = profiling.profile_token(self.staff)
+        with self.profiling(enabled=False):
+            self.client.get(reverse('home'), {profiling.QUERY_PARAM: token})
+            self.assertEqual(os.listdir(self.tmpdir), [])  # anonymous
+
+            self.client.force_login(self.staff)
+            self.client.get(reverse('home'), {profiling.QUERY_PARAM: token + 'x'})
+            self.assertEqual(os.listdir(self.tmpdir), [])  # bad signature
+
+            self.client.get(reverse('home'), {profiling.QUERY_PARAM: token})
+            record = profiling.ProfileStore(self.tmpdir, 10, 10).records()[0]
+            self.assertTrue(record['forced'])
+            self.assertIn('cumulative', record['cprofile'])
+
+            page = self.client.get(reverse('panel_profiles'), {'view': 'home'})
+            self.assertContains(page, '<code>home</code>', html=False)
+
+            download = self.client.get(reverse('panel_profiles'), {'view': 'home', 'download': '1'})
+            self.assertEqual(download['Content-Disposition'], 'attachment; filename="home.collapsed.txt"')
+            unknown = self.client.get(reverse('panel_profiles'), {'view': 'x"\r\nSet-Cookie: a=b', 'download': '1'})
+            self.assertEqual(unknown.status_code, 404)
+
+    def test_store_rotates(self):
+        store = profiling.ProfileStore(self.tmpdir, max_files=3, max_writes_per_minute=100)
+        for i in range(5):
+            store.save({'view': 'v', 'duration_ms': i, 'started_at': '', 'stacks': {}})
+        self.assertEqual(len(store.records()), 3)
+
+
+class StructuredLoggingTests(TestCase):
+    def make_logger(self, **filter_kwargs):
+        stream = io.StringIO()
+        target = logging.StreamHandler(stream)
+        target.setFormatter(log.JsonFormatter())
+        target.addFilter(log.PayloadFilter(**filter_kwargs))
+        handler = log.AsyncQueueHandler([target])
+        logger = logging.getLogger('cantrilapp.tests.structured')
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        self.addCleanup(handler.close)
+        return logger, handler, stream
+
+    def lines(self, handler, stream):
+        handler.stop()  # drains the queue
+        return [json.loads(line) for line in stream.getvalue().splitlines()]
+
+    def test_json_lines_with_truncated_payload(self):
+        logger, handler, stream = self.make_logger(max_chars=10)
+        logger.info('webhook %s', 'x', extra={'payload': {'text': 'a' * 50}, 'qid': 'q1'})
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            logger.warning('failed', exc_info=True)
+        first, second = self.lines(handler, stream)
+        self.assertEqual((first['msg'], first['qid']), ('webhook x', 'q1'))
+        self.assertEqual(len(first['payload']), 11)
+        self.assertTrue(first['payload_truncated'])
+        self.assertIn('ValueError: boom', second['exc'])
+
+    def test_sampled_out_payload_keeps_the_record(self):
+        logger, handler, stream = self.make_logger(sample_rate=0.0)
+        logger.info('webhook', extra={'payload': [1, 2, 3]})
+        (line,) = self.lines(handler, stream)
+        self.assertIsNone(line['payload'])
+        self.assertTrue(line['payload_sampled_out'])
+
+    def test_full_queue_drops_instead_of_blocking(self):
+        logger, handler, stream = self.make_logger()
+        handler.stop()
+        handler.queue.maxsize = 1
+        logger.info('one')
+        logger.info('two')
+        self.assertEqual(handler.dropped, 1)
+
+
+class N8nClientTests(TestCase):
+    def test_breaker_fails_fast_then_recovers(self):
+        with override_settings(N8N={'failure_threshold': 2, 'reset_timeout': 123.0}), \
+                mock.patch('cantrilapp.n8n.requests.Session.post', side_effect=n8n.requests.ConnectionError) as post:
+            breaker = n8n.get_breaker()
+            self.addCleanup(breaker.record_success)
+            for _ in range(2):
+                with self.assertRaises(n8n.requests.ConnectionError):
+                    n8n.post('text', json={})
+            with self.assertRaises(n8n.N8nUnavailable):
+                n8n.post('text', json={})
+            self.assertEqual(post.call_count, 2)
+            self.assertIn('cantril_n8n_circuit_open 1', metrics.render_prometheus())
+
+            breaker.opened_at -= 124  # reset_timeout elapsed: one trial call goes out
+            post.side_effect = None
+            post.return_value = _FakeN8nResponse()
+            n8n.post('text', json={})
+            self.assertEqual(breaker.state, n8n.CircuitBreaker.CLOSED)
+            self.assertEqual(post.call_args.kwargs['timeout'], (3.05, 10.0))
+
+    def test_cancelled_trial_does_not_wedge_the_breaker(self):
+        with override_settings(N8N={'failure_threshold': 1, 'reset_timeout': 123.0}), \
+                mock.patch('httpx.AsyncClient.post', new_callable=mock.AsyncMock,
+                           side_effect=asyncio.CancelledError) as post:
+            breaker = n8n.get_breaker()
+            self.addCleanup(breaker.record_success)
+            breaker.record_failure()
+            breaker.opened_at -= 124
+            with self.assertRaises(asyncio.CancelledError):
+                async_to_sync(n8n.apost)('text', json={})
+            self.assertEqual(post.call_count, 1)
+            # no verdict: the next call is the trial
+            self.assertEqual(breaker.state, n8n.CircuitBreaker.OPEN)
+            self.assertTrue(breaker.allow())
+
+            # a trial that never reports back stops blocking after reset_timeout
+            self.assertFalse(breaker.allow())
+            breaker.trial_at -= 124
+            self.assertTrue(breaker.allow())
+
+    def test_shared_session_and_mime_table(self):
+        self.assertIs(n8n.get_session(), n8n.get_session())
+        self.assertEqual(n8n.mime_type('audio_answers/x.WEBM'), 'audio/webm')
+        self.assertEqual(n8n.mime_type('x.bin'), 'application/octet-stream')
+
+
+class ReconcileTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.patient = Patient.objects.create(pesel='90010112345', first_name='Jan', last_name='Test')
+        now = timezone.now()
+
+        def answer(question_id, kind='text', age=timedelta(hours=1), **fields):
+            pr = PatientResponse.objects.create(patient=cls.patient, json_survey_id='run-1', question_id=question_id,
+                                                response_type=kind, text_answer='x', **fields)
+            PatientResponse.objects.filter(pk=pr.pk).update(created_at=now - age)
+            return pr.pk
+
+        cls.ok = answer('q1')
+        cls.failing = answer('q2')
+        cls.fresh = answer('q3', age=timedelta(seconds=5))
+        cls.scale = answer('q4', kind='scale')
+        cls.exhausted = answer('q5', dispatch_attempts=10)
+        cls.recent_retry = answer('q6', dispatch_attempts=1, last_dispatch_at=now - timedelta(minutes=1))
+
+    def test_sweep_sends_stale_answers_and_records_attempts(self):
+        failed = _FakeN8nResponse()
+        failed.status_code = 500
+        out = io.StringIO()
+        with mock.patch('cantrilapp.n8n.requests.Session.post', side_effect=[_FakeN8nResponse(), failed]) as post:
+            call_command('reconcile_responses', rate=0, stdout=out, stderr=io.StringIO())
+        self.assertEqual([c.kwargs['json']['questionID'] for c in post.call_args_list], ['q1', 'q2'])
+
+        rows = {r.pk: r for r in PatientResponse.objects.all()}
+        self.assertTrue(rows[self.ok].is_processed)
+        self.assertFalse(rows[self.failing].is_processed)
+        self.assertEqual((rows[self.ok].dispatch_attempts, rows[self.failing].dispatch_attempts), (1, 1))
+        self.assertIsNotNone(rows[self.failing].last_dispatch_at)
+        self.assertEqual(rows[self.exhausted].dispatch_attempts, 10)
+        self.assertIn('Backlog: 5 answer(s)', out.getvalue())
+        self.assertIn('1 accepted, 1 failed', out.getvalue())
+
+    def test_backlog_age_percentiles(self):
+        ages = reconcile.backlog_ages(reconcile.dispatch_backlog(), timezone.now())
+        self.assertEqual(ages['count'], 5)
+        self.assertGreaterEqual(ages['max'], 3600)
+        self.assertLessEqual(ages['p50'], ages['p90'])
+        self.assertLessEqual(ages['p90'], ages['p99'])
+
+
+class AdminChangelistTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser('admin', password='x')
+        cls.patients = [Patient.objects.create(pesel=f'850101{i:05d}', last_name=f'N{i}') for i in range(3)]
+        cls.other = Patient.objects.create(pesel='90010112345')
+        cls.responses = [
+            PatientResponse.objects.create(patient=p, json_survey_id='run', question_id='q1', response_type=kind,
+                                           evaluated_score=5, scored_at=timezone.now(), is_processed=True)
+            for p in cls.patients + [cls.other] for kind in ('text', 'scale')
+        ]
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def test_changelist_without_full_count(self):
+        url = reverse('admin:cantrilapp_patientresponse_changelist')
+        with CaptureQueriesContext(connection) as ctx:
+            page = self.client.get(url)
+        self.assertEqual(page.status_code, 200)
+        counts = [q['sql'] for q in ctx.captured_queries if 'COUNT(' in q['sql'] and RESPONSE_TABLE in q['sql']]
+        self.assertEqual(counts, [])
+        joins = [q['sql'] for q in ctx.captured_queries if 'FROM "cantrilapp_patient"' in q['sql']]
+        self.assertEqual(joins, [])  # list_select_related: no per-row patient lookups
+
+    def test_pesel_prefix_is_a_range(self):
+        url = reverse('admin:cantrilapp_patientresponse_changelist')
+        with CaptureQueriesContext(connection) as ctx:
+            page = self.client.get(url, {'q': '850101'})
+        self.assertEqual(len(page.context['cl'].result_list), 6)
+        self.assertFalse([q for q in ctx.captured_queries if 'LIKE' in q['sql']])
+
+        page = self.client.get(reverse('admin:cantrilapp_patient_changelist'), {'q': '9001'})
+        self.assertEqual(list(page.context['cl'].result_list), [self.other])
+
+    def test_rescore_action_is_one_update(self):
+        ids = [str(r.pk) for r in self.responses[:4]]  # 2 text + 2 scale
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.post(reverse('admin:cantrilapp_patientresponse_changelist'),
+                             {'action': 'rescore', '_selected_action': ids})
+        self.assertEqual(len([q for q in ctx.captured_queries if q['sql'].startswith('UPDATE')]), 1)
+        text = PatientResponse.objects.filter(pk__in=ids, response_type='text')
+        self.assertEqual(list(text.values_list('is_processed', 'evaluated_score').distinct()), [(False, None)])
+        # the cleared score is stamped for the incremental jobs
+        self.assertFalse(text.filter(scored_at__isnull=True).exists())
+        self.assertEqual(PatientResponse.objects.filter(pk__in=ids, response_type='scale', evaluated_score=5).count(), 2)
+
+
+class FragmentCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.survey = Survey.objects.create(title='Ankieta')
+        cls.patient = Patient.objects.create(pesel='90010112345', first_name='Jan', last_name='Test')
+        for run in ('run-1', 'run-2'):
+            for q in ('q1', 'q2'):
+                PatientResponse.objects.create(patient=cls.patient, survey=cls.survey, json_survey_id=run,
+                                               question_id=q, response_type='text', text_answer='x')
+
+    def setUp(self):
+        fragments.get_cache().clear()
+        self.url = reverse('panel_survey_completions', args=[self.survey.id, self.patient.id])
+
+    def get(self, url):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        return response, [q['sql'] for q in ctx.captured_queries if RESPONSE_TABLE in q['sql']]
+
+    def test_repeated_views_are_served_from_cache(self):
+        for url in (self.url, reverse('panel_history'), reverse('panel_patient_history', args=[self.patient.id])):
+            first, queries = self.get(url)
+            self.assertTrue(queries)
+            second, queries = self.get(url)
+            self.assertEqual(queries, [])
+            self.assertEqual(first.content, second.content)
+
+    def test_score_rerenders_only_the_scored_run(self):
+        self.get(self.url)
+        with self.captureOnCommitCallbacks(execute=True):
+            record_scores([('q1', 'run-2', 8)])
+        response, queries = self.get(self.url)
+        self.assertContains(response, 'Wynik: 8.0')
+        cards = [sql for sql in queries if 'ORDER BY' in sql and '"question_id"' in sql]
+        self.assertEqual(len(cards), 1)
+        self.assertIn("'run-2'", cards[0])
+        self.assertNotIn("'run-1'", cards[0])
+
+    def test_new_response_bumps_patient_and_run(self):
+        scopes = [fragments.HISTORY, fragments.patient_scope(self.patient.id), fragments.run_scope('run-3')]
+        before = fragments.generations(scopes)
+        with self.captureOnCommitCallbacks(execute=True):
+            PatientResponse.objects.create(patient=self.patient, survey=self.survey, json_survey_id='run-3',
+                                           question_id='q1', response_type='scale', scale_value=5)
+        after = fragments.generations(scopes)
+        self.assertTrue(all(after[s] > before[s] for s in scopes))
+
+
+class ConditionalGetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.survey = Survey.objects.create(title='Ankieta')
+        cls.patient = Patient.objects.create(pesel='90010112345')
+        PatientResponse.objects.create(patient=cls.patient, survey=cls.survey, json_survey_id='run-1',
+                                       question_id='q1', response_type='scale', scale_value=5)
+
+    def setUp(self):
+        fragments.get_cache().clear()
+
+    def revalidate(self, url, etag, **params):
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url, params, HTTP_IF_NONE_MATCH=etag)
+        return response, [q['sql'] for q in ctx.captured_queries if RESPONSE_TABLE in q['sql']]
+
+    def test_panel_page_answers_304_until_data_changes(self):
+        url = reverse('panel_history')
+        first = self.client.get(url)
+        self.assertIn('ETag', first)
+        self.assertIn('Last-Modified', first)
+        self.assertIn('no-cache', first['Cache-Control'])
+
+        response, queries = self.revalidate(url, first['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(queries, [])
+        self.assertEqual(self.client.get(url, {'q': 'x'}, HTTP_IF_NONE_MATCH=first['ETag']).status_code, 200)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            PatientResponse.objects.create(patient=self.patient, survey=self.survey, json_survey_id='run-2',
+                                           question_id='q1', response_type='scale', scale_value=7)
+        self.assertEqual(self.revalidate(url, first['ETag'])[0].status_code, 200)
+
+    def test_counter_pages_are_not_validated_with_the_cache_off(self):
+        caches = {**settings.CACHES, 'fragments': settings.FRAGMENT_CACHE_BACKENDS['off']}
+        with override_settings(CACHES=caches):
+            for url in (reverse('panel_history'), reverse('panel_patient_history', args=[self.patient.id]),
+                        reverse('panel_results')):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 200)
+                self.assertNotIn('ETag', response)
+                self.assertNotIn('Last-Modified', response)
+
+    def test_results_304_reads_only_watermarks(self):
+        url = reverse('panel_results')
+        etag = self.client.get(url, {'pesel': self.patient.pesel})['ETag']
+        response, queries = self.revalidate(url, etag, pesel=self.patient.pesel)
+        self.assertEqual(response.status_code, 304)
+        self.assertTrue(queries)
+        self.assertTrue(all('MAX(' in sql for sql in queries))
+
+        PatientResponse.objects.update(evaluated_score=8, scored_at=timezone.now())
+        self.assertEqual(self.revalidate(url, etag, pesel=self.patient.pesel)[0].status_code, 200)
+
+    def test_question_page_follows_survey_version(self):
+        session = self.client.session
+        session.update({'patient_id': self.patient.id, 'survey_uuid': str(self.survey.id), 'answers': {}})
+        session.save()
+        url = reverse('ankieta_cantril_question', args=[1])
+        self.client.get(url)  # sets the CSRF cookie, which is part of the ETag
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.revalidate(url, etag)[0].status_code, 304)
+
+        Survey.objects.filter(pk=self.survey.pk).update(version=2)
+        self.assertEqual(self.revalidate(url, etag)[0].status_code, 200)
+        # the GET past the last question saves the run: never validated
+        with tempfile.TemporaryDirectory() as tmp, override_settings(BASE_DIR=tmp):
+            self.assertNotIn('ETag', self.client.get(reverse('ankieta_cantril_question', args=[99])))
+
+
+class ScoreEventsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.survey = Survey.objects.create(title='Ankieta')
+        cls.patient = Patient.objects.create(pesel='90010112345', first_name='Jan', last_name='Test')
+        cls.other = Patient.objects.create(pesel='85020254321')
+        for patient, run in ((cls.patient, 'run-1'), (cls.other, 'run-2')):
+            PatientResponse.objects.create(patient=patient, survey=cls.survey, json_survey_id=run,
+                                           question_id='q1', response_type='audio')
+
+    def setUp(self):
+        self.enterContext(mock.patch.object(events, '_broker', None))
+        self.broker = events.get_broker()
+
+    def score(self, *items):
+        with self.captureOnCommitCallbacks(execute=True):
+            record_scores(list(items))
+
+    async def read(self, url, **headers):
+        # streams end after SCORE_EVENTS['max_age']
+        response = await self.async_client.get(url, headers=headers)
+        chunks = [chunk.decode() async for chunk in response.streaming_content]
+        return response, chunks
+
+    def test_scores_are_published_with_their_patient(self):
+        start = self.broker.last_id()
+        self.score(('q1', 'run-1', 7), ('q1', 'run-2', '4'), ('q9', 'run-1', 1))
+        self.assertEqual([(e.patient, e.data) for e in self.broker._since(start)], [
+            (self.patient.id, {'patient': self.patient.id, 'run': 'run-1', 'question': 'q1', 'score': 7.0}),
+            (self.other.id, {'patient': self.other.id, 'run': 'run-2', 'question': 'q1', 'score': 4.0}),
+        ])
+
+    def test_resume_is_refused_across_restarts_and_gaps(self):
+        broker = events.Broker(buffer_size=2)
+        ids = [broker.publish(1, 'r', {}).id for _ in range(4)]
+        self.assertEqual([e.id for e in broker._since(ids[2])], ids[3:])
+        self.assertIsNone(broker._since(ids[0]))
+        self.assertIsNone(broker._since('other-3'))
+
+    @override_settings(ASYNC_VIEWS=True, SCORE_EVENTS={'max_age': 0})
+    async def test_stream_replays_missed_scores_for_its_patient(self):
+        start = self.broker.last_id()
+        await sync_to_async(self.score)(('q1', 'run-2', 3), ('q1', 'run-1', 9))
+        url = reverse('panel_score_events') + f'?patient={self.patient.id}'
+        response, (retry, event) = await self.read(url, **{'Last-Event-ID': start})
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertTrue(retry.startswith('retry: '))
+        self.assertIn('event: score', event)
+        self.assertIn('"run": "run-1"', event)
+        self.assertEqual(self.broker.subscriber_count(), 0)
+
+    @override_settings(ASYNC_VIEWS=True, SCORE_EVENTS={'max_age': 0.5, 'heartbeat': 0.1})
+    async def test_live_score_reaches_open_stream(self):
+        response = await self.async_client.get(reverse('panel_score_events') + '?run=run-1')
+        stream = response.streaming_content
+        await anext(stream)  # retry: subscribed from here on
+        await sync_to_async(self.score)(('q1', 'run-2', 3), ('q1', 'run-1', 6))
+        rest = [chunk.decode() async for chunk in stream]
+        self.assertIn('"score": 6.0', rest[0])
+        self.assertNotIn('run-2', ''.join(rest))
+
+    @override_settings(ASYNC_VIEWS=True)
+    async def test_unknown_last_event_id_resets(self):
+        _, (_, reset) = await self.read(reverse('panel_score_events'), **{'Last-Event-ID': 'gone-12'})
+        self.assertTrue(reset.startswith('event: reset'))
+
+    @override_settings(ASYNC_VIEWS=True, SCORE_EVENTS={'max_age': 0})
+    async def test_stale_rendered_id_starts_from_now(self):
+        _, chunks = await self.read(reverse('panel_score_events') + '?last_event_id=gone-12')
+        self.assertEqual(len(chunks), 1)
+        self.assertTrue(chunks[0].startswith('retry: '))
+
+    @override_settings(ASYNC_VIEWS=True)
+    def test_restart_invalidates_pages_with_a_stream(self):
+        fragments.get_cache().clear()
+        for url in (reverse('panel_results'),
+                    reverse('panel_survey_completions', args=[self.survey.id, self.patient.id])):
+            etag = self.client.get(url)['ETag']
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            with mock.patch.object(events, '_broker', None):
+                self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+    @override_settings(ASYNC_VIEWS=True)
+    def test_panel_page_resumes_from_render_time(self):
+        self.score(('q1', 'run-1', 5))
+        page = self.client.get(reverse('panel_results'), {'pesel': self.patient.pesel})
+        self.assertContains(page, f'patient={self.patient.id}&amp;last_event_id={self.broker.last_id()}')
+        self.assertContains(page, 'data-score="run-1|q1"')
+
+    def test_wsgi_deployments_get_no_stream(self):
+        self.assertEqual(self.client.get(reverse('panel_score_events')).status_code, 204)
+        page = self.client.get(reverse('panel_results'))
+        self.assertNotContains(page, 'score_events.js')
+
+
+class SurveyEditingTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.mkdtemp(prefix='cantril-surveys-')
+        self.addCleanup(shutil.rmtree, tmp, ignore_errors=True)
+        self.enterContext(override_settings(BASE_DIR=tmp))
+        self.active = os.path.join(tmp, 'ankieta_pytania.json')
+        self.enterContext(mock.patch('cantrilapp.views.QUESTION_FILE_PATH', self.active))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.survey, _ = surveys.save_survey('Nastroj', 'classic', [
+                {'key': f'q{i}', 'text': f'Pytanie {i}'} for i in range(1, 5)
+            ], active_file=self.active)
+
+    def post(self, rows, title='Nastroj', **extra):
+        return self.client.post(reverse('manage_questions'), {
+            'title': title, 'survey_uuid': str(self.survey.id), 'ladder_design': 'classic',
+            'questions': [text for _, text in rows], 'question_keys': [key for key, _ in rows],
+            'scale_labels_min[]': [''] * len(rows), 'scale_labels_max[]': [''] * len(rows), **extra,
+        })
+
+    def test_edit_applies_only_the_diff_and_keeps_question_ids(self):
+        ids = dict(self.survey.questions.values_list('key', 'id'))
+        rows = [('q3', 'Pytanie 3'), ('q1', 'Pytanie 1 (nowe)'), ('', 'Nowe pytanie'), ('q2', 'Pytanie 2')]
+        with self.captureOnCommitCallbacks(execute=True), CaptureQueriesContext(connection) as ctx:
+            self.post(rows)
+        writes = [q['sql'].split()[0] for q in ctx.captured_queries
+                  if q['sql'].startswith(('INSERT', 'UPDATE', 'DELETE')) and 'django_session' not in q['sql']]
+        # survey row, one DELETE (q4), one bulk UPDATE (q1 text, q3/q1/q2 moved), one INSERT
+        self.assertEqual(sorted(writes), ['DELETE', 'INSERT', 'UPDATE', 'UPDATE'])
+        questions = list(self.survey.questions.order_by('order'))
+        self.assertEqual([q.text for q in questions], [text for _, text in rows])
+        self.assertEqual({q.key: q.id for q in questions if q.key in ids}, {k: ids[k] for k in ('q1', 'q2', 'q3')})
+        with open(self.active, encoding='utf-8') as f:
+            mirror = json.load(f)
+        self.assertEqual([q['id'] for q in mirror['questions']], [q.key for q in questions])
+        self.assertEqual(os.listdir(os.path.dirname(self.active)).count('ankieta_pytania.json'), 1)
+        self.survey.refresh_from_db()
+        self.assertEqual(self.survey.version, 2)
+
+    def test_resubmitting_unchanged_survey_writes_nothing(self):
+        rows = [(f'q{i}', f'Pytanie {i}') for i in range(1, 5)]
+        with CaptureQueriesContext(connection) as ctx:
+            self.post(rows)
+        self.assertFalse([q for q in ctx.captured_queries
+                          if q['sql'].startswith(('INSERT', 'UPDATE', 'DELETE')) and 'django_session' not in q['sql']])
+
+    def test_title_uniqueness_ignores_case(self):
+        with self.assertRaises(surveys.SurveyTitleTaken):
+            surveys.save_survey('NASTROJ', 'classic', [{'text': 'x'}])
+        self.assertEqual(Survey.objects.count(), 1)
+        other, _ = surveys.save_survey('Sen', 'classic', [{'text': 'x'}])
+        self.post([('q1', 'Pytanie 1')], survey_uuid=str(other.id), title='nastroj')
+        other.refresh_from_db()
+        self.assertEqual(other.title, 'Sen')
+
+
+class PatientImportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.existing = Patient.objects.create(pesel=pesel_for(date(1950, 3, 4), 17, True),
+                                              first_name='Ewa', last_name='Stara')
+
+    def setUp(self):
+        tmp = tempfile.mkdtemp(prefix='cantril-import-')
+        self.addCleanup(shutil.rmtree, tmp, ignore_errors=True)
+        self.tmp = tmp
+        self.enterContext(override_settings(BASE_DIR=tmp))
+
+    def write_csv(self, lines):
+        path = os.path.join(self.tmp, 'pacjenci.csv')
+        with open(path, 'w', encoding='utf-8-sig') as f:
+            f.write('\n'.join(lines) + '\n')
+        return path
+
+    def test_validate_pesels_checks_checksum_and_birth_date(self):
+        good = [pesel_for(date(1899, 12, 31), 1, True), pesel_for(date(2004, 2, 29), 2, False)]
+        born, errors = patients.validate_pesels(good + ['12345678901', '123', '90023012340'])
+        self.assertEqual([d.item() for d in born[:2]], [date(1899, 12, 31), date(2004, 2, 29)])
+        self.assertEqual(errors[:2], [None, None])
+        self.assertIn('suma kontrolna', errors[2])
+        self.assertIn('11 cyfr', errors[3])
+        self.assertTrue(errors[4])  # 30 February
+
+    def test_command_upserts_in_batches_and_reports_errors(self):
+        new = [pesel_for(date(1980 + i, 1, 1 + i), i, i % 2 == 0) for i in range(5)]
+        path = self.write_csv([
+            'PESEL;first_name;date_of_birth',
+            f'{new[0]};Anna;1980-01-01',
+            f'{new[1]};Piotr;',
+            f'{self.existing.pesel};Ewa Maria;',
+            '12345678901;Zły;',
+            f'{new[2]};Ola;1999-01-01',
+            f'{new[1]};Duplikat;',
+            f'{new[3]};Jan;',
+            f'{new[4]};Adam;',
+        ])
+        out = io.StringIO()
+        with CaptureQueriesContext(connection) as ctx:
+            call_command('import_patients', path, '--batch-size', '3', stdout=out)
+        self.assertIn('4 created, 1 updated, 3 rejected', out.getvalue())
+        inserts = [q for q in ctx.captured_queries if q['sql'].startswith('INSERT INTO "cantrilapp_patient"')]
+        self.assertEqual(len(inserts), 2)  # the middle batch has no valid rows
+        self.assertIn('ON CONFLICT', inserts[0]['sql'])
+
+        self.existing.refresh_from_db()
+        self.assertEqual((self.existing.first_name, self.existing.last_name), ('Ewa Maria', 'Stara'))
+        self.assertEqual(Patient.objects.get(pesel=new[3]).date_of_birth, date(1983, 1, 4))
+        with open(path + '.errors.csv', encoding='utf-8') as f:
+            report = list(csv.reader(f))
+        self.assertEqual(report[0], ['line', 'pesel', 'error', 'pesel', 'first_name', 'date_of_birth'])
+        self.assertEqual([row[0] for row in report[1:]], ['5', '6', '7'])
+        self.assertIn('wiersz 3', report[3][2])
+
+    def test_panel_upload(self):
+        staff = User.objects.create_user('staff', is_staff=True)
+        self.client.force_login(staff)
+        upload = SimpleUploadedFile('p.csv', f'pesel,last_name\n{pesel_for(date(1990, 5, 6), 5, False)},Nowy\n1,x\n'.encode())
+        page = self.client.post(reverse('manage_patients'), {'action': 'import', 'csv': upload})
+        self.assertContains(page, '1 nowych, 0 zaktualizowanych, 1 odrzuconych')
+        report = re.search(r'report=([\w.-]+)', page.content.decode()).group(1)
+        download = self.client.get(reverse('manage_patients'), {'report': report})
+        self.assertIn(b'PESEL musi', b''.join(download.streaming_content))
+        self.assertEqual(self.client.get(reverse('manage_patients'), {'report': '../db.sqlite3'}).status_code, 404)
+
+    def test_panel_search_and_delete(self):
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+        with CaptureQueriesContext(connection) as ctx:
+            page = self.client.get(reverse('manage_patients'), {'q': self.existing.pesel[:4]})
+        self.assertContains(page, self.existing.pesel)
+        self.assertFalse([q for q in ctx.captured_queries if 'LIKE' in q['sql']])
+
+        response = self.client.post(reverse('manage_patients'), {'action': 'delete', 'patient_id': 'x'})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(Patient.objects.filter(pk=self.existing.pk).exists())
+        self.client.post(reverse('manage_patients'), {'action': 'delete', 'patient_id': self.existing.pk})
+        self.assertFalse(Patient.objects.filter(pk=self.existing.pk).exists())
+
+
+class StaticAssetTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.root = tempfile.mkdtemp(prefix='cantril-static-')
+        cls.addClassCleanup(shutil.rmtree, cls.root, ignore_errors=True)
+        storages = {
+            'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+            'staticfiles': {'BACKEND': 'cantrilapp.staticfiles.CompressedManifestStaticFilesStorage'},
+        }
+        cls.enterClassContext(override_settings(STATIC_ROOT=cls.root, STORAGES=storages))
+        call_command('collectstatic', interactive=False, verbosity=0)
+
+    def test_collectstatic_writes_hashed_files_with_gzip_siblings(self):
+        name = staticfiles_storage.stored_name('css/cantril.css')
+        self.assertRegex(name, staticfiles.HASHED_RE)
+        with open(os.path.join(self.root, name), 'rb') as f, open(os.path.join(self.root, name + '.gz'), 'rb') as gz:
+            self.assertEqual(gzip.decompress(gz.read()), f.read())
+        for design, _ in Survey.LADDER_DESIGNS:
+            staticfiles_storage.stored_name(f'css/ladder/{design}.css')  # ValueError when a bundle is missing
+
+    def test_question_page_links_only_its_design(self):
+        html = render_to_string('ankieta_question.html', {
+            'ladder_design': 'modern', 'scale_range': range(1, 11), 'question_number': 1, 'total_questions': 3,
+        })
+        self.assertIn(staticfiles_storage.url('css/ladder/modern.css'), html)
+        self.assertNotIn('ladder/classic', html)
+        self.assertNotIn('style="width:120px', html)
+
+    def test_serve_sends_precompressed_file_with_cache_headers(self):
+        name = staticfiles_storage.stored_name('css/cantril.css')
+        response = self.client.get(f'/static/{name}', HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(response['Content-Type'], 'text/css')
+        self.assertEqual(response['Cache-Control'], staticfiles.IMMUTABLE)
+        self.assertIn('Accept-Encoding', response['Vary'])
+        with open(os.path.join(self.root, name + '.gz'), 'rb') as f:
+            self.assertEqual(b''.join(response.streaming_content), f.read())
+
+        plain = self.client.get('/static/css/cantril.css')
+        self.assertNotIn('Content-Encoding', plain)
+        self.assertEqual(plain['Cache-Control'], 'no-cache')
+        again = self.client.get('/static/css/cantril.css', HTTP_IF_MODIFIED_SINCE=plain['Last-Modified'])
+        self.assertEqual(again.status_code, 304)
+        for path in (f'/static/{name}.gz', '/static/../manage.py', '/static/css/missing.css'):
+            self.assertEqual(self.client.get(path).status_code, 404, path)
+
+
+class TemplateRenderingTests(TestCase):
+    def setUp(self):
+        ladder.clear_cache()
+        self.addCleanup(ladder.clear_cache)
+
+    def test_ladder_fragment_is_rendered_once_per_design_and_labels(self):
+        html = ladder.ladder_html('modern', {'max': '<b>Najlepiej</b>', 'min': 'Źle'})
+        self.assertIs(ladder.ladder_html('modern', {'min': 'Źle', 'max': '<b>Najlepiej</b>'}), html)
+        self.assertEqual(ladder._render.cache_info().misses, 1)
+        self.assertIn('ladder-design-modern', html)
+        self.assertIn('&lt;b&gt;Najlepiej', html)
+        self.assertEqual(html.count('class="ladder-step"'), 10)
+
+    def test_saving_a_survey_precompiles_its_ladders(self):
+        tmp = tempfile.mkdtemp(prefix='cantril-surveys-')
+        self.addCleanup(shutil.rmtree, tmp, ignore_errors=True)
+        questions = [{'text': 'A', 'scale_labels': {'min': 'Źle', 'max': 'Dobrze'}}, {'text': 'B'}]
+        with override_settings(BASE_DIR=tmp), self.captureOnCommitCallbacks(execute=True):
+            surveys.save_survey('Precompile', 'circular', questions)
+        self.assertEqual(ladder._render.cache_info().currsize, 2)
+        ladder.ladder_html('circular', {'min': 'Źle', 'max': 'Dobrze'})
+        self.assertEqual(ladder._render.cache_info().hits, 1)
+
+    def test_response_card_tag(self):
+        rows = [{'question_text': f'Pytanie {i}', 'response_type': 'audio', 'json_survey_id': 'run1',
+                 'question_id': f'q{i}', 'evaluated_label': 'Brak', 'patient_pesel': '90010100000'} for i in range(3)]
+        html = render_to_string('panel_results.html', {'rows': rows})
+        self.assertEqual(html.count('class="response-card"'), 3)
+        self.assertIn('data-score="run1|q2"', html)
+
+    def test_bench_templates_reports_every_page_and_mode(self):
+        out = io.StringIO()
+        call_command('bench_templates', '--iterations', '2', '--warmup', '0', '--rows', '3', '--json', stdout=out)
+        results = json.loads(out.getvalue())
+        self.assertEqual({(r['page'], r['mode']) for r in results}, {
+            (page, mode) for page in ('ankieta_question', 'panel_results', 'panel_history_patients')
+            for mode in ('development', 'production')
+        })
+
+
+class KioskTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.survey = Survey.objects.create(title='Kiosk', ladder_design='modern')
+        Question.objects.bulk_create([
+            Question(survey=cls.survey, key=f'q{i}', text=f'Pytanie {i}', order=i,
+                     scale_labels={'min': 'Źle', 'max': 'Dobrze'})
+            for i in (1, 2)
+        ])
+
+    def setUp(self):
+        tmp = tempfile.mkdtemp(prefix='cantril-kiosk-')
+        self.addCleanup(shutil.rmtree, tmp, ignore_errors=True)
+        self.enterContext(override_settings(MEDIA_ROOT=tmp))
+        self.pesel = pesel_for(date(1985, 6, 7), 3, True)
+
+    def run_data(self, n=0, mode='cantril', answers=None):
+        return {
+            'run_id': f'{n:032x}_20250115T1030{n % 60:02d}', 'survey': str(self.survey.id), 'pesel': self.pesel,
+            'mode': mode, 'started_at': '2025-01-15T10:30:00Z', 'finished_at': '2025-01-15T10:32:00Z',
+            'answers': answers or [{'question': f'q{i}', 'type': 'scale', 'value': i + 5} for i in (1, 2)],
+        }
+
+    def sync(self, runs, **files):
+        return self.client.post(reverse('kiosk_sync'), {'runs': json.dumps(runs), 'device': 'tablet-1', **files})
+
+    def test_sync_stores_whole_runs_and_is_idempotent(self):
+        runs = [self.run_data(1), self.run_data(2)]
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.sync(runs)
+        self.assertEqual(response.json(), {'status': 'ok', 'runs': {r['run_id']: 'created' for r in runs}})
+        patient = Patient.objects.get(pesel=self.pesel)
+        self.assertEqual(patient.date_of_birth, date(1985, 6, 7))
+        rows = PatientResponse.objects.filter(json_survey_id=runs[0]['run_id']).order_by('question_id')
+        self.assertEqual([(r.question_id, r.scale_value, r.question_text) for r in rows],
+                         [('q1', 6, 'Pytanie 1'), ('q2', 7, 'Pytanie 2')])
+        self.assertEqual(KioskRun.objects.get(run_id=runs[0]['run_id']).device, 'tablet-1')
+
+        # the device lost the response and sends everything again
+        with self.assertNumQueries(1):
+            again = self.sync(runs).json()
+        self.assertEqual(set(again['runs'].values()), {'duplicate'})
+        self.assertEqual(PatientResponse.objects.count(), 4)
+
+    def test_invalid_run_is_rejected_without_partial_rows(self):
+        bad = self.run_data(3, answers=[
+            {'question': 'q1', 'type': 'scale', 'value': 4},
+            {'question': 'q2', 'type': 'scale', 'value': 11},
+        ])
+        wrong_type = self.run_data(4, mode='voice')
+        result = self.sync([bad, wrong_type, self.run_data(5)]).json()['runs']
+        self.assertIn('1-10', result[bad['run_id']])
+        self.assertIn('niedozwolony', result[wrong_type['run_id']])
+        self.assertEqual(result[self.run_data(5)['run_id']], 'created')
+        self.assertEqual(PatientResponse.objects.count(), 2)
+        self.assertEqual(self.sync('nope').status_code, 400)
+
+    def test_run_with_an_invalid_pesel_is_rejected(self):
+        run = dict(self.run_data(8), pesel='12345678901')
+        self.assertEqual(kiosk.ingest([run], {}), {run['run_id']: 'rejected: Błędna suma kontrolna PESEL'})
+        self.assertFalse(Patient.objects.filter(pesel=run['pesel']).exists())
+
+    def test_voice_run_uploads_audio_for_the_sweeper(self):
+        data = self.run_data(6, mode='voice', answers=[
+            {'question': 'q1', 'type': 'audio', 'file': 'a1'},
+            {'question': 'q2', 'type': 'text', 'value': 'Dobrze'},
+        ])
+        self.assertEqual(self.sync([data], a1=SimpleUploadedFile('a1.webm', b'\x1a\x45\xdf\xa3webm', 'audio/webm')).json()['runs'],
+                         {data['run_id']: 'created'})
+        audio = PatientResponse.objects.get(question_id='q1')
+        self.assertTrue(audio.audio_file.name.startswith('audio_answers/'))
+        self.assertFalse(audio.is_processed)  # left for reconcile_responses
+        missing = self.run_data(7, mode='voice', answers=[{'question': 'q1', 'type': 'audio', 'file': 'gone'}])
+        self.assertIn('brak pliku', self.sync([missing]).json()['runs'][missing['run_id']])
+
+    def test_definitions_and_service_worker(self):
+        surveys_ = self.client.get(reverse('kiosk_surveys')).json()['surveys']
+        q1 = surveys_[0]['questions'][0]
+        self.assertEqual((surveys_[0]['id'], q1['id']), (str(self.survey.id), 'q1'))
+        self.assertIn('ladder-design-modern', q1['ladder'])
+        sw = self.client.get(reverse('kiosk_service_worker'))
+        self.assertEqual(sw['Content-Type'], 'text/javascript; charset=utf-8')
+        body = sw.content.decode()
+        for url in (reverse('kiosk'), reverse('kiosk_surveys'), '/static/js/kiosk.js', '/static/css/ladder/modern.css'):
+            self.assertIn(json.dumps(url), body)
+        self.assertIn('csrftoken', self.client.get(reverse('kiosk')).cookies)
+
+
+class AudioProfileTests(TestCase):
+    def setUp(self):
+        tmp = tempfile.mkdtemp(prefix='cantril-audio-')
+        self.addCleanup(shutil.rmtree, tmp, ignore_errors=True)
+        self.enterContext(override_settings(BASE_DIR=tmp, MEDIA_ROOT=tmp))
+        self.active = os.path.join(tmp, 'ankieta_pytania.json')
+        self.enterContext(mock.patch('cantrilapp.views.QUESTION_FILE_PATH', self.active))
+        self.n8n = self.enterContext(mock.patch('cantrilapp.n8n.requests.Session.post', return_value=_FakeN8nResponse()))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.survey, _ = surveys.save_survey('Głos', 'classic', [{'key': 'q1', 'text': 'Jak się czujesz?'}],
+                                                 active_file=self.active,
+                                                 audio_profile=audio.clean_profile({'bitrate': 16000, 'max_seconds': 10}))
+        patient = Patient.objects.create(pesel='90010112345')
+        session = self.client.session
+        session.update({'patient_id': patient.id, 'survey_uuid': str(self.survey.id), 'survey_run_id': 'run-audio'})
+        session.save()
+
+    def answer(self, data, **extra):
+        upload = SimpleUploadedFile('a.webm', data, content_type='audio/webm')
+        return self.client.post(reverse('ankieta_voice_question', args=[1]),
+                                {'response_type': 'audio', 'audio_file': upload}, **extra)
+
+    def test_profile_is_validated_and_versioned(self):
+        self.assertEqual(audio.profile_for(self.survey), {'bitrate': 16000, 'max_seconds': 10, 'trim_silence': False})
+        for bad in ({'bitrate': 12345}, {'max_seconds': 5}, {'bitrate': 'x'}):
+            with self.assertRaises(ValueError):
+                audio.clean_profile(bad)
+        self.client.post(reverse('manage_questions'), {
+            'title': 'Głos', 'survey_uuid': str(self.survey.id), 'ladder_design': 'classic',
+            'questions': ['Jak się czujesz?'], 'question_keys': ['q1'],
+            'audio_bitrate': '32000', 'audio_max_seconds': '60', 'audio_trim_silence': 'on',
+        })
+        self.survey.refresh_from_db()
+        self.assertEqual((self.survey.version, self.survey.audio_profile),
+                         (2, {'bitrate': 32000, 'max_seconds': 60, 'trim_silence': True}))
+        page = self.client.get(reverse('ankieta_voice_question', args=[1]))
+        self.assertEqual(page.context['audio_profile']['max_bytes'], audio.max_bytes(audio.profile_for(self.survey)))
+        self.assertContains(page, '<script id="audio_profile" type="application/json">')
+
+    def test_uploads_are_checked_against_the_profile(self):
+        limit = audio.max_bytes(audio.profile_for(self.survey))
+        page = self.answer(b'\x1a\x45\xdf\xa3' + b'0' * limit)
+        self.assertContains(page, 'Nagranie jest za duże')
+        self.assertContains(self.answer(b'RIFF0000WAVE'), 'Nieobsługiwany format')
+        # whole body announced larger than any profile allows: answered before it is read
+        self.assertEqual(self.answer(b'OggS', CONTENT_LENGTH=str(audio.MAX_UPLOAD_BYTES * 2)).status_code, 413)
+        self.assertFalse(PatientResponse.objects.exists())
+
+        # CSRF is still checked, after the upload handlers are in place
+        self.client.handler.enforce_csrf_checks = True
+        self.assertEqual(self.answer(b'OggS').status_code, 403)
+        self.client.handler.enforce_csrf_checks = False
+        self.assertEqual(self.answer(b'OggS' + b'0' * 1000).status_code, 302)
+        self.assertTrue(PatientResponse.objects.get(json_survey_id='run-audio').audio_file.name.endswith('.webm'))
+
+    def test_safari_mp4_recording_is_accepted(self):
+        # older iPad Safari records AAC in MP4 when it has no Opus encoder
+        mp4 = b'\x00\x00\x00\x1cftypM4A ' + b'0' * 1000
+        upload = SimpleUploadedFile('response.m4a', mp4, content_type='audio/mp4')
+        page = self.client.post(reverse('ankieta_voice_question', args=[1]), {'response_type': 'audio', 'audio_file': upload})
+        self.assertEqual(page.status_code, 302)
+        self.assertTrue(PatientResponse.objects.get(json_survey_id='run-audio').audio_file.name.endswith('.m4a'))
+        self.assertIn('audio/mp4', audio.client_profile(audio.profile_for(self.survey))['mime_types'])
+        self.assertEqual(n8n.mime_type('response.m4a'), 'audio/mp4')
+
+
+class ArchiveTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.survey = Survey.objects.create(title='Retencja', ladder_design='classic')
+        cls.patient = Patient.objects.create(pesel='90010112345')
+        now = timezone.now()
+        for run_id, age in (('run-old', 800), ('run-older', 900), ('run-new', 10)):
+            PatientResponse.objects.bulk_create([
+                PatientResponse(patient=cls.patient, survey=cls.survey, json_survey_id=run_id, question_id=f'q{i}',
+                                question_text=f'Pytanie {i}', response_type='scale', scale_value=i + 4,
+                                evaluated_score=i + 4, is_processed=True)
+                for i in (1, 2)
+            ])
+            PatientResponse.objects.filter(json_survey_id=run_id).update(created_at=now - timedelta(days=age))
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='cantril-archive-')
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+        self.enterContext(override_settings(ARCHIVE_DIR=self.dir))
+
+    def archive(self, *args):
+        out = io.StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('archive_responses', *args, stdout=out)
+        return out.getvalue()
+
+    def test_old_runs_move_to_monthly_files_and_read_back(self):
+        hot = {r.pk: (r.question_id, r.scale_value, r.created_at)
+               for r in PatientResponse.objects.filter(json_survey_id__in=['run-old', 'run-older'])}
+        self.assertIn('[dry run] 2 run(s), 4 response(s)', self.archive('--months', '24', '--dry-run'))
+        self.assertEqual(os.listdir(self.dir), [])
+
+        self.assertIn('2 run(s), 4 response(s)', self.archive('--months', '24', '--batch-runs', '1', '--delete-batch', '1'))
+        self.assertEqual(set(PatientResponse.objects.values_list('json_survey_id', flat=True)), {'run-new'})
+        runs = {r.run_id: r for r in ArchivedRun.objects.all()}
+        self.assertEqual(set(runs), {'run-old', 'run-older'})
+        old = runs['run-old']
+        self.assertEqual((old.responses, old.processed, old.scores, old.mean_scale, old.survey_id),
+                         (2, 2, {'q1': [5, 5.0], 'q2': [6, 6.0]}, 5.5, self.survey.id))
+        with open(archive.index_path(self.dir, old.period)) as f:
+            self.assertEqual(json.load(f)[f'{self.patient.id}/run-old'], [old.offset, old.length, 2])
+        # one gzip stream per month: zcat reads every run in it
+        with gzip.open(archive.data_path(self.dir, old.period), 'rt') as f:
+            self.assertTrue(all(json.loads(line)['json_survey_id'] in runs for line in f))
+
+        back = archive.read_runs(runs.values(), self.dir)
+        self.assertEqual({r.pk: (r.question_id, r.scale_value, r.created_at) for rows in back.values() for r in rows}, hot)
+        # nothing left past retention
+        self.assertIn('0 run(s)', self.archive())
+
+    def test_panel_pages_show_archived_runs(self):
+        self.archive()
+        completions = self.client.get(reverse('panel_survey_completions', args=[self.survey.id, self.patient.id]))
+        self.assertEqual(len(completions.context['completion_cards']), 3)
+        self.assertContains(completions, 'Archiwum', count=2)
+        results = self.client.get(reverse('panel_results'), {'pesel': self.patient.pesel, 'survey_id': 'run-old'})
+        self.assertEqual([(r['question_id'], r['scale_value']) for r in results.context['rows']], [('q1', 5), ('q2', 6)])
+        history = self.client.get(reverse('panel_history'))
+        self.assertContains(history, 'survey_id=run-older')
+        runs = self.client.get(reverse('panel_patient_history', args=[self.patient.id]))
+        self.assertContains(runs, '<td>6</td>')
+
+    def test_missing_archive_file_falls_back_to_summaries(self):
+        self.archive()
+        for name in os.listdir(self.dir):
+            os.remove(os.path.join(self.dir, name))
+        with self.assertLogs('cantrilapp.archive', 'WARNING'):
+            results = self.client.get(reverse('panel_results'), {'pesel': self.patient.pesel, 'survey_id': 'run-old'})
+        self.assertEqual([(r['question_id'], r['scale_value'], r['evaluated_score']) for r in results.context['rows']],
+                         [('q1', 5, 5.0), ('q2', 6, 6.0)])
+        with self.assertLogs('cantrilapp.archive', 'WARNING'):
+            completions = self.client.get(reverse('panel_survey_completions', args=[self.survey.id, self.patient.id]))
+        self.assertEqual(len(completions.context['completion_cards']), 3)
+
+
+class ExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.survey = Survey.objects.create(title='Eksport')
+        cls.patient = Patient.objects.create(pesel='90010112345', first_name='Anna')
+        for day, run_id in ((10, 'run-a'), (20, 'run-b')):
+            PatientResponse.objects.bulk_create([
+                PatientResponse(patient=cls.patient, survey=cls.survey, json_survey_id=run_id, question_id=f'q{i}',
+                                response_type='scale', scale_value=i)
+                for i in range(1, 4)
+            ])
+            PatientResponse.objects.filter(json_survey_id=run_id).update(
+                created_at=timezone.make_aware(datetime(2025, 1, day, 12)))
+        cls.staff = User.objects.create_user('staff', is_staff=True)
+
+    def setUp(self):
+        self.client.force_login(self.staff)
+
+    def export(self, **params):
+        response = self.client.get(reverse('export_responses'), params)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content)
+
+    def rows(self, body):
+        return list(csv.DictReader(io.StringIO(body.decode('utf-8'))))
+
+    def test_streams_csv_and_gzip(self):
+        response, body = self.export()
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        rows = self.rows(body)
+        self.assertEqual(list(rows[0]), [name for name, _ in exports.EXPORT_COLUMNS])
+        self.assertEqual([(r['survey_run_id'], r['question_id']) for r in rows][:2], [('run-a', 'q1'), ('run-a', 'q2')])
+        self.assertEqual(len(rows), 6)
+        gz, gz_body = self.export(gzip='1')
+        self.assertEqual(gz['Content-Type'], 'application/gzip')
+        self.assertEqual(gzip.decompress(gz_body), body)
+
+    def test_filters_and_validation(self):
+        self.assertEqual({r['survey_run_id'] for r in self.rows(self.export(survey_id='run-b')[1])}, {'run-b'})
+        _, body = self.export(date_from='2025-01-15', date_to='2025-01-20', survey=str(self.survey.id))
+        self.assertEqual({r['survey_run_id'] for r in self.rows(body)}, {'run-b'})
+        self.assertEqual(self.rows(self.export(pesel='00000000000')[1]), [])
+        for bad in ({'date_from': '2025-02-30'}, {'date_to': 'jutro'}, {'survey': 'nie-uuid'}):
+            self.assertEqual(self.client.get(reverse('export_responses'), bad).status_code, 400)
+        with self.assertRaises(CommandError):
+            call_command('export_responses', '--date-from', '2025-13-01', stdout=io.StringIO())
+
+    def test_staff_only(self):
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse('export_responses')).status_code, 302)
+
+    @override_settings(ASYNC_VIEWS=True)
+    @mock.patch('cantrilapp.exports.ROWS_PER_WRITE', 2)
+    async def test_asgi_body_is_an_async_iterator(self):
+        await self.async_client.aforce_login(self.staff)
+        response = await self.async_client.get(reverse('export_responses'))
+        self.assertTrue(response.is_async)
+        chunks = [chunk async for chunk in response.streaming_content]
+        # header, then the rows two at a time - not one buffered blob
+        self.assertEqual(len(chunks), 4)
+        self.assertEqual(len(self.rows(b''.join(chunks))), 6)
+
+
+class SnapshotTests(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp(prefix='cantril-snapshots-')
+        self.addCleanup(shutil.rmtree, self.dir, ignore_errors=True)
+        survey = Survey.objects.create(title='Snapshot')
+        patient = Patient.objects.create(pesel='90010112345')
+        for month in (1, 2):
+            PatientResponse.objects.bulk_create([
+                PatientResponse(patient=patient, survey=survey, json_survey_id=f'run-{month}', question_id=f'q{i}',
+                                response_type='scale', scale_value=i)
+                for i in (1, 2)
+            ])
+            PatientResponse.objects.filter(json_survey_id=f'run-{month}').update(
+                created_at=timezone.make_aware(datetime(2025, month, 10, 12)))
+        self.survey = survey
+
+    def snapshot(self):
+        call_command('snapshot_responses', '--dir', self.dir, stdout=io.StringIO())
+        return snapshots.load_manifest(self.dir)
+
+    def test_parts_are_appended_after_the_watermark(self):
+        manifest = self.snapshot()
+        self.assertEqual([(p['month'], p['survey'], p['rows'], p['runs']) for p in manifest['parts']],
+                         [('2025-01', str(self.survey.id), 2, ['run-1']), ('2025-02', str(self.survey.id), 2, ['run-2'])])
+        self.assertEqual(manifest['question_ids'], ['q1', 'q2'])
+        first = manifest['parts'][0]
+        self.assertEqual(list(snapshots.load_column(self.dir, first, 'scale_value')), [1.0, 2.0])
+        self.assertTrue(np.isnat(snapshots.load_column(self.dir, first, 'scored_at')).all())
+        column = os.path.join(self.dir, first['path'], 'scale_value.npy')
+        with open(column, 'rb') as f:
+            written = f.read()
+
+        # nothing new: no part, but the watermark moves on
+        again = self.snapshot()
+        self.assertEqual(again['parts'], manifest['parts'])
+        self.assertGreater(again['watermark'], manifest['watermark'])
+
+        # a re-scored answer is appended as a new part of its month; older parts stay as they were
+        PatientResponse.objects.filter(json_survey_id='run-1', question_id='q2').update(
+            evaluated_score=7, scored_at=timezone.now())
+        latest = self.snapshot()
+        self.assertEqual(latest['parts'][:2], manifest['parts'])
+        added = latest['parts'][2]
+        self.assertEqual((added['partition'], added['rows']), (first['partition'], 1))
+        self.assertEqual(list(snapshots.load_column(self.dir, added, 'evaluated_score')), [7.0])
+        with open(column, 'rb') as f:
+            self.assertEqual(f.read(), written)
+
+    def test_score_stamped_before_the_watermark_but_committed_after_is_picked_up(self):
+        manifest = self.snapshot()
+        # a BatchedWriter batch stamped scored_at before the snapshot started and committed after it read
+        stamped = parse_datetime(manifest['watermark']) - timedelta(seconds=1)
+        PatientResponse.objects.filter(json_survey_id='run-2', question_id='q1').update(
+            evaluated_score=3, scored_at=stamped)
+        added = self.snapshot()['parts'][len(manifest['parts']):]
+        self.assertEqual([(p['month'], p['rows']) for p in added], [('2025-02', 1)])
+        self.assertEqual(list(snapshots.load_column(self.dir, added[0], 'evaluated_score')), [3.0])
+
+
+class BatchedWriteTests(TransactionTestCase):
+    """The writer thread has its own connection, so its commits have to be visible here."""
+
+    def queue(self, writer, fn, *args):
+        # queued before the thread starts, so the items land in one batch
+        future = Future()
+        writer._queue.put((future, fn, args, {}))
+        return future
+
+    def test_batches_are_capped(self):
+        writer = db.BatchedWriter(max_batch=3)
+        for n in range(5):
+            self.queue(writer, str, n)
+        self.assertEqual([len(writer._next_batch()), len(writer._next_batch())], [3, 2])
+
+    def test_failing_item_rolls_back_alone(self):
+        def create(pesel, fail=False):
+            Patient.objects.create(pesel=pesel)
+            if fail:
+                raise ValueError(pesel)
+            return pesel
+
+        writer = db.BatchedWriter()
+        futures = [self.queue(writer, create, '90010100001'), self.queue(writer, create, '90010100002', True),
+                   self.queue(writer, create, '90010100003')]
+        writer._ensure_thread()
+        self.assertEqual(futures[0].result(timeout=5), '90010100001')
+        self.assertIsInstance(futures[1].exception(timeout=5), ValueError)
+        self.assertEqual(futures[2].result(timeout=5), '90010100003')
+        self.assertEqual(sorted(Patient.objects.values_list('pesel', flat=True)), ['90010100001', '90010100003'])
+
+    @override_settings(WRITE_BATCHING={'scores': {'enabled': True}})
+    def test_record_scores_through_the_writer(self):
+        patient = Patient.objects.create(pesel='90010112345')
+        PatientResponse.objects.create(patient=patient, json_survey_id='run-w', question_id='q1', response_type='text')
+        self.addCleanup(db._writers.pop, 'scores', None)
+        self.assertIsNotNone(db.get_writer('scores'))
+        self.assertEqual(record_scores([('q1', 'run-w', 7), ('q9', 'run-w', 3)]), [1, 0])
+        row = PatientResponse.objects.get(question_id='q1')
+        self.assertEqual((row.evaluated_score, row.is_processed), (7.0, True))
+        self.assertIsNotNone(row.scored_at)
+
+
+@override_settings(DATABASE_REPLICA_MAX_LAG=60, DATABASE_PIN_PRIMARY_SECONDS=30)
+class ReplicaRoutingTests(SimpleTestCase):
+    def setUp(self):
+        self.lag = 10.0
+        self.measured = 0
+
+        def measure():
+            self.measured += 1
+            return self.lag
+
+        self.enterContext(mock.patch('cantrilapp.routers.replica_configured', return_value=True))
+        self.enterContext(mock.patch('cantrilapp.routers._measure_lag', side_effect=measure))
+        self.enterContext(mock.patch.dict(routers._lag_cache, {'value': None, 'checked_at': 0.0}))
+        self.router = routers.PrimaryReplicaRouter()
+
+    def target(self):
+        return self.router.db_for_read(PatientResponse)
+
+    def remeasure(self, lag):
+        self.lag = lag
+        routers._lag_cache['checked_at'] = 0.0
+
+    def test_reads_go_to_a_fresh_replica_only_when_asked(self):
+        self.assertEqual(self.target(), 'default')
+        with routers.read_replica():
+            self.assertEqual(self.target(), 'replica')
+            with routers.use_primary():
+                self.assertEqual(self.target(), 'default')
+            # the lag is measured once per LAG_CACHE_SECONDS
+            self.assertEqual(self.measured, 1)
+            self.remeasure(61)
+            self.assertEqual(self.target(), 'default')
+            self.remeasure(None)
+            self.assertEqual(self.target(), 'default')
+        self.assertEqual(self.router.db_for_write(PatientResponse), 'default')
+
+    def test_replica_reads_view_and_primary_pin(self):
+        seen = []
+        view = routers.replica_reads(lambda request: seen.append(self.target()))
+        request = RequestFactory().get('/')
+        request.session = {}
+        view(request)
+        routers.pin_primary(request)
+        view(request)
+        # the pin expires
+        request.session[routers.PIN_SESSION_KEY] = time.time() - 1
+        view(request)
+        self.assertEqual(seen, ['replica', 'default', 'replica'])
+
+        # a streamed body keeps the target it was created with
+        with routers.read_replica():
+            body = routers.preserve_read_target(self.target() for _ in range(1))
+        self.assertEqual(list(body), ['replica'])
+
+    def test_sqlite_snapshot_is_dated_from_the_start_of_the_copy(self):
+        tmp = tempfile.mkdtemp(prefix='cantril-replica-')
+        self.addCleanup(shutil.rmtree, tmp, ignore_errors=True)
+        paths = {'default': os.path.join(tmp, 'db.sqlite3'), 'replica': os.path.join(tmp, 'replica.sqlite3')}
+        source = sqlite3.connect(paths['default'])
+        source.execute('PRAGMA journal_mode=WAL')
+        source.execute('CREATE TABLE t (x)')
+        source.executemany('INSERT INTO t VALUES (?)', [(n,) for n in range(100)])
+        source.commit()
+        source.close()
+        with mock.patch('cantrilapp.routers._sqlite_path', side_effect=paths.get), \
+                mock.patch('time.time', return_value=1_700_000_000.0):
+            routers.refresh_sqlite_replica()
+        self.assertEqual(os.path.getmtime(paths['replica']), 1_700_000_000.0)
+        replica = sqlite3.connect(paths['replica'])
+        self.addCleanup(replica.close)
+        self.assertEqual(replica.execute('SELECT COUNT(*) FROM t').fetchone(), (100,))
+
+
+class SeedSyntheticTests(TestCase):
+    def test_small_dataset(self):
+        tmp = tempfile.mkdtemp(prefix='cantril-seed-')
+        self.addCleanup(shutil.rmtree, tmp, ignore_errors=True)
+        with override_settings(MEDIA_ROOT=tmp):
+            call_command('seed_synthetic', patients=20, surveys=2, versions=2, questions=3, runs=15, audio_files=2,
+                         audio_bytes=512, seed=32, stdout=io.StringIO())
+        self.assertEqual((Patient.objects.count(), Survey.objects.count(), Question.objects.count()), (20, 2, 6))
+        self.assertEqual(PatientResponse.objects.count(), 45)
+        self.assertEqual(PatientResponse.objects.values('json_survey_id').distinct().count(), 15)
+
+        pesels, born = zip(*Patient.objects.values_list('pesel', 'date_of_birth'))
+        birth_dates, errors = patients.validate_pesels(list(pesels))
+        self.assertEqual(errors, [None] * 20)
+        self.assertEqual(list(birth_dates.astype(date)), list(born))
+        for name in PatientResponse.objects.exclude(audio_file='').exclude(audio_file__isnull=True).values_list(
+                'audio_file', flat=True).distinct():
+            self.assertTrue(os.path.exists(os.path.join(tmp, name)))
+
+
+class LoadTestHarnessTests(TransactionTestCase):
+    """A tiny in-process run: the app server threads need the survey committed.
+
+    One patient only - the in-memory test database locks whole tables between
+    connections, which a concurrent run would report as errors.
+    """
+
+    def test_report_shape(self):
+        tmp = tempfile.mkdtemp(prefix='cantril-loadtest-')
+        self.addCleanup(shutil.rmtree, tmp, ignore_errors=True)
+        survey = Survey.objects.create(title='Obciążenie')
+        Question.objects.bulk_create([Question(survey=survey, key=f'q{i}', text=f'Pytanie {i}', order=i) for i in (1, 2)])
+        output = os.path.join(tmp, 'report.json')
+        with override_settings(MEDIA_ROOT=tmp, BASE_DIR=tmp):
+            call_command('loadtest', patients=1, sessions=2, ramp_up=0, voice_ratio=0.5, audio_bytes=256,
+                         n8n_latency_ms=0, n8n_jitter_ms=0, seed=33, output=output, stderr=io.StringIO())
+        with open(output, encoding='utf-8') as f:
+            report = json.load(f)
+        self.assertEqual(set(report), {'meta', 'totals', 'urls', 'db', 'n8n', 'error_samples'})
+        self.assertEqual((report['totals']['sessions_completed'], report['totals']['errors']), (2, 0))
+        self.assertEqual(report['meta']['patients'], 1)
+        self.assertLessEqual({'ankieta_choice', 'ankieta_select_survey', 'ankieta_done'}, set(report['urls']))
+        self.assertEqual(set(report['urls']['ankieta_done']), {'count', 'p50', 'p95', 'p99', 'mean', 'max', 'errors'})
+        self.assertGreater(report['db']['statements'], 0)
+        self.assertEqual(PatientResponse.objects.values('json_survey_id').distinct().count(), 2)
+
+
+class ScoreAgreementTests(TestCase):
+    def test_metrics_per_group(self):
+        x = [2, 4, 6, 8, 5]
+        y = [3, 5, 8, 9, 7]
+        m = analytics.agreement_metrics(np.array([0, 0, 0, 0, 1]), x, y, 2)
+        d = np.subtract(y[:4], x[:4])
+        self.assertEqual(list(m['n']), [4, 1])
+        self.assertAlmostEqual(m['bias'][0], d.mean())
+        self.assertAlmostEqual(m['mad'][0], np.abs(d).mean())
+        self.assertAlmostEqual(m['corr'][0], np.corrcoef(x[:4], y[:4])[0, 1])
+        self.assertAlmostEqual(m['loa_lower'][0], d.mean() - 1.96 * d.std(ddof=1))
+        self.assertAlmostEqual(m['loa_upper'][0], d.mean() + 1.96 * d.std(ddof=1))
+        # a single pair has a bias but no spread or correlation
+        self.assertEqual((m['bias'][1], m['mad'][1]), (2.0, 2.0))
+        self.assertTrue(np.isnan([m['corr'][1], m['loa_lower'][1], m['loa_upper'][1]]).all())
+
+    def test_refresh_recomputes_touched_months_only(self):
+        survey = Survey.objects.create(title='Zgodność')
+        patient = Patient.objects.create(pesel='90010112345')
+
+        def answer(created_at, scale, score):
+            r = PatientResponse.objects.create(patient=patient, survey=survey, json_survey_id='run', question_id='q1',
+                                               response_type='text', scale_value=scale, evaluated_score=score)
+            PatientResponse.objects.filter(pk=r.pk).update(created_at=created_at, scored_at=created_at)
+            return r
+
+        january = timezone.make_aware(datetime(2025, 1, 15, 12))
+        march = timezone.make_aware(datetime(2025, 3, 15, 12))
+        answer(january, 5, 6)
+        answer(january, 7, 7)
+        late = answer(march, 4, 8)
+        self.assertEqual(analytics.refresh_score_agreement()[0], [date(2025, 1, 1), date(2025, 3, 1)])
+        self.assertEqual(ScoreAgreement.objects.get(period=date(2025, 1, 1)).sample_size, 2)
+        self.assertEqual(analytics.refresh_score_agreement()[0], [])
+
+        # a score stamped just before the watermark but committed after the last run
+        watermark = JobWatermark.objects.get(name=analytics.JOB_NAME).value
+        PatientResponse.objects.filter(pk=late.pk).update(evaluated_score=9, scored_at=watermark - timedelta(seconds=1))
+        self.assertEqual(analytics.refresh_score_agreement()[0], [date(2025, 3, 1)])
+        self.assertEqual(ScoreAgreement.objects.get(period=date(2025, 3, 1)).bias, 5.0)
+
+        # admin "rescore" clears the score: its month loses the row
+        admin = User.objects.create_superuser('admin', password='x')
+        self.client.force_login(admin)
+        self.client.post(reverse('admin:cantrilapp_patientresponse_changelist'),
+                         {'action': 'rescore', '_selected_action': [str(late.pk)]})
+        self.assertEqual(analytics.refresh_score_agreement()[0], [date(2025, 3, 1)])
+        self.assertFalse(ScoreAgreement.objects.filter(period=date(2025, 3, 1)).exists())
+
+
+# URLconf for AsyncViewTests: the app's URLs with the ASGI variants swapped in
+ASYNC_VIEWS = {
+    'ankieta_voice_question': views.ankieta_voice_question_async,
+    'n8n_results_webhook': views.n8n_results_webhook_async,
+}
+urlpatterns = [
+    path(str(p.pattern), ASYNC_VIEWS.get(p.name, p.callback), name=p.name)
+    for p in app_urls.urlpatterns
+]
+
+
+@override_settings(ROOT_URLCONF='cantrilapp.tests')
+class AsyncViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.patient = Patient.objects.create(pesel='90010112345', first_name='Jan', last_name='Test')
+
+    def setUp(self):
+        media = tempfile.mkdtemp(prefix='cantril-media-')
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        self.enterContext(override_settings(MEDIA_ROOT=media))
+        session = self.client.session
+        session['patient_id'] = self.patient.id
+        session['survey_run_id'] = 'run-async'
+        session.save()
+        self.n8n = self.enterContext(mock.patch('httpx.AsyncClient.post', new_callable=mock.AsyncMock,
+                                                return_value=_FakeN8nResponse()))
+
+    def test_text_answer_goes_through_pooled_client(self):
+        url = reverse('ankieta_voice_question', args=[1])
+        with mock.patch('cantrilapp.fragments.invalidate', wraps=fragments.invalidate) as invalidate:
+            page = self.client.post(url, {'response_type': 'text', 'text_answer': 'dobrze'})
+        self.assertRedirects(page, reverse('ankieta_voice_question', args=[2]), fetch_redirect_response=False)
+        pr = PatientResponse.objects.get(json_survey_id='run-async')
+        self.assertTrue(pr.is_processed)
+        # once for the insert (post_save), once when n8n accepted the answer
+        self.assertEqual(invalidate.call_args_list.count(mock.call(patients=[self.patient.id], runs=['run-async'])), 2)
+        self.assertEqual(self.n8n.call_args.kwargs['json']['text'], 'dobrze')
+
+    def receive_body(self):
+        bodies = []
+
+        async def post(url, **kwargs):
+            bodies.append((kwargs['headers'], b''.join([chunk async for chunk in kwargs['content']])))
+            return _FakeN8nResponse()
+        self.n8n.side_effect = post
+        return bodies
+
+    def test_audio_is_streamed_as_multipart(self):
+        bodies = self.receive_body()
+        audio_bytes = b'\x1a\x45\xdf\xa3' + b'0' * 1000
+        upload = SimpleUploadedFile('a.webm', audio_bytes, content_type='audio/webm')
+        self.client.post(reverse('ankieta_voice_question', args=[1]), {'response_type': 'audio', 'audio_file': upload})
+        (headers, body), = bodies
+        self.assertEqual(int(headers['Content-Length']), len(body))
+        received = RequestFactory().generic('POST', '/', body, content_type=headers['Content-Type'])
+        self.assertEqual(received.POST['surveyID'], 'run-async')
+        self.assertEqual(received.FILES['audio'].content_type, 'audio/webm')
+        self.assertEqual(received.FILES['audio'].read(), audio_bytes)
+        self.assertTrue(PatientResponse.objects.get(json_survey_id='run-async').is_processed)
+
+    def test_audio_upload_does_not_block_the_loop(self):
+        bodies = self.receive_body()
+
+        class SlowFile(io.BytesIO):
+            def read(self, size=-1):
+                time.sleep(0.03)  # a storage backend reading over the network
+                return super().read(size)
+
+        content = b'0' * (3 * n8n.AUDIO_CHUNK_BYTES)
+        storage = mock.Mock(size=mock.Mock(return_value=len(content)),
+                            open=mock.Mock(side_effect=lambda name, mode: SlowFile(content)))
+        pr = PatientResponse(patient=self.patient, json_survey_id='run-async', question_id='q1',
+                             response_type='audio', audio_file='audio_answers/a.webm')
+
+        async def upload_while_ticking():
+            ticks, done = 0, False
+
+            async def tick():
+                nonlocal ticks
+                while not done:
+                    ticks += 1
+                    await asyncio.sleep(0.002)
+            ticker = asyncio.ensure_future(tick())
+            await n8n.asend_answer(pr)
+            done = True
+            await ticker
+            return ticks
+
+        with mock.patch.object(n8n, 'default_storage', storage):
+            ticks = async_to_sync(upload_while_ticking)()
+        self.assertTrue(bodies[0][1].count(content))
+        # four reads of 30 ms each: the loop kept running while they were in worker threads
+        self.assertGreater(ticks, 20)
+
+    def test_results_webhook(self):
+        PatientResponse.objects.create(patient=self.patient, json_survey_id='run-async', question_id='q1',
+                                       response_type='text', text_answer='x')
+        page = self.client.post(reverse('n8n_results_webhook'),
+                                json.dumps({'questionID': 'q1', 'surveyID': 'run-async', 'score': 7}),
+                                content_type='application/json')
+        self.assertEqual(page.json()['updated'], 1)
+        self.assertEqual(PatientResponse.objects.get(json_survey_id='run-async').evaluated_score, 7)
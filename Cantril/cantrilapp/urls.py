@@ -1,6 +1,15 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
+# ASGI deployments serve the I/O-bound endpoints from their async variants
+if settings.ASYNC_VIEWS:
+    voice_question_view = views.ankieta_voice_question_async
+    results_webhook_view = views.n8n_results_webhook_async
+else:
+    voice_question_view = views.ankieta_voice_question
+    results_webhook_view = views.n8n_results_webhook
+
 urlpatterns = [
     # Strona startowa
     path('', views.home, name='home'),
@@ -9,9 +18,15 @@ urlpatterns = [
     path('ankieta/start/', views.ankieta_choice, name='ankieta_choice'),
     path('ankieta/select-survey/', views.ankieta_select_survey, name='ankieta_select_survey'),
     path('ankieta/cantril/question/<int:question_number>/', views.ankieta_cantril_question, name='ankieta_cantril_question'),
-    path('ankieta/voice/question/<int:question_number>/', views.ankieta_voice_question, name='ankieta_voice_question'),
+    path('ankieta/voice/question/<int:question_number>/', voice_question_view, name='ankieta_voice_question'),
     path('ankieta/done/', views.ankieta_done, name='ankieta_done'),
 
+    # Tryb kiosku (offline): service worker, definicje ankiet, synchronizacja przebiegów
+    path('kiosk/', views.kiosk_home, name='kiosk'),
+    path('kiosk/sw.js', views.kiosk_service_worker, name='kiosk_service_worker'),
+    path('kiosk/surveys.json', views.kiosk_surveys, name='kiosk_surveys'),
+    path('kiosk/sync/', views.kiosk_sync, name='kiosk_sync'),
+
     # Stary formularz (opcjonalny)
     path('form/', views.patient_form, name='patient_form'),
 
@@ -21,11 +36,19 @@ urlpatterns = [
     # Panel lekarza
     path('panel/', views.panel_home, name='panel_home'),
     path('panel/ladder-designs/', views.ladder_designs, name='ladder_designs'),
+    path('panel/patients/', views.manage_patients, name='manage_patients'),
     path('panel/results/', views.panel_results, name='panel_results'),
     path('panel/history/', views.panel_history, name='panel_history'),
     path('panel/patient/<int:patient_id>/history/', views.panel_patient_history, name='panel_patient_history'),
     path('panel/survey/<uuid:survey_id>/patient/<int:patient_id>/completions/', views.panel_survey_completions, name='panel_survey_completions'),
+    path('panel/export/responses/', views.export_responses, name='export_responses'),
+    path('panel/events/scores/', views.panel_score_events, name='panel_score_events'),
+    path('panel/agreement/', views.panel_agreement, name='panel_agreement'),
+    path('panel/profiles/', views.panel_profiles, name='panel_profiles'),
+
+    # Prometheus metrics
+    path('metrics', views.metrics_endpoint, name='metrics'),
 
     # Webhook endpoint for n8n results
-    path('webhook/n8n/results/', views.n8n_results_webhook, name='n8n_results_webhook'),
+    path('webhook/n8n/results/', results_webhook_view, name='n8n_results_webhook'),
 ]
\ No newline at end of file
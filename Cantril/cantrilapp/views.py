@@ -1,24 +1,40 @@
+import hashlib
+import io
 import json
+import logging
 import os
-import requests
+import re
 import uuid
 from datetime import datetime
+from urllib.parse import urlencode
+from asgiref.sync import sync_to_async
 from django.utils import timezone
-from django.db.models import Count, Max, Min, Q
+from django.db.models import Count, F, Max, Min, Q, Sum
 from django.shortcuts import render, redirect, get_object_or_404
-from django.views.decorators.csrf import csrf_exempt
-from django.http import JsonResponse
+from django.template.loader import render_to_string
+from django.urls import reverse
+from django.templatetags.static import static
+from django.utils.safestring import mark_safe
+from django.views.decorators.csrf import csrf_exempt, ensure_csrf_cookie
+from django.views.decorators.http import require_POST
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseBadRequest, JsonResponse, StreamingHttpResponse
 from django import forms
 from django.conf import settings
 from django.contrib import messages
+from django.contrib.admin.views.decorators import staff_member_required
 from django.core.files.storage import default_storage
-from .models import Patient, PatientResponse, Survey, Question
+from .models import ArchivedRun, Patient, PatientResponse, Survey, Question, ScoreAgreement
+from . import analytics, archive, audio, conditional, events, exports, fragments, kiosk, ladder, metrics, n8n, patients, profiling, surveys
+from .routers import apreserve_read_target, pin_primary, preserve_read_target, replica_reads
+from .scoring import record_scores
+
+logger = logging.getLogger(__name__)
+webhook_log = logging.getLogger('cantrilapp.webhook')
 
 # =====================
 # Konfiguracja pliku JSON i n8n
 # =====================
 QUESTION_FILE_PATH = os.path.join(settings.BASE_DIR, 'ankieta_pytania.json')
-N8N_WEBHOOK_URL = "http://localhost:5678/webhook/198c3dbf-28a7-4fbd-a770-483b2ce47bdc"
 
 def get_questions_from_json():
     """Wczytuje pytania z pliku JSON lub domyślne."""
@@ -51,13 +67,31 @@ def get_survey_metadata_from_json():
                 metadata["ladder_design"] = data.get("ladder_design", "classic")
         except json.JSONDecodeError:
             pass
+    # każdy design ma swój arkusz static/css/ladder/<design>.css
+    if metadata["ladder_design"] not in dict(Survey.LADDER_DESIGNS):
+        metadata["ladder_design"] = "classic"
     return metadata
 
 
-def format_survey_label(survey_id, fallback_dt=None):
+def survey_titles_for_runs(survey_ids):
+    """Prefetch {uuid: title} for run ids whose prefix is a Survey UUID (one query)."""
+    uuids = set()
+    for survey_id in survey_ids:
+        prefix = str(survey_id or '').rsplit('_', 1)[0]
+        try:
+            uuids.add(uuid.UUID(hex=prefix))
+        except ValueError:
+            continue
+    if not uuids:
+        return {}
+    return dict(Survey.objects.filter(id__in=uuids).values_list('id', 'title'))
+
+
+def format_survey_label(survey_id, fallback_dt=None, titles=None):
     """Return human-friendly label for a survey id, e.g. 'Ankieta - 2025-12-29 15:14:51'.
     If survey_id contains a timestamp suffix like _YYYYmmddTHHMMSS we parse it.
     Otherwise use fallback_dt (a datetime) when available, else return the raw id.
+    Pass titles from survey_titles_for_runs() to avoid a query per call.
     """
     if not survey_id:
         return survey_id
@@ -68,16 +102,15 @@ def format_survey_label(survey_id, fallback_dt=None):
             ts = parts[1]
             # try to resolve prefix as UUID hex and find Survey title
             try:
-                import uuid as _uuid
-                survey_uuid = _uuid.UUID(hex=prefix)
-                try:
-                    s = Survey.objects.get(id=survey_uuid)
-                    # parse timestamp
-                    if len(ts) == 15 and ts[8] == 'T':
-                        dt = datetime.strptime(ts, '%Y%m%dT%H%M%S')
-                        return f"{s.title} - {dt.strftime('%Y-%m-%d %H:%M:%S')}"
-                except Survey.DoesNotExist:
-                    pass
+                survey_uuid = uuid.UUID(hex=prefix)
+                if titles is not None:
+                    title = titles.get(survey_uuid)
+                else:
+                    title = Survey.objects.filter(id=survey_uuid).values_list('title', flat=True).first()
+                # parse timestamp
+                if title is not None and len(ts) == 15 and ts[8] == 'T':
+                    dt = datetime.strptime(ts, '%Y%m%dT%H%M%S')
+                    return f"{title} - {dt.strftime('%Y-%m-%d %H:%M:%S')}"
             except Exception:
                 # not a uuid hex, fall back
                 pass
@@ -154,103 +187,72 @@ def manage_questions(request):
             messages.error(request, 'Tytuł ankiety jest wymagany.')
             return redirect('manage_questions')
 
-        # If editing existing survey, check if title changed to duplicate
+        survey = None
         if survey_uuid:
-            try:
-                survey = Survey.objects.get(id=survey_uuid)
-                # Only check for duplicates if title actually changed
-                if survey.title.lower() != title.lower() and Survey.objects.filter(title__iexact=title).exclude(id=survey_uuid).exists():
-                    messages.error(request, 'Ankieta o takiej nazwie już istnieje. Podaj unikalny tytuł.')
-                    return redirect('manage_questions')
-            except Survey.DoesNotExist:
+            survey = Survey.objects.filter(id=survey_uuid).first()
+            if survey is None:
                 messages.error(request, 'Ankieta nie znaleziona.')
                 return redirect('manage_questions')
-        else:
-            # For new surveys, check for duplicate titles
-            if Survey.objects.filter(title__iexact=title).exists():
-                messages.error(request, 'Ankieta o takiej nazwie już istnieje. Podaj unikalny tytuł.')
-                return redirect('manage_questions')
 
         # Get ladder design
         ladder_design = request.POST.get('ladder_design', 'classic').strip()
-        
-        questions_list = request.POST.getlist('questions')
+
+        # recording profile of voice answers (unchecked checkbox = no silence trim)
+        try:
+            audio_profile = audio.clean_profile({
+                'bitrate': request.POST.get('audio_bitrate') or audio.DEFAULT_AUDIO_PROFILE['bitrate'],
+                'max_seconds': request.POST.get('audio_max_seconds') or audio.DEFAULT_AUDIO_PROFILE['max_seconds'],
+                'trim_silence': request.POST.get('audio_trim_silence', ''),
+            })
+        except ValueError as e:
+            messages.error(request, str(e))
+            return redirect('manage_questions')
+
+        # one entry per form row; empty rows are dropped together with their labels and key
+        texts = request.POST.getlist('questions')
+        keys = request.POST.getlist('question_keys')
         scale_labels_min = request.POST.getlist('scale_labels_min[]')
         scale_labels_max = request.POST.getlist('scale_labels_max[]')
-        
-        clean_questions = [q.strip() for q in questions_list if q.strip()]
 
-        if not clean_questions:
-            messages.error(request, 'Proszę dodać co najmniej jedno pytanie.')
-            return redirect('manage_questions')
+        def field(values, i):
+            return values[i].strip() if i < len(values) else ''
 
         questions_with_data = [
             {
-                "text": q,
+                "key": field(keys, i),
+                "text": q.strip(),
                 "scale_labels": {
-                    "min": scale_labels_min[i].strip() if i < len(scale_labels_min) else "",
-                    "max": scale_labels_max[i].strip() if i < len(scale_labels_max) else ""
+                    "min": field(scale_labels_min, i),
+                    "max": field(scale_labels_max, i),
                 }
-            } 
-            for i, q in enumerate(clean_questions)
+            }
+            for i, q in enumerate(texts) if q.strip()
         ]
 
-        # Create or update survey
-        if survey_uuid:
-            # Update existing survey
-            survey = Survey.objects.get(id=survey_uuid)
-            survey.title = title
-            survey.ladder_design = ladder_design
-            survey.save()
-            
-            # Delete and recreate questions
-            Question.objects.filter(survey=survey).delete()
-            action_text = "została zaktualizowana"
-        else:
-            # Create new survey
-            survey = Survey.objects.create(title=title, ladder_design=ladder_design)
-            action_text = "została utworzona"
+        if not questions_with_data:
+            messages.error(request, 'Proszę dodać co najmniej jedno pytanie.')
+            return redirect('manage_questions')
 
-        # Create Question records with scale_labels
-        for order, q_data in enumerate(questions_with_data, start=1):
-            Question.objects.create(
-                survey=survey,
-                text=q_data['text'],
-                order=order,
-                scale_labels=q_data.get('scale_labels', {})
+        # diff against the stored questions; JSON mirrors are written after commit
+        try:
+            survey, changes = surveys.save_survey(
+                title, ladder_design, questions_with_data, survey=survey, active_file=QUESTION_FILE_PATH,
+                audio_profile=audio_profile,
             )
+        except surveys.SurveyTitleTaken:
+            messages.error(request, 'Ankieta o takiej nazwie już istnieje. Podaj unikalny tytuł.')
+            return redirect('manage_questions')
+        action_text = "została zaktualizowana" if survey_uuid else "została utworzona"
+        logger.info('survey saved', extra={'payload': {'survey': str(survey.id), **changes}})
 
-        # Update the active JSON file for patient flow (backward compatibility)
-        data = {
-            "title": title,
-            "ladder_design": ladder_design,
-            "questions": [
-                {
-                    "id": f"q{i+1}",
-                    "text": q_data['text'],
-                    "scale_labels": q_data.get('scale_labels', {})
-                }
-                for i, q_data in enumerate(questions_with_data)
-            ]
-        }
-        
-        with open(QUESTION_FILE_PATH, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
-
-        # Also save survey-specific JSON
-        surveys_dir = os.path.join(settings.BASE_DIR, 'surveys')
-        os.makedirs(surveys_dir, exist_ok=True)
-        survey_path = os.path.join(surveys_dir, f"{survey.id}.json")
-        with open(survey_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
-
+        pin_primary(request)
         messages.success(request, f"✅ Ankieta '{title}' {action_text}!")
         return redirect('manage_questions')
 
     # GET request - show form
     mode = request.GET.get('mode', 'list')  # 'list', 'new', or survey_uuid for edit
     
-    surveys = Survey.objects.all().order_by('-id')
+    survey_list = Survey.objects.all().order_by('-id')
     initial_data = None
     edit_survey_uuid = None
 
@@ -270,6 +272,7 @@ def manage_questions(request):
                             "survey_uuid": str(edit_survey.id),
                             "title": edit_survey.title or json_data.get("title", ""),
                             "ladder_design": edit_survey.ladder_design or json_data.get("ladder_design", "classic"),
+                            "audio_profile": audio.profile_for(edit_survey),
                             "questions": json_data.get("questions", [])
                         }
                 except:
@@ -281,9 +284,10 @@ def manage_questions(request):
                     "survey_uuid": str(edit_survey.id),
                     "title": edit_survey.title,
                     "ladder_design": edit_survey.ladder_design,
+                    "audio_profile": audio.profile_for(edit_survey),
                     "questions": [
                         {
-                            "id": f"q{q.order}",
+                            "id": q.key,
                             "text": q.text,
                             "scale_labels": q.scale_labels or {"min": "", "max": ""}
                         }
@@ -303,21 +307,115 @@ def manage_questions(request):
             "survey_uuid": "",
             "title": "",
             "ladder_design": "classic",
+            "audio_profile": audio.profile_for(None),
             "questions": [{"id": "q1", "text": "", "scale_labels": {"min": "", "max": ""}}]
         }
 
-    # Debug: print structure
-    print(f"DEBUG manage_questions - initial_data: {initial_data}")
+    logger.debug('manage_questions initial data', extra={'payload': initial_data})
     
     context = {
         'data': initial_data,
-        'surveys': surveys,
+        'surveys': survey_list,
         'edit_survey_uuid': edit_survey_uuid,
-        'mode': 'edit' if edit_survey_uuid else 'new'
+        'mode': 'edit' if edit_survey_uuid else 'new',
+        'audio_bitrates': audio.BITRATES,
+        'audio_max_seconds': audio.MAX_SECONDS,
     }
     
     return render(request, 'generator.html', context)
 
+# =====================
+# Pacjenci (lista, dodawanie, import CSV)
+# =====================
+IMPORT_REPORT_RE = re.compile(r'[\w-]+\.errors\.csv')
+PATIENT_LIST_LIMIT = 200
+
+
+def _imports_dir():
+    return os.path.join(settings.BASE_DIR, 'imports')
+
+
+def _import_patients_csv(upload):
+    """Run a PatientImport over an uploaded CSV; the error report lands in BASE_DIR/imports."""
+    os.makedirs(_imports_dir(), exist_ok=True)
+    report_name = f"{timezone.now():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:6]}.errors.csv"
+    report_path = os.path.join(_imports_dir(), report_name)
+    job = patients.PatientImport()
+    # the upload is read line by line from its temporary file, never as a whole
+    source = io.TextIOWrapper(upload.file, encoding='utf-8-sig', newline='')
+    with open(report_path, 'w', encoding='utf-8', newline='') as report:
+        job.report = report
+        job.run(source)
+    if not job.stats['errors']:
+        os.remove(report_path)
+        report_name = None
+    return job, report_name
+
+
+@staff_member_required
+def manage_patients(request):
+    """Patient list with search, single add/update, delete and bulk CSV import (staff only)."""
+    report = request.GET.get('report', '')
+    if report:
+        if not IMPORT_REPORT_RE.fullmatch(report):
+            raise Http404
+        path = os.path.join(_imports_dir(), report)
+        if not os.path.exists(path):
+            raise Http404
+        return FileResponse(open(path, 'rb'), as_attachment=True, filename=report, content_type='text/csv')
+
+    import_job = report_name = None
+    if request.method == 'POST':
+        action = request.POST.get('action', 'add')
+        if action == 'delete':
+            patient_id = request.POST.get('patient_id', '')
+            if not patient_id.isdigit():
+                messages.error(request, 'Nieprawidłowy identyfikator pacjenta.')
+                return redirect('manage_patients')
+            Patient.objects.filter(id=patient_id).delete()
+            messages.success(request, 'Pacjent usunięty.')
+            return redirect('manage_patients')
+        if action == 'import':
+            upload = request.FILES.get('csv')
+            if upload is None:
+                messages.error(request, 'Wybierz plik CSV.')
+                return redirect('manage_patients')
+            try:
+                import_job, report_name = _import_patients_csv(upload)
+            except (ValueError, UnicodeDecodeError) as e:
+                messages.error(request, f'Nie udało się wczytać pliku: {e}')
+                return redirect('manage_patients')
+            pin_primary(request)  # the summary and errors are rendered below
+        else:
+            pesel = (request.POST.get('pesel') or '').strip()
+            born, errors = patients.validate_pesels([pesel])
+            if errors[0]:
+                messages.error(request, errors[0])
+                return redirect('manage_patients')
+            Patient.objects.update_or_create(pesel=pesel, defaults={
+                'first_name': (request.POST.get('first_name') or '').strip()[:50],
+                'last_name': (request.POST.get('last_name') or '').strip()[:50],
+                'date_of_birth': born[0].item(),
+            })
+            pin_primary(request)
+            messages.success(request, f'Pacjent {pesel} zapisany.')
+            return redirect('manage_patients')
+
+    q = request.GET.get('q', '').strip()
+    qs = Patient.objects.order_by('-created_at', '-id')
+    if q.isdigit():
+        qs = qs.filter(**patients.pesel_prefix(q))  # range on the unique PESEL index
+    elif q:
+        qs = qs.filter(last_name__istartswith=q)
+    return render(request, 'manage_patients.html', {
+        'patients': list(qs[:PATIENT_LIST_LIMIT]),
+        'limit': PATIENT_LIST_LIMIT,
+        'q': q,
+        'import_job': import_job,
+        'report_name': report_name,
+    })
+
+
 # =====================
 # Strona główna
 # =====================
@@ -342,6 +440,19 @@ def ankieta_choice(request):
         form = PeselForm()
     return render(request, 'ankieta_choice.html', {'form': form})
 
+def _select_survey_fingerprint(request):
+    patient_id = request.session.get('patient_id')
+    if not patient_id:
+        return None
+    surveys, surveys_at = conditional.surveys_version()
+    versions = conditional.generations(fragments.patient_scope(patient_id))
+    if versions is None:
+        return None
+    gens, changed = versions
+    return (patient_id, surveys, gens), conditional.latest(surveys_at, changed)
+
+
+@conditional.conditional_page(_select_survey_fingerprint)
 def ankieta_select_survey(request):
     """Show available surveys and last completion date for each."""
     patient_id = request.session.get('patient_id')
@@ -350,19 +461,18 @@ def ankieta_select_survey(request):
 
     patient = Patient.objects.get(id=patient_id)
     surveys = Survey.objects.all()
-    
-    # Get last completion date for each survey
-    surveys_with_history = []
-    for survey in surveys:
-        last_response = PatientResponse.objects.filter(
-            patient=patient,
-            survey=survey
-        ).order_by('-created_at').first()
-        
-        surveys_with_history.append({
-            'survey': survey,
-            'last_completed': last_response.created_at if last_response else None
-        })
+
+    # Last completion date for each survey (one aggregate query)
+    last_completed = dict(
+        PatientResponse.objects.filter(patient=patient, survey__isnull=False)
+        .values('survey')
+        .annotate(last=Max('created_at'))
+        .values_list('survey', 'last')
+    )
+    surveys_with_history = [
+        {'survey': survey, 'last_completed': last_completed.get(survey.id)}
+        for survey in surveys
+    ]
     
     if request.method == "POST":
         survey_uuid = request.POST.get('survey_uuid')
@@ -390,6 +500,20 @@ def ankieta_select_survey(request):
 # =====================
 # Pojedyncze pytanie ankiety (scale/text/audio)
 # =====================
+def _question_fingerprint(request, question_number):
+    """Question pages come from the question JSON; None without a patient or when the GET ends the run."""
+    if not request.session.get('patient_id'):
+        return None
+    if int(question_number) > len(get_questions_from_json()):
+        return None
+    file_version, modified = conditional.file_version(QUESTION_FILE_PATH)
+    survey = None
+    if request.session.get('survey_uuid'):
+        survey = Survey.objects.filter(id=request.session['survey_uuid']).values_list('version', 'updated_at').first()
+    return (file_version, survey), conditional.latest(modified, survey[1] if survey else None)
+
+
+@conditional.conditional_page(_question_fingerprint)
 def ankieta_cantril_question(request, question_number):
     """Cantril ladder flow (scale answers)."""
     question_number = int(question_number)
@@ -414,15 +538,16 @@ def ankieta_cantril_question(request, question_number):
             except Survey.DoesNotExist:
                 pass
 
-        # Zapisz odpowiedzi do bazy i przygotuj JSON outbox
+        # Zapisz odpowiedzi do bazy (jednym INSERT-em) i przygotuj JSON outbox
         out = []
+        to_create = []
         for q_num_str, answer_data in answers.items():
             idx = int(q_num_str) - 1
             q_data = questions[idx] if 0 <= idx < len(questions) else {}
             question_id = q_data.get('id', f'q{q_num_str}')
             response_type = answer_data["type"]
 
-            response = PatientResponse.objects.create(
+            to_create.append(PatientResponse(
                 patient=patient,
                 survey=survey,
                 json_survey_id=survey_id,
@@ -432,7 +557,7 @@ def ankieta_cantril_question(request, question_number):
                 text_answer=answer_data.get("value") if response_type=="text" else "",
                 question_text=q_data.get('text', '') if isinstance(q_data, dict) else (q_data or ''),
                 is_processed=False
-            )
+            ))
 
             out.append({
                 "patientID": str(patient.id),
@@ -444,6 +569,10 @@ def ankieta_cantril_question(request, question_number):
                 "textAnswer": answer_data.get('value') if response_type=='text' else None,
             })
 
+        PatientResponse.objects.bulk_create(to_create)
+        # bulk_create sends no post_save
+        fragments.invalidate(patients=[patient.id], runs=[survey_id])
+
         # write outbox JSON for later n8n processing (simulate webhook payload)
         out_dir = os.path.join(settings.BASE_DIR, 'outbox')
         os.makedirs(out_dir, exist_ok=True)
@@ -477,9 +606,8 @@ def ankieta_cantril_question(request, question_number):
                     'question': question_text,
                     'question_number': question_number,
                     'total_questions': total_questions,
-                    'scale_range': list(range(1, 11)),
                     'ladder_design': survey_metadata['ladder_design'],
-                    'scale_labels': q_data.get('scale_labels', {}),
+                    'ladder': ladder.ladder_html(survey_metadata['ladder_design'], q_data.get('scale_labels')),
                     'error': 'Proszę udzielić odpowiedzi',
                 })
             request.session['answers'][str(question_number)] = {"type": "scale", "value": int(answer)}
@@ -493,9 +621,8 @@ def ankieta_cantril_question(request, question_number):
                     'question': question_text,
                     'question_number': question_number,
                     'total_questions': total_questions,
-                    'scale_range': list(range(1, 11)),
                     'ladder_design': survey_metadata['ladder_design'],
-                    'scale_labels': q_data.get('scale_labels', {}),
+                    'ladder': ladder.ladder_html(survey_metadata['ladder_design'], q_data.get('scale_labels')),
                     'error': 'Proszę wpisać odpowiedź',
                 })
             request.session['answers'][str(question_number)] = {"type": "text", "value": answer}
@@ -507,187 +634,245 @@ def ankieta_cantril_question(request, question_number):
         'question': question_text,
         'question_number': question_number,
         'total_questions': total_questions,
-        'scale_range': list(range(1, 11)),
         'ladder_design': survey_metadata['ladder_design'],
-        'scale_labels': q_data.get('scale_labels', {}) if isinstance(q_data, dict) else {}
+        'ladder': ladder.ladder_html(
+            survey_metadata['ladder_design'], q_data.get('scale_labels') if isinstance(q_data, dict) else None,
+        ),
     })
 
 
-def ankieta_voice_question(request, question_number):
-    """Voice/text flow. Audio files are saved immediately and a PatientResponse is created per question.
-    Recording should start client-side on load and stop when user clicks Next (form submission).
-    """
-    question_number = int(question_number)
+def _session_survey(request):
+    """Survey of the run in the session (or None), loaded once per request."""
+    if not hasattr(request, '_session_survey'):
+        survey_uuid = request.session.get('survey_uuid')
+        request._session_survey = Survey.objects.filter(id=survey_uuid).first() if survey_uuid else None
+    return request._session_survey
+
+
+def _voice_state(request, question_number):
+    """Session/ORM part of the voice flow; None when there is no patient in the session."""
     patient_id = request.session.get('patient_id')
     if not patient_id:
-        return redirect('ankieta_choice')
+        return None
 
     patient = Patient.objects.get(id=patient_id)
     questions = get_questions_from_json()
-    total_questions = len(questions)
 
-    survey_id = request.session.get('survey_run_id', str(uuid.uuid4()))
-    survey_uuid = request.session.get('survey_uuid')
-    survey = None
-    if survey_uuid:
-        try:
-            survey = Survey.objects.get(id=survey_uuid)
-        except Survey.DoesNotExist:
-            pass
+    state = {
+        'patient': patient,
+        'survey': _session_survey(request),
+        'survey_id': request.session.get('survey_run_id', str(uuid.uuid4())),
+        'question_number': question_number,
+        'total_questions': len(questions),
+    }
+    if question_number <= len(questions):
+        q_raw = questions[question_number - 1]
+        if isinstance(q_raw, dict):
+            state['question_text'] = q_raw.get('text', '')
+            state['question_id'] = q_raw.get('id', f'q{question_number}')
+        else:
+            state['question_text'] = q_raw
+            state['question_id'] = f'q{question_number}'
+    return state
+
+
+def _finish_voice_run(request, state):
+    # we already created PatientResponse for each question in this flow
+    # create outbox file listing responses for later n8n processing
+    patient, survey_id = state['patient'], state['survey_id']
+    responses = PatientResponse.objects.filter(patient=patient, json_survey_id=survey_id)
+    out = []
+    for r in responses:
+        out.append({
+            "patientID": str(patient.id),
+            "surveyID": survey_id,
+            "questionID": r.question_id,
+            "question": "",
+            "responseType": r.response_type,
+            "textAnswer": r.text_answer,
+            "audioFile": r.audio_file.url if r.audio_file else None,
+        })
 
-    # --- KONIEC ANKIETY ---
-    if question_number > total_questions:
-        # we already created PatientResponse for each question in this flow
-        # create outbox file listing responses for later n8n processing
-        responses = PatientResponse.objects.filter(patient=patient, json_survey_id=survey_id)
-        out = []
-        for r in responses:
-            out.append({
-                "patientID": str(patient.id),
-                "surveyID": survey_id,
-                "questionID": r.question_id,
-                "question": "",
-                "responseType": r.response_type,
-                "textAnswer": r.text_answer,
-                "audioFile": r.audio_file.url if r.audio_file else None,
-            })
+    out_dir = os.path.join(settings.BASE_DIR, 'outbox')
+    os.makedirs(out_dir, exist_ok=True)
+    out_path = os.path.join(out_dir, f"{survey_id}_{patient.id}.json")
+    with open(out_path, 'w', encoding='utf-8') as f:
+        json.dump(out, f, ensure_ascii=False, indent=2)
 
-        out_dir = os.path.join(settings.BASE_DIR, 'outbox')
-        os.makedirs(out_dir, exist_ok=True)
-        out_path = os.path.join(out_dir, f"{survey_id}_{patient.id}.json")
-        with open(out_path, 'w', encoding='utf-8') as f:
-            json.dump(out, f, ensure_ascii=False, indent=2)
+    request.session.flush()
+    return render(request, 'ankieta_done.html')
 
-        request.session.flush()
-        return render(request, 'ankieta_done.html')
 
-    # --- WYŚWIETLANIE PYTANIA ---
-    q_raw = questions[question_number - 1]
-    if isinstance(q_raw, dict):
-        q_data = q_raw
-        question_text = q_data.get('text', '')
-        question_id_default = q_data.get('id', f'q{question_number}')
-    else:
-        q_data = None
-        question_text = q_raw
-        question_id_default = f'q{question_number}'
+def _voice_page(request, state, error=None):
+    context = {
+        'question': state['question_text'],
+        'question_number': state['question_number'],
+        'total_questions': state['total_questions'],
+        'audio_profile': audio.client_profile(audio.profile_for(state['survey'])),
+    }
+    if error:
+        context['error'] = error
+    return render(request, 'ankieta_voice_question.html', context)
+
+
+def _voice_upload_limits(request, question_number):
+    """(per file, per request) byte limits of a voice answer: the recording profile of the session's survey."""
+    limit = audio.max_bytes(audio.profile_for(_session_survey(request)))
+    return limit, limit + audio.FORM_BYTES
+
+
+def _voice_audio_error(request, state):
+    """Error shown on the question page, or None when the recording fits the survey's profile."""
+    profile = audio.profile_for(state['survey'])
+    if 'audio_file' in request.oversized_uploads:
+        return f'Nagranie jest za duże (limit {profile["max_seconds"]} s).'
+    audio_file = request.FILES.get('audio_file')
+    if not audio_file:
+        return 'Proszę nagrać odpowiedź'
+    try:
+        audio.check_upload(audio_file, profile)
+    except audio.AudioRejected as e:
+        return str(e)
+    return None
+
+
+def _save_voice_response(state, response_type, **answer):
+    return PatientResponse.objects.create(
+        patient=state['patient'],
+        survey=state['survey'],
+        json_survey_id=state['survey_id'],
+        question_id=state['question_id'],
+        response_type=response_type,
+        question_text=state['question_text'],
+        is_processed=False,
+        # counted up front: the n8n call follows right after the insert
+        dispatch_attempts=1,
+        last_dispatch_at=timezone.now(),
+        **answer
+    )
+
+
+def _store_audio(audio_file):
+    # storage copies the upload in chunks
+    filename = f"{uuid.uuid4().hex}_{audio_file.name}"
+    return default_storage.save(os.path.join('audio_answers', filename), audio_file)
+
+
+def _n8n_accepted(kind, resp):
+    status = getattr(resp, 'status_code', 0) or 0
+    logger.info('n8n %s webhook status %s', kind, status)
+    if 200 <= status < 300:
+        return True
+    logger.warning('n8n returned non-2xx for %s webhook: %s', kind, status,
+                   extra={'payload': getattr(resp, 'text', None)})
+    return False
+
+
+def _send_to_n8n(pr):
+    """Send the answer to n8n and mark it processed on success; errors never break the flow
+    (unaccepted answers are retried by ``manage.py reconcile_responses``)."""
+    kind = pr.response_type
+    try:
+        if _n8n_accepted(kind, n8n.send_answer(pr)):
+            pr.is_processed = True
+            pr.save(update_fields=['is_processed'])
+    except n8n.N8nUnavailable as e:
+        logger.info('%s answer not sent: %s', kind, e)
+    except Exception:
+        logger.warning('Błąd przy wysyłce do n8n (%s)', kind, exc_info=True)
+
+
+async def _asend_to_n8n(pr):
+    """_send_to_n8n on the pooled async client."""
+    kind = pr.response_type
+    try:
+        if _n8n_accepted(kind, await n8n.asend_answer(pr)):
+            await PatientResponse.objects.filter(pk=pr.pk).aupdate(is_processed=True)
+            # update() sends no post_save: cached cards would keep showing the answer as pending
+            await sync_to_async(fragments.invalidate)(patients=[pr.patient_id], runs=[pr.json_survey_id])
+    except n8n.N8nUnavailable as e:
+        logger.info('%s answer not sent: %s', kind, e)
+    except Exception:
+        logger.warning('Błąd przy wysyłce do n8n (%s)', kind, exc_info=True)
+
+
+@audio.limit_uploads(_voice_upload_limits)
+@conditional.conditional_page(_question_fingerprint)
+def ankieta_voice_question(request, question_number):
+    """Voice/text flow. Audio files are saved immediately and a PatientResponse is created per question.
+    Recording should start client-side on load and stop when user clicks Next (form submission).
+    """
+    question_number = int(question_number)
+    state = _voice_state(request, question_number)
+    if state is None:
+        return redirect('ankieta_choice')
+
+    # --- KONIEC ANKIETY ---
+    if question_number > state['total_questions']:
+        return _finish_voice_run(request, state)
 
+    # --- WYŚWIETLANIE PYTANIA ---
     if request.method == 'POST':
         response_type = request.POST.get('response_type', 'audio')
 
         if response_type == 'text':
             text = request.POST.get('text_answer', '').strip()
             if not text:
-                return render(request, 'ankieta_voice_question.html', {
-                    'question': question_text,
-                    'question_number': question_number,
-                    'total_questions': total_questions,
-                    'error': 'Proszę wpisać odpowiedź',
-                })
-            # save response immediately
-            question_id = question_id_default
-            pr = PatientResponse.objects.create(
-                patient=patient,
-                survey=survey,
-                json_survey_id=survey_id,
-                question_id=question_id,
-                response_type='text',
-                text_answer=text,
-                question_text=question_text,
-                is_processed=False
-            )
-
-            # Send webhook to n8n for text response and mark processed on success
-            try:
-                data = {
-                    'question': question_text,
-                    'patientID': str(patient.id),
-                    'surveyID': survey_id,
-                    'questionID': question_id,
-                    'text': text
-                }
-                resp = requests.post(N8N_WEBHOOK_URL, json=data, timeout=10)
-                print('➡️ n8n text webhook status:', getattr(resp, 'status_code', None))
-                if getattr(resp, 'status_code', 0) >= 200 and getattr(resp, 'status_code', 0) < 300:
-                    pr.is_processed = True
-                    pr.save()
-                else:
-                    print('⚠️ n8n returned non-2xx for text webhook:', getattr(resp, 'status_code', None), getattr(resp, 'text', None))
-            except Exception as e:
-                print('⚠️ Błąd przy wysyłce tekstu do n8n:', e)
+                return _voice_page(request, state, 'Proszę wpisać odpowiedź')
+            # save response immediately, then send to n8n
+            pr = _save_voice_response(state, 'text', text_answer=text)
+            _send_to_n8n(pr)
 
         elif response_type == 'audio':
-            audio_file = request.FILES.get('audio_file')
-            if not audio_file:
-                return render(request, 'ankieta_voice_question.html', {
-                    'question': question_text,
-                    'question_number': question_number,
-                    'total_questions': total_questions,
-                    'error': 'Proszę nagrać odpowiedź',
-                })
+            error = _voice_audio_error(request, state)
+            if error:
+                return _voice_page(request, state, error)
+            pr = _save_voice_response(state, 'audio', audio_file=_store_audio(request.FILES['audio_file']))
+            _send_to_n8n(pr)
 
-            # save audio to storage
-            filename = f"{uuid.uuid4().hex}_{audio_file.name}"
-            save_path = os.path.join('audio_answers', filename)
-            saved_name = default_storage.save(save_path, audio_file)
+        return redirect('ankieta_voice_question', question_number=question_number + 1)
 
-            question_id = question_id_default
-            pr = PatientResponse.objects.create(
-                patient=patient,
-                survey=survey,
-                json_survey_id=survey_id,
-                question_id=question_id,
-                response_type='audio',
-                audio_file=saved_name,
-                question_text=question_text,
-                is_processed=False
-            )
+    return _voice_page(request, state)
 
-            # Prepare webhook payload and send multipart to n8n
-            try:
-                # open saved file for sending
-                f = default_storage.open(saved_name, 'rb')
-                # determine mime by extension
-                lower = saved_name.lower()
-                if lower.endswith('.mp3'):
-                    mime = 'audio/mpeg'
-                elif lower.endswith('.wav'):
-                    mime = 'audio/wav'
-                elif lower.endswith('.webm'):
-                    mime = 'audio/webm'
-                else:
-                    mime = 'application/octet-stream'
 
-                files = {'audio': (os.path.basename(saved_name), f, mime)}
+@audio.limit_uploads(_voice_upload_limits)
+@conditional.conditional_page(_question_fingerprint)
+async def ankieta_voice_question_async(request, question_number):
+    """ankieta_voice_question for ASGI (settings.ASYNC_VIEWS): the n8n call is awaited on the
+    pooled client (cantrilapp.n8n) instead of holding a worker thread; session, ORM and
+    storage work runs through sync_to_async.
+    """
+    question_number = int(question_number)
+    state = await sync_to_async(_voice_state)(request, question_number)
+    if state is None:
+        return redirect('ankieta_choice')
+
+    if question_number > state['total_questions']:
+        return await sync_to_async(_finish_voice_run)(request, state)
 
-                # Simple payload for n8n
-                data = {
-                    'question': question_text,
-                    'patientID': str(patient.id),
-                    'surveyID': survey_id,
-                    'questionID': question_id
-                }
+    if request.method == 'POST':
+        response_type = request.POST.get('response_type', 'audio')
 
-                # send to n8n (non-blocking: errors are caught) and mark processed on success
-                resp = requests.post(N8N_WEBHOOK_URL, data=data, files=files, timeout=10)
-                print('➡️ n8n audio webhook status:', getattr(resp, 'status_code', None))
-                if getattr(resp, 'status_code', 0) >= 200 and getattr(resp, 'status_code', 0) < 300:
-                    pr.is_processed = True
-                    pr.save()
-                else:
-                    print('⚠️ n8n returned non-2xx for audio webhook:', getattr(resp, 'status_code', None), getattr(resp, 'text', None))
-                f.close()
-            except Exception as e:
-                # don't break the flow if webhook fails
-                print('⚠️ Błąd przy wysyłce do n8n:', e)
+        if response_type == 'text':
+            text = request.POST.get('text_answer', '').strip()
+            if not text:
+                return await sync_to_async(_voice_page)(request, state, 'Proszę wpisać odpowiedź')
+            pr = await sync_to_async(_save_voice_response)(state, 'text', text_answer=text)
+            await _asend_to_n8n(pr)
+
+        elif response_type == 'audio':
+            error = await sync_to_async(_voice_audio_error)(request, state)
+            if error:
+                return await sync_to_async(_voice_page)(request, state, error)
+
+            def save():
+                return _save_voice_response(state, 'audio', audio_file=_store_audio(request.FILES['audio_file']))
+            pr = await sync_to_async(save)()
+            await _asend_to_n8n(pr)
 
         return redirect('ankieta_voice_question', question_number=question_number + 1)
 
-    return render(request, 'ankieta_voice_question.html', {
-        'question': question_text,
-        'question_number': question_number,
-        'total_questions': total_questions,
-    })
+    return await sync_to_async(_voice_page)(request, state)
 
 # =====================
 # Zakończenie ankiety
@@ -696,6 +881,69 @@ def ankieta_done(request):
     return render(request, 'ankieta_done.html')
 
 
+# =====================
+# Tryb kiosku (offline, cantrilapp.kiosk)
+# =====================
+# precached by the service worker next to the kiosk page and the survey definitions
+KIOSK_ASSETS = [
+    'css/cantril.css', 'css/ladder.css', *[f'css/ladder/{d}.css' for d, _ in Survey.LADDER_DESIGNS],
+    'js/ui.js', 'js/ladder.js', 'js/recorder.js', 'js/kiosk.js',
+]
+
+
+@ensure_csrf_cookie
+def kiosk_home(request):
+    """Offline survey app for clinic tablets; the page itself only needs static data."""
+    return render(request, 'kiosk.html', {
+        'designs': [d for d, _ in Survey.LADDER_DESIGNS],
+        'config': kiosk.kiosk_config(),
+        'csrf_cookie_name': settings.CSRF_COOKIE_NAME,
+    })
+
+
+def kiosk_service_worker(request):
+    """Service worker script, served from /kiosk/ so that its scope covers the kiosk page."""
+    precache = [reverse('kiosk'), reverse('kiosk_surveys')] + [static(path) for path in KIOSK_ASSETS]
+    # a deploy (new templates or hashed asset names) installs a new worker with a fresh cache
+    version = hashlib.sha1(repr((conditional.release(), precache)).encode()).hexdigest()[:12]
+    response = render(request, 'kiosk_sw.js', {
+        'version': version,
+        'precache': mark_safe(json.dumps(precache)),
+        'pages': mark_safe(json.dumps(precache[:2])),
+    }, content_type='text/javascript; charset=utf-8')
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+def _kiosk_surveys_fingerprint(request):
+    version, changed = conditional.surveys_version()
+    return (version,), changed
+
+
+@conditional.conditional_page(_kiosk_surveys_fingerprint)
+def kiosk_surveys(request):
+    """Compiled survey definitions (questions with pre-rendered ladders) for offline use."""
+    return JsonResponse({'surveys': kiosk.survey_definitions()})
+
+
+def _kiosk_upload_limits(request):
+    # per file: any survey's profile; each file is checked against its own survey in kiosk.ingest
+    return audio.MAX_UPLOAD_BYTES, kiosk.kiosk_config()['max_request_bytes']
+
+
+@audio.limit_uploads(_kiosk_upload_limits)
+@require_POST
+def kiosk_sync(request):
+    """Batch upload of runs recorded offline; idempotent per run (cantrilapp.kiosk.ingest)."""
+    try:
+        runs = json.loads(request.POST.get('runs') or 'null')
+        results = kiosk.ingest(runs, request.FILES, device=request.POST.get('device', ''),
+                               oversized=request.oversized_uploads)
+    except ValueError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    return JsonResponse({'status': 'ok', 'runs': results})
+
+
 # =====================
 # Panel lekarza + n8n webhook
 # =====================
@@ -739,10 +987,11 @@ def ladder_designs(request):
         # Update design
         data['ladder_design'] = new_design
         
-        # Save back to JSON
-        with open(QUESTION_FILE_PATH, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
+        # Save back to JSON (replaced atomically: patient pages read it concurrently)
+        surveys.write_json_atomic(QUESTION_FILE_PATH, data)
+        ladder.precompile(data)
         
+        pin_primary(request)
         messages.success(request, f"✅ Design drabiny zmieniony na: {new_design}!")
         return redirect('ladder_designs')
     
@@ -752,8 +1001,11 @@ def ladder_designs(request):
     })
 
 
-def panel_results(request):
-    """Show processed results. Filterable by pesel or survey_id."""
+# newest answers on one results page; the unfiltered page walks resp_created_idx only this far
+RESULTS_LIMIT = 500
+
+
+def _results_queryset(request):
     pesel = request.GET.get('pesel', '').strip()
     survey_id = request.GET.get('survey_id', '').strip()
 
@@ -763,9 +1015,56 @@ def panel_results(request):
     # Only filter by survey_id if it's a valid non-None value
     if survey_id and survey_id != 'None':
         qs = qs.filter(json_survey_id=survey_id)
+    return qs, pesel, survey_id
+
+
+def _archived_results(pesel, run_id):
+    """Answers of an archived run as unsaved PatientResponse objects, newest first."""
+    runs = ArchivedRun.objects.select_related('patient').filter(run_id=run_id)
+    if pesel:
+        runs = runs.filter(patient__pesel=pesel)
+    rows = [r for run_rows in archive.read_runs(list(runs)).values() for r in run_rows]
+    rows.sort(key=lambda r: r.created_at, reverse=True)
+    return rows
+
+
+def _with_score_events(fingerprint):
+    """Adds the broker's boot to the ETag of a page that embeds ``_score_events_url``.
+
+    After a restart the rendered resume id is gone; a revalidated copy would
+    keep reconnecting with it.
+    """
+    def wrapped(request, *args, **kwargs):
+        result = fingerprint(request, *args, **kwargs)
+        if result is None or not settings.ASYNC_VIEWS:
+            return result
+        parts, last_modified = result
+        return (parts, events.get_broker().boot), last_modified
+    return wrapped
+
+
+def _results_fingerprint(request):
+    # watermarks of the rows shown; the history counter also catches deletes and renames
+    versions = conditional.generations(fragments.HISTORY)
+    if versions is None:
+        return None
+    watermarks = conditional.response_watermarks(_results_queryset(request)[0])
+    return (watermarks, versions[0]), conditional.latest(*watermarks)
+
+
+@replica_reads
+@conditional.conditional_page(_with_score_events(_results_fingerprint))
+def panel_results(request):
+    """Show processed results. Filterable by pesel or survey_id."""
+    qs, pesel, survey_id = _results_queryset(request)
 
     # prepare simple rows
     rows = []
+    qs = list(qs[:RESULTS_LIMIT])
+    if not qs and survey_id and survey_id != 'None':
+        # a run past retention: read it back from the archive
+        qs = _archived_results(pesel, survey_id)
+    titles = survey_titles_for_runs({r.json_survey_id for r in qs})
     for r in qs:
         # format created_at into local timezone defined in settings (e.g. Europe/Warsaw)
         created_cet = None
@@ -798,7 +1097,7 @@ def panel_results(request):
         rows.append({
             'patient_pesel': r.patient.pesel,
             'json_survey_id': r.json_survey_id,
-            'survey_label': format_survey_label(r.json_survey_id, r.created_at),
+            'survey_label': format_survey_label(r.json_survey_id, r.created_at, titles),
             'question_id': r.question_id,
             'question_text': qtext,
             'response_type': r.response_type,
@@ -814,20 +1113,53 @@ def panel_results(request):
             'created_label': created_label,
         })
 
-    return render(request, 'panel_results.html', {'rows': rows, 'pesel': pesel, 'survey_id': survey_id})
+    filtered = bool(pesel or (survey_id and survey_id != 'None'))
+    score_events_url = None
+    if rows or not filtered:
+        score_events_url = _score_events_url(
+            patients={r.patient_id for r in qs} if pesel else (),
+            runs=[survey_id] if survey_id and survey_id != 'None' else (),
+        )
+    return render(request, 'panel_results.html', {
+        'rows': rows, 'limit': RESULTS_LIMIT, 'pesel': pesel, 'survey_id': survey_id,
+        'score_events_url': score_events_url,
+    })
 
 
-def panel_history(request):
-    """History of filled surveys grouped by patient and survey_id.
+@staff_member_required
+@replica_reads
+def export_responses(request):
+    """Stream responses as CSV (optionally gzip). Filters match panel_results plus date range (staff only).
 
-    Search supports: pesel, first/last name, survey_id.
+    Query params: pesel, survey_id (run id), survey (UUID), date_from, date_to (YYYY-MM-DD), gzip=1.
     """
-    q = request.GET.get('q', '').strip()
-    
-    # Ignore if q is the string "None"
-    if q == 'None':
-        q = ''
+    compress = request.GET.get('gzip') == '1'
+    try:
+        qs = exports.export_queryset(
+            pesel=request.GET.get('pesel', '').strip(),
+            survey_id=request.GET.get('survey_id', '').strip(),
+            survey_uuid=request.GET.get('survey', '').strip(),
+            date_from=request.GET.get('date_from', '').strip(),
+            date_to=request.GET.get('date_to', '').strip(),
+        )
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e), content_type='text/plain; charset=utf-8')
+
+    chunks = exports.iter_encoded(exports.iter_csv(qs), compress=compress)
+    # the body is produced after the view returns, so carry the replica routing along;
+    # under ASGI as an async iterator, chunk by chunk
+    response = StreamingHttpResponse(
+        apreserve_read_target(chunks) if settings.ASYNC_VIEWS else preserve_read_target(chunks),
+        content_type='application/gzip' if compress else 'text/csv; charset=utf-8',
+    )
+    response['Content-Disposition'] = f'attachment; filename="{exports.export_filename(compress)}"'
+    # don't let a reverse proxy buffer the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 
+def _history_patients(q):
+    """Patients with their runs for panel_history, filtered by the search term."""
     base_qs = PatientResponse.objects.select_related('patient')
     if q:
         base_qs = base_qs.filter(
@@ -854,6 +1186,28 @@ def panel_history(request):
         .order_by('patient__pesel', '-last_response_at')
     )
 
+    aggregated = list(aggregated)
+    archived_qs = ArchivedRun.objects.all()
+    if q:
+        archived_qs = archived_qs.filter(
+            Q(patient__pesel__icontains=q)
+            | Q(patient__first_name__icontains=q)
+            | Q(patient__last_name__icontains=q)
+            | Q(run_id__icontains=q)
+        )
+    archived = list(archived_qs.values(
+        'patient_id', 'patient__pesel', 'patient__first_name', 'patient__last_name',
+        'first_response_at', 'last_response_at',
+        json_survey_id=F('run_id'), responses_count=F('responses'), processed_count=F('processed'),
+    ))
+    if archived:
+        for row in archived:
+            row['archived'] = True
+        aggregated += archived
+        # same order as the query above: pesel, then newest run first
+        aggregated.sort(key=lambda row: row['last_response_at'], reverse=True)
+        aggregated.sort(key=lambda row: row['patient__pesel'] or '')
+    titles = survey_titles_for_runs({row['json_survey_id'] for row in aggregated})
     patients_map = {}
     for row in aggregated:
         pid = row['patient_id']
@@ -881,11 +1235,12 @@ def panel_history(request):
         patients_map[pid]['surveys'].append(
             {
                 'survey_id': row['json_survey_id'],
-                'survey_label': format_survey_label(row['json_survey_id'], fallback_dt),
+                'survey_label': format_survey_label(row['json_survey_id'], fallback_dt, titles),
                 'responses_count': row['responses_count'],
                 'processed_count': row['processed_count'],
                 'first_response_at': first_local,
                 'last_response_at': last_local,
+                'archived': row.get('archived', False),
             }
         )
 
@@ -902,14 +1257,42 @@ def panel_history(request):
             if p['surveys']:
                 filtered.append(p)
         patients = filtered
+    return patients
 
-    return render(request, 'panel_history.html', {'patients': patients, 'q': q})
 
+def _gens_fingerprint(*scopes):
+    """Fingerprint of a fragment-backed page: its generation counters, Last-Modified = last bump.
 
-def panel_patient_history(request, patient_id: int):
-    """Patient card: list survey runs (survey_id) for a single patient."""
-    patient = get_object_or_404(Patient, id=patient_id)
+    None (no validation) when the fragment cache is off.
+    """
+    def fingerprint(request, *args, **kwargs):
+        return conditional.generations(*[scope(*args, **kwargs) if callable(scope) else scope for scope in scopes])
+    return fingerprint
 
+
+@replica_reads
+@conditional.conditional_page(_gens_fingerprint(fragments.HISTORY))
+def panel_history(request):
+    """History of filled surveys grouped by patient and survey_id.
+
+    Search supports: pesel, first/last name, survey_id. The rendered list is
+    cached per search term until a response, patient or survey changes.
+    """
+    q = request.GET.get('q', '').strip()
+    
+    # Ignore if q is the string "None"
+    if q == 'None':
+        q = ''
+
+    patients_html = fragments.cached(
+        'history', q, [fragments.HISTORY],
+        lambda: render_to_string('panel_history_patients.html', {'patients': _history_patients(q)}),
+    )
+    return render(request, 'panel_history.html', {'patients_html': patients_html, 'q': q})
+
+
+def _patient_runs(patient):
+    """Surveys filled by one patient with response counts, newest first."""
     # Get all surveys with responses from this patient
     survey_responses = PatientResponse.objects.filter(
         patient=patient,
@@ -921,9 +1304,29 @@ def panel_patient_history(request, patient_id: int):
         last_response_at=Max('created_at'),
     ).order_by('-last_response_at')
 
+    survey_responses = list(survey_responses)
+    # fold in runs moved to the archive (cantrilapp.archive)
+    archived = ArchivedRun.objects.filter(patient=patient, survey__isnull=False).values('survey').annotate(
+        responses_count=Sum('responses'),
+        processed_count=Sum('processed'),
+        first_response_at=Min('first_response_at'),
+        last_response_at=Max('last_response_at'),
+    ).order_by()
+    by_survey = {item['survey']: item for item in survey_responses}
+    for item in archived:
+        hot = by_survey.get(item['survey'])
+        if hot is None:
+            survey_responses.append(item)
+            continue
+        hot['responses_count'] += item['responses_count']
+        hot['processed_count'] += item['processed_count']
+        hot['first_response_at'] = min(hot['first_response_at'], item['first_response_at'])
+        hot['last_response_at'] = max(hot['last_response_at'], item['last_response_at'])
+    survey_responses.sort(key=lambda item: item['last_response_at'], reverse=True)
+    surveys_by_id = Survey.objects.in_bulk([item['survey'] for item in survey_responses])
     surveys_list = []
     for item in survey_responses:
-        survey = Survey.objects.get(id=item['survey'])
+        survey = surveys_by_id[item['survey']]
         try:
             first_local = timezone.localtime(item['first_response_at']).strftime('%Y-%m-%d %H:%M:%S') if item.get('first_response_at') else None
         except Exception:
@@ -946,89 +1349,273 @@ def panel_patient_history(request, patient_id: int):
             'first_response_at': first_local,
             'last_response_at': last_local,
         })
+    return surveys_list
+
 
+@replica_reads
+@conditional.conditional_page(_gens_fingerprint(
+    lambda patient_id: fragments.patient_scope(patient_id), fragments.SURVEYS,
+))
+def panel_patient_history(request, patient_id: int):
+    """Patient card: list survey runs (survey_id) for a single patient."""
+    patient = get_object_or_404(Patient, id=patient_id)
+    runs_html = fragments.cached(
+        'patient_runs', patient.id, [fragments.patient_scope(patient.id), fragments.SURVEYS],
+        lambda: render_to_string('panel_patient_runs.html', {'patient': patient, 'surveys': _patient_runs(patient)}),
+    )
     return render(
         request,
         'panel_patient_history.html',
         {
             'patient': patient,
-            'surveys': surveys_list,
+            'runs_html': runs_html,
         },
     )
 
 
-def panel_survey_completions(request, survey_id: int, patient_id: int):
-    """View all completions of a specific survey by a specific patient."""
-    survey = get_object_or_404(Survey, id=survey_id)
-    patient = get_object_or_404(Patient, id=patient_id)
-    
+def _completion_runs(survey, patient):
+    """json_survey_id -> time of its last answer for every completion of this survey, newest first."""
     # First, get all responses for this patient and survey (with survey FK set)
     responses_with_survey = PatientResponse.objects.filter(
         patient=patient,
         survey=survey
-    ).order_by('-created_at')
-    
-    # Collect json_survey_id values from these responses
-    survey_session_ids = set(r.json_survey_id for r in responses_with_survey if r.json_survey_id)
-    
-    # Now also include any older responses with the same json_survey_id but no survey FK
-    # (for backwards compatibility)
-    if survey_session_ids:
-        all_responses = PatientResponse.objects.filter(
-            Q(patient=patient, survey=survey) |
-            Q(patient=patient, json_survey_id__in=survey_session_ids)
-        ).order_by('-created_at')
-    else:
-        all_responses = responses_with_survey
-    
-    # Group by completion session (json_survey_id)
-    completions = {}
-    for response in all_responses:
-        session_id = response.json_survey_id
-        if session_id not in completions:
-            completions[session_id] = {
-                'session_id': session_id,
-                'completed_at': response.created_at,
-                'responses': []
-            }
-        completions[session_id]['responses'].append(response)
-    
-    # Sort completions by date
-    completions_list = sorted(
-        completions.values(),
-        key=lambda x: x['completed_at'],
-        reverse=True
     )
     
-    # Format dates
-    for completion in completions_list:
-        try:
-            completion['completed_at_local'] = timezone.localtime(
-                completion['completed_at']
-            ).strftime('%Y-%m-%d %H:%M:%S')
-        except Exception:
-            completion['completed_at_local'] = str(completion['completed_at'])
-    
+    # Also include any older responses with the same json_survey_id but no survey FK
+    # (for backwards compatibility); the run ids come from a subquery on the index
+    all_responses = PatientResponse.objects.filter(
+        Q(patient=patient, survey=survey) |
+        Q(patient=patient, json_survey_id__in=responses_with_survey.exclude(json_survey_id='').values('json_survey_id'))
+    )
+    runs = (
+        all_responses.values('json_survey_id')
+        .annotate(completed_at=Max('created_at'))
+        .order_by('-completed_at')
+    )
+    completed = {row['json_survey_id']: row['completed_at'] for row in runs}
+    completed.update(
+        ArchivedRun.objects.filter(patient=patient, survey=survey).values_list('run_id', 'last_response_at')
+    )
+    return dict(sorted(completed.items(), key=lambda item: item[1], reverse=True))
+
+
+def _completion_cards(survey, patient, run_ids):
+    """Rendered card per completion; only runs whose answers changed are queried and rendered."""
+    def build(missing):
+        runs = [key[2] for key in missing]
+        cond = Q(patient=patient, json_survey_id__in=[r for r in runs if r])
+        if not all(runs):
+            # answers saved without a run id belong to this survey's page only
+            cond |= Q(patient=patient, survey=survey) & (Q(json_survey_id__isnull=True) | Q(json_survey_id=''))
+
+        # Group by completion session (json_survey_id)
+        completions = {}
+        for response in PatientResponse.objects.filter(cond).order_by('-created_at'):
+            session_id = response.json_survey_id
+            if session_id not in completions:
+                completions[session_id] = {
+                    'session_id': session_id,
+                    'completed_at': response.created_at,
+                    'responses': []
+                }
+            completions[session_id]['responses'].append(response)
+
+        # runs past retention are read back from the archive
+        cold = [r for r in runs if r and r not in completions]
+        if cold:
+            archived = ArchivedRun.objects.filter(patient=patient, run_id__in=cold)
+            for session_id, responses in archive.read_runs(list(archived)).items():
+                responses.reverse()
+                completions[session_id] = {
+                    'session_id': session_id,
+                    'completed_at': responses[0].created_at,
+                    'responses': responses,
+                    'archived': True,
+                }
+
+        # Format dates
+        for completion in completions.values():
+            try:
+                completion['completed_at_local'] = timezone.localtime(
+                    completion['completed_at']
+                ).strftime('%Y-%m-%d %H:%M:%S')
+            except Exception:
+                completion['completed_at_local'] = str(completion['completed_at'])
+
+        return {
+            key: render_to_string('panel_completion_card.html', {'completion': completions[key[2]]})
+            for key in missing if key[2] in completions
+        }
+
+    items = {
+        (patient.id, survey.id, run_id): [fragments.run_scope(run_id) if run_id else fragments.patient_scope(patient.id)]
+        for run_id in run_ids
+    }
+    cards = fragments.cached_many('completion', items, build)
+    return [cards[key] for key in items if key in cards]
+
+
+@replica_reads
+@conditional.conditional_page(_with_score_events(_gens_fingerprint(
+    lambda survey_id, patient_id: fragments.patient_scope(patient_id), fragments.SURVEYS,
+)))
+def panel_survey_completions(request, survey_id: int, patient_id: int):
+    """View all completions of a specific survey by a specific patient.
+
+    The page caches its list of cards per patient; each card is cached per run,
+    so a new or rescored run re-renders only its own card.
+    """
+    survey = get_object_or_404(Survey, id=survey_id)
+    patient = get_object_or_404(Patient, id=patient_id)
+    completion_cards = fragments.cached(
+        'completions', (survey.id, patient.id), [fragments.patient_scope(patient.id)],
+        lambda: _completion_cards(survey, patient, _completion_runs(survey, patient)),
+    )
     return render(
         request,
         'panel_survey_completions.html',
         {
             'survey': survey,
             'patient': patient,
-            'completions': completions_list,
+            'completion_cards': completion_cards,
+            'score_events_url': _score_events_url(patients=[patient.id]),
         }
     )
 
 
-@csrf_exempt
-def n8n_results_webhook(request):
-    """Endpoint to receive processed results from n8n.
+def _score_events_url(patients=(), runs=()):
+    """Live-score stream for a page, resuming from the moment it was rendered; None without ASGI."""
+    if not settings.ASYNC_VIEWS:
+        return None
+    query = [('patient', p) for p in patients] + [('run', r) for r in runs]
+    query.append(('last_event_id', events.get_broker().last_id()))
+    return f"{reverse('panel_score_events')}?{urlencode(query)}"
 
-    Expected: form-data or JSON with keys like 'questionID', 'patientID', 'surveyID', 'score'
+
+async def panel_score_events(request):
+    """Server-Sent Events with n8n scores as the webhook applies them.
+
+    ``?patient=<id>`` / ``?run=<json_survey_id>`` (repeatable) narrow the stream;
+    a reconnect resumes after Last-Event-ID (``?last_event_id=`` on the first
+    connect, rendered into the page; from now if it is gone). A stream holds its connection for minutes,
+    which only an ASGI server can afford: under WSGI the endpoint answers 204 and
+    EventSource stops retrying, leaving the page as it was.
     """
-    if request.method != 'POST':
-        return JsonResponse({'status': 'error', 'message': 'POST expected'})
+    if not settings.ASYNC_VIEWS:
+        return HttpResponse(status=204)
+    patients = {int(p) for p in request.GET.getlist('patient') if p.isdigit()}
+    runs = {r for r in request.GET.getlist('run') if r}
+    reconnect_id = request.headers.get('Last-Event-ID')
+    last_event_id = reconnect_id or request.GET.get('last_event_id')
+    response = StreamingHttpResponse(
+        events.stream(patients, runs, last_event_id, events.events_config(), rendered=not reconnect_id),
+        content_type='text/event-stream',
+    )
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'  # nginx: pass events through unbuffered
+    return response
+
+
+def _agreement_fingerprint(request):
+    versions = conditional.generations(fragments.SURVEYS)
+    if versions is None:
+        return None
+    watermark = conditional.job_watermark(analytics.JOB_NAME)
+    gens, changed = versions
+    return (watermark, gens), conditional.latest(watermark, changed)
+
+
+@replica_reads
+@conditional.conditional_page(_agreement_fingerprint)
+def panel_agreement(request):
+    """Self-report vs n8n score agreement per survey/question/month (precomputed).
+
+    Data comes from ScoreAgreement, refreshed by the compute_score_agreement command.
+    """
+    survey_uuid = request.GET.get('survey', '').strip()
+    question_id = request.GET.get('question_id', '').strip()
+
+    qs = ScoreAgreement.objects.select_related('survey')
+    if survey_uuid and survey_uuid != 'None':
+        qs = qs.filter(survey_id=survey_uuid)
+    if question_id:
+        qs = qs.filter(question_id=question_id)
+
+    rows = []
+    for a in qs:
+        rows.append({
+            'period': a.period.strftime('%Y-%m'),
+            'survey_title': a.survey.title if a.survey else '—',
+            'question_id': a.question_id,
+            'sample_size': a.sample_size,
+            'bias': a.bias,
+            'mean_abs_diff': a.mean_abs_diff,
+            'correlation': a.correlation,
+            'loa_lower': a.loa_lower,
+            'loa_upper': a.loa_upper,
+            'computed_at': timezone.localtime(a.computed_at).strftime('%Y-%m-%d %H:%M'),
+        })
+
+    return render(request, 'panel_agreement.html', {
+        'rows': rows,
+        'surveys': Survey.objects.order_by('title'),
+        'survey_uuid': survey_uuid,
+        'question_id': question_id,
+    })
+
+
+@staff_member_required
+def panel_profiles(request):
+    """Slowest endpoints from the request profiler, with collapsed stacks (staff only)."""
+    store = profiling.get_store()
+    selected = request.GET.get('view', '').strip()
+
+    record = None
+    if request.GET.get('file'):
+        record = store.load(request.GET['file'])
+
+    endpoints = profiling.endpoint_summary(store.records())
+    if request.GET.get('download') and selected:
+        endpoint = next((e for e in endpoints if e['view'] == selected), None)
+        if endpoint is None:
+            raise Http404('No profiles for this view')
+        response = HttpResponse(profiling.collapsed(endpoint['stacks']), content_type='text/plain; charset=utf-8')
+        # view names can be raw paths when a URL did not resolve
+        filename = re.sub(r'[^\w.-]+', '_', endpoint['view']).strip('._') or 'profile'
+        response['Content-Disposition'] = f'attachment; filename="{filename}.collapsed.txt"'
+        return response
+
+    detail = None
+    for e in endpoints:
+        e['top_frames'] = profiling.top_frames(e['stacks'], limit=10)
+        if e['view'] == selected:
+            detail = e
+
+    return render(request, 'panel_profiles.html', {
+        'endpoints': endpoints,
+        'detail': detail,
+        'record': record,
+        'record_top_frames': profiling.top_frames(record.get('stacks', {})) if record else [],
+        'config': profiling.profiling_config(),
+        'token': profiling.profile_token(request.user),
+        'query_param': profiling.QUERY_PARAM,
+    })
 
+
+def metrics_endpoint(request):
+    """Prometheus scrape target (request histograms, outbox backlog, webhook lag)."""
+    token = getattr(settings, 'METRICS_TOKEN', '')
+    if token:
+        allowed = request.headers.get('Authorization', '') == f'Bearer {token}'
+    else:
+        allowed = request.META.get('REMOTE_ADDR') in getattr(settings, 'METRICS_ALLOWED_IPS', [])
+    if not allowed:
+        return HttpResponse(status=403)
+    return HttpResponse(metrics.render_prometheus(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def _webhook_items(request):
+    """Parse an n8n results delivery into (question_id, run_id, score) tuples; None when empty."""
     # Try to parse as JSON first, then fall back to form data
     payload = None
     try:
@@ -1037,16 +1624,15 @@ def n8n_results_webhook(request):
         # Try form data
         payload = request.POST.dict()
         if not payload:
-            return JsonResponse({'status': 'error', 'message': 'No data received'})
+            return None
 
     # Ensure payload is a list
     if isinstance(payload, dict):
         payload = [payload]
 
-    print(f"🔍 DEBUG n8n webhook: {json.dumps(payload, indent=2)}")
+    webhook_log.debug('n8n webhook: %d item(s)', len(payload), extra={'payload': payload})
 
-    updated = 0
-    created = 0
+    items = []
     for item in payload:
         # Get required fields
         qid = item.get('question ID') or item.get('questionID') or item.get('question_id') or item.get('questionId')
@@ -1054,24 +1640,51 @@ def n8n_results_webhook(request):
         score = item.get('score') or item.get('evaluated_score') or item.get('rating')
 
         if not qid or not survey:
-            print(f"⚠️ Missing qid or survey: qid={qid}, survey={survey}")
+            webhook_log.warning('Missing qid or survey: qid=%s, survey=%s', qid, survey)
             continue
 
-        print(f"📝 Processing: qid={qid}, survey={survey}, score={score}")
+        webhook_log.debug('Processing: qid=%s, survey=%s, score=%s', qid, survey, score)
+        items.append((qid, survey, score))
+    return items
 
-        # Find PatientResponse by json_survey_id (renamed from survey_id) and questionID
-        try:
-            pr = PatientResponse.objects.get(question_id=str(qid), json_survey_id=str(survey))
-            pr.evaluated_score = float(score) if score is not None else None
-            pr.is_processed = True
-            pr.save()
-            updated += 1
-            print(f"✏️ Updated PatientResponse {pr.id}")
-        except PatientResponse.DoesNotExist:
-            print(f"❌ PatientResponse not found for json_survey_id={survey}, qid={qid}")
 
+def _webhook_result(items, counts):
+    updated = 0
+    created = 0
+    # PatientResponse found by json_survey_id (renamed from survey_id) and questionID
+    for (qid, survey, score), count in zip(items, counts):
+        if count:
+            updated += count
+            webhook_log.debug('Updated PatientResponse json_survey_id=%s, qid=%s', survey, qid)
+        else:
+            webhook_log.warning('PatientResponse not found for json_survey_id=%s, qid=%s', survey, qid)
     return JsonResponse({'status': 'ok', 'updated': updated, 'created': created})
 
+
+@csrf_exempt
+def n8n_results_webhook(request):
+    """Endpoint to receive processed results from n8n.
+
+    Expected: form-data or JSON with keys like 'questionID', 'patientID', 'surveyID', 'score'
+    """
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'message': 'POST expected'})
+    items = _webhook_items(request)
+    if items is None:
+        return JsonResponse({'status': 'error', 'message': 'No data received'})
+    return _webhook_result(items, record_scores(items))
+
+
+@csrf_exempt
+async def n8n_results_webhook_async(request):
+    """n8n_results_webhook for ASGI (settings.ASYNC_VIEWS): only the score writes take a thread."""
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'message': 'POST expected'})
+    items = _webhook_items(request)
+    if items is None:
+        return JsonResponse({'status': 'error', 'message': 'No data received'})
+    return _webhook_result(items, await sync_to_async(record_scores)(items))
+
 # =====================
 # Stary formularz pacjenta (opcjonalny)
 # =====================
@@ -0,0 +1,347 @@
+// Tryb kiosku: ankieta offline, odpowiedzi w IndexedDB, wysyłka paczkami (cantrilapp.kiosk)
+(function(){
+  const root = document.getElementById('kiosk');
+  if(!root) return;
+  const cfg = {
+    surveysUrl: root.dataset.surveysUrl,
+    syncUrl: root.dataset.syncUrl,
+    swUrl: root.dataset.swUrl,
+    csrfCookie: root.dataset.csrfCookie || 'csrftoken',
+    syncInterval: Number(root.dataset.syncInterval || 60) * 1000,
+    maxRuns: Number(root.dataset.maxRuns || 20),
+  };
+  const $ = (id) => document.getElementById(id);
+  const SCREENS = ['screen_start', 'screen_surveys', 'screen_question', 'screen_done'];
+
+  // =====================
+  // IndexedDB: runs (cały przebieg, keyPath run_id) + audio (Blob per plik)
+  // =====================
+  const dbReady = new Promise((resolve, reject) => {
+    const open = indexedDB.open('cantril-kiosk', 1);
+    open.onupgradeneeded = () => {
+      const db = open.result;
+      db.createObjectStore('runs', {keyPath: 'run_id'}).createIndex('status', 'status');
+      db.createObjectStore('audio');
+    };
+    open.onsuccess = () => resolve(open.result);
+    open.onerror = () => reject(open.error);
+  });
+
+  function tx(stores, mode, fn){
+    return dbReady.then((db) => new Promise((resolve, reject) => {
+      const t = db.transaction(stores, mode);
+      const result = fn(t);
+      t.oncomplete = () => resolve(result && 'result' in result ? result.result : result);
+      t.onerror = () => reject(t.error);
+      t.onabort = () => reject(t.error);
+    }));
+  }
+  const putRun = (run) => tx(['runs'], 'readwrite', (t) => t.objectStore('runs').put(run));
+  const putAudio = (key, blob) => tx(['audio'], 'readwrite', (t) => t.objectStore('audio').put(blob, key));
+  const getAudio = (key) => tx(['audio'], 'readonly', (t) => t.objectStore('audio').get(key));
+  const runsByStatus = (status) => tx(['runs'], 'readonly', (t) => t.objectStore('runs').index('status').getAll(status));
+
+  function deleteRun(run){
+    return tx(['runs', 'audio'], 'readwrite', (t) => {
+      t.objectStore('runs').delete(run.run_id);
+      run.answers.filter((a) => a.file).forEach((a) => t.objectStore('audio').delete(a.file));
+    });
+  }
+
+  // =====================
+  // Pomocnicze
+  // =====================
+  function show(screen){
+    SCREENS.forEach((id) => { $(id).hidden = id !== screen; });
+  }
+
+  function newRunId(){
+    // ten sam format co przebiegi startowane na serwerze: <uuid hex>_<YYYYmmddTHHMMSS>
+    const hex = (crypto.randomUUID ? crypto.randomUUID() : Array.from(crypto.getRandomValues(new Uint8Array(16)),
+      (b) => b.toString(16).padStart(2, '0')).join('')).replace(/-/g, '');
+    const stamp = new Date().toISOString().replace(/[-:]/g, '').slice(0, 15);
+    return `${hex}_${stamp}`;
+  }
+
+  function peselValid(pesel){
+    if(!/^\d{11}$/.test(pesel)) return false;
+    const weights = [1, 3, 7, 9, 1, 3, 7, 9, 1, 3];
+    const sum = weights.reduce((acc, w, i) => acc + w * Number(pesel[i]), 0);
+    return (10 - sum % 10) % 10 === Number(pesel[10]);
+  }
+
+  function csrfToken(){
+    const match = document.cookie.match(new RegExp('(?:^|; )' + cfg.csrfCookie + '=([^;]*)'));
+    return match ? decodeURIComponent(match[1]) : '';
+  }
+
+  function deviceId(){
+    let id = localStorage.getItem('cantrilKioskDevice');
+    if(!id){
+      id = newRunId().slice(0, 12);
+      localStorage.setItem('cantrilKioskDevice', id);
+    }
+    return id;
+  }
+
+  // =====================
+  // Definicje ankiet (cache service workera, kopia w localStorage)
+  // =====================
+  let surveys = [];
+
+  function loadSurveys(){
+    return fetch(cfg.surveysUrl, {credentials: 'same-origin'})
+      .then((r) => { if(!r.ok) throw new Error(r.status); return r.json(); })
+      .then((data) => {
+        surveys = data.surveys;
+        localStorage.setItem('cantrilKioskSurveys', JSON.stringify(surveys));
+      })
+      .catch(() => { surveys = JSON.parse(localStorage.getItem('cantrilKioskSurveys') || '[]'); });
+  }
+
+  function renderSurveyList(){
+    const list = $('survey_list');
+    list.innerHTML = '';
+    $('surveys_empty').hidden = surveys.length > 0;
+    surveys.forEach((s) => {
+      const card = document.createElement('div');
+      card.className = 'dashboard-card';
+      const title = document.createElement('h3');
+      title.textContent = s.title;
+      const count = document.createElement('p');
+      count.textContent = `${s.questions.length} pytań`;
+      const btn = document.createElement('button');
+      btn.type = 'button';
+      btn.className = 'btn';
+      btn.textContent = 'Rozpocznij';
+      btn.addEventListener('click', () => startRun(s));
+      card.append(title, count, btn);
+      list.appendChild(card);
+    });
+  }
+
+  // =====================
+  // Przebieg ankiety
+  // =====================
+  let pending = null;   // {pesel, mode} z ekranu startowego
+  let run = null;       // bieżący przebieg (zapisywany po każdej odpowiedzi)
+  let survey = null;
+  let scaleValue = 5;
+  let recorded = null;  // Blob ostatniego nagrania
+
+  function startRun(s){
+    survey = s;
+    run = {
+      run_id: newRunId(),
+      survey: s.id,
+      survey_version: s.version,
+      pesel: pending.pesel,
+      mode: pending.mode,
+      started_at: new Date().toISOString(),
+      finished_at: null,
+      answers: [],
+      status: 'open',
+    };
+    putRun(run).then(showQuestion);
+  }
+
+  function resumeOpenRun(){
+    // przebieg przerwany np. przeładowaniem strony wraca od pierwszego pytania bez odpowiedzi
+    return runsByStatus('open').then((open) => {
+      const last = open.sort((a, b) => a.started_at.localeCompare(b.started_at)).pop();
+      survey = last && surveys.find((s) => s.id === last.survey);
+      if(!survey) return false;
+      run = last;
+      showQuestion();
+      return true;
+    });
+  }
+
+  function setScale(v){
+    scaleValue = v;
+    $('out').textContent = v;
+    document.querySelectorAll('#question_ladder .ladder-step').forEach((s) => {
+      const on = Number(s.dataset.value) <= v;
+      s.setAttribute('aria-checked', on ? 'true' : 'false');
+      s.classList.toggle('active', on);
+    });
+  }
+
+  function showQuestion(){
+    const index = run.answers.length;
+    const q = survey.questions[index];
+    if(!q) return finishRun();
+    $('question_progress').textContent = `Pytanie ${index + 1} z ${survey.questions.length}`;
+    $('question_text').textContent = q.text;
+    $('question_error').hidden = true;
+    const scale = run.mode === 'cantril';
+    $('question_scale').hidden = !scale;
+    $('question_voice').hidden = scale;
+    if(scale){
+      $('question_ladder').innerHTML = q.ladder;  // wyrenderowane na serwerze (cantrilapp.ladder)
+      document.querySelectorAll('#question_ladder .ladder-step').forEach((s) => {
+        s.tabIndex = 0;
+        s.addEventListener('click', () => setScale(Number(s.dataset.value)));
+      });
+      setScale(5);
+    } else {
+      recorded = null;
+      $('text_answer').value = '';
+      $('audio_preview').hidden = true;
+      $('record_status').textContent = 'Nie nagrywasz';
+    }
+    show('screen_question');
+  }
+
+  function answerCurrent(){
+    const q = survey.questions[run.answers.length];
+    const answer = {question: q.id, text: q.text};
+    if(run.mode === 'cantril'){
+      answer.type = 'scale';
+      answer.value = scaleValue;
+      return Promise.resolve(answer);
+    }
+    const text = $('text_answer').value.trim();
+    if(recorded){
+      answer.type = 'audio';
+      answer.file = `${run.run_id}_${q.id}`;
+      return putAudio(answer.file, recorded).then(() => answer);
+    }
+    if(!text) return Promise.reject(new Error('Nagraj lub wpisz odpowiedź.'));
+    answer.type = 'text';
+    answer.value = text;
+    return Promise.resolve(answer);
+  }
+
+  function finishRun(){
+    run.finished_at = new Date().toISOString();
+    run.status = 'pending';
+    return putRun(run).then(() => {
+      run = null;
+      show('screen_done');
+      sync();
+    });
+  }
+
+  // =====================
+  // Nagrywanie (tryb głosowy)
+  // =====================
+  let recording = null;
+
+  function toggleRecording(){
+    if(recording){
+      recording.stop();
+      return;
+    }
+    // profil nagrań ankiety (cantrilapp.audio): mono Opus, bitrate, limit czasu, pomijanie ciszy
+    CantrilRecorder.start(survey.audio_profile, {
+      onTick: (left) => { $('record_status').textContent = `● Nagrywanie… (pozostało ${left} s)`; },
+      onStop: (blob) => {
+        recording = null;
+        recorded = blob;
+        $('audio_preview').src = URL.createObjectURL(recorded);
+        $('audio_preview').hidden = false;
+        $('record_status').textContent = '✓ Nagranie zapisane';
+        $('record_btn').textContent = '🎤 Nagraj ponownie';
+      },
+    }).then((r) => {
+      recording = r;
+      $('record_status').textContent = '● Nagrywanie…';
+      $('record_btn').textContent = '⏹ Zatrzymaj';
+    }).catch(() => { $('record_status').textContent = 'Brak dostępu do mikrofonu'; });
+  }
+
+  // =====================
+  // Synchronizacja: paczki po max_runs, serwer odpowiada statusem każdego przebiegu
+  // =====================
+  let syncing = false;
+
+  function updateStatus(){
+    $('kiosk_network').textContent = navigator.onLine ? 'online' : 'offline';
+    return runsByStatus('pending').then((runs) => { $('kiosk_pending').textContent = runs.length; });
+  }
+
+  function uploadBatch(batch){
+    const form = new FormData();
+    form.append('device', deviceId());
+    return Promise.all(batch.map((r) => Promise.all(r.answers.filter((a) => a.file).map((a) =>
+      getAudio(a.file).then((blob) => {
+        if(blob) form.append(a.file, blob, `${a.file}.${CantrilRecorder.extension(blob.type)}`);
+      })
+    )))).then(() => {
+      form.append('runs', JSON.stringify(batch.map(({status, error, ...r}) => r)));
+      return fetch(cfg.syncUrl, {
+        method: 'POST', body: form, credentials: 'same-origin', headers: {'X-CSRFToken': csrfToken()},
+      });
+    }).then((r) => { if(!r.ok) throw new Error(r.status); return r.json(); })
+      .then((data) => Promise.all(batch.map((r) => {
+        const result = data.runs[r.run_id] || '';
+        if(result === 'created' || result === 'duplicate') return deleteRun(r);
+        if(result.startsWith('rejected')) return putRun({...r, status: 'rejected', error: result});
+        return null;  // bez odpowiedzi: ponowimy przy następnej synchronizacji
+      })));
+  }
+
+  function sync(){
+    if(syncing || !navigator.onLine) return updateStatus();
+    syncing = true;
+    return runsByStatus('pending').then((runs) => {
+      const batches = [];
+      for(let i = 0; i < runs.length; i += cfg.maxRuns) batches.push(runs.slice(i, i + cfg.maxRuns));
+      return batches.reduce((chain, batch) => chain.then(() => uploadBatch(batch)), Promise.resolve());
+    }).catch(() => {}).then(() => { syncing = false; return updateStatus(); });
+  }
+
+  // =====================
+  // Zdarzenia
+  // =====================
+  $('start_form').addEventListener('submit', (e) => {
+    e.preventDefault();
+    const pesel = $('kiosk_pesel').value.trim();
+    if(!peselValid(pesel)){
+      $('start_error').textContent = 'Nieprawidłowy numer PESEL.';
+      $('start_error').hidden = false;
+      return;
+    }
+    $('start_error').hidden = true;
+    pending = {pesel, mode: e.target.elements.mode.value};
+    renderSurveyList();
+    show('screen_surveys');
+  });
+
+  $('next_btn').addEventListener('click', () => {
+    if(recording){
+      recording.stop();  // nagranie trafia do odpowiedzi po zatrzymaniu
+      return;
+    }
+    answerCurrent().then((answer) => {
+      run.answers.push(answer);
+      return putRun(run).then(showQuestion);
+    }).catch((err) => {
+      $('question_error').textContent = err.message;
+      $('question_error').hidden = false;
+    });
+  });
+
+  $('record_btn').addEventListener('click', toggleRecording);
+  $('restart_btn').addEventListener('click', () => {
+    $('kiosk_pesel').value = '';
+    show('screen_start');
+  });
+
+  window.addEventListener('online', sync);
+  window.addEventListener('offline', updateStatus);
+  setInterval(sync, cfg.syncInterval);
+
+  if('serviceWorker' in navigator){
+    navigator.serviceWorker.register(cfg.swUrl).catch(() => {});
+  }
+  if(navigator.storage && navigator.storage.persist){
+    navigator.storage.persist();  // nagrania nie mogą zniknąć przy braku miejsca
+  }
+
+  loadSurveys()
+    .then(resumeOpenRun)
+    .then((resumed) => { if(!resumed) show('screen_start'); })
+    .then(sync);
+})();
@@ -0,0 +1,93 @@
+// Nagrywanie odpowiedzi głosowych wg profilu ankiety (cantrilapp.audio.client_profile):
+// mono Opus (WebM/Ogg; AAC w MP4 na starszym Safari) o zadanym bitrate, limit czasu,
+// opcjonalnie pauza w czasie ciszy.
+//
+//   const rec = await CantrilRecorder.start(profile, {onStop: (blob) => ..., onTick: (left) => ...});
+//   rec.stop();
+window.CantrilRecorder = (function(){
+  const DEFAULTS = {
+    bitrate: 24000, max_seconds: 120, trim_silence: false,
+    mime_types: ['audio/webm;codecs=opus', 'audio/ogg;codecs=opus', 'audio/mp4'],
+    silence_threshold: 0.015, silence_ms: 800,
+  };
+
+  function pickMimeType(types){
+    if(!window.MediaRecorder || !MediaRecorder.isTypeSupported) return '';
+    return types.find((t) => MediaRecorder.isTypeSupported(t)) || '';
+  }
+
+  function extension(mimeType){
+    if(mimeType.indexOf('ogg') !== -1) return 'ogg';
+    return mimeType.indexOf('mp4') !== -1 ? 'm4a' : 'webm';
+  }
+
+  async function start(profile, handlers){
+    const p = Object.assign({}, DEFAULTS, profile || {});
+    handlers = handlers || {};
+    const input = await navigator.mediaDevices.getUserMedia({
+      audio: {channelCount: 1, echoCancellation: true, noiseSuppression: true, autoGainControl: true},
+    });
+
+    // downmix to one channel regardless of what the microphone delivers; the analyser feeds the silence trim
+    const ctx = new (window.AudioContext || window.webkitAudioContext)();
+    const source = ctx.createMediaStreamSource(input);
+    const mono = ctx.createMediaStreamDestination();
+    mono.channelCount = 1;
+    mono.channelCountMode = 'explicit';
+    const analyser = ctx.createAnalyser();
+    analyser.fftSize = 2048;
+    source.connect(analyser);
+    source.connect(mono);
+
+    const mimeType = pickMimeType(p.mime_types);
+    const options = {audioBitsPerSecond: p.bitrate};
+    if(mimeType) options.mimeType = mimeType;
+    const recorder = new MediaRecorder(mono.stream, options);
+    const chunks = [];
+    const startedAt = Date.now();
+    const samples = new Float32Array(analyser.fftSize);
+    let silentMs = 0;
+    let finished = false;
+
+    recorder.ondataavailable = (e) => { if(e.data && e.data.size) chunks.push(e.data); };
+    recorder.onstop = () => {
+      clearInterval(timer);
+      input.getTracks().forEach((t) => t.stop());
+      ctx.close();
+      const type = recorder.mimeType || mimeType || 'audio/webm';
+      const blob = new Blob(chunks, {type: type});
+      blob.extension = extension(type);
+      if(handlers.onStop) handlers.onStop(blob);
+    };
+
+    const TICK = 100;
+    const timer = setInterval(() => {
+      const elapsed = (Date.now() - startedAt) / 1000;
+      if(elapsed >= p.max_seconds) return stop();
+      if(handlers.onTick) handlers.onTick(Math.max(0, Math.ceil(p.max_seconds - elapsed)));
+      if(!p.trim_silence) return;
+      analyser.getFloatTimeDomainData(samples);
+      let sum = 0;
+      for(let i = 0; i < samples.length; i++) sum += samples[i] * samples[i];
+      const level = Math.sqrt(sum / samples.length);
+      if(level < p.silence_threshold){
+        silentMs += TICK;
+        if(silentMs >= p.silence_ms && recorder.state === 'recording') recorder.pause();
+      } else {
+        silentMs = 0;
+        if(recorder.state === 'paused') recorder.resume();
+      }
+    }, TICK);
+
+    function stop(){
+      if(finished) return;
+      finished = true;
+      if(recorder.state !== 'inactive') recorder.stop();
+    }
+
+    recorder.start(1000);
+    return {stop: stop, mimeType: recorder.mimeType || mimeType, profile: p};
+  }
+
+  return {start: start, pickMimeType: pickMimeType, extension: extension};
+})();
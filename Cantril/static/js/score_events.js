@@ -0,0 +1,56 @@
+// Live n8n scores on panel pages (see cantrilapp.events / views.panel_score_events).
+// Elements marked data-score="<run>|<question>" get the new score, data-score-status
+// the "processed" badge; nothing else on the page is touched.
+(function(){
+  var script = document.currentScript;
+  var url = script && script.dataset.eventsUrl;
+  if(!url || !window.EventSource) return;
+
+  var RESET_KEY = 'cantril-score-events-reset';
+
+  function formatScore(el, score){
+    if(score === null || score === undefined) return 'Brak';
+    var digits = parseInt(el.dataset.scoreDigits || '1', 10);
+    return Number(score).toFixed(digits) + (el.dataset.scoreSuffix || '');
+  }
+
+  function flash(el){
+    el.style.transition = 'background-color 1.5s';
+    el.style.backgroundColor = '#d1fae5';
+    setTimeout(function(){ el.style.backgroundColor = ''; }, 1500);
+  }
+
+  function apply(data){
+    var key = data.run + '|' + data.question;
+    document.querySelectorAll('[data-score]').forEach(function(el){
+      if(el.dataset.score !== key) return;
+      el.textContent = formatScore(el, data.score);
+      el.style.color = '#047857';
+      flash(el);
+    });
+    document.querySelectorAll('[data-score-status]').forEach(function(el){
+      if(el.dataset.scoreStatus !== key) return;
+      el.innerHTML = '<span style="display:inline-block; padding:2px 8px; background:#d1fae5; color:#065f46; border-radius:4px; font-size:0.8rem;">✓ Przetworzony</span>';
+      if(data.score !== null){
+        var small = document.createElement('small');
+        small.style.color = '#666';
+        small.textContent = 'Wynik: ' + Number(data.score).toFixed(1);
+        el.appendChild(document.createElement('br'));
+        el.appendChild(small);
+      }
+    });
+  }
+
+  var source = new EventSource(url);
+  source.addEventListener('score', function(e){ apply(JSON.parse(e.data)); });
+  source.addEventListener('reset', function(){
+    // events were lost (server restart, other worker, slow tab): reload once,
+    // but not in a loop when the stream keeps resetting
+    source.close();
+    var last = parseInt(sessionStorage.getItem(RESET_KEY) || '0', 10);
+    if(Date.now() - last > 60000){
+      sessionStorage.setItem(RESET_KEY, String(Date.now()));
+      location.reload();
+    }
+  });
+})();